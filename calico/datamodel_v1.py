@@ -24,8 +24,11 @@ made in a new copy of the file with revved version suffix.  That allows
 us to maintain multiple copies of the data model in parallel during
 migrations.
 """
+import functools
 import logging
 import re
+import weakref
+from collections import namedtuple
 
 _log = logging.getLogger(__name__)
 
@@ -81,6 +84,22 @@ HOST_IP_KEY_RE = re.compile(r'^' + HOST_DIR +
 IPAM_V4_CIDR_KEY_RE = re.compile(r'^' + VERSION_DIR +
                                  r'/ipam/v4/pool/(?P<encoded_cidr>[^/]+)')
 
+# Kinds of key recognised by parse_key().
+KIND_RULES = "rules"
+KIND_TAGS = "tags"
+KIND_ENDPOINT = "endpoint"
+KIND_HOST_IP = "host_ip"
+KIND_IPAM_V4_POOL = "ipam_v4_pool"
+
+# Key parsed by parse_key().  The ID is the profile ID for rules and tags,
+# an EndpointId for endpoints, the hostname for host IPs and the encoded
+# CIDR for IPAM pools.
+ParsedKey = namedtuple("ParsedKey", ["kind", "id"])
+# Builds a ParsedKey from a (kind, id) tuple without going through the
+# namedtuple's Python-level __new__; parse_key() is on the hot path for
+# snapshot loads.
+_new_parsed_key = functools.partial(tuple.__new__, ParsedKey)
+
 ENDPOINT_STATUS_UP = "up"
 ENDPOINT_STATUS_DOWN = "down"
 ENDPOINT_STATUS_ERROR = "error"
@@ -140,19 +159,75 @@ def get_profile_id_for_profile_dir(key):
 
 
 def get_endpoint_id_from_key(key):
-    m = ENDPOINT_KEY_RE.match(key)
-    if m:
-        # Got an endpoint.
-        host = m.group("hostname")
-        orch = m.group("orchestrator")
-        workload_id = m.group("workload_id")
-        endpoint_id = m.group("endpoint_id")
-        combined_id = EndpointId(host, orch, workload_id, endpoint_id)
-        return combined_id
+    parsed = parse_key(key)
+    if parsed is not None and parsed.kind == KIND_ENDPOINT:
+        return parsed.id
     else:
         return None
 
 
+def parse_key(key):
+    """
+    Classifies an etcd key.  Equivalent to matching it against
+    RULES_KEY_RE, TAGS_KEY_RE, ENDPOINT_KEY_RE, HOST_IP_KEY_RE and
+    IPAM_V4_CIDR_KEY_RE but splits the key once rather than running up to
+    five regexes.  Like those regexes, it matches on a prefix of the key.
+
+    :param str key: etcd key.
+    :returns ParsedKey: the kind of key and its ID, or None if the key
+        isn't one of those kinds.
+    """
+    # We never need to look beyond the 11th path segment.
+    parts = key.split("/", 11)
+    num_parts = len(parts)
+    if num_parts < 6 or parts[0] or parts[1] != "calico":
+        return None
+    section = parts[2]
+    subdir = parts[3]
+    if section == "v1":
+        if subdir == "host":
+            # /calico/v1/host/<hostname>/workload/<orchestrator>/
+            # <workload_id>/endpoint/<endpoint_id> or
+            # /calico/v1/host/<hostname>/bird_ip.
+            hostname = parts[4]
+            if not hostname:
+                return None
+            leaf = parts[5]
+            if leaf == "workload":
+                if (num_parts > 9 and parts[6] and parts[7] and
+                        parts[8] == "endpoint" and parts[9]):
+                    return _new_parsed_key((
+                        KIND_ENDPOINT,
+                        EndpointId(hostname, parts[6], parts[7], parts[9])
+                    ))
+            elif leaf.startswith("bird_ip"):
+                return _new_parsed_key((KIND_HOST_IP, hostname))
+        elif subdir == "policy":
+            # /calico/v1/policy/profile/<profile_id>/rules or tags.
+            if num_parts > 6 and parts[4] == "profile" and parts[5]:
+                leaf = parts[6]
+                if leaf.startswith("rules"):
+                    return _new_parsed_key((KIND_RULES, parts[5]))
+                if leaf.startswith("tags"):
+                    return _new_parsed_key((KIND_TAGS, parts[5]))
+        elif subdir == "ipam":
+            # /calico/v1/ipam/v4/pool/<encoded_cidr>
+            if (num_parts > 6 and parts[4] == "v4" and parts[5] == "pool" and
+                    parts[6]):
+                return _new_parsed_key((KIND_IPAM_V4_POOL, parts[6]))
+    elif section == "felix":
+        # Endpoint status: /calico/felix/v1/host/<hostname>/workload/
+        # <orchestrator>/<workload_id>/endpoint/<endpoint_id>.
+        if (num_parts > 10 and subdir == "v1" and parts[4] == "host" and
+                parts[5] and parts[6] == "workload" and parts[7] and
+                parts[8] and parts[9] == "endpoint" and parts[10]):
+            return _new_parsed_key((
+                KIND_ENDPOINT,
+                EndpointId(parts[5], parts[7], parts[8], parts[10])
+            ))
+    return None
+
+
 def hostname_from_status_key(key):
     """
     Get hostname from a status key (or None if this is not a status key).
@@ -169,17 +244,45 @@ def hostname_from_status_key(key):
     return hostname
 
 
+# Registry of live EndpointIds, keyed on their (host, orchestrator, workload,
+# endpoint) tuple.  Weak so that IDs are freed once nothing refers to them.
+_endpoint_ids = weakref.WeakValueDictionary()
+
+
 class EndpointId(object):
-    __slots__ = ["host", "orchestrator", "workload", "endpoint"]
+    """
+    ID of an endpoint.
 
-    def __init__(self, host, orchestrator, workload, endpoint):
-        # We intern these strings since they can occur in many IDs.  The
-        # host and orchestrator are trivially repeated for all endpoints
-        # on a host.  The others get repeated over time.
-        self.host = intern(host.encode("utf8"))
-        self.orchestrator = intern(orchestrator.encode("utf8"))
-        self.workload = intern(workload.encode("utf8"))
-        self.endpoint = intern(endpoint.encode("utf8"))
+    EndpointIds are flyweights: constructing one returns the existing
+    instance with the same fields if there is one.  That means that equal
+    IDs are the same object, so equality is identity, and each ID computes
+    its hash only once.  IDs are dict keys and set members all over Felix,
+    so both matter.
+    """
+    __slots__ = ["host", "orchestrator", "workload", "endpoint", "_hash",
+                 "__weakref__"]
+
+    def __new__(cls, host, orchestrator, workload, endpoint):
+        key = (host, orchestrator, workload, endpoint)
+        ep_id = _endpoint_ids.get(key)
+        if ep_id is None:
+            # We intern these strings since they can occur in many IDs.  The
+            # host and orchestrator are trivially repeated for all endpoints
+            # on a host.  The others get repeated over time.
+            key = tuple(intern(s.encode("utf8")) for s in key)
+            ep_id = _endpoint_ids.get(key)
+        if ep_id is None:
+            ep_id = super(EndpointId, cls).__new__(cls)
+            (ep_id.host, ep_id.orchestrator, ep_id.workload,
+             ep_id.endpoint) = key
+            ep_id._hash = hash(key)
+            _endpoint_ids[key] = ep_id
+        return ep_id
+
+    def __reduce__(self):
+        # Copies and unpickled IDs go through the registry too.
+        return EndpointId, (self.host, self.orchestrator, self.workload,
+                            self.endpoint)
 
     @property
     def path_for_status(self):
@@ -190,18 +293,5 @@ class EndpointId(object):
     def __str__(self):
         return self.__class__.__name__ + ("<%s>" % self.endpoint)
 
-    def __eq__(self, other):
-        if other is self:
-            return True
-        if not isinstance(other, EndpointId):
-            return False
-        return (other.endpoint == self.endpoint and
-                other.workload == self.workload and
-                other.host == self.host and
-                other.orchestrator == self.orchestrator)
-
-    def __ne__(self, other):
-        return not (self == other)
-
     def __hash__(self):
-        return hash(self.endpoint) + hash(self.workload)
+        return self._hash
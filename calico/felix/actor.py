@@ -72,6 +72,10 @@ the beginning.  To make use of that function, an Actor must:
   ensuring, of course, that it did not leave any resources
   partially-modified.
 
+If the Actor can identify the message(s) that caused the failure, it
+may instead raise FailMessagesAndRetry, which fails just those messages
+and re-executes the rest of the batch in one go.
+
 Thread safety
 ~~~~~~~~~~~~~
 
@@ -315,6 +319,25 @@ class Actor(object):
                 num_splits += 1  # For diags.
                 _stats.increment("Split batches")
                 continue
+            except FailMessagesAndRetry as e:
+                # The subclass identified the messages that caused the
+                # failure.  Fail those and re-run the rest of the batch as
+                # a single batch.
+                _log.warn("Failing %s message(s) and retrying the rest of "
+                          "the batch.", len(e.exceptions_by_index))
+                remaining = []
+                for index, msg in enumerate(batch):
+                    exc = e.exceptions_by_index.get(index)
+                    if exc is None:
+                        remaining.append(msg)
+                        continue
+                    for future in msg.results:
+                        future.set_exception(exc)
+                        _stats.increment("Messages completed")
+                if remaining:
+                    batches.insert(0, remaining)
+                _stats.increment("Batches retried without failed messages")
+                continue
             except BaseException as e:
                 # Most-likely a bug.  Report failure to all callers.
                 _log.exception("_finish_msg_batch failed.")
@@ -439,6 +462,18 @@ class SplitBatchAndRetry(Exception):
     pass
 
 
+class FailMessagesAndRetry(Exception):
+    """
+    Exception that may be raised by _finish_msg_batch() to fail the
+    messages at the given indexes in the batch, with the given exceptions,
+    and to re-execute the remaining messages as a single batch.
+    """
+    def __init__(self, exceptions_by_index):
+        super(FailMessagesAndRetry, self).__init__()
+        assert exceptions_by_index, "Must fail at least one message"
+        self.exceptions_by_index = exceptions_by_index
+
+
 def wait_and_check(async_results):
     for r in async_results:
         r.get()
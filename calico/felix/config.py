@@ -210,6 +210,59 @@ class Config(object):
         self.add_parameter("EndpointReportingDelaySecs",
                            "Minimum delay between per-endpoint status reports",
                            1, value_is_int=True)
+        self.add_parameter("DataplaneDriver",
+                           "Dataplane to program: 'kernel' or 'simulated' "
+                           "(an in-process model, for benchmarking)",
+                           "kernel")
+        self.add_parameter("SimulatedDataplaneLatencyMs",
+                           "Time taken by each simulated dataplane "
+                           "operation, in milliseconds",
+                           0, value_is_int=True)
+        self.add_parameter("ShareProfileChains",
+                           "Whether profiles with identical rules should "
+                           "share a single iptables chain",
+                           False, value_is_bool=True)
+        self.add_parameter("CidrIpsetMinRules",
+                           "Minimum number of consecutive rules differing "
+                           "only in CIDR to compile into an ipset; 0 "
+                           "disables",
+                           0, value_is_int=True)
+        self.add_parameter("DispatchChainMaxFanout",
+                           "Maximum number of interfaces to dispatch from "
+                           "one dispatch chain before splitting it",
+                           16, value_is_int=True)
+        self.add_parameter("FirewallBackend",
+                           "Firewall to program: 'iptables' or 'nftables'",
+                           "iptables")
+        self.add_parameter("IptablesLockDetection",
+                           "Whether to treat iptables-restore failures caused "
+                           "by another process holding the xtables lock as "
+                           "retryable, and count them separately",
+                           False, value_is_bool=True)
+        self.add_parameter("IpsetAuditInterval",
+                           "How often to check that our ipsets' members "
+                           "have not been changed by another process, in "
+                           "seconds; 0 disables",
+                           0, value_is_int=True)
+        self.add_parameter("IpsetNetlinkEnabled",
+                           "Whether to program ipsets over netlink, if the "
+                           "kernel supports it, rather than with the ipset "
+                           "command",
+                           False, value_is_bool=True)
+        self.add_parameter("RouteNetlinkEnabled",
+                           "Whether to program routes and ARP entries over "
+                           "RTNETLINK rather than with the ip and arp "
+                           "commands",
+                           False, value_is_bool=True)
+        self.add_parameter("RouteTableCacheEnabled",
+                           "Whether to track routes with RTNETLINK events "
+                           "and diff against that cache rather than listing "
+                           "routes with the ip command",
+                           False, value_is_bool=True)
+        self.add_parameter("ConntrackNetlinkEnabled",
+                           "Whether to remove conntrack flows over netlink "
+                           "rather than with the conntrack command",
+                           False, value_is_bool=True)
 
         # Read the environment variables, then the configuration file.
         self._read_env_vars()
@@ -266,6 +319,28 @@ class Config(object):
             self.parameters["EndpointReportingEnabled"].value
         self.ENDPOINT_REPORT_DELAY = \
             self.parameters["EndpointReportingDelaySecs"].value
+        self.DATAPLANE_DRIVER = self.parameters["DataplaneDriver"].value
+        self.SIM_DATAPLANE_LATENCY_MS = \
+            self.parameters["SimulatedDataplaneLatencyMs"].value
+        self.SHARE_PROFILE_CHAINS = \
+            self.parameters["ShareProfileChains"].value
+        self.CIDR_IPSET_MIN_RULES = \
+            self.parameters["CidrIpsetMinRules"].value
+        self.DISPATCH_MAX_FANOUT = \
+            self.parameters["DispatchChainMaxFanout"].value
+        self.FIREWALL_BACKEND = self.parameters["FirewallBackend"].value
+        self.IPTABLES_LOCK_DETECTION = \
+            self.parameters["IptablesLockDetection"].value
+        self.IPSET_AUDIT_INTERVAL = \
+            self.parameters["IpsetAuditInterval"].value
+        self.IPSET_NETLINK_ENABLED = \
+            self.parameters["IpsetNetlinkEnabled"].value
+        self.ROUTE_NETLINK_ENABLED = \
+            self.parameters["RouteNetlinkEnabled"].value
+        self.ROUTE_TABLE_CACHE_ENABLED = \
+            self.parameters["RouteTableCacheEnabled"].value
+        self.CONNTRACK_NETLINK_ENABLED = \
+            self.parameters["ConntrackNetlinkEnabled"].value
 
         self._validate_cfg(final=final)
 
@@ -421,11 +496,45 @@ class Config(object):
             log.warning("Endpoint status delay is negative, defaulting to 1.")
             self.ENDPOINT_REPORT_DELAY = 1
 
+        if self.DATAPLANE_DRIVER not in ("kernel", "simulated"):
+            raise ConfigException("Invalid field value",
+                                  self.parameters["DataplaneDriver"])
+
+        if self.FIREWALL_BACKEND not in ("iptables", "nftables"):
+            raise ConfigException("Invalid field value",
+                                  self.parameters["FirewallBackend"])
+
+        if self.SIM_DATAPLANE_LATENCY_MS < 0:
+            log.warning("Simulated dataplane latency is negative, "
+                        "defaulting to 0.")
+            self.SIM_DATAPLANE_LATENCY_MS = 0
+
+        if self.CIDR_IPSET_MIN_RULES < 0:
+            log.warning("CIDR ipset minimum rule count is negative, "
+                        "disabling CIDR ipsets.")
+            self.CIDR_IPSET_MIN_RULES = 0
+
+        if self.DISPATCH_MAX_FANOUT < 2:
+            log.warning("Dispatch chain fan-out must be at least 2, "
+                        "defaulting to 16.")
+            self.DISPATCH_MAX_FANOUT = 16
+
+        if self.IPSET_AUDIT_INTERVAL < 0:
+            log.warning("Ipset audit interval is negative, disabling "
+                        "ipset audits.")
+            self.IPSET_AUDIT_INTERVAL = 0
+
         if not final:
             # Do not check that unset parameters are defaulted; we have more
             # config to read.
             return
 
+        if self.FIREWALL_BACKEND == "nftables" and self.IP_IN_IP_ENABLED:
+            # The hosts ipset is programmed before we know the backend.
+            raise ConfigException("IP-in-IP is not supported with the "
+                                  "nftables backend",
+                                  self.parameters["FirewallBackend"])
+
         for name, parameter in self.parameters.iteritems():
             if parameter.value is None:
                 # No value, not even a default
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.ctnetlink
+~~~~~~~~~~~~~~~
+
+Removes conntrack flows over the kernel's ctnetlink interface rather than
+by running the conntrack command.
+
+The conntrack command scans the whole table for each IP and direction.
+ConntrackNetlinkClient.remove_flows() scans it once for any number of
+IPs and then deletes all the matching flows in a batch.
+"""
+import errno
+import logging
+import socket
+import struct
+
+from calico.felix.futils import StatCounter
+from calico.felix import netlink
+from calico.felix.netlink import (encode_attr, encode_nested_attr,
+                                  parse_attrs, NetlinkError, NetlinkSocket)
+
+_log = logging.getLogger(__name__)
+
+# These constants map to constants in the Linux kernel; see
+# include/uapi/linux/netfilter/nfnetlink_conntrack.h.
+NFNL_SUBSYS_CTNETLINK = 1
+NFNETLINK_V0 = 0
+
+IPCTNL_MSG_CT_GET = 1
+IPCTNL_MSG_CT_DELETE = 2
+IPCTNL_MSG_CT_GET_STATS_CPU = 4
+
+CTA_TUPLE_ORIG = 1
+CTA_TUPLE_REPLY = 2
+CTA_ID = 12
+CTA_ZONE = 18
+
+# Attributes nested in CTA_TUPLE_ORIG/REPLY.
+CTA_TUPLE_IP = 1
+
+NFGENMSG = struct.Struct("=BBH")
+
+_VERSION_TO_FAMILY = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+
+class ConntrackNetlinkClient(object):
+    """
+    Client for the kernel's ctnetlink interface.
+    """
+    def __init__(self, sock=None):
+        """
+        :param sock: optional pre-made netlink socket, for test.
+        """
+        self._nl = NetlinkSocket(netlink.NETLINK_NETFILTER, sock=sock)
+        self._stats = StatCounter("Conntrack netlink")
+
+    def check_available(self):
+        """
+        :raises NetlinkError: if ctnetlink isn't available.
+        """
+        self._nl.dump(_msg_type(IPCTNL_MSG_CT_GET_STATS_CPU),
+                      encode_nfgenmsg(socket.AF_UNSPEC))
+
+    def remove_flows(self, ip_addresses, ip_version):
+        """
+        Removes the flows that have any of the given IPs as their source
+        or destination, in either direction.
+
+        :returns int: the number of flows removed.
+        :raises NetlinkError: if the dump fails or a flow can't be removed
+            for a reason other than it having gone already.
+        """
+        family = _VERSION_TO_FAMILY[ip_version]
+        addrs = set(socket.inet_pton(family, ip) for ip in ip_addresses)
+        deletes = []
+        for _, _, payload in self._nl.iter_dump(_msg_type(IPCTNL_MSG_CT_GET),
+                                                encode_nfgenmsg(family)):
+            self._stats.increment("Flows checked")
+            attrs = dict(parse_attrs(payload[NFGENMSG.size:]))
+            if not _flow_addrs(attrs).isdisjoint(addrs):
+                deletes.append(encode_delete(family, attrs))
+        failures = self._nl.send_batch(deletes, stop_on_error=False)
+        # ENOENT means that the flow expired after we saw it.
+        errors = [err for _, err in failures if err != errno.ENOENT]
+        self._stats.increment("Flows removed", len(deletes) - len(failures))
+        if errors:
+            raise NetlinkError(errors[0])
+        return len(deletes) - len(failures)
+
+
+def create_client():
+    """
+    :returns ConntrackNetlinkClient: a client, or None if ctnetlink isn't
+        available to us.
+    """
+    try:
+        client = ConntrackNetlinkClient()
+        client.check_available()
+    except (socket.error, NetlinkError) as e:
+        _log.warning("Conntrack netlink interface unavailable (%r), using "
+                     "the conntrack command", e)
+        return None
+    return client
+
+
+def encode_nfgenmsg(family):
+    return NFGENMSG.pack(family, NFNETLINK_V0, 0)
+
+
+def encode_delete(family, attrs):
+    """
+    :param dict attrs: the top-level attributes of the flow, from a dump.
+    :returns tuple: (msg_type, flags, payload) of a request to delete the
+        flow.  It includes the flow's ID so that we don't delete a newer
+        flow with the same tuple.
+    """
+    payload = (encode_nfgenmsg(family) +
+               encode_nested_attr(CTA_TUPLE_ORIG, attrs[CTA_TUPLE_ORIG]))
+    for attr_type in (CTA_ID, CTA_ZONE):
+        if attr_type in attrs:
+            payload += encode_attr(attr_type, attrs[attr_type])
+    return _msg_type(IPCTNL_MSG_CT_DELETE), 0, payload
+
+
+def _flow_addrs(attrs):
+    """
+    :returns set[str]: the packed source and destination addresses of the
+        flow's original and reply tuples.
+    """
+    addrs = set()
+    for tuple_type in (CTA_TUPLE_ORIG, CTA_TUPLE_REPLY):
+        tuple_attrs = dict(parse_attrs(attrs.get(tuple_type, "")))
+        addrs.update(data for _, data in
+                     parse_attrs(tuple_attrs.get(CTA_TUPLE_IP, "")))
+    return addrs
+
+
+def _msg_type(cmd):
+    return (NFNL_SUBSYS_CTNETLINK << 8) | cmd
@@ -0,0 +1,1069 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.dataplane
+~~~~~~~~~~~~~~~
+
+Pluggable dataplane backends.
+
+All of Felix's access to the dataplane goes through a handful of
+primitives: running one of the kernel's command-line tools
+(iptables-restore/save, ipset, ip, arp, conntrack), reading or writing a
+file under /proc/sys or /sys and listening for RTNETLINK link events.
+By default, those primitives talk to the real kernel.  Installing a
+Dataplane object with futils.set_dataplane() redirects them.
+
+SimulatedDataplane is an in-process model of the parts of the kernel
+that Felix programs: iptables tables and chains, ipsets, routes, ARP
+entries, conntrack flows, interfaces and their sysctls.  It parses the
+same input as the real tools, fails in the same way (including the
+"line N failed" output that we parse from iptables-restore) and can
+inject a configurable latency per operation.  It allows a full Felix to
+be benchmarked at scale without root.
+
+Unlike the rest of Felix, this module requires Python 2.7.
+"""
+from collections import Counter, OrderedDict
+import copy
+import errno
+import logging
+import os
+import shlex
+import socket
+import struct
+
+import gevent
+import gevent.queue
+import netaddr
+
+from calico import common
+from calico.felix.futils import (FailedSystemCall, CommandOutput,
+                                 StatCounter)
+
+_log = logging.getLogger(__name__)
+
+# Names of the operations that SimulatedDataplane can delay; used as keys in
+# its latency dict.
+OP_IPTABLES_RESTORE = "iptables-restore"
+OP_IPTABLES_SAVE = "iptables-save"
+OP_IPTABLES = "iptables"
+OP_IPSET = "ipset"
+OP_IP = "ip"
+OP_ARP = "arp"
+OP_CONNTRACK = "conntrack"
+OP_FILE = "file"
+
+# Built-in chains (and their default policies) for each table that we model.
+BUILTIN_CHAINS = {
+    "filter": ["INPUT", "FORWARD", "OUTPUT"],
+    "nat": ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"],
+    "raw": ["PREROUTING", "OUTPUT"],
+    "mangle": ["PREROUTING", "INPUT", "FORWARD", "OUTPUT", "POSTROUTING"],
+}
+TABLES_BY_IP_VERSION = {
+    4: ["filter", "nat", "raw", "mangle"],
+    6: ["filter", "raw", "mangle"],
+}
+
+# Targets that are implemented by iptables extensions rather than by chains.
+BUILTIN_TARGETS = set([
+    "ACCEPT", "DROP", "RETURN", "REJECT", "LOG", "MARK", "DNAT", "SNAT",
+    "MASQUERADE", "REDIRECT", "QUEUE", "NFQUEUE", "NOTRACK", "CT", "TCPMSS",
+])
+
+# Subset of the kernel's interface flags and netlink constants that we emit.
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_RUNNING = 0x40
+IFF_MULTICAST = 0x1000
+IFF_LOWER_UP = 0x10000
+RTMGRP_LINK = 1
+NLMSG_DONE = 3
+NLM_F_MULTI = 0x2
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+IF_OPER_DOWN = 2
+IF_OPER_UP = 6
+AF_UNSPEC = 0
+ARPHRD_ETHER = 1
+
+IPSET_VERSION = "v6.29"
+IPTABLES_VERSION = "v1.4.21"
+
+
+class Dataplane(object):
+    """
+    Interface to a dataplane backend.
+
+    A backend is installed with futils.set_dataplane().  Once installed,
+    futils.check_call() and futils.check_output() route all shell-outs to
+    the backend, devices reads and writes /proc/sys and /sys via it and the
+    InterfaceWatcher gets its netlink socket from it.
+    """
+    def check_call(self, args, input_str=None):
+        """
+        Runs a command, as futils.check_call().
+
+        :returns CommandOutput: the stdout and stderr of the command.
+        :raises FailedSystemCall: if the command fails.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def check_output(self, args):
+        """
+        Runs a command, returning its stdout.
+
+        :raises FailedSystemCall: if the command fails.
+        """
+        return self.check_call(args).stdout
+
+    def read_file(self, path):
+        """
+        :returns str: contents of the given /proc or /sys file.
+        :raises IOError: if the file doesn't exist.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def write_file(self, path, value):
+        """
+        Writes the given value to a /proc or /sys file.
+
+        :raises IOError: if the file doesn't exist.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def netlink_socket(self, groups):
+        """
+        :returns: an RTNETLINK socket, already bound to the given multicast
+            groups.  Only recv() and sendto() of an RTM_GETLINK dump
+            request are required to be supported.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+
+class SimulatedDataplane(Dataplane):
+    """
+    In-process simulation of the kernel dataplane.
+
+    Not thread-safe; like the rest of Felix, it expects to be driven from
+    greenlets.  The simulation is deliberately strict: unknown commands and
+    options are rejected so that a change to the commands Felix issues
+    shows up as a failure rather than being silently ignored.
+    """
+    def __init__(self, latency=None, default_latency=0,
+                 auto_create_prefix=None):
+        """
+        :param dict[str,float] latency: Map from operation name (one of the
+            OP_* constants) to the time, in seconds, that each such operation
+            should take.
+        :param float default_latency: Latency of operations that are not
+            listed in latency.
+        :param str auto_create_prefix: If set, interfaces with this prefix
+            spring into existence (up) the first time they are looked up.
+            Useful when driving a full Felix, where there is no orchestrator
+            to create the workload interfaces.
+        """
+        self.latency = latency or {}
+        self.default_latency = default_latency
+        self.auto_create_prefix = auto_create_prefix
+        # Number of upcoming iptables-restore calls that should fail as if
+        # another process were holding the xtables lock.
+        self.xtables_lock_failures = 0
+
+        # Map from IP version to table name to _SimTable.
+        self.tables = {}
+        for ip_version, tables in TABLES_BY_IP_VERSION.iteritems():
+            self.tables[ip_version] = dict((t, _SimTable(t)) for t in tables)
+
+        # Map from ipset name to _SimIpset.
+        self.ipsets = OrderedDict()
+
+        # Map from IP version to dict mapping IP to interface name.
+        self.routes = {4: {}, 6: {}}
+        # Map from IP to (MAC, interface name).
+        self.arp_entries = {}
+        # Set of (IP, interface name) for proxy NDP entries.
+        self.proxy_ndp_entries = set()
+        # Map from IP version to list of flows.  Each flow is a dict with
+        # keys orig-src, orig-dst, reply-src and reply-dst.
+        self.flows = {4: [], 6: []}
+        # Map from path to value for sysctls that aren't interface-specific.
+        self.sysctls = {
+            "/proc/sys/net/ipv4/conf/all/rp_filter": "1",
+            "/proc/sys/net/ipv4/conf/default/rp_filter": "1",
+        }
+
+        self._netlink_queues = []
+        self._stats = StatCounter("Simulated dataplane")
+
+        # Map from interface name to _SimInterface.
+        self.interfaces = OrderedDict()
+        self._next_ifindex = 1
+        self.add_interface("lo")
+
+    # Dataplane interface.
+
+    def check_call(self, args, input_str=None):
+        cmd = os.path.basename(args[0])
+        try:
+            handler = self._HANDLERS[cmd]
+        except KeyError:
+            # As if the binary was missing.
+            raise OSError(errno.ENOENT, "No such file or directory: %s" % cmd)
+        self._stats.increment("%s calls" % cmd)
+        self._delay(self._op_for_cmd(cmd))
+        rc, stdout, stderr = handler(self, cmd, list(args[1:]), input_str)
+        if rc:
+            raise FailedSystemCall("Failed system call", args, rc, stdout,
+                                   stderr, input=input_str)
+        return CommandOutput(stdout, stderr)
+
+    def read_file(self, path):
+        self._stats.increment("File reads")
+        self._delay(OP_FILE)
+        if path.startswith("/sys/class/net/"):
+            parts = path.split("/")
+            if len(parts) != 6 or parts[5] != "flags":
+                raise IOError(errno.ENOENT, "No such file or directory", path)
+            iface = self._lookup_interface(parts[4])
+            if iface is None:
+                raise IOError(errno.ENOENT, "No such file or directory", path)
+            return "0x%x\n" % iface.flags
+        return self._sysctl_entry(path)[0] + "\n"
+
+    def write_file(self, path, value):
+        self._stats.increment("File writes")
+        self._delay(OP_FILE)
+        _, key = self._sysctl_entry(path)
+        value = str(value).strip()
+        if key is None:
+            self.sysctls[path] = value
+        else:
+            iface_name, leaf = key
+            self.interfaces[iface_name].sysctls[leaf] = value
+
+    def netlink_socket(self, groups):
+        queue = gevent.queue.Queue()
+        if groups & RTMGRP_LINK:
+            self._netlink_queues.append(queue)
+        return _SimNetlinkSocket(self, queue)
+
+    # Methods used to drive the simulation, e.g. by a benchmark playing the
+    # role of the orchestrator.
+
+    def add_interface(self, name, mac=None, up=True):
+        """Creates an interface, as the orchestrator would for a VM."""
+        assert name not in self.interfaces, "Interface %s exists" % name
+        index = self._next_ifindex
+        self._next_ifindex += 1
+        if mac is None:
+            mac = "02:00:%02x:%02x:%02x:%02x" % tuple(
+                ord(c) for c in struct.pack(">I", index))
+        iface = _SimInterface(name, index, mac)
+        self.interfaces[name] = iface
+        self.set_interface_up(name, up)
+        return iface
+
+    def remove_interface(self, name):
+        """Removes an interface, along with its routes and ARP entries."""
+        iface = self.interfaces.pop(name)
+        for routes in self.routes.itervalues():
+            for ip, dev in routes.items():
+                if dev == name:
+                    del routes[ip]
+        for ip, (_, dev) in self.arp_entries.items():
+            if dev == name:
+                del self.arp_entries[ip]
+        self.proxy_ndp_entries = set(e for e in self.proxy_ndp_entries
+                                     if e[1] != name)
+        self._send_link_event(RTM_DELLINK, iface)
+
+    def set_interface_up(self, name, up):
+        iface = self.interfaces[name]
+        if up:
+            iface.flags |= IFF_UP | IFF_RUNNING | IFF_LOWER_UP
+        else:
+            iface.flags &= ~(IFF_UP | IFF_RUNNING | IFF_LOWER_UP)
+        self._send_link_event(RTM_NEWLINK, iface)
+
+    def add_flow(self, ip_version, orig_src, orig_dst):
+        """Adds a conntrack flow (with the natural reply direction)."""
+        self.flows[ip_version].append({
+            "orig-src": orig_src, "orig-dst": orig_dst,
+            "reply-src": orig_dst, "reply-dst": orig_src,
+        })
+
+    def chain_referenced(self, ip_version, table, chain):
+        return self.tables[ip_version][table].chain_refs[chain] > 0
+
+    # Internals.
+
+    def _op_for_cmd(self, cmd):
+        if cmd.endswith("tables-restore"):
+            return OP_IPTABLES_RESTORE
+        elif cmd.endswith("tables-save"):
+            return OP_IPTABLES_SAVE
+        elif cmd.endswith("tables"):
+            return OP_IPTABLES
+        return cmd
+
+    def _delay(self, op):
+        latency = self.latency.get(op, self.default_latency)
+        if latency:
+            gevent.sleep(latency)
+
+    def _lookup_interface(self, name):
+        iface = self.interfaces.get(name)
+        if (iface is None and self.auto_create_prefix and
+                name.startswith(self.auto_create_prefix)):
+            _log.info("Auto-creating simulated interface %s", name)
+            iface = self.add_interface(name)
+        return iface
+
+    def _sysctl_entry(self, path):
+        """
+        Looks up a /proc/sys path.
+
+        :returns (value, key): key is None for global sysctls, otherwise a
+            tuple (interface name, path with the interface name elided).
+        :raises IOError: if the file would not exist.
+        """
+        if path in self.sysctls:
+            return self.sysctls[path], None
+        parts = path.split("/")
+        # /proc/sys/net/ipv4/conf/<iface>/rp_filter
+        if (len(parts) == 8 and parts[:4] == ["", "proc", "sys", "net"] and
+                parts[5] in ("conf", "neigh")):
+            iface = self._lookup_interface(parts[6])
+            if iface is not None:
+                leaf = "/".join(parts[4:6] + [parts[7]])
+                return iface.sysctls.get(leaf, "0"), (iface.name, leaf)
+        raise IOError(errno.ENOENT, "No such file or directory", path)
+
+    def _send_link_event(self, msg_type, iface):
+        if not self._netlink_queues:
+            return
+        data = _encode_link_msg(msg_type, iface)
+        for queue in self._netlink_queues:
+            queue.put(data)
+
+    # iptables.
+
+    def _handle_iptables_restore(self, cmd, args, input_str):
+        ip_version = 6 if cmd.startswith("ip6") else 4
+        unknown = set(args) - set(["--noflush", "-n", "--verbose", "-v"])
+        if unknown or "--noflush" not in args and "-n" not in args:
+            # Felix always uses --noflush; without it we'd need to model
+            # wholesale replacement of tables.
+            return 2, "", "%s: unsupported arguments %s\n" % (cmd, args)
+        if self.xtables_lock_failures > 0:
+            self.xtables_lock_failures -= 1
+            return 4, "", ("Another app is currently holding the xtables "
+                           "lock. Perhaps you want to use the -w option?\n")
+        tables = self.tables[ip_version]
+        pending = None
+        line_num = 0
+        for line_num, line in enumerate((input_str or "").splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("*"):
+                table_name = line[1:]
+                if table_name not in tables:
+                    return 1, "", ("%s: unable to initialize table '%s'\n"
+                                   "Error occurred at line: %s\n" %
+                                   (cmd, table_name, line_num))
+                pending = tables[table_name].copy()
+                continue
+            if pending is None:
+                return 1, "", ("%s: no command specified\n"
+                               "Error occurred at line: %s\n" %
+                               (cmd, line_num))
+            if line == "COMMIT":
+                tables[pending.name] = pending
+                pending = None
+                continue
+            if not pending.apply_line(line):
+                return 1, "", "%s: line %s failed\n" % (cmd, line_num)
+        if pending is not None:
+            return 1, "", "%s: COMMIT expected at line %s\n" % (
+                cmd, line_num + 1)
+        return 0, "", ""
+
+    def _handle_iptables_save(self, cmd, args, input_str):
+        ip_version = 6 if cmd.startswith("ip6") else 4
+        tables = self.tables[ip_version]
+        if args[:1] in (["--table"], ["-t"]) and len(args) == 2:
+            names = [args[1]]
+        elif not args:
+            names = sorted(tables.keys())
+        else:
+            return 2, "", "%s: unsupported arguments %s\n" % (cmd, args)
+        lines = ["# Generated by %s %s (simulated)" %
+                 (cmd, IPTABLES_VERSION)]
+        for name in names:
+            if name not in tables:
+                return 1, "", ("%s: unable to initialize table '%s'\n" %
+                               (cmd, name))
+            lines.append("*%s" % name)
+            table = tables[name]
+            for chain in table.chains:
+                policy = table.policies.get(chain, "-")
+                lines.append(":%s %s [0:0]" % (chain, policy))
+            for chain, rules in table.chains.iteritems():
+                for rule in rules:
+                    lines.append("-A %s %s" % (chain, rule))
+            lines.append("COMMIT")
+            lines.append("# Completed")
+        return 0, "\n".join(lines) + "\n", ""
+
+    def _handle_iptables(self, cmd, args, input_str):
+        ip_version = 6 if cmd.startswith("ip6") else 4
+        args = [a for a in args if a not in ("--wait", "-w")]
+        if (len(args) != 3 or args[0] not in ("--list", "-L") or
+                args[1] not in ("--table", "-t")):
+            return 2, "", "%s: unsupported arguments %s\n" % (cmd, args)
+        table = self.tables[ip_version].get(args[2])
+        if table is None:
+            return 3, "", ("%s: can't initialize %s table `%s': Table does "
+                           "not exist\n" % (cmd, cmd, args[2]))
+        paragraphs = []
+        for chain, rules in table.chains.iteritems():
+            if chain in table.policies:
+                header = "Chain %s (policy %s)" % (chain,
+                                                   table.policies[chain])
+            else:
+                header = "Chain %s (%s references)" % (
+                    chain, table.chain_refs[chain])
+            lines = [header, "target     prot opt source    destination"]
+            for rule in rules:
+                lines.append("%-10s all  --  anywhere  anywhere  %s" %
+                             (_rule_target(rule.split()), rule))
+            paragraphs.append("\n".join(lines))
+        return 0, "\n\n".join(paragraphs) + "\n", ""
+
+    # ipset.
+
+    def _handle_ipset(self, cmd, args, input_str):
+        if not args:
+            return 1, "", "ipset %s: No command specified.\n" % IPSET_VERSION
+        if args == ["restore"]:
+            return self._ipset_restore(input_str or "")
+        if args[0] == "list":
+            return self._ipset_list(args[1:])
+        if args[0] == "save":
+            return self._ipset_list(["-o", "save"] + args[1:])
+        if args[0] in ("destroy", "flush", "create", "add", "del", "swap"):
+            err = self._apply_ipset_cmd(args)
+            if err:
+                return 1, "", "ipset %s: %s\n" % (IPSET_VERSION, err)
+            return 0, "", ""
+        return 1, "", ("ipset %s: No command specified: unknown argument "
+                       "%s\n" % (IPSET_VERSION, args[0]))
+
+    def _ipset_restore(self, input_str):
+        # Like the real ipset restore, there's no transactionality: commands
+        # before a failing line stay applied.
+        for line_num, line in enumerate(input_str.splitlines(), 1):
+            words = line.split()
+            if not words or words[0].startswith("#") or words == ["COMMIT"]:
+                continue
+            err = self._apply_ipset_cmd(words)
+            if err:
+                return 1, "", ("ipset %s: Error in line %s: %s\n" %
+                               (IPSET_VERSION, line_num, err))
+        return 0, "", ""
+
+    def _apply_ipset_cmd(self, words):
+        """
+        Applies a single ipset command.
+
+        :returns: None on success, or an error string.
+        """
+        exist = False
+        for flag in ("-exist", "--exist", "-!"):
+            while flag in words:
+                words.remove(flag)
+                exist = True
+        op, args = words[0], words[1:]
+        if op == "create":
+            if len(args) < 2:
+                return "Syntax error: missing set name or type"
+            name, set_type, opts = args[0], args[1], args[2:]
+            if set_type not in ("hash:ip", "hash:net"):
+                return "Syntax error: unknown settype %s" % set_type
+            if len(name) >= 32:
+                return "Syntax error: setname '%s' is longer than 31 " \
+                       "characters" % name
+            params = {"family": "inet", "hashsize": "1024",
+                      "maxelem": "65536"}
+            if len(opts) % 2:
+                return "Syntax error: option %s requires a value" % opts[-1]
+            for key, value in zip(opts[::2], opts[1::2]):
+                if key not in params:
+                    return "Syntax error: unknown argument %s" % key
+                params[key] = value
+            if params["family"] not in ("inet", "inet6"):
+                return "Syntax error: unknown family %s" % params["family"]
+            new_set = _SimIpset(name, set_type, params["family"],
+                                int(params["hashsize"]),
+                                int(params["maxelem"]))
+            existing = self.ipsets.get(name)
+            if existing is not None:
+                if exist and existing.same_params(new_set):
+                    return None
+                return ("Set cannot be created: set with the same name "
+                        "already exists")
+            self.ipsets[name] = new_set
+            return None
+
+        if not args:
+            return "Syntax error: missing set name"
+        ipset = self.ipsets.get(args[0])
+        if ipset is None:
+            return "The set with the given name does not exist"
+        if op in ("add", "del"):
+            if len(args) != 2:
+                return "Syntax error: missing element"
+            member = args[1]
+            version = 4 if ipset.family == "inet" else 6
+            if ipset.type == "hash:ip":
+                valid = common.validate_ip_addr(member, version)
+            else:
+                valid = common.validate_cidr(member, version)
+            if not valid:
+                return ("Syntax error: '%s' is invalid as number" % member)
+            # Like the kernel, store members in canonical form.
+            member = _canonical_member(ipset.type, member)
+            if op == "add":
+                if member in ipset.members:
+                    if exist:
+                        return None
+                    return ("Element cannot be added to the set: it's "
+                            "already added")
+                if len(ipset.members) >= ipset.maxelem:
+                    return "Hash is full, cannot add more elements"
+                ipset.members.add(member)
+            else:
+                if member not in ipset.members:
+                    if exist:
+                        return None
+                    return ("Element cannot be deleted from the set: it's "
+                            "not added")
+                ipset.members.discard(member)
+            return None
+        elif op == "flush":
+            ipset.members = set()
+            return None
+        elif op == "swap":
+            if len(args) != 2:
+                return "Syntax error: missing second set name"
+            other = self.ipsets.get(args[1])
+            if other is None:
+                return ("The set with the given name does not exist")
+            if other.type != ipset.type or other.family != ipset.family:
+                return ("The sets cannot be swapped: their type does not "
+                        "match")
+            # Swap contents, not names, to keep the OrderedDict stable.
+            self.ipsets[args[0]], self.ipsets[args[1]] = other, ipset
+            other.name, ipset.name = ipset.name, other.name
+            return None
+        elif op == "destroy":
+            if self._ipset_in_use(ipset.name):
+                return ("Set cannot be destroyed: it is in use by a kernel "
+                        "component")
+            del self.ipsets[ipset.name]
+            return None
+        return "Syntax error: unknown command %s" % op
+
+    def _ipset_in_use(self, name):
+        return any(table.set_refs[name] > 0
+                   for tables in self.tables.itervalues()
+                   for table in tables.itervalues())
+
+    def _ipset_list(self, args):
+        save_format = False
+        names_only = False
+        while args and args[0].startswith("-"):
+            if args[:2] == ["-o", "save"] or args[:2] == ["-output", "save"]:
+                save_format = True
+                args = args[2:]
+            elif args[0] in ("-n", "-name"):
+                names_only = True
+                args = args[1:]
+            else:
+                return 1, "", "ipset %s: Unknown argument %s\n" % (
+                    IPSET_VERSION, args[0])
+        if args:
+            ipset = self.ipsets.get(args[0])
+            if ipset is None:
+                return 1, "", ("ipset %s: The set with the given name does "
+                               "not exist\n" % IPSET_VERSION)
+            sets = [ipset]
+        else:
+            sets = self.ipsets.values()
+        if names_only:
+            return 0, "".join(s.name + "\n" for s in sets), ""
+        if save_format:
+            return 0, "".join(s.save_lines() for s in sets), ""
+        return 0, "\n".join(s.list_lines(self._ipset_in_use(s.name))
+                            for s in sets), ""
+
+    # ip/arp/conntrack.
+
+    def _handle_ip(self, cmd, args, input_str):
+        if args == ["-batch", "-"]:
+            return self._ip_batch(cmd, input_str or "")
+        # None means "infer from the address", as ip does.
+        ip_version = None
+        if args[:1] == ["-6"]:
+            ip_version = 6
+            args = args[1:]
+        elif args[:1] == ["-4"]:
+            ip_version = 4
+            args = args[1:]
+        if not args:
+            return 255, "", "Usage: ip [ OPTIONS ] OBJECT { COMMAND | help }\n"
+        obj, args = args[0], args[1:]
+        if obj == "link":
+            return self._ip_link(args)
+        elif obj == "route":
+            return self._ip_route(ip_version, args)
+        elif obj == "neigh":
+            return self._ip_neigh(ip_version, args)
+        elif obj == "tunnel":
+            if (len(args) == 4 and args[0] == "add" and
+                    args[2:] == ["mode", "ipip"]):
+                if args[1] in self.interfaces:
+                    return 1, "", "add tunnel \"tunl0\" failed: File exists\n"
+                self.add_interface(args[1], up=False)
+                return 0, "", ""
+        return 255, "", ('Object "%s" is unknown, try "ip help".\n' % obj)
+
+    def _ip_batch(self, cmd, input_str):
+        for line_no, line in enumerate(input_str.splitlines(), 1):
+            if not line.strip():
+                continue
+            rc, _, stderr = self._handle_ip(cmd, line.split(), None)
+            if rc:
+                return 1, "", "%sCommand failed -:%s\n" % (stderr, line_no)
+        return 0, "", ""
+
+    def _ip_link(self, args):
+        if args[:1] in (["list"], ["show"]) and len(args) <= 2:
+            if len(args) == 2:
+                iface = self._lookup_interface(args[1])
+                if iface is None:
+                    return 1, "", ('Device "%s" does not exist.\n' % args[1])
+                ifaces = [iface]
+            else:
+                ifaces = self.interfaces.values()
+            return 0, "".join(i.link_lines() for i in ifaces), ""
+        if args[:1] == ["set"] and len(args) >= 3:
+            iface = self._lookup_interface(args[1])
+            if iface is None:
+                return 1, "", ('Cannot find device "%s"\n' % args[1])
+            if args[2:] == ["up"]:
+                self.set_interface_up(iface.name, True)
+            elif args[2:] == ["down"]:
+                self.set_interface_up(iface.name, False)
+            elif args[2] == "mtu" and len(args) == 4:
+                iface.mtu = int(args[3])
+            else:
+                return 255, "", "Error: argument \"%s\" is wrong\n" % args[2]
+            return 0, "", ""
+        return 255, "", "Command \"%s\" is unknown\n" % " ".join(args)
+
+    def _ip_route(self, ip_version, args):
+        if ip_version is None:
+            ip_version = 6 if ":" in "".join(args[1:2]) else 4
+        routes = self.routes[ip_version]
+        if args[:1] in (["list"], ["show"]):
+            if args[1:2] != ["dev"] or len(args) != 3:
+                return 255, "", "Error: unsupported arguments %s\n" % args
+            iface = self._lookup_interface(args[2])
+            if iface is None:
+                return 1, "", 'Cannot find device "%s"\n' % args[2]
+            suffix = "scope link" if ip_version == 4 else "metric 1024"
+            out = "".join("%s %s\n" % (ip, suffix)
+                          for ip, dev in sorted(routes.iteritems())
+                          if dev == iface.name)
+            return 0, out, ""
+        if (args[:1] in (["replace"], ["add"], ["del"]) and
+                len(args) == 4 and args[2] == "dev"):
+            op, ip, iface = args[0], args[1], self._lookup_interface(args[3])
+            if iface is None:
+                return 1, "", 'Cannot find device "%s"\n' % args[3]
+            if not common.validate_ip_addr(ip.split("/")[0], ip_version):
+                return 1, "", 'Error: an inet prefix is expected rather ' \
+                              'than "%s".\n' % ip
+            if op == "del":
+                if routes.get(ip) != iface.name:
+                    return 2, "", "RTNETLINK answers: No such process\n"
+                del routes[ip]
+                return 0, "", ""
+            if op == "add" and ip in routes:
+                return 2, "", "RTNETLINK answers: File exists\n"
+            if not iface.flags & IFF_UP:
+                return 2, "", "RTNETLINK answers: Network is down\n"
+            routes[ip] = iface.name
+            return 0, "", ""
+        return 255, "", "Error: unsupported arguments %s\n" % args
+
+    def _ip_neigh(self, ip_version, args):
+        if (len(args) == 5 and args[0] in ("add", "del") and
+                args[1] == "proxy" and args[3] == "dev"):
+            iface = self._lookup_interface(args[4])
+            if iface is None:
+                return 1, "", 'Cannot find device "%s"\n' % args[4]
+            entry = (args[2], iface.name)
+            if args[0] == "add":
+                if entry in self.proxy_ndp_entries:
+                    return 2, "", "RTNETLINK answers: File exists\n"
+                self.proxy_ndp_entries.add(entry)
+            else:
+                if entry not in self.proxy_ndp_entries:
+                    return 2, "", "RTNETLINK answers: No such file or " \
+                                  "directory\n"
+                self.proxy_ndp_entries.discard(entry)
+            return 0, "", ""
+        if (len(args) == 8 and args[0] == "replace" and args[2] == "lladdr"
+                and args[4] == "dev" and args[6:] == ["nud", "permanent"]):
+            iface = self._lookup_interface(args[5])
+            if iface is None:
+                return 1, "", 'Cannot find device "%s"\n' % args[5]
+            self.arp_entries[args[1]] = (args[3], iface.name)
+            return 0, "", ""
+        if len(args) == 4 and args[0] == "del" and args[2] == "dev":
+            iface = self._lookup_interface(args[3])
+            if iface is None:
+                return 1, "", 'Cannot find device "%s"\n' % args[3]
+            entry = self.arp_entries.get(args[1])
+            if entry is None or entry[1] != iface.name:
+                return 2, "", "RTNETLINK answers: No such file or directory\n"
+            del self.arp_entries[args[1]]
+            return 0, "", ""
+        return 255, "", "Error: unsupported arguments %s\n" % args
+
+    def _handle_arp(self, cmd, args, input_str):
+        if len(args) == 5 and args[0] == "-s" and args[3] == "-i":
+            ip, mac, iface = args[1], args[2], self._lookup_interface(args[4])
+            if iface is None:
+                return 255, "", "SIOCSARP: No such device\n"
+            self.arp_entries[ip] = (mac, iface.name)
+            return 0, "", ""
+        if len(args) == 4 and args[0] == "-d" and args[2] == "-i":
+            entry = self.arp_entries.get(args[1])
+            if entry is None or entry[1] != args[3]:
+                return 255, "", "No ARP entry for %s\n" % args[1]
+            del self.arp_entries[args[1]]
+            return 0, "", ""
+        return 255, "", "arp: unsupported arguments %s\n" % args
+
+    def _handle_conntrack(self, cmd, args, input_str):
+        if (len(args) != 5 or args[0] != "--family" or
+                args[1] not in ("ipv4", "ipv6") or args[2] != "--delete" or
+                args[3] not in ("--orig-src", "--orig-dst",
+                                "--reply-src", "--reply-dst")):
+            return 2, "", "conntrack: unsupported arguments %s\n" % args
+        ip_version = int(args[1][-1])
+        key = args[3][2:]
+        flows = self.flows[ip_version]
+        remaining = [f for f in flows if f[key] != args[4]]
+        deleted = len(flows) - len(remaining)
+        self.flows[ip_version] = remaining
+        msg = ("conntrack v1.4.2 (conntrack-tools): %s flow entries have "
+               "been deleted.\n" % deleted)
+        return (0 if deleted else 1), "", msg
+
+    _HANDLERS = {
+        "iptables-restore": _handle_iptables_restore,
+        "ip6tables-restore": _handle_iptables_restore,
+        "iptables-save": _handle_iptables_save,
+        "ip6tables-save": _handle_iptables_save,
+        "iptables": _handle_iptables,
+        "ip6tables": _handle_iptables,
+        "ipset": _handle_ipset,
+        "ip": _handle_ip,
+        "arp": _handle_arp,
+        "conntrack": _handle_conntrack,
+    }
+
+
+class _SimTable(object):
+    """
+    An iptables table.  Copied at the start of each iptables-restore
+    transaction; the copy replaces the original on COMMIT.  The copy is
+    shallow, chains' rule lists are copied on first write.
+    """
+    def __init__(self, name):
+        self.name = name
+        # OrderedDict mapping chain name to list of rules.  Each rule is
+        # stored as the text following the chain name in the line that
+        # created it.
+        self.chains = OrderedDict()
+        self.policies = {}
+        for chain in BUILTIN_CHAINS[name]:
+            self.chains[chain] = []
+            self.policies[chain] = "ACCEPT"
+        # Number of rules that jump to each chain/match on each ipset.
+        self.chain_refs = Counter()
+        self.set_refs = Counter()
+        self._copied = None
+
+    def copy(self):
+        cp = copy.copy(self)
+        cp.chains = OrderedDict(self.chains)
+        cp.policies = dict(self.policies)
+        cp.chain_refs = Counter(self.chain_refs)
+        cp.set_refs = Counter(self.set_refs)
+        cp._copied = set()
+        return cp
+
+    def _writable_rules(self, chain):
+        if self._copied is not None and chain not in self._copied:
+            self.chains[chain] = list(self.chains[chain])
+            self._copied.add(chain)
+        return self.chains[chain]
+
+    def _update_refs(self, rule_words, delta):
+        target = _rule_target(rule_words)
+        if target is not None and target not in BUILTIN_TARGETS:
+            self.chain_refs[target] += delta
+        for i, word in enumerate(rule_words[:-1]):
+            if word == "--match-set":
+                self.set_refs[rule_words[i + 1]] += delta
+
+    def _flush(self, chain):
+        for rule in self.chains[chain]:
+            self._update_refs(rule.split(), -1)
+        self.chains[chain] = []
+        if self._copied is not None:
+            self._copied.add(chain)
+
+    def apply_line(self, line):
+        """
+        Applies a single line of iptables-restore input.
+
+        :returns bool: True on success, False if iptables-restore would
+            report that the line failed.
+        """
+        builtins = BUILTIN_CHAINS[self.name]
+        if line.startswith(":"):
+            # ":<chain> <policy> [<packets>:<bytes>]".  Creates the chain or,
+            # since we're in noflush mode, flushes it if it already exists.
+            words = line[1:].split()
+            chain = words[0]
+            policy = words[1] if len(words) > 1 else "-"
+            if chain in builtins:
+                if policy != "-":
+                    self.policies[chain] = policy
+            elif chain in self.chains:
+                self._flush(chain)
+            else:
+                self.chains[chain] = []
+            return True
+
+        try:
+            words = shlex.split(line)
+        except ValueError:
+            return False
+        if not words:
+            return False
+        op, args = words[0], words[1:]
+        if op in ("-A", "--append", "-I", "--insert", "-D", "--delete"):
+            if not args or args[0] not in self.chains:
+                return False
+            chain, rule_words = args[0], args[1:]
+            position = 0
+            if op in ("-I", "--insert") and rule_words and \
+                    rule_words[0].isdigit():
+                position = int(rule_words.pop(0)) - 1
+            rule = " ".join(_quote_word(w) for w in rule_words)
+            if op in ("-D", "--delete"):
+                if rule not in self.chains[chain]:
+                    return False
+                self._writable_rules(chain).remove(rule)
+                self._update_refs(rule.split(), -1)
+                return True
+            target = _rule_target(rule_words)
+            if target is None:
+                return False
+            if target not in BUILTIN_TARGETS and target not in self.chains:
+                return False
+            rules = self._writable_rules(chain)
+            if op in ("-A", "--append"):
+                rules.append(rule)
+            elif position > len(rules):
+                return False
+            else:
+                rules.insert(position, rule)
+            self._update_refs(rule.split(), 1)
+            return True
+        elif op in ("-F", "--flush"):
+            if len(args) > 1 or args and args[0] not in self.chains:
+                return False
+            for chain in (args or list(self.chains)):
+                self._flush(chain)
+            return True
+        elif op in ("-N", "--new-chain"):
+            if len(args) != 1 or args[0] in self.chains:
+                return False
+            self.chains[args[0]] = []
+            return True
+        elif op in ("-X", "--delete-chain"):
+            if len(args) != 1:
+                return False
+            chain = args[0]
+            if (chain not in self.chains or chain in builtins or
+                    self.chains[chain] or self.chain_refs[chain]):
+                return False
+            del self.chains[chain]
+            return True
+        return False
+
+
+class _SimInterface(object):
+    def __init__(self, name, index, mac):
+        self.name = name
+        self.index = index
+        self.mac = mac
+        self.flags = IFF_BROADCAST | IFF_MULTICAST
+        self.mtu = 1500
+        # Per-interface sysctls, keyed on the path below /proc/sys/net with
+        # the interface name removed, e.g. "ipv4/conf/rp_filter".
+        self.sysctls = {}
+
+    def link_lines(self):
+        flag_names = ["BROADCAST", "MULTICAST"]
+        if self.flags & IFF_UP:
+            flag_names += ["UP", "LOWER_UP"]
+        state = "UP" if self.flags & IFF_UP else "DOWN"
+        return ("%s: %s: <%s> mtu %s qdisc pfifo_fast state %s mode DEFAULT "
+                "qlen 1000\n    link/ether %s brd ff:ff:ff:ff:ff:ff\n" %
+                (self.index, self.name, ",".join(flag_names), self.mtu,
+                 state, self.mac))
+
+
+class _SimIpset(object):
+    def __init__(self, name, set_type, family, hashsize, maxelem):
+        self.name = name
+        self.type = set_type
+        self.family = family
+        self.hashsize = hashsize
+        self.maxelem = maxelem
+        self.members = set()
+
+    def same_params(self, other):
+        return ((self.type, self.family, self.hashsize, self.maxelem) ==
+                (other.type, other.family, other.hashsize, other.maxelem))
+
+    def _header(self):
+        return "family %s hashsize %s maxelem %s" % (
+            self.family, self.hashsize, self.maxelem)
+
+    def list_lines(self, in_use):
+        lines = ["Name: %s" % self.name,
+                 "Type: %s" % self.type,
+                 "Revision: 4",
+                 "Header: %s" % self._header(),
+                 "Size in memory: %s" % (16528 + 16 * len(self.members)),
+                 "References: %s" % (1 if in_use else 0),
+                 "Members:"]
+        lines.extend(sorted(self.members))
+        return "\n".join(lines) + "\n"
+
+    def save_lines(self):
+        lines = ["create %s %s %s" % (self.name, self.type, self._header())]
+        lines.extend("add %s %s" % (self.name, m)
+                     for m in sorted(self.members))
+        return "\n".join(lines) + "\n"
+
+
+class _SimNetlinkSocket(object):
+    """
+    Stand-in for a bound RTNETLINK socket; recv() blocks (the greenlet)
+    until the simulation generates an event.  Supports RTM_GETLINK dumps.
+    """
+    def __init__(self, dataplane, queue):
+        self._dataplane = dataplane
+        self._queue = queue
+
+    def sendto(self, data, addr):
+        _, msg_type, flags, seq, _ = struct.unpack_from("=LHHLL", data)
+        if msg_type != RTM_GETLINK:
+            raise socket.error(errno.EOPNOTSUPP, "Unsupported request")
+        # The kernel would split a large dump across datagrams.
+        self._queue.put("".join(
+            _encode_link_msg(RTM_NEWLINK, iface, NLM_F_MULTI, seq)
+            for iface in self._dataplane.interfaces.itervalues()) +
+            struct.pack("=LHHLLi", 20, NLMSG_DONE, NLM_F_MULTI, seq, 0, 0))
+
+    def recv(self, bufsize):
+        data = self._queue.get()
+        return data[:bufsize]
+
+
+def _encode_link_msg(msg_type, iface, flags=0, seq=0):
+    """
+    Encodes an RTM_NEWLINK/RTM_DELLINK message as the kernel would, with
+    the IFLA_ADDRESS, IFLA_IFNAME and IFLA_OPERSTATE attributes.
+    """
+    operstate = IF_OPER_UP if iface.flags & IFF_UP else IF_OPER_DOWN
+    attrs = _encode_rta(IFLA_ADDRESS, "".join(
+        chr(int(b, 16)) for b in iface.mac.split(":")))
+    attrs += _encode_rta(IFLA_IFNAME, iface.name + "\0")
+    attrs += _encode_rta(IFLA_OPERSTATE, struct.pack("=B", operstate))
+    ifinfo = struct.pack("=BBHiII", AF_UNSPEC, 0, ARPHRD_ETHER,
+                         iface.index, iface.flags, 0xffffffff)
+    body = ifinfo + attrs
+    hdr = struct.pack("=LHHLL", 16 + len(body), msg_type, flags, seq, 0)
+    return hdr + body
+
+
+def _canonical_member(set_type, member):
+    if set_type == "hash:ip":
+        return str(netaddr.IPAddress(member))
+    net = netaddr.IPNetwork(member).cidr
+    if net.size == 1:
+        return str(net.ip)
+    return str(net)
+
+
+def _encode_rta(rta_type, data):
+    rta_len = 4 + len(data)
+    padding = "\0" * (((rta_len + 3) & ~3) - rta_len)
+    return struct.pack("=HH", rta_len, rta_type) + data + padding
+
+
+def _rule_target(rule_words):
+    """
+    :returns: the target of the rule given as a list of words, or None
+        if it has no --jump/--goto.
+    """
+    for i, word in enumerate(rule_words[:-1]):
+        if word in ("-j", "--jump", "-g", "--goto"):
+            return rule_words[i + 1]
+    return None
+
+
+def _quote_word(word):
+    if not word or any(c.isspace() for c in word) or '"' in word:
+        return '"%s"' % word.replace('"', '\\"')
+    return word
@@ -18,6 +18,7 @@ felix.devices
 
 Utility functions for managing devices in Felix.
 """
+from collections import namedtuple
 import logging
 from calico.felix.actor import Actor, actor_message
 import os
@@ -26,12 +27,33 @@ import struct
 
 from calico import common
 from calico.felix import futils
+from calico.felix import netlink
 
 # Logger
 from calico.felix.futils import FailedSystemCall
+from calico.felix.netlink import NetlinkError
+from calico.felix.rtnetlink import (IFINFOMSG, RTM_GETLINK,
+                                    encode_getlink_dump)
 
 _log = logging.getLogger(__name__)
 
+# Client for programming routes over RTNETLINK, or None to use "ip -batch".
+_rtnetlink_client = None
+# rtnetlink.RouteTable tracking the routes to each interface, or None to
+# list them with the ip command.
+_route_table = None
+# Client for removing conntrack flows over ctnetlink, or None to use the
+# conntrack command.
+_ctnetlink_client = None
+# ConntrackManager that removes conntrack flows in the background, or None
+# to remove them inline.
+_conntrack_manager = None
+# InterfaceTable maintained by the InterfaceWatcher, or None if it isn't
+# running.
+_interface_table = None
+_sysctl_stats = futils.StatCounter("Interface sysctls")
+_route_stats = futils.StatCounter("Route programming")
+
 
 def configure_global_kernel_config():
     """
@@ -83,10 +105,13 @@ def interface_exists(interface):
     :returns: True if interface device exists
     :raises: FailedSystemCall if ip link list fails.
 
-    We could check under /sys/class/net here, but there's a window where
-    /sys/class/net/<iface> might still exist for a link that is in the process
-    of being deleted, so we use ip link list instead.
+    Uses the InterfaceWatcher's interface table, once it has loaded.
+    Otherwise: we could check under /sys/class/net here, but there's a window
+    where /sys/class/net/<iface> might still exist for a link that is in the
+    process of being deleted, so we use ip link list instead.
     """
+    if _interface_table is not None and _interface_table.loaded:
+        return _interface_table.get(interface) is not None
     try:
         futils.check_call(["ip", "link", "list", interface])
         return True
@@ -105,6 +130,10 @@ def list_interface_ips(ip_type, interface):
     :param str interface: Interface name
     :returns: a set of all addresses for which there is a route to the device.
     """
+    if _route_table is not None:
+        return _route_table.interface_ips(
+            futils.IP_TYPE_TO_VERSION[ip_type], interface)
+
     ips = set()
 
     if ip_type == futils.IPV4:
@@ -150,10 +179,12 @@ def configure_interface_ipv4(if_name):
     """
     # Enable the kernel's RPF check, which ensures that a VM cannot spoof
     # its IP address.
-    _write_proc_sys('/proc/sys/net/ipv4/conf/%s/rp_filter' % if_name, 1)
-    _write_proc_sys('/proc/sys/net/ipv4/conf/%s/route_localnet' % if_name, 1)
-    _write_proc_sys("/proc/sys/net/ipv4/conf/%s/proxy_arp" % if_name, 1)
-    _write_proc_sys("/proc/sys/net/ipv4/neigh/%s/proxy_delay" % if_name, 0)
+    _write_interface_sysctls(if_name, [
+        ('/proc/sys/net/ipv4/conf/%s/rp_filter' % if_name, 1),
+        ('/proc/sys/net/ipv4/conf/%s/route_localnet' % if_name, 1),
+        ("/proc/sys/net/ipv4/conf/%s/proxy_arp" % if_name, 1),
+        ("/proc/sys/net/ipv4/neigh/%s/proxy_delay" % if_name, 0),
+    ])
 
 
 def configure_interface_ipv6(if_name, proxy_target):
@@ -168,7 +199,9 @@ def configure_interface_ipv6(if_name, proxy_target):
     :returns: None
     :raises: FailedSystemCall
     """
-    _write_proc_sys("/proc/sys/net/ipv6/conf/%s/proxy_ndp" % if_name, 1)
+    _write_interface_sysctls(if_name, [
+        ("/proc/sys/net/ipv6/conf/%s/proxy_ndp" % if_name, 1),
+    ])
 
     # Allows None if no IPv6 proxy target is required.
     if proxy_target:
@@ -177,15 +210,71 @@ def configure_interface_ipv6(if_name, proxy_target):
 
 
 def _read_proc_sys(name):
+    dataplane = futils.get_dataplane()
+    if dataplane is not None:
+        return dataplane.read_file(name).strip()
     with open(name, "rb") as f:
         return f.read().strip()
 
 
+def _write_interface_sysctls(if_name, values):
+    """
+    Writes the given sysctls of an interface, skipping any that we have
+    already written with the same value to the same instance of the
+    interface.
+
+    We only skip writes once the interface table has loaded: it forgets
+    what we wrote when an interface is removed, so a recreated interface,
+    which gets the default values, is written afresh.
+
+    :param list values: (path, value) tuples.
+    :raises IOError: if a write fails, for example because the interface
+        doesn't exist.
+    """
+    iface = None
+    if _interface_table is not None and _interface_table.loaded:
+        iface = _interface_table.get(if_name)
+    if iface is None:
+        written = {}
+    else:
+        written = _interface_table.written_sysctls(iface.index)
+    for name, value in values:
+        value = str(value)
+        if written.get(name) == value:
+            _sysctl_stats.increment("Writes skipped")
+            continue
+        _write_proc_sys(name, value)
+        _sysctl_stats.increment("Writes")
+        written[name] = value
+
+
 def _write_proc_sys(name, value):
+    dataplane = futils.get_dataplane()
+    if dataplane is not None:
+        dataplane.write_file(name, value)
+        return
     with open(name, "wb") as f:
         f.write(str(value))
 
 
+def set_rtnetlink_client(client):
+    """
+    Sets the RTNETLINK client used to program routes and ARP entries, or
+    None to run "ip -batch" instead.
+    """
+    global _rtnetlink_client
+    _rtnetlink_client = client
+
+
+def set_route_table(route_table):
+    """
+    Sets the route table used to look up the routes to each interface, or
+    None to run "ip route list" instead.
+    """
+    global _route_table
+    _route_table = route_table
+
+
 def add_route(ip_type, ip, interface, mac):
     """
     Add a route to a given interface (including arp config).
@@ -202,13 +291,7 @@ def add_route(ip_type, ip, interface, mac):
     """
     if mac is None and ip:
         raise ValueError("mac must be supplied if ip is provided")
-
-    if ip_type == futils.IPV4:
-        futils.check_call(['arp', '-s', ip, mac, '-i', interface])
-        futils.check_call(["ip", "route", "replace", ip, "dev", interface])
-    else:
-        futils.check_call(["ip", "-6", "route", "replace", ip, "dev",
-                           interface])
+    _program_routes(_add_route_lines(ip_type, ip, interface, mac))
 
 
 def del_route(ip_type, ip, interface):
@@ -220,17 +303,15 @@ def del_route(ip_type, ip, interface):
     :param str interface: Interface name
     :raises FailedSystemCall
     """
-    if ip_type == futils.IPV4:
-        futils.check_call(['arp', '-d', ip, '-i', interface])
-        futils.check_call(["ip", "route", "del", ip, "dev", interface])
-    else:
-        futils.check_call(["ip", "-6", "route", "del", ip, "dev", interface])
+    _program_routes(_del_route_lines(ip_type, ip, interface))
 
 
 def set_routes(ip_type, ips, interface, mac=None, reset_arp=False):
     """
     Set the routes on the interface to be the specified set.
 
+    All the route and ARP changes are made in one batch.
+
     :param ip_type: Type of IP (IPV4 or IPV6)
     :param set ips: IPs to set up (any not in the set are removed)
     :param str interface: Interface name
@@ -245,14 +326,58 @@ def set_routes(ip_type, ips, interface, mac=None, reset_arp=False):
     current_ips = list_interface_ips(ip_type, interface)
 
     removed_ips = (current_ips - ips)
-    for ip in removed_ips:
-        del_route(ip_type, ip, interface)
-    remove_conntrack_flows(removed_ips, 4 if ip_type == futils.IPV4 else 6)
-    for ip in (ips - current_ips):
-        add_route(ip_type, ip, interface, mac)
+    lines = []
+    for ip in sorted(removed_ips):
+        lines.extend(_del_route_lines(ip_type, ip, interface))
+    for ip in sorted(ips - current_ips):
+        lines.extend(_add_route_lines(ip_type, ip, interface, mac))
     if reset_arp:
-        for ip in (ips & current_ips):
-            futils.check_call(['arp', '-s', ip, mac, '-i', interface])
+        for ip in sorted(ips & current_ips):
+            lines.append(_neigh_replace_line(ip, interface, mac))
+    _program_routes(lines)
+    remove_conntrack_flows(removed_ips, 4 if ip_type == futils.IPV4 else 6)
+
+
+def _add_route_lines(ip_type, ip, interface, mac):
+    lines = []
+    if ip_type == futils.IPV4:
+        lines.append(_neigh_replace_line(ip, interface, mac))
+    lines.append("route replace %s dev %s" % (ip, interface))
+    return lines
+
+
+def _del_route_lines(ip_type, ip, interface):
+    lines = []
+    if ip_type == futils.IPV4:
+        lines.append("neigh del %s dev %s" % (ip, interface))
+    lines.append("route del %s dev %s" % (ip, interface))
+    return lines
+
+
+def _neigh_replace_line(ip, interface, mac):
+    # Equivalent to "arp -s": a static ARP entry.
+    return "neigh replace %s lladdr %s dev %s nud permanent" % (ip, mac,
+                                                                interface)
+
+
+def _program_routes(lines):
+    """
+    Applies "ip -batch" lines, over RTNETLINK if we have a client.  On
+    failure, the lines before the failing one have been applied; over
+    RTNETLINK, so may some of those after it.  The lines are idempotent
+    so the caller can simply retry.
+
+    :raises FailedSystemCall
+    """
+    if not lines:
+        return
+    _route_stats.increment("Batches")
+    _route_stats.increment("Lines", len(lines))
+    if _rtnetlink_client is not None:
+        _rtnetlink_client.run_batch(lines)
+    else:
+        futils.check_call(["ip", "-batch", "-"],
+                          input_str="\n".join(lines) + "\n")
 
 
 def interface_up(if_name):
@@ -260,18 +385,28 @@ def interface_up(if_name):
     Checks whether a given interface is up.
 
     Check this by examining the interface flags and looking for whether the
-    IFF_UP flag has been set. IFF_UP is the flag 0x01, so read in the flags
-    (represented by a hexadecimal integer) and check if the 1 bit is set.
+    IFF_UP flag has been set.  The flags come from the InterfaceWatcher's
+    interface table once it has loaded.  Otherwise, IFF_UP is the flag 0x01,
+    so read in the flags (represented by a hexadecimal integer) and check if
+    the 1 bit is set.
 
     :param str if_name: Interface name
     :returns: True if interface up, False if down or cannot detect
     """
+    if _interface_table is not None and _interface_table.loaded:
+        iface = _interface_table.get(if_name)
+        return iface is not None and bool(iface.flags & IFF_UP)
+
     flags_file = '/sys/class/net/%s/flags' % if_name
 
     try:
-        with open(flags_file, 'r') as f:
-            flags = f.read().strip()
-            _log.debug("Interface %s has flags %s", if_name, flags)
+        dataplane = futils.get_dataplane()
+        if dataplane is not None:
+            flags = dataplane.read_file(flags_file).strip()
+        else:
+            with open(flags_file, 'r') as f:
+                flags = f.read().strip()
+        _log.debug("Interface %s has flags %s", if_name, flags)
     except IOError as e:
         # If we fail to check that the interface is up, then it has probably
         # gone under our feet or is flapping.
@@ -282,12 +417,61 @@ def interface_up(if_name):
     return bool(int(flags, 16) & 1)
 
 
+def set_interface_table(table):
+    """
+    Sets the InterfaceTable used by interface_exists() and interface_up().
+    """
+    global _interface_table
+    _interface_table = table
+
+
+def set_ctnetlink_client(client):
+    """
+    Sets the ctnetlink client used to remove conntrack flows, or None to
+    run the conntrack command instead.
+    """
+    global _ctnetlink_client
+    _ctnetlink_client = client
+
+
+def set_conntrack_manager(manager):
+    """
+    Sets the ConntrackManager that removes conntrack flows in the
+    background, or None to remove them inline.
+    """
+    global _conntrack_manager
+    _conntrack_manager = manager
+
+
 def remove_conntrack_flows(ip_addresses, ip_version):
     """
     Removes any conntrack entries that use any of the given IP
     addresses in their source/destination.
+
+    If a ConntrackManager has been set, queues the removal to it and
+    returns without waiting.
     """
     assert ip_version in (4, 6)
+    if not ip_addresses:
+        return
+    if _conntrack_manager is not None:
+        _conntrack_manager.remove_flows(ip_addresses, ip_version, async=True)
+    else:
+        _remove_conntrack_flows(ip_addresses, ip_version)
+
+
+def _remove_conntrack_flows(ip_addresses, ip_version):
+    if _ctnetlink_client is not None:
+        try:
+            removed = _ctnetlink_client.remove_flows(ip_addresses,
+                                                     ip_version)
+        except (NetlinkError, socket.error):
+            _log.exception("Failed to remove conntrack flows over netlink, "
+                           "falling back to the conntrack command.")
+        else:
+            _log.debug("Removed %s conntrack flows for %s IPs", removed,
+                       len(ip_addresses))
+            return
     for ip in ip_addresses:
         _log.debug("Removing conntrack rules for %s", ip)
         for direction in ["--orig-src", "--orig-dst",
@@ -309,20 +493,59 @@ def remove_conntrack_flows(ip_addresses, ip_version):
                                    "Ignoring.", ip)
 
 
+class ConntrackManager(Actor):
+    """
+    Actor that removes conntrack flows in the background, so that endpoint
+    teardown doesn't wait for it.  The removals queued during a batch are
+    combined so that, over ctnetlink, the conntrack table is scanned once
+    per IP version per batch.
+    """
+    def __init__(self):
+        super(ConntrackManager, self).__init__()
+        # Map from IP version to the IPs whose flows should be removed at the
+        # end of the batch.
+        self._pending = {4: set(), 6: set()}
+
+    @actor_message()
+    def remove_flows(self, ip_addresses, ip_version):
+        """
+        Queues removal of the flows for the given IPs; see
+        remove_conntrack_flows().
+        """
+        self._pending[ip_version].update(ip_addresses)
+
+    def _finish_msg_batch(self, batch, results):
+        for ip_version in (4, 6):
+            ip_addresses = self._pending[ip_version]
+            if ip_addresses:
+                self._pending[ip_version] = set()
+                _remove_conntrack_flows(ip_addresses, ip_version)
+
+
 # These constants map to constants in the Linux kernel. This is a bit poor, but
 # the kernel can never change them, so live with it for now.
 RTMGRP_LINK = 1
 
 NLMSG_NOOP = 1
 NLMSG_ERROR = 2
+NLMSG_DONE = 3
 
 RTM_NEWLINK = 16
 RTM_DELLINK = 17
 
+IFF_UP = 0x1
+IFLA_ADDRESS = 1
 IFLA_IFNAME = 3
 IFLA_OPERSTATE = 16
 IF_OPER_UP = 6
 
+# Sequence number of our RTM_GETLINK dump request; events have sequence
+# number 0.
+DUMP_SEQ = 1
+
+Interface = namedtuple("Interface", ["name", "index", "flags", "operstate",
+                                     "mac"])
+
 
 class RTNetlinkError(Exception):
     """
@@ -331,118 +554,182 @@ class RTNetlinkError(Exception):
     pass
 
 
+class InterfaceTable(object):
+    """
+    The host's interfaces, as Interface tuples.  Seeded from an RTM_GETLINK
+    dump and kept up to date by the InterfaceWatcher.
+    """
+    def __init__(self):
+        # Set once the dump has completed.
+        self.loaded = False
+        self._by_name = {}
+        self._by_index = {}
+        # Map from interface index to the sysctls that we have written for
+        # it, as a dict mapping path to value.
+        self._sysctls = {}
+
+    def get(self, name):
+        """
+        :returns Interface: the named interface, or None if it doesn't exist.
+        """
+        return self._by_name.get(name)
+
+    def get_by_index(self, index):
+        return self._by_index.get(index)
+
+    def written_sysctls(self, index):
+        """
+        :returns dict: the sysctls that have been written for the interface,
+            mapping path to value; for the caller to update.  Discarded when
+            the interface is removed.
+        """
+        return self._sysctls.setdefault(index, {})
+
+    def update(self, iface):
+        old = self._by_index.get(iface.index)
+        if old is not None and old.name != iface.name:
+            # Renamed.
+            self._remove_name(old)
+        stale = self._by_name.get(iface.name)
+        if stale is not None and stale.index != iface.index:
+            # Recreated; we must have missed the old one's removal.
+            del self._by_index[stale.index]
+            self._sysctls.pop(stale.index, None)
+        self._by_index[iface.index] = iface
+        self._by_name[iface.name] = iface
+
+    def remove(self, index):
+        old = self._by_index.pop(index, None)
+        self._sysctls.pop(index, None)
+        if old is not None:
+            self._remove_name(old)
+
+    def _remove_name(self, iface):
+        if self._by_name.get(iface.name) is iface:
+            del self._by_name[iface.name]
+
+    def __len__(self):
+        return len(self._by_index)
+
+
 class InterfaceWatcher(Actor):
     def __init__(self, update_splitter):
         super(InterfaceWatcher, self).__init__()
         self.update_splitter = update_splitter
-        self.interfaces = {}
+        self.interface_table = InterfaceTable()
+        # A dict that remembers the detailed flags of an interface
+        # when we last signalled it as being up.  We use this to avoid
+        # sending duplicate interface_update signals.
+        self._if_last_flags = {}
 
     @actor_message()
     def watch_interfaces(self):
         """
         Detects when interfaces appear, sending notifications to the update
-        splitter.
+        splitter, and maintains the interface table.
 
         :returns: Never returns.
         """
         # Create the netlink socket and bind to RTMGRP_LINK,
-        s = socket.socket(socket.AF_NETLINK,
-                          socket.SOCK_RAW,
-                          socket.NETLINK_ROUTE)
-        s.bind((os.getpid(), RTMGRP_LINK))
-
-        # A dict that remembers the detailed flags of an interface
-        # when we last signalled it as being up.  We use this to avoid
-        # sending duplicate interface_update signals.
-        if_last_flags = {}
+        dataplane = futils.get_dataplane()
+        if dataplane is not None:
+            s = dataplane.netlink_socket(RTMGRP_LINK)
+        else:
+            s = socket.socket(socket.AF_NETLINK,
+                              socket.SOCK_RAW,
+                              socket.NETLINK_ROUTE)
+            s.bind((os.getpid(), RTMGRP_LINK))
+
+        # Now that we're subscribed, ask for the existing interfaces.  The
+        # dump's replies and the events come back on the same socket, in
+        # order, so the table can't miss an update.
+        if not getattr(dataplane, "auto_create_prefix", None):
+            # (Simulated interfaces that are created by looking them up
+            # can't be found in the table.)
+            set_interface_table(self.interface_table)
+        s.sendto(netlink.encode_msg(RTM_GETLINK,
+                                    netlink.NLM_F_REQUEST | netlink.NLM_F_DUMP,
+                                    DUMP_SEQ, encode_getlink_dump()), (0, 0))
 
         while True:
-            # Get the next set of data.
+            # Get the next set of data; it may contain many messages.
             data = s.recv(65535)
 
-            # First 16 bytes is the message header; unpack it.
-            hdr = data[:16]
-            data = data[16:]
-            msg_len, msg_type, flags, seq, pid = struct.unpack("=LHHLL", hdr)
-
-            if msg_type == NLMSG_NOOP:
-                # Noop - get some more data.
-                continue
-            elif msg_type == NLMSG_ERROR:
-                # We have got an error. Raise an exception which brings the
-                # process down.
-                raise RTNetlinkError("Netlink error message, header : %s",
-                                     futils.hex(hdr))
-            _log.debug("Netlink message type %s len %s", msg_type, msg_len)
-
-            if msg_type in [RTM_NEWLINK, RTM_DELLINK]:
-                # A new or removed interface.  Read the struct
-                # ifinfomsg, which is 16 bytes.
-                hdr = data[:16]
-                data = data[16:]
-                _, _, _, index, flags, _ = struct.unpack("=BBHiII", hdr)
-                _log.debug("Interface index %s flags %x", index, flags)
-
-                # Bytes left is the message length minus the two headers of 16
-                # bytes each.
-                remaining = msg_len - 32
-
-                # Loop through attributes, looking for the pieces of
-                # information that we need.
-                ifname = None
-                operstate = None
-                while remaining:
-                    # The data content is an array of RTA objects, each of
-                    # which has a 4 byte header and some data.
-                    rta_len, rta_type = struct.unpack("=HH", data[:4])
-
-                    # This check comes from RTA_OK, and terminates a string of
-                    # routing attributes.
-                    if rta_len < 4:
-                        break
-
-                    rta_data = data[4:rta_len]
-
-                    # Remove the RTA object from the data. The length to jump
-                    # is the rta_len rounded up to the nearest 4 byte boundary.
-                    increment = int((rta_len + 3) / 4) * 4
-                    data = data[increment:]
-                    remaining -= increment
-
-                    if rta_type == IFLA_IFNAME:
-                        ifname = rta_data[:-1]
-                        _log.debug("IFLA_IFNAME: %s", ifname)
-                    elif rta_type == IFLA_OPERSTATE:
-                        operstate, = struct.unpack("=B", rta_data[:1])
-                        _log.debug("IFLA_OPERSTATE: %s", operstate)
-
-                if (ifname and
-                        (msg_type == RTM_DELLINK or operstate != IF_OPER_UP)):
-                    # The interface is down; make sure the other actors know
-                    # about it.
-                    self.update_splitter.on_interface_update(ifname,
-                                                             iface_up=False,
-                                                             async=True)
-                    # Remove any record we had of the interface so that, when
-                    # it goes back up, we'll report that.
-                    if_last_flags.pop(ifname, None)
-
-                if (ifname and
-                    msg_type == RTM_NEWLINK and
-                    operstate == IF_OPER_UP and
-                    (ifname not in if_last_flags or
-                     if_last_flags[ifname] != flags)):
-                    # We only care about notifying when a new
-                    # interface is usable, which - according to
-                    # https://www.kernel.org/doc/Documentation/networking/
-                    # operstates.txt - is fully conveyed by the
-                    # operstate.  (When an interface goes away, it
-                    # automatically takes its routes with it.)
-                    _log.debug("New network interface : %s %x", ifname, flags)
-                    if_last_flags[ifname] = flags
-                    self.update_splitter.on_interface_update(ifname,
-                                                             iface_up=True,
-                                                             async=True)
+            for msg_type, flags, seq, payload in netlink.parse_messages(data):
+                if msg_type == NLMSG_NOOP:
+                    # Noop - get some more data.
+                    continue
+                elif msg_type == NLMSG_DONE:
+                    # End of a multipart message, i.e. our dump.
+                    if seq == DUMP_SEQ and not self.interface_table.loaded:
+                        _log.info("Loaded %s interfaces",
+                                  len(self.interface_table))
+                        self.interface_table.loaded = True
+                    continue
+                elif msg_type == NLMSG_ERROR:
+                    # We have got an error. Raise an exception which brings the
+                    # process down.
+                    raise RTNetlinkError("Netlink error message, error "
+                                         "%s for seq %s" %
+                                         (netlink.parse_error(payload), seq))
+                _log.debug("Netlink message type %s len %s", msg_type,
+                           len(payload))
+
+                if msg_type in [RTM_NEWLINK, RTM_DELLINK]:
+                    self._on_link_msg(msg_type, payload)
+
+    def _on_link_msg(self, msg_type, payload):
+        """
+        Handles a new or removed interface, from an event or the dump.
+        """
+        _, _, _, index, flags, _ = IFINFOMSG.unpack_from(payload)
+        _log.debug("Interface index %s flags %x", index, flags)
+
+        # Look for the pieces of information that we need in the
+        # attributes.
+        attrs = dict(netlink.parse_attrs(payload[IFINFOMSG.size:]))
+        ifname = attrs.get(IFLA_IFNAME, "").rstrip("\0") or None
+        operstate = None
+        if attrs.get(IFLA_OPERSTATE):
+            operstate, = struct.unpack("=B", attrs[IFLA_OPERSTATE][:1])
+        mac = None
+        if IFLA_ADDRESS in attrs:
+            mac = ":".join("%02x" % ord(c) for c in attrs[IFLA_ADDRESS])
+        _log.debug("Interface %s operstate %s", ifname, operstate)
+
+        if msg_type == RTM_DELLINK:
+            self.interface_table.remove(index)
+        elif ifname:
+            self.interface_table.update(
+                Interface(ifname, index, flags, operstate, mac))
+
+        if (ifname and
+                (msg_type == RTM_DELLINK or operstate != IF_OPER_UP)):
+            # The interface is down; make sure the other actors know
+            # about it.
+            self.update_splitter.on_interface_update(ifname,
+                                                     iface_up=False,
+                                                     async=True)
+            # Remove any record we had of the interface so that, when
+            # it goes back up, we'll report that.
+            self._if_last_flags.pop(ifname, None)
+
+        if (ifname and
+            msg_type == RTM_NEWLINK and
+            operstate == IF_OPER_UP and
+            (ifname not in self._if_last_flags or
+             self._if_last_flags[ifname] != flags)):
+            # We only care about notifying when a new
+            # interface is usable, which - according to
+            # https://www.kernel.org/doc/Documentation/networking/
+            # operstates.txt - is fully conveyed by the
+            # operstate.  (When an interface goes away, it
+            # automatically takes its routes with it.)
+            _log.debug("New network interface : %s %x", ifname, flags)
+            self._if_last_flags[ifname] = flags
+            self.update_splitter.on_interface_update(ifname,
+                                                     iface_up=True,
+                                                     async=True)
 
 
 class BadKernelConfig(Exception):
@@ -26,9 +26,14 @@ from calico.felix.frules import (
     CHAIN_TO_ENDPOINT, CHAIN_FROM_ENDPOINT, CHAIN_FROM_LEAF, CHAIN_TO_LEAF,
     chain_names, interface_to_suffix
 )
+from calico.felix.futils import StatCounter
 
 _log = logging.getLogger(__name__)
 
+# Maximum length of the interface name prefix that we put in a leaf chain's
+# name.  iptables limits chain names to 28 characters.
+MAX_LEAF_PREFIX_LEN = 28 - len(CHAIN_FROM_LEAF + "-")
+
 
 class DispatchChains(Actor):
     """
@@ -46,7 +51,11 @@ class DispatchChains(Actor):
         self.iptables_updater = iptables_updater
         self.ifaces = set()
         self.programmed_leaf_chains = set()
+        self._programmed_chain_contents = {}
+        """Map from chain name to the updates that we last successfully
+        programmed for it."""
         self._dirty = False
+        self._stats = StatCounter("IPv%s dispatch chains" % ip_version)
 
     @actor_message()
     def apply_snapshot(self, ifaces):
@@ -58,9 +67,10 @@ class DispatchChains(Actor):
         """
         _log.info("Applying dispatch chains snapshot.")
         self.ifaces = set(ifaces)  # Take a copy.
-        # Always reprogram the chain, even if it's empty.  This makes sure that
-        # we resync and it stops the iptables layer from marking our chain as
-        # missing.
+        # Always reprogram all the chains, even if they're empty or
+        # unchanged.  This makes sure that we resync and it stops the
+        # iptables layer from marking our chain as missing.
+        self._programmed_chain_contents = {}
         self._dirty = True
 
     @actor_message()
@@ -111,24 +121,30 @@ class DispatchChains(Actor):
         Calculates the iptables update to rewrite our chains.
 
         To avoid traversing lots of dispatch rules to find the right one,
-        we build a tree of chains.  Currently, the tree can only be
-        two layers deep: a root chain and a layer of leaves.
+        we build a tree of chains, keyed on successive characters of the
+        interface name.
 
         Interface names look like this: "prefix1234abc".  The "prefix"
         part is always the same so we ignore it.  We call "1234abc", the
         "suffix".
 
-        The root chain contains two sorts of rules:
+        The root chain always splits the interfaces by the first character
+        of their suffix.  Each chain contains two sorts of rules:
 
         * where there are multiple interfaces whose suffixes start with
-          the same character, it contains a rule that matches on
+          the same characters, it contains a rule that matches on
           that prefix of the "suffix"(!) and directs the packet to a
           leaf chain for that prefix.
 
         * as an optimization, if there is only one interface whose
-          suffix starts with a given character, it contains a dispatch
+          suffix starts with a given prefix, it contains a dispatch
           rule for that exact interface name.
 
+        A leaf chain with more than DISPATCH_MAX_FANOUT interfaces is split
+        again on the next character, and so on, which keeps the number of
+        rules that a packet traverses logarithmic in the number of
+        interfaces.
+
         For example, if we have interface names "tapA1" "tapB1" "tapB2",
         we'll get (in pseudo code):
 
@@ -151,91 +167,102 @@ class DispatchChains(Actor):
             * chain updates dict.
             * complete set of leaf chains that are now required.
         """
-
-        # iptables update fragments/dependencies for the root chains.
         updates = defaultdict(list)
-        root_to_upds = updates[CHAIN_TO_ENDPOINT]
-        root_from_upds = updates[CHAIN_FROM_ENDPOINT]
-
         dependencies = defaultdict(set)
-        root_to_deps = dependencies[CHAIN_TO_ENDPOINT]
-        root_from_deps = dependencies[CHAIN_FROM_ENDPOINT]
-
-        # Separate the interface names by their prefixes so we can count them
-        # and decide whether to program a leaf chain or not.
-        interfaces_by_prefix = defaultdict(set)
-        for iface in ifaces:
-            ep_suffix = interface_to_suffix(self.config, iface)
-            prefix = ep_suffix[:1]
-            interfaces_by_prefix[prefix].add(iface)
-
-        # Spin through the interfaces by prefix.  Either add them directly
-        # to the root chain or create a leaf and add them there.
         new_leaf_chains = set()
-        for prefix, interfaces in interfaces_by_prefix.iteritems():
-            use_root_chain = len(interfaces) == 1
-            if use_root_chain:
-                # Optimization: there's only one interface with this prefix,
-                # don't program a leaf chain.
-                disp_to_chain = CHAIN_TO_ENDPOINT
-                disp_from_chain = CHAIN_FROM_ENDPOINT
-                to_deps = root_to_deps
-                from_deps = root_from_deps
-                to_upds = root_to_upds
-                from_upds = root_from_upds
-            else:
+        suffixes = dict((iface, interface_to_suffix(self.config, iface))
+                        for iface in ifaces)
+        self._add_dispatch_rules(CHAIN_FROM_ENDPOINT, CHAIN_TO_ENDPOINT, "",
+                                 suffixes, updates, dependencies,
+                                 new_leaf_chains)
+        chains_to_delete = self.programmed_leaf_chains - new_leaf_chains
+
+        return chains_to_delete, dependencies, updates, new_leaf_chains
+
+    def _add_dispatch_rules(self, from_chain, to_chain, prefix, suffixes,
+                            updates, dependencies, new_leaf_chains):
+        """
+        Adds the dispatch rules for the given interfaces to the given pair
+        of chains, recursing to create leaf chains as required.
+
+        :param str prefix: prefix of the suffix shared by all the interfaces;
+            "" for the root chains.
+        :param dict[str,str] suffixes: map from interface name to suffix for
+            the interfaces to dispatch from these chains.
+        """
+        from_upds = updates[from_chain]
+        to_upds = updates[to_chain]
+        from_deps = dependencies[from_chain]
+        to_deps = dependencies[to_chain]
+
+        split = (not prefix or
+                 (len(suffixes) > self.config.DISPATCH_MAX_FANOUT and
+                  len(prefix) < MAX_LEAF_PREFIX_LEN))
+        if split:
+            # Separate the interface names by the next character of their
+            # suffix so we can count them and decide whether to program a
+            # leaf chain or not.
+            direct_ifaces = set()
+            suffixes_by_prefix = defaultdict(dict)
+            for iface, suffix in suffixes.iteritems():
+                if len(suffix) <= len(prefix):
+                    # Suffix is exactly the prefix, can't split further.
+                    direct_ifaces.add(iface)
+                else:
+                    child_prefix = suffix[:len(prefix) + 1]
+                    suffixes_by_prefix[child_prefix][iface] = suffix
+            # Sort so that the same interfaces always render the same way,
+            # this lets us skip rewriting unchanged chains.
+            for child_prefix, child_suffixes in \
+                    sorted(suffixes_by_prefix.iteritems()):
+                if len(child_suffixes) == 1:
+                    # Optimization: there's only one interface with this
+                    # prefix, don't program a leaf chain.
+                    direct_ifaces.update(child_suffixes)
+                    continue
                 # There's more than one interface with this prefix, program
                 # a leaf chain.
-                disp_to_chain = CHAIN_TO_LEAF + "-" + prefix
-                disp_from_chain = CHAIN_FROM_LEAF + "-" + prefix
-                to_upds = updates[disp_to_chain]
-                from_upds = updates[disp_from_chain]
-                to_deps = dependencies[disp_to_chain]
-                from_deps = dependencies[disp_from_chain]
-                new_leaf_chains.add(disp_from_chain)
-                new_leaf_chains.add(disp_to_chain)
-                # Root chain depends on its leaves.
-                root_from_deps.add(disp_to_chain)
-                root_to_deps.add(disp_from_chain)
-                # Point root chain at prefix chain.
-                iface_match = self.config.IFACE_PREFIX + prefix + "+"
-                root_from_upds.append(
+                child_from = CHAIN_FROM_LEAF + "-" + child_prefix
+                child_to = CHAIN_TO_LEAF + "-" + child_prefix
+                new_leaf_chains.add(child_from)
+                new_leaf_chains.add(child_to)
+                # Parent chain depends on its leaves.
+                from_deps.add(child_from)
+                to_deps.add(child_to)
+                # Point parent chain at prefix chain.
+                iface_match = self.config.IFACE_PREFIX + child_prefix + "+"
+                from_upds.append(
                     "--append %s --in-interface %s --goto %s" %
-                    (CHAIN_FROM_ENDPOINT, iface_match, disp_from_chain)
+                    (from_chain, iface_match, child_from)
                 )
-                root_to_upds.append(
+                to_upds.append(
                     "--append %s --out-interface %s --goto %s" %
-                    (CHAIN_TO_ENDPOINT, iface_match, disp_to_chain)
+                    (to_chain, iface_match, child_to)
                 )
-
-            # Common processing, add the per-endpoint rules to whichever
-            # chain we decided above.
-            for iface in interfaces:
-                # Add rule to leaf or global chain to direct traffic to the
-                # endpoint-specific one.  Note that we use --goto, which means
-                # that the endpoint-specific chain will return to our parent
-                # rather than to this chain.
-                ep_suffix = interface_to_suffix(self.config, iface)
-                to_chain_name, from_chain_name = chain_names(ep_suffix)
-                from_upds.append("--append %s --in-interface %s --goto %s" %
-                                 (disp_from_chain, iface, from_chain_name))
-                from_deps.add(from_chain_name)
-                to_upds.append("--append %s --out-interface %s --goto %s" %
-                               (disp_to_chain, iface, to_chain_name))
-                to_deps.add(to_chain_name)
-
-            if not use_root_chain:
-                # Add a default drop to the end of the leaf chain.
-                from_upds.append("--append %s --jump DROP" % disp_from_chain)
-                to_upds.append("--append %s --jump DROP" % disp_to_chain)
-
-        # Both TO and FROM chains end with a DROP so that interfaces that
-        # we don't know about yet can't bypass our rules.
-        root_from_upds.append("--append %s --jump DROP" % CHAIN_FROM_ENDPOINT)
-        root_to_upds.append("--append %s --jump DROP" % CHAIN_TO_ENDPOINT)
-        chains_to_delete = self.programmed_leaf_chains - new_leaf_chains
-
-        return chains_to_delete, dependencies, updates, new_leaf_chains
+                self._add_dispatch_rules(child_from, child_to, child_prefix,
+                                         child_suffixes, updates,
+                                         dependencies, new_leaf_chains)
+        else:
+            direct_ifaces = suffixes.keys()
+
+        # Add the per-endpoint rules to this chain.
+        for iface in sorted(direct_ifaces):
+            # Add rule to leaf or global chain to direct traffic to the
+            # endpoint-specific one.  Note that we use --goto, which means
+            # that the endpoint-specific chain will return to our parent
+            # rather than to this chain.
+            to_chain_name, from_chain_name = chain_names(suffixes[iface])
+            from_upds.append("--append %s --in-interface %s --goto %s" %
+                             (from_chain, iface, from_chain_name))
+            from_deps.add(from_chain_name)
+            to_upds.append("--append %s --out-interface %s --goto %s" %
+                           (to_chain, iface, to_chain_name))
+            to_deps.add(to_chain_name)
+
+        # All chains end with a DROP so that interfaces that we don't know
+        # about yet can't bypass our rules.
+        from_upds.append("--append %s --jump DROP" % from_chain)
+        to_upds.append("--append %s --jump DROP" % to_chain)
 
     def _reprogram_chains(self):
         """
@@ -247,16 +274,41 @@ class DispatchChains(Actor):
                   len(self.ifaces))
         update = self._calculate_update(self.ifaces)
         to_delete, deps, updates, new_leaf_chains = update
-        futures = [
-            self.iptables_updater.rewrite_chains(updates, deps,
-                                                 async=True),
-            self.iptables_updater.delete_chains(to_delete,
-                                                async=True),
-        ]
+        # Only send the chains that have changed since we last programmed
+        # them.  Since a chain's dependencies are derived from its contents,
+        # they can't have changed either.
+        changed_updates = {}
+        changed_deps = {}
+        for chain, chain_updates in updates.iteritems():
+            if self._programmed_chain_contents.get(chain) != chain_updates:
+                changed_updates[chain] = chain_updates
+                changed_deps[chain] = deps[chain]
+        num_rules = sum(len(u) for u in changed_updates.itervalues())
+        _log.info("%s Rewriting %s of %s dispatch chains (%s rules), "
+                  "deleting %s", self, len(changed_updates), len(updates),
+                  num_rules, len(to_delete))
+        self._stats.increment("Chains rewritten", by=len(changed_updates))
+        self._stats.increment("Chains unchanged",
+                              by=len(updates) - len(changed_updates))
+        self._stats.increment("Rules rewritten", by=num_rules)
+        futures = []
+        if changed_updates:
+            futures.append(
+                self.iptables_updater.rewrite_chains(changed_updates,
+                                                     changed_deps,
+                                                     async=True)
+            )
+        if to_delete:
+            futures.append(
+                self.iptables_updater.delete_chains(to_delete, async=True)
+            )
         wait_and_check(futures)
 
-        # Track our chains so we can clean them up.
+        # Track our chains so we can clean them up and avoid rewriting them.
         self.programmed_leaf_chains = new_leaf_chains
+        self._programmed_chain_contents.update(changed_updates)
+        for chain in to_delete:
+            self._programmed_chain_contents.pop(chain, None)
 
     def __str__(self):
         return (
@@ -32,18 +32,24 @@ import signal
 import gevent
 
 from calico import common
+from calico.felix import ctnetlink
 from calico.felix import devices
 from calico.felix import futils
+from calico.felix import ipset_netlink
+from calico.felix import rtnetlink
 from calico.felix.fiptables import IptablesUpdater
+from calico.felix.fnftables import NftablesUpdater, NftSet
 from calico.felix.dispatch import DispatchChains
 from calico.felix.profilerules import RulesManager
 from calico.felix.frules import install_global_rules
 from calico.felix.splitter import UpdateSplitter
 from calico.felix.config import Config
 from calico.felix.futils import IPV4, IPV6
-from calico.felix.devices import InterfaceWatcher
+from calico.felix.devices import InterfaceWatcher, ConntrackManager
 from calico.felix.endpoint import EndpointManager
-from calico.felix.ipsets import IpsetManager, IpsetActor, HOSTS_IPSET_V4
+from calico.felix.ipsets import (IpsetManager, IpsetActor, IpsetWriter,
+                                 HOSTS_IPSET_V4, set_ipset_class,
+                                 set_netlink_client)
 from calico.felix.masq import MasqueradeManager
 from calico.felix.fetcd import EtcdAPI
 
@@ -66,18 +72,52 @@ def _main_greenlet(config):
         config_loaded = etcd_api.load_config(async=False)
         config_loaded.wait()
 
+        if config.DATAPLANE_DRIVER == "simulated":
+            # Benchmarking mode: nothing touches the real kernel.  There's no
+            # orchestrator to create workload interfaces so the simulation
+            # creates them on demand.
+            _log.warning("Using the simulated dataplane.")
+            # Imported here since the simulation needs Python 2.7 (for
+            # OrderedDict and Counter) but Felix itself supports 2.6.
+            from calico.felix.dataplane import SimulatedDataplane
+            futils.set_dataplane(SimulatedDataplane(
+                default_latency=config.SIM_DATAPLANE_LATENCY_MS / 1000.0,
+                auto_create_prefix=config.IFACE_PREFIX))
+
         # Ensure the Kernel's global options are correctly configured for
         # Calico.
         devices.configure_global_kernel_config()
+        if (config.ROUTE_NETLINK_ENABLED and
+                config.DATAPLANE_DRIVER == "kernel"):
+            devices.set_rtnetlink_client(rtnetlink.create_client())
+        if (config.ROUTE_TABLE_CACHE_ENABLED and
+                config.DATAPLANE_DRIVER == "kernel"):
+            devices.set_route_table(rtnetlink.create_route_table())
+        if (config.CONNTRACK_NETLINK_ENABLED and
+                config.DATAPLANE_DRIVER == "kernel"):
+            devices.set_ctnetlink_client(ctnetlink.create_client())
+
+        if config.FIREWALL_BACKEND == "nftables":
+            _log.info("Using the nftables firewall backend.")
+            updater_cls = NftablesUpdater
+            set_ipset_class(NftSet)
+        else:
+            updater_cls = IptablesUpdater
+            if (config.IPSET_NETLINK_ENABLED and
+                    config.DATAPLANE_DRIVER == "kernel"):
+                set_netlink_client(ipset_netlink.create_client())
 
         _log.info("Main greenlet: Configuration loaded, starting remaining "
                   "actors...")
-        v4_filter_updater = IptablesUpdater("filter", ip_version=4,
-                                            config=config)
-        v4_nat_updater = IptablesUpdater("nat", ip_version=4, config=config)
-        v4_ipset_mgr = IpsetManager(IPV4)
+        v4_filter_updater = updater_cls("filter", ip_version=4,
+                                        config=config)
+        v4_nat_updater = updater_cls("nat", ip_version=4, config=config)
+        v4_ipset_writer = IpsetWriter(IPV4)
+        v4_ipset_mgr = IpsetManager(IPV4, v4_ipset_writer,
+                                    config.IPSET_AUDIT_INTERVAL)
         v4_masq_manager = MasqueradeManager(IPV4, v4_nat_updater)
-        v4_rules_manager = RulesManager(4, v4_filter_updater, v4_ipset_mgr)
+        v4_rules_manager = RulesManager(config, 4, v4_filter_updater,
+                                        v4_ipset_mgr)
         v4_dispatch_chains = DispatchChains(config, 4, v4_filter_updater)
         v4_ep_manager = EndpointManager(config,
                                         IPV4,
@@ -86,11 +126,14 @@ def _main_greenlet(config):
                                         v4_rules_manager,
                                         etcd_api.status_reporter)
 
-        v6_raw_updater = IptablesUpdater("raw", ip_version=6, config=config)
-        v6_filter_updater = IptablesUpdater("filter", ip_version=6,
-                                            config=config)
-        v6_ipset_mgr = IpsetManager(IPV6)
-        v6_rules_manager = RulesManager(6, v6_filter_updater, v6_ipset_mgr)
+        v6_raw_updater = updater_cls("raw", ip_version=6, config=config)
+        v6_filter_updater = updater_cls("filter", ip_version=6,
+                                        config=config)
+        v6_ipset_writer = IpsetWriter(IPV6)
+        v6_ipset_mgr = IpsetManager(IPV6, v6_ipset_writer,
+                                    config.IPSET_AUDIT_INTERVAL)
+        v6_rules_manager = RulesManager(config, 6, v6_filter_updater,
+                                        v6_ipset_mgr)
         v6_dispatch_chains = DispatchChains(config, 6, v6_filter_updater)
         v6_ep_manager = EndpointManager(config,
                                         IPV6,
@@ -109,6 +152,8 @@ def _main_greenlet(config):
                                           v4_nat_updater],
                                          v4_masq_manager)
         iface_watcher = InterfaceWatcher(update_splitter)
+        conntrack_manager = ConntrackManager()
+        devices.set_conntrack_manager(conntrack_manager)
 
         _log.info("Starting actors.")
         hosts_ipset_v4.start()
@@ -116,6 +161,7 @@ def _main_greenlet(config):
 
         v4_filter_updater.start()
         v4_nat_updater.start()
+        v4_ipset_writer.start()
         v4_ipset_mgr.start()
         v4_masq_manager.start()
         v4_rules_manager.start()
@@ -124,12 +170,14 @@ def _main_greenlet(config):
 
         v6_raw_updater.start()
         v6_filter_updater.start()
+        v6_ipset_writer.start()
         v6_ipset_mgr.start()
         v6_rules_manager.start()
         v6_dispatch_chains.start()
         v6_ep_manager.start()
 
         iface_watcher.start()
+        conntrack_manager.start()
 
         top_level_actors = [
             hosts_ipset_v4,
@@ -138,6 +186,7 @@ def _main_greenlet(config):
             v4_nat_updater,
             v4_filter_updater,
             v4_nat_updater,
+            v4_ipset_writer,
             v4_ipset_mgr,
             v4_masq_manager,
             v4_rules_manager,
@@ -146,12 +195,14 @@ def _main_greenlet(config):
 
             v6_raw_updater,
             v6_filter_updater,
+            v6_ipset_writer,
             v6_ipset_mgr,
             v6_rules_manager,
             v6_dispatch_chains,
             v6_ep_manager,
 
             iface_watcher,
+            conntrack_manager,
             etcd_api,
         ]
 
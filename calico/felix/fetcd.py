@@ -35,10 +35,11 @@ from gevent.event import Event
 from calico import common
 from calico.common import ValidationFailed, validate_ip_addr, canonicalise_ip
 from calico.datamodel_v1 import (VERSION_DIR, READY_KEY, CONFIG_DIR,
-                                 RULES_KEY_RE, TAGS_KEY_RE,
                                  dir_for_per_host_config,
                                  PROFILE_DIR, HOST_DIR, EndpointId, POLICY_DIR,
-                                 HOST_IP_KEY_RE, IPAM_V4_CIDR_KEY_RE,
+                                 parse_key, KIND_RULES, KIND_TAGS,
+                                 KIND_ENDPOINT, KIND_HOST_IP,
+                                 KIND_IPAM_V4_POOL,
                                  key_for_last_status, key_for_status,
                                  FELIX_STATUS_DIR, get_endpoint_id_from_key,
                                  dir_for_felix_status, ENDPOINT_STATUS_ERROR,
@@ -450,31 +451,47 @@ class _FelixEtcdWatcher(EtcdWatcher, gevent.Greenlet):
         self.ipv4_by_hostname.clear()
         still_ready = False
         for child in etcd_snapshot_response.children:
-            profile_id, rules = parse_if_rules(child)
-            if profile_id:
-                rules_by_id[profile_id] = rules
-                continue
-            profile_id, tags = parse_if_tags(child)
-            if profile_id:
-                tags_by_id[profile_id] = tags
-                continue
-            endpoint_id, endpoint = parse_if_endpoint(self._config, child)
-            if endpoint_id and endpoint:
-                endpoints_by_id[endpoint_id] = endpoint
-                self.endpoint_ids_per_host[endpoint_id.host].add(endpoint_id)
-                continue
-            pool_id, pool = parse_if_ipam_v4_pool(child)
-            if pool_id and pool:
-                ipv4_pools_by_id[pool_id] = pool
-                continue
-            if self._config.IP_IN_IP_ENABLED:
-                hostname, ip = parse_if_host_ip(child)
-                if hostname and ip:
-                    self.ipv4_by_hostname[hostname] = ip
-                    continue
-
-            # Double-check the flag hasn't changed since we read it before.
-            if child.key == READY_KEY:
+            # Classify the key once rather than trying each kind in turn.
+            key = parse_key(child.key)
+            kind = key.kind if key is not None else None
+            deleted = child.action == "delete"
+            if kind == KIND_RULES:
+                profile_id = intern(key.id.encode("utf8"))
+                if deleted:
+                    rules_by_id[profile_id] = None
+                else:
+                    rules_by_id[profile_id] = parse_rules(profile_id,
+                                                          child.value)
+            elif kind == KIND_TAGS:
+                profile_id = intern(key.id.encode("utf8"))
+                if deleted:
+                    tags_by_id[profile_id] = None
+                else:
+                    tags_by_id[profile_id] = parse_tags(profile_id,
+                                                        child.value)
+            elif kind == KIND_ENDPOINT:
+                if deleted:
+                    _log.debug("Found deleted endpoint %s", key.id)
+                else:
+                    endpoint = parse_endpoint(self._config, key.id,
+                                              child.value)
+                    if endpoint:
+                        # EndpointId does the interning for us.
+                        endpoints_by_id[key.id] = endpoint
+                        self.endpoint_ids_per_host[key.id.host].add(key.id)
+            elif kind == KIND_IPAM_V4_POOL:
+                if not deleted:
+                    pool = parse_ipam_pool(key.id, child.value)
+                    if pool:
+                        ipv4_pools_by_id[key.id] = pool
+            elif kind == KIND_HOST_IP:
+                if self._config.IP_IN_IP_ENABLED and not deleted:
+                    ip = parse_host_ip(key.id, child.value)
+                    if ip:
+                        self.ipv4_by_hostname[key.id] = ip
+            elif child.key == READY_KEY:
+                # Double-check the flag hasn't changed since we read it
+                # before.
                 if child.value == "true":
                     still_ready = True
                 else:
@@ -894,20 +911,6 @@ json_decoder = json.JSONDecoder(
 )
 
 
-def parse_if_endpoint(config, etcd_node):
-    combined_id = get_endpoint_id_from_key(etcd_node.key)
-    if combined_id:
-        # Got an endpoint.
-        if etcd_node.action == "delete":
-            _log.debug("Found deleted endpoint %s", combined_id)
-            endpoint = None
-        else:
-            endpoint = parse_endpoint(config, combined_id, etcd_node.value)
-        # EndpointId does the interning for us.
-        return combined_id, endpoint
-    return None, None
-
-
 def parse_endpoint(config, combined_id, raw_json):
     endpoint = safe_decode_json(raw_json,
                                 log_tag="endpoint %s" % combined_id.endpoint)
@@ -922,19 +925,6 @@ def parse_endpoint(config, combined_id, raw_json):
     return endpoint
 
 
-def parse_if_rules(etcd_node):
-    m = RULES_KEY_RE.match(etcd_node.key)
-    if m:
-        # Got some rules.
-        profile_id = m.group("profile_id")
-        if etcd_node.action == "delete":
-            rules = None
-        else:
-            rules = parse_rules(profile_id, etcd_node.value)
-        return intern(profile_id.encode("utf8")), rules
-    return None, None
-
-
 def parse_rules(profile_id, raw_json):
     rules = safe_decode_json(raw_json, log_tag="rules %s" % profile_id)
     try:
@@ -947,19 +937,6 @@ def parse_rules(profile_id, raw_json):
         return rules
 
 
-def parse_if_tags(etcd_node):
-    m = TAGS_KEY_RE.match(etcd_node.key)
-    if m:
-        # Got some tags.
-        profile_id = m.group("profile_id")
-        if etcd_node.action == "delete":
-            tags = None
-        else:
-            tags = parse_tags(profile_id, etcd_node.value)
-        return intern(profile_id.encode("utf8")), tags
-    return None, None
-
-
 def parse_tags(profile_id, raw_json):
     tags = safe_decode_json(raw_json, log_tag="tags %s" % profile_id)
     try:
@@ -974,19 +951,6 @@ def parse_tags(profile_id, raw_json):
         return intern_list(tags)
 
 
-def parse_if_host_ip(etcd_node):
-    m = HOST_IP_KEY_RE.match(etcd_node.key)
-    if m:
-        # Got some rules.
-        hostname = m.group("hostname")
-        if etcd_node.action == "delete":
-            ip = None
-        else:
-            ip = parse_host_ip(hostname, etcd_node.value)
-        return hostname, ip
-    return None, None
-
-
 def parse_host_ip(hostname, raw_value):
     if raw_value is None or validate_ip_addr(raw_value):
         return canonicalise_ip(raw_value, None)
@@ -995,19 +959,6 @@ def parse_host_ip(hostname, raw_value):
         return None
 
 
-def parse_if_ipam_v4_pool(etcd_node):
-    m = IPAM_V4_CIDR_KEY_RE.match(etcd_node.key)
-    if m:
-        # Got some rules.
-        pool_id = m.group("encoded_cidr")
-        if etcd_node.action == "delete":
-            pool = None
-        else:
-            pool = parse_ipam_pool(pool_id, etcd_node.value)
-        return pool_id, pool
-    return None, None
-
-
 def parse_ipam_pool(pool_id, raw_json):
     pool = safe_decode_json(raw_json, log_tag="ipam pool %s" % pool_id)
     try:
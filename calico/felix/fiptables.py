@@ -25,17 +25,18 @@ import random
 import time
 import itertools
 import re
+import shlex
 
-from gevent import subprocess
 import gevent
 import sys
 
 from calico.felix import frules, futils
 from calico.felix.actor import (
-    Actor, actor_message, ResultOrExc, SplitBatchAndRetry
+    Actor, actor_message, FailMessagesAndRetry, ResultOrExc,
+    SplitBatchAndRetry
 )
 from calico.felix.frules import FELIX_PREFIX
-from calico.felix.futils import FailedSystemCall, StatCounter
+from calico.felix.futils import FailedSystemCall, StatCounter, StatHistogram
 
 _log = logging.getLogger(__name__)
 
@@ -68,7 +69,11 @@ class IptablesUpdater(Actor):
     are on the queue in one atomic batch. This is dramatically faster than
     issuing single iptables requests.
 
-    If a request fails, it does a binary chop using the SplitBatchAndRetry
+    If a request fails, it uses the line number reported by
+    ip(6)tables-restore to find the request that wrote the failing chain,
+    fails that request and retries the rest of the batch in one go (using
+    the FailMessagesAndRetry mechanism).  If the failure can't be traced to
+    a request, it falls back to a binary chop using the SplitBatchAndRetry
     mechanism to report the error to the correct request.
 
     Dependency tracking
@@ -102,6 +107,7 @@ class IptablesUpdater(Actor):
                                                         (ip_version, table))
         self.table = table
         self.refresh_interval = config.REFRESH_INTERVAL
+        self.detect_lock_contention = config.IPTABLES_LOCK_DETECTION
         if ip_version == 4:
             self._restore_cmd = "iptables-restore"
             self._save_cmd = "iptables-save"
@@ -121,6 +127,14 @@ class IptablesUpdater(Actor):
         """
         Flag that is set after the graceful restart window is over.
         """
+        self._chain_contents_in_dataplane = {}
+        """
+        Map from chain name to normalized content (see _normalize_rule()) for
+        the chains that were in the dataplane at start of day and that we
+        haven't since touched.  Used to adopt, rather than rewrite, chains
+        that already have the right content during the graceful restart
+        window.
+        """
 
         self._programmed_chain_contents = {}
         """Map from chain name to chain contents, only contains chains that
@@ -138,6 +152,10 @@ class IptablesUpdater(Actor):
         self._requiring_chains = defaultdict(set)
         """Map from chain to the set of chains that depend on it.
         Inverse of self.required_chains."""
+        self._shared_chains = set()
+        """Set of content-addressed chains that are shared between their
+        referrers.  These are deleted automatically once nothing depends
+        on them."""
 
         # Since it's fairly complex to keep track of the changes required
         # for a particular batch and still be able to roll-back the changes
@@ -148,10 +166,17 @@ class IptablesUpdater(Actor):
         for this batch."""
         self._completion_callbacks = None
         """List of callbacks to issue once the current batch completes."""
+        self._msgs_by_chain = None
+        """Map from chain name to the message in the current batch that
+        last updated or deleted that chain."""
+        self._callbacks_by_msg = None
+        """Map from message to its completion callback."""
 
         # Diagnostic counters.
         self._stats = StatCounter("IPv%s %s iptables updater" %
                                   (ip_version, table))
+        self._histograms = StatHistogram("IPv%s %s iptables-restore" %
+                                         (ip_version, table))
 
         # Avoid duplicating init logic.
         self._reset_batched_work()
@@ -172,8 +197,11 @@ class IptablesUpdater(Actor):
         """Reset the per-batch state in preparation for a new batch."""
         self._txn = _Transaction(self._programmed_chain_contents,
                                  self._required_chains,
-                                 self._requiring_chains)
+                                 self._requiring_chains,
+                                 self._shared_chains)
         self._completion_callbacks = []
+        self._msgs_by_chain = {}
+        self._callbacks_by_msg = {}
 
     @actor_message(needs_own_batch=True)
     def _load_chain_names_from_iptables(self):
@@ -183,10 +211,16 @@ class IptablesUpdater(Actor):
         Populates self._chains_in_dataplane.
         """
         self._stats.increment("Refreshed chain list")
-        raw_ipt_output = subprocess.check_output([self._save_cmd, "--table",
-                                                  self.table])
+        raw_ipt_output = futils.check_output([self._save_cmd, "--table",
+                                              self.table])
         self._chains_in_dataplane = _extract_our_chains(self.table,
                                                         raw_ipt_output)
+        if not self._grace_period_finished:
+            # Remember the existing content so that we can adopt chains
+            # that the previous Felix process left in the right state.
+            self._chain_contents_in_dataplane = _extract_our_chain_contents(
+                self.table, raw_ipt_output
+            )
 
     def _get_unreferenced_chains(self):
         """
@@ -195,13 +229,13 @@ class IptablesUpdater(Actor):
         :returns list[str]: list of chains currently in the dataplane that
             are not referenced by other chains.
         """
-        raw_ipt_output = subprocess.check_output(
+        raw_ipt_output = futils.check_output(
             [self._iptables_cmd, "--wait", "--list", "--table", self.table])
         return _extract_our_unreffed_chains(raw_ipt_output)
 
     @actor_message()
     def rewrite_chains(self, update_calls_by_chain,
-                       dependent_chains, callback=None):
+                       dependent_chains, callback=None, shared_chains=None):
         """
         Atomically apply a set of updates to the table.
 
@@ -212,6 +246,11 @@ class IptablesUpdater(Actor):
         :param dependent_chains: map from chain name to a set of chains
                that that chain requires to exist. They will be created
                (with a default drop) if they don't exist.
+        :param shared_chains: optional map from chain name to update calls
+               for chains that are named after their contents and shared
+               between the chains in update_calls_by_chain.  A shared chain
+               is only written if it is not already programmed and it is
+               deleted automatically once no chain depends on it.
         :raises FailedSystemCall if a problem occurred.
         """
         # We actually apply the changes in _finish_msg_batch().  Index the
@@ -220,13 +259,24 @@ class IptablesUpdater(Actor):
         _log.debug("iptables update: %s", update_calls_by_chain)
         _log.debug("iptables deps: %s", dependent_chains)
         self._stats.increment("Chain rewrites")
+        for chain, updates in (shared_chains or {}).iteritems():
+            if self._txn.store_shared_chain(chain,
+                                            ["--flush %s" % chain] + updates):
+                # Only the message that writes the chain is to blame if
+                # it fails, not those that reuse it.
+                self._msgs_by_chain[chain] = self._current_msg
+                self._stats.increment("Shared chains written")
+            else:
+                self._stats.increment("Shared chains reused")
         for chain, updates in update_calls_by_chain.iteritems():
             # TODO: double-check whether this flush is needed.
             updates = ["--flush %s" % chain] + updates
             deps = dependent_chains.get(chain, set())
             self._txn.store_rewrite_chain(chain, updates, deps)
+            self._msgs_by_chain[chain] = self._current_msg
         if callback:
             self._completion_callbacks.append(callback)
+            self._callbacks_by_msg[self._current_msg] = callback
 
     # Does direct table manipulation, forbid batching with other messages.
     @actor_message(needs_own_batch=True)
@@ -358,8 +408,10 @@ class IptablesUpdater(Actor):
         self._stats.increment("Chain deletes")
         for chain in chain_names:
             self._txn.store_delete(chain)
+            self._msgs_by_chain[chain] = self._current_msg
         if callback:
             self._completion_callbacks.append(callback)
+            self._callbacks_by_msg[self._current_msg] = callback
 
     # It's much simpler to do cleanup in its own batch so that it doesn't have
     # to worry about in-flight updates.
@@ -391,6 +443,7 @@ class IptablesUpdater(Actor):
             except NothingToDo:
                 pass
             self._grace_period_finished = True
+            self._chain_contents_in_dataplane = {}
 
         # Now the generic cleanup, look for chains that we're not expecting to
         # be there and delete them.
@@ -469,6 +522,7 @@ class IptablesUpdater(Actor):
 
     def _finish_msg_batch(self, batch, results):
         start = time.time()
+        input_lines = None
         try:
             # We use two passes to update the dataplane.  In the first pass,
             # we make any updates, create new chains and replace to-be-deleted
@@ -497,10 +551,22 @@ class IptablesUpdater(Actor):
                 final_result = ResultOrExc(None, e)
                 results[0] = final_result
             else:
+                culprit = self._find_culprit_msg(batch, input_lines, e)
+                if culprit is None:
+                    _log.error("Non-retryable error from a combined batch, "
+                               "splitting the batch to narrow down culprit.")
+                    self._stats.increment("Split batch due to error")
+                    raise SplitBatchAndRetry()
                 _log.error("Non-retryable error from a combined batch, "
-                           "splitting the batch to narrow down culprit.")
-                self._stats.increment("Split batch due to error")
-                raise SplitBatchAndRetry()
+                           "caused by %s; failing it and retrying the rest "
+                           "of the batch.", culprit)
+                self._stats.increment("Messages failed due to iptables "
+                                      "error")
+                self._stats.increment("Batch retried without culprit")
+                callback = self._callbacks_by_msg.get(culprit)
+                if callback:
+                    callback(e)
+                raise FailMessagesAndRetry({batch.index(culprit): e})
         else:
             # Modify succeeded, update our indexes for next time.
             self._update_indexes()
@@ -532,6 +598,26 @@ class IptablesUpdater(Actor):
         end = time.time()
         _log.debug("Batch time: %.2f %s", end - start, len(batch))
 
+    def _find_culprit_msg(self, batch, input_lines, e):
+        """
+        Uses the line number in an ip(6)tables-restore error to find the
+        message that wrote the failing chain.
+
+        :returns Message|None: the message in the batch that caused the
+            failure or None if the failure couldn't be traced to a single
+            message.
+        """
+        if input_lines is None or not isinstance(e, FailedSystemCall):
+            return None
+        line_number = _ipt_restore_failed_line_number(e.stderr or "")
+        if line_number is None or not 0 < line_number <= len(input_lines):
+            return None
+        chain = _chain_from_ipt_line(input_lines[line_number - 1])
+        msg = self._msgs_by_chain.get(chain)
+        if msg is None or msg not in batch:
+            return None
+        return msg
+
     def _delete_best_effort(self, chains):
         """
         Try to delete all the chains in the input list. Any errors are silently
@@ -593,6 +679,7 @@ class IptablesUpdater(Actor):
         self._programmed_chain_contents = self._txn.prog_chains
         self._required_chains = self._txn.required_chns
         self._requiring_chains = self._txn.requiring_chns
+        self._shared_chains = self._txn.shared_chains
 
     def _calculate_ipt_modify_input(self):
         """
@@ -639,9 +726,18 @@ class IptablesUpdater(Actor):
 
         # Now add the actual chain updates.
         for chain, chain_updates in self._txn.updates.iteritems():
+            if self._chain_already_programmed(chain, chain_updates):
+                _log.debug("Adopting existing chain %s", chain)
+                self._stats.increment("Chains adopted")
+                continue
+            self._stats.increment("Chains rewritten")
             modified_chains.add(chain)
             input_lines.extend(chain_updates)
 
+        # Once we've touched a chain, its start-of-day content is stale.
+        for chain in modified_chains:
+            self._chain_contents_in_dataplane.pop(chain, None)
+
         # Finally, prepend the input with instructions that do an idempotent
         # create-and-flush operation for the chains that we need to create or
         # rewrite.
@@ -651,6 +747,23 @@ class IptablesUpdater(Actor):
             raise NothingToDo
         return ["*%s" % self.table] + input_lines + ["COMMIT"]
 
+    def _chain_already_programmed(self, chain, chain_updates):
+        """
+        :returns bool: True if we're in the graceful restart window and the
+            dataplane already contains the given chain with exactly the
+            content of chain_updates (after normalization).
+        """
+        if (self._grace_period_finished or self._txn.refresh or
+                chain not in self._chain_contents_in_dataplane):
+            return False
+        try:
+            normalized = [_normalize_rule(u)[1] for u in chain_updates
+                          if not u.startswith("--flush ")]
+        except ValueError:
+            _log.warning("Failed to normalize rules for chain %s", chain)
+            return False
+        return normalized == self._chain_contents_in_dataplane[chain]
+
     def _calculate_ipt_delete_input(self, chains):
         """
         Calculate the input for phase 2 of a batch, where we actually
@@ -693,64 +806,99 @@ class IptablesUpdater(Actor):
     def _execute_iptables(self, input_lines, fail_log_level=logging.ERROR):
         """
         Runs ip(6)tables-restore with the given input.  Retries iff
-        the COMMIT fails.
+        the COMMIT fails (or, if lock contention detection is enabled,
+        if another process is holding the xtables lock).
 
         :raises FailedSystemCall: if the command fails on a non-commit
             line or if it repeatedly fails and retries are exhausted.
         """
         backoff = 0.01
         num_tries = 0
+        num_retries = 0
+        num_lock_failures = 0
+        total_backoff = 0
         success = False
-        while not success:
-            input_str = "\n".join(input_lines) + "\n"
-            _log.debug("%s input:\n%s", self._restore_cmd, input_str)
-
-            # Run iptables-restore in noflush mode so that it doesn't
-            # blow away all the tables we're not touching.
-            cmd = [self._restore_cmd, "--noflush", "--verbose"]
-            try:
-                futils.check_call(cmd, input_str=input_str)
-            except FailedSystemCall as e:
-                # Parse the output to determine if error is retryable.
-                retryable, detail = _parse_ipt_restore_error(input_lines,
-                                                             e.stderr)
-                num_tries += 1
-                if retryable:
-                    if num_tries < MAX_IPT_RETRIES:
-                        _log.info("%s failed with retryable error. Retry in "
-                                  "%.2fs", self._iptables_cmd, backoff)
-                        self._stats.increment("iptables commit failure "
-                                              "(retryable)")
-                        gevent.sleep(backoff)
-                        if backoff > MAX_IPT_BACKOFF:
-                            backoff = MAX_IPT_BACKOFF
-                        backoff *= (1.5 + random.random())
-                        continue
+        self._histograms.record("Input lines", len(input_lines))
+        try:
+            while not success:
+                input_str = "\n".join(input_lines) + "\n"
+                _log.debug("%s input:\n%s", self._restore_cmd, input_str)
+
+                # Run iptables-restore in noflush mode so that it doesn't
+                # blow away all the tables we're not touching.
+                cmd = [self._restore_cmd, "--noflush", "--verbose"]
+                start_time = time.time()
+                try:
+                    futils.check_call(cmd, input_str=input_str)
+                except FailedSystemCall as e:
+                    self._histograms.record(
+                        "Restore time (ms)",
+                        (time.time() - start_time) * 1000
+                    )
+                    # Parse the output to determine if error is retryable.
+                    if (self.detect_lock_contention and
+                            _xtables_lock_held(e.stderr)):
+                        retryable = True
+                        detail = "xtables lock held by another process."
+                        num_lock_failures += 1
+                        failure_stat = ("iptables commit failure "
+                                        "(xtables lock held)")
+                    else:
+                        retryable, detail = _parse_ipt_restore_error(
+                            input_lines, e.stderr
+                        )
+                        failure_stat = "iptables commit failure (retryable)"
+                    num_tries += 1
+                    if retryable:
+                        if num_tries < MAX_IPT_RETRIES:
+                            _log.info("%s failed with retryable error: %s "
+                                      "Retry in %.2fs", self._iptables_cmd,
+                                      detail, backoff)
+                            self._stats.increment(failure_stat)
+                            gevent.sleep(backoff)
+                            total_backoff += backoff
+                            num_retries += 1
+                            if backoff > MAX_IPT_BACKOFF:
+                                backoff = MAX_IPT_BACKOFF
+                            backoff *= (1.5 + random.random())
+                            continue
+                        else:
+                            _log.log(
+                                fail_log_level,
+                                "Failed to run %s.  Out of retries: %s.\n"
+                                "Output:\n%s\n"
+                                "Error:\n%s\n"
+                                "Input was:\n%s",
+                                self._restore_cmd, detail, e.stdout, e.stderr,
+                                input_str)
+                            self._stats.increment("iptables commit failure "
+                                                  "(out of retries)")
                     else:
                         _log.log(
                             fail_log_level,
-                            "Failed to run %s.  Out of retries: %s.\n"
+                            "%s failed with non-retryable error: %s.\n"
                             "Output:\n%s\n"
                             "Error:\n%s\n"
                             "Input was:\n%s",
                             self._restore_cmd, detail, e.stdout, e.stderr,
                             input_str)
-                        self._stats.increment("iptables commit failure "
-                                              "(out of retries)")
+                        self._stats.increment("iptables non-retryable "
+                                              "failure")
+                    raise
                 else:
-                    _log.log(
-                        fail_log_level,
-                        "%s failed with non-retryable error: %s.\n"
-                        "Output:\n%s\n"
-                        "Error:\n%s\n"
-                        "Input was:\n%s",
-                        self._restore_cmd, detail, e.stdout, e.stderr,
-                        input_str)
-                    self._stats.increment("iptables non-retryable failure")
-                raise
-            else:
-                self._stats.increment("iptables success")
-                success = True
+                    self._histograms.record(
+                        "Restore time (ms)",
+                        (time.time() - start_time) * 1000
+                    )
+                    self._stats.increment("iptables success")
+                    success = True
+        finally:
+            self._histograms.record("Retries per commit", num_retries)
+            self._histograms.record("Backoff time (ms)",
+                                    total_backoff * 1000)
+            if self.detect_lock_contention:
+                self._histograms.record("xtables lock failures per commit",
+                                        num_lock_failures)
 
 
 class _Transaction(object):
@@ -771,7 +919,8 @@ class _Transaction(object):
     def __init__(self,
                  old_prog_chain_contents,
                  old_deps,
-                 old_requiring_chains):
+                 old_requiring_chains,
+                 old_shared_chains=frozenset()):
         # Figure out what stub chains should already be present.
         old_required_chains = set(old_requiring_chains.keys())
         old_explicitly_programmed_chains = set(old_prog_chain_contents.keys())
@@ -787,6 +936,7 @@ class _Transaction(object):
         self.prog_chains = old_prog_chain_contents.copy()
         self.required_chns = copy.deepcopy(old_deps)
         self.requiring_chns = copy.deepcopy(old_requiring_chains)
+        self.shared_chains = set(old_shared_chains)
 
         # Memoized values of the properties below.  See chains_to_stub(),
         # affected_chains() and chains_to_delete() below.
@@ -831,6 +981,31 @@ class _Transaction(object):
         self.prog_chains[chain] = updates
         self._invalidate_cache()
 
+    def store_shared_chain(self, chain, updates):
+        """
+        Records that the given content-addressed chain is required.  Since
+        the chain's name is derived from its contents, the chain is only
+        rewritten if it isn't already programmed.
+
+        The shared chain is deleted automatically when the last chain that
+        depends on it is rewritten or deleted.  Callers should therefore
+        store the rewrite of the referring chain in the same transaction.
+
+        :returns bool: True if the chain needs to be written.
+        """
+        assert chain is not None
+        assert updates is not None
+        self.shared_chains.add(chain)
+        if chain in self.prog_chains:
+            _log.debug("Shared chain %s already programmed", chain)
+            return False
+        _log.debug("Storing new shared chain %s", chain)
+        self.explicit_deletes.discard(chain)
+        self.updates[chain] = updates
+        self.prog_chains[chain] = updates
+        self._invalidate_cache()
+        return True
+
     def store_refresh(self):
         """
         Records that we should refresh all chains as part of this transaction.
@@ -860,6 +1035,15 @@ class _Transaction(object):
             self.required_chns[chain] = new_deps
         else:
             self.required_chns.pop(chain, None)
+        # Shared chains are only kept alive by their referrers; delete any
+        # that we just removed the last reference to.
+        for dependency in old_deps - set(new_deps):
+            if (dependency in self.shared_chains and
+                    dependency not in self.requiring_chns):
+                _log.debug("Shared chain %s no longer referenced",
+                           dependency)
+                self.shared_chains.discard(dependency)
+                self.store_delete(dependency)
 
     def _invalidate_cache(self):
         self._chains_to_stub = None
@@ -960,6 +1144,139 @@ def _extract_our_chains(table, raw_ipt_save_output):
     return chains
 
 
+def _extract_our_chain_contents(table, raw_ipt_save_output):
+    """
+    Parses the output from iptables-save to extract the normalized
+    content of the felix-programmed chains.
+
+    :returns dict[str,list[tuple]]: map from chain name to list of
+        normalized rules.  Chains whose rules can't be parsed are omitted.
+    """
+    contents = {}
+    unparseable = set()
+    current_table = None
+    for line in raw_ipt_save_output.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            current_table = line[1:]
+        elif current_table != table:
+            continue
+        elif line.startswith(":"):
+            chain = line[1:line.index(" ")]
+            if chain.startswith(FELIX_PREFIX):
+                contents[chain] = []
+        elif line.startswith("-A "):
+            try:
+                chain, rule = _normalize_rule(line)
+            except ValueError:
+                _log.warning("Failed to parse iptables-save line %r", line)
+                unparseable.add(line.split()[1])
+            else:
+                if chain in contents:
+                    contents[chain].append(rule)
+    for chain in unparseable:
+        contents.pop(chain, None)
+    return contents
+
+
+# Map from long-form option to the short form that iptables-save uses.
+_SHORT_OPTS = {
+    "--append": "-A",
+    "--source": "-s",
+    "--destination": "-d",
+    "--in-interface": "-i",
+    "--out-interface": "-o",
+    "--protocol": "-p",
+    "--jump": "-j",
+    "--goto": "-g",
+    "--match": "-m",
+    "--source-ports": "--sports",
+    "--destination-ports": "--dports",
+}
+# Options that take two arguments.
+_TWO_ARG_OPTS = set(["--match-set"])
+# Options that take no arguments.
+_NO_ARG_OPTS = set(["--invert"])
+_PROTOCOL_ALIASES = {
+    "icmpv6": "ipv6-icmp",
+}
+# Map from (normalized) protocol to the match module that iptables-save
+# adds after "-p <protocol>".
+_IMPLICIT_PROTOCOL_MODULES = {
+    "tcp": "tcp",
+    "udp": "udp",
+    "sctp": "sctp",
+    "icmp": "icmp",
+    "ipv6-icmp": "icmp6",
+}
+
+
+def _normalize_rule(line):
+    """
+    Normalizes an "--append" rule, either as we render it or as
+    iptables-save reports it, so that the two can be compared.
+
+    iptables-save uses short options, adds the implicit match module for
+    the rule's protocol, makes host addresses into /32s, and reformats
+    marks.  Since matches are
+    ANDed together, their order doesn't matter, so they are sorted.
+    Rules that normalize differently are simply rewritten, so the
+    normalization only needs to be exact for the rules that we generate.
+
+    :returns tuple[str,tuple]: the chain name and the normalized rule.
+    :raises ValueError: if the line can't be parsed.
+    """
+    words = shlex.split(line)
+    if len(words) < 2 or _SHORT_OPTS.get(words[0], words[0]) != "-A":
+        raise ValueError("Not an append: %r" % line)
+    chain = words[1]
+    options = []
+    negate = False
+    i = 2
+    while i < len(words):
+        opt = _SHORT_OPTS.get(words[i], words[i])
+        if opt == "!":
+            negate = True
+            i += 1
+            continue
+        if not opt.startswith("-"):
+            raise ValueError("Unexpected word %r in %r" % (opt, line))
+        if opt in _NO_ARG_OPTS:
+            values = ()
+        elif opt in _TWO_ARG_OPTS:
+            values = tuple(words[i + 1:i + 3])
+        else:
+            values = tuple(words[i + 1:i + 2])
+        if opt not in _NO_ARG_OPTS and not values:
+            raise ValueError("Missing value for %s in %r" % (opt, line))
+        i += 1 + len(values)
+        if opt in ("-s", "-d") and "/" not in values[0]:
+            values = (values[0] + ("/128" if ":" in values[0] else "/32"),)
+        elif opt == "-p":
+            values = (_PROTOCOL_ALIASES.get(values[0], values[0]),)
+        elif opt in ("--ctstate", "--dports", "--sports"):
+            values = (",".join(sorted(values[0].split(","))),)
+        elif opt == "--mac-source":
+            values = (values[0].lower(),)
+        elif opt in ("--set-mark", "--set-xmark", "--mark"):
+            value, _, mask = values[0].partition("/")
+            if not mask:
+                mask = "0xffffffff"
+            values = ("%#x/%#x" % (int(value, 0), int(mask, 0)),)
+            if opt == "--set-mark":
+                opt = "--set-xmark"
+        options.append((negate, opt) + values)
+        negate = False
+    # Drop the protocol's match module, which is only sometimes explicit.
+    # Other modules are kept since their options can be ambiguous, for
+    # example "--mark" is used by both "mark" and "connmark".
+    protocols = [o[2] for o in options if o[:2] == (False, "-p")]
+    if len(protocols) == 1 and protocols[0] in _IMPLICIT_PROTOCOL_MODULES:
+        implicit = (False, "-m", _IMPLICIT_PROTOCOL_MODULES[protocols[0]])
+        options = [o for o in options if o != implicit]
+    return chain, tuple(sorted(options))
+
+
 def _extract_our_unreffed_chains(raw_ipt_output):
     """
     Parses the output from "ip(6)tables --list" to find the set of
@@ -996,16 +1313,15 @@ def _parse_ipt_restore_error(input_lines, err):
     :return tuple[bool,str]: tuple, the first (bool) element indicates
         whether the error is retryable; the second is a detail message.
     """
-    match = re.search(r"line (\d+) failed", err)
-    if match:
+    line_number = _ipt_restore_failed_line_number(err)
+    if line_number is not None:
         # Have a line number, work out if this was a commit
         # failure, which is caused by concurrent access and is
         # retryable.
-        line_number = int(match.group(1))
         _log.debug("ip(6)tables-restore failure on line %s", line_number)
         line_index = line_number - 1
         offending_line = input_lines[line_index]
-        if offending_line.strip == "COMMIT":
+        if offending_line.strip() == "COMMIT":
             return True, "COMMIT failed; likely concurrent access."
         else:
             return False, "Line %s failed: %s" % (line_number, offending_line)
@@ -1013,6 +1329,44 @@ def _parse_ipt_restore_error(input_lines, err):
         return False, "ip(6)tables-restore failed with output: %s" % err
 
 
+def _ipt_restore_failed_line_number(err):
+    """
+    :param str err: captures stderr from iptables-restore.
+    :return int|None: the (1-based) number of the input line that
+        iptables-restore reported as failing, or None if there wasn't one.
+    """
+    match = re.search(r"line (\d+) failed", err)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def _chain_from_ipt_line(line):
+    """
+    :param str line: a line of iptables-restore input.
+    :return str|None: the name of the chain that the line operates on or
+        None if the line doesn't operate on a chain.
+    """
+    words = line.split()
+    if not words:
+        return None
+    if words[0].startswith(":"):
+        return words[0][1:]
+    if words[0] in ("--append", "-A", "--flush", "-F", "--insert", "-I",
+                    "--delete-chain", "-X") and len(words) > 1:
+        return words[1]
+    return None
+
+
+def _xtables_lock_held(err):
+    """
+    :param str err: captures stderr from iptables-restore.
+    :return bool: True if iptables-restore failed because another process
+        (such as docker or kube-proxy) was holding the xtables lock.
+    """
+    return "xtables lock" in err
+
+
 class NothingToDo(Exception):
     pass
 
@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.fnftables
+~~~~~~~~~~~~~~~
+
+nftables dataplane backend.
+
+The rest of Felix renders its policy as iptables-restore fragments.  The
+NftablesUpdater is a drop-in replacement for the IptablesUpdater that
+translates each iptables-restore transaction into an nftables script and
+applies it, atomically, with "nft -f".  Each iptables table maps to an
+nftables table of our own (for example, "felix-filter" in the "ip" family)
+containing base chains that hook into the kernel at the same points as
+the corresponding iptables built-in chains.
+
+Runs of dispatch rules (an exact interface match and a goto) are collapsed
+into a verdict map so that dispatch is a single lookup.  "--match-set"
+matches become references to native nftables sets, which are programmed by
+NftSet, a replacement for ipsets.Ipset.
+"""
+import logging
+import re
+import shlex
+import time
+
+from calico.felix import futils
+from calico.felix.actor import actor_message
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.frules import FELIX_PREFIX
+from calico.felix.futils import FailedSystemCall
+from calico.felix.ipsets import Ipset
+
+_log = logging.getLogger(__name__)
+
+NFT_FAMILY = {4: "ip", 6: "ip6"}
+NFT_ADDR_KEYWORD = {4: "ip", 6: "ip6"}
+NFT_TABLE_PREFIX = FELIX_PREFIX
+
+# Base chains, in the order that they're declared, for each iptables table:
+# (chain name, chain type, hook, priority).
+NFT_BASE_CHAINS = {
+    "filter": [
+        ("INPUT", "filter", "input", 0),
+        ("FORWARD", "filter", "forward", 0),
+        ("OUTPUT", "filter", "output", 0),
+    ],
+    "nat": [
+        ("PREROUTING", "nat", "prerouting", -100),
+        ("INPUT", "nat", "input", 100),
+        ("OUTPUT", "nat", "output", -100),
+        ("POSTROUTING", "nat", "postrouting", 100),
+    ],
+    "raw": [
+        ("PREROUTING", "filter", "prerouting", -300),
+        ("OUTPUT", "filter", "output", -300),
+    ],
+}
+
+# The tables that Felix programs for each IP version.  NftSets are written
+# to all of them since nftables sets are local to a table.
+NFT_TABLES_BY_IP_VERSION = {
+    4: ["filter", "nat"],
+    6: ["filter", "raw"],
+}
+
+_VERDICTS = {
+    "ACCEPT": "accept",
+    "DROP": "drop",
+    "RETURN": "return",
+}
+_PROTOCOLS = {
+    "icmpv6": "ipv6-icmp",
+    "ipencap": "4",
+}
+_CHAIN_RE = re.compile(r'^\s*chain (\S+) \{')
+_SET_RE = re.compile(r'^\s*set (\S+) \{')
+_JUMP_RE = re.compile(r'\b(?:jump|goto) ([^\s,}]+)')
+
+
+def nft_table_name(table):
+    return NFT_TABLE_PREFIX + table
+
+
+def _table_spec(table, ip_version):
+    return "%s %s" % (NFT_FAMILY[ip_version], nft_table_name(table))
+
+
+def _all_table_specs():
+    """
+    :returns list[str]: specs of all the tables that we program, for both
+        IP versions.
+    """
+    return [_table_spec(table, ip_version)
+            for ip_version, tables in sorted(NFT_TABLES_BY_IP_VERSION.items())
+            for table in tables]
+
+
+def _iface_pattern(iface):
+    # iptables uses "+" as its interface wildcard; nftables uses "*".
+    if iface.endswith("+"):
+        iface = iface[:-1] + "*"
+    return '"%s"' % iface
+
+
+def _port_spec(ports):
+    ports = [p.replace(":", "-") for p in ports.split(",")]
+    if len(ports) == 1:
+        return ports[0]
+    return "{ %s }" % ", ".join(ports)
+
+
+def translate_rule(fragment, ip_version):
+    """
+    Translates the body of an iptables rule (with the "--append <chain>"
+    removed) into the equivalent nftables rule.
+
+    Only the matches and targets that Felix generates are supported.
+
+    :param str fragment: iptables rule body, for example
+        "--protocol tcp --dport 80 --jump ACCEPT".
+    :param int ip_version: 4 or 6.
+    :returns str: nftables rule body, for example
+        "meta l4proto tcp tcp dport 80 accept".
+    :raises UnsupportedRuleFragment: if the fragment can't be translated.
+    """
+    words = shlex.split(fragment)
+    addr = NFT_ADDR_KEYWORD[ip_version]
+    matches = []
+    statements = []
+    verdict = None
+    comment = None
+    protocol = None
+    negate = False
+    i = 0
+
+    def arg(offset=1):
+        try:
+            return words[i + offset]
+        except IndexError:
+            raise UnsupportedRuleFragment(fragment)
+
+    def op():
+        return "!= " if negate else ""
+
+    while i < len(words):
+        word = words[i]
+        if word == "!":
+            negate = True
+            i += 1
+            continue
+        if word in ("--protocol", "-p"):
+            protocol = arg()
+            matches.append("meta l4proto %s%s" %
+                           (op(), _PROTOCOLS.get(protocol, protocol)))
+            i += 2
+        elif word in ("--source", "-s", "--destination", "-d"):
+            dirn = "saddr" if word in ("--source", "-s") else "daddr"
+            matches.append("%s %s %s%s" % (addr, dirn, op(), arg()))
+            i += 2
+        elif word in ("--in-interface", "-i", "--out-interface", "-o"):
+            key = "iifname" if word in ("--in-interface", "-i") else "oifname"
+            matches.append("%s %s%s" % (key, op(), _iface_pattern(arg())))
+            i += 2
+        elif word in ("--match", "-m"):
+            # The match module's own options do the work.
+            i += 2
+            continue
+        elif word == "--match-set":
+            dirn = "saddr" if arg(2) == "src" else "daddr"
+            matches.append("%s %s %s@%s" % (addr, dirn, op(), arg()))
+            i += 3
+        elif word in ("--sport", "--dport", "--source-ports",
+                      "--destination-ports"):
+            if protocol not in ("tcp", "udp"):
+                raise UnsupportedRuleFragment(fragment)
+            if word in ("--sport", "--source-ports"):
+                dirn = "sport"
+            else:
+                dirn = "dport"
+            matches.append("%s %s %s%s" % (protocol, dirn, op(),
+                                            _port_spec(arg())))
+            i += 2
+        elif word in ("--icmp-type", "--icmpv6-type"):
+            keyword = "icmp" if word == "--icmp-type" else "icmpv6"
+            parts = arg().split("/")
+            matches.append("%s type %s%s" % (keyword, op(), parts[0]))
+            if len(parts) > 1:
+                matches.append("%s code %s%s" % (keyword, op(), parts[1]))
+            i += 2
+        elif word == "--ctstate":
+            states = arg().lower().split(",")
+            matches.append("ct state %s{ %s }" % (op(), ", ".join(states)))
+            i += 2
+        elif word == "--mark":
+            value, _, mask = arg().partition("/")
+            if mask:
+                matches.append("meta mark & %#x %s %#x" %
+                               (int(mask, 0), "!=" if negate else "==",
+                                int(value, 0)))
+            else:
+                matches.append("meta mark %s%#x" % (op(), int(value, 0)))
+            i += 2
+        elif word == "--mac-source":
+            matches.append("ether saddr %s%s" % (op(), arg().lower()))
+            i += 2
+        elif word == "--invert":
+            # --match rpfilter --invert: the reverse path lookup failed.
+            matches.append("fib saddr . iif oif missing")
+            i += 1
+        elif word == "--comment":
+            comment = arg()
+            i += 2
+        elif word in ("--jump", "-j"):
+            target = arg()
+            if target == "MARK":
+                if arg(2) != "--set-mark":
+                    raise UnsupportedRuleFragment(fragment)
+                statements.append("meta mark set %#x" % int(arg(3), 0))
+                i += 4
+            elif target == "DNAT":
+                if arg(2) != "--to-destination":
+                    raise UnsupportedRuleFragment(fragment)
+                verdict = "dnat to %s" % arg(3)
+                i += 4
+            elif target == "MASQUERADE":
+                verdict = "masquerade"
+                i += 2
+            else:
+                verdict = _VERDICTS.get(target, "jump %s" % target)
+                i += 2
+        elif word in ("--goto", "-g"):
+            verdict = "goto %s" % arg()
+            i += 2
+        else:
+            raise UnsupportedRuleFragment(fragment)
+        negate = False
+
+    parts = matches + statements
+    if verdict:
+        parts.append(verdict)
+    if comment is not None:
+        parts.append('comment "%s"' % comment.replace('"', "'"))
+    return " ".join(parts)
+
+
+def _dispatch_entry(words):
+    """
+    :returns tuple|NoneType: (interface key, interface name, target chain)
+        if the rule is a dispatch rule that can be collapsed into a verdict
+        map (an exact interface match and a goto); None otherwise.
+    """
+    if (len(words) == 4 and
+            words[0] in ("--in-interface", "--out-interface") and
+            not words[1].endswith("+") and
+            words[2] == "--goto"):
+        key = "iifname" if words[0] == "--in-interface" else "oifname"
+        return key, words[1], words[3]
+    return None
+
+
+def ipt_restore_to_nft(input_lines, ip_version):
+    """
+    Translates the input for an iptables-restore call into an nftables
+    script with the same effect.
+
+    :param list[str] input_lines: iptables-restore input, as generated by
+        the IptablesUpdater.
+    :param int ip_version: 4 or 6.
+    :returns list[str]: lines of the nftables script.
+    :raises UnsupportedRuleFragment: if the input can't be translated.
+    """
+    script = []
+    table = None
+    # Pending verdict map entries: (chain, interface key, list of entries).
+    pending_vmap = None
+
+    def flush_vmap():
+        if pending_vmap:
+            chain, key, entries = pending_vmap
+            script.append(
+                "add rule %s %s %s vmap { %s }" % (
+                    _table_spec(table, ip_version), chain, key,
+                    ", ".join('"%s" : goto %s' % e for e in entries)
+                )
+            )
+
+    for line in input_lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("*"):
+            table = line[1:]
+            script.extend(_table_header(table, ip_version))
+            continue
+        if table is None:
+            raise UnsupportedRuleFragment(line)
+        spec = _table_spec(table, ip_version)
+        if line == "COMMIT":
+            flush_vmap()
+            pending_vmap = None
+            table = None
+            continue
+        if line.startswith(":"):
+            # Idempotent create-and-flush.
+            flush_vmap()
+            pending_vmap = None
+            chain = line[1:].split()[0]
+            script.append("add chain %s %s" % (spec, chain))
+            script.append("flush chain %s %s" % (spec, chain))
+            continue
+        command, _, rest = line.partition(" ")
+        if command in ("--append", "-A"):
+            chain, _, body = rest.partition(" ")
+            entry = _dispatch_entry(body.split())
+            if entry is not None:
+                key, iface, target = entry
+                if (pending_vmap and pending_vmap[0] == chain and
+                        pending_vmap[1] == key):
+                    if iface not in [e[0] for e in pending_vmap[2]]:
+                        pending_vmap[2].append((iface, target))
+                    continue
+                flush_vmap()
+                pending_vmap = (chain, key, [(iface, target)])
+                continue
+            flush_vmap()
+            pending_vmap = None
+            script.append("add rule %s %s %s" %
+                          (spec, chain, translate_rule(body, ip_version)))
+        else:
+            flush_vmap()
+            pending_vmap = None
+            if command in ("--flush", "-F"):
+                script.append("flush chain %s %s" % (spec, rest))
+            elif command in ("--delete-chain", "-X"):
+                script.append("delete chain %s %s" % (spec, rest))
+            else:
+                raise UnsupportedRuleFragment(line)
+    if table is not None:
+        raise UnsupportedRuleFragment("Missing COMMIT")
+    return script
+
+
+def _table_header(table, ip_version):
+    """
+    :returns list[str]: nftables commands that idempotently create our
+        table and its base chains.
+    """
+    spec = _table_spec(table, ip_version)
+    lines = ["add table %s" % spec]
+    for chain, chain_type, hook, priority in NFT_BASE_CHAINS[table]:
+        lines.append("add chain %s %s { type %s hook %s priority %s; "
+                     "policy accept; }" %
+                     (spec, chain, chain_type, hook, priority))
+    return lines
+
+
+def _extract_our_nft_chains(raw_nft_output):
+    """
+    Parses the output of "nft list table".
+
+    :returns set[str]: names of our (non-base) chains in the table.
+    """
+    chains = set()
+    for line in raw_nft_output.splitlines():
+        match = _CHAIN_RE.match(line)
+        if match and match.group(1).startswith(FELIX_PREFIX):
+            chains.add(match.group(1))
+    return chains
+
+
+def _extract_our_unreffed_nft_chains(raw_nft_output):
+    """
+    Parses the output of "nft list table".
+
+    :returns set[str]: names of our chains that are not the target of any
+        jump, goto or verdict map entry.
+    """
+    chains = _extract_our_nft_chains(raw_nft_output)
+    referenced = set(_JUMP_RE.findall(raw_nft_output))
+    return chains - referenced
+
+
+class NftablesUpdater(IptablesUpdater):
+    """
+    Replacement for the IptablesUpdater that programs nftables.
+
+    Shares its bookkeeping and batching with the IptablesUpdater, which it
+    drives with iptables-restore input; only the interaction with the
+    dataplane differs.  Since we own the whole nftables table, rules that
+    are "inserted" into the kernel chains are programmed by rewriting the
+    corresponding base chain of our table.
+    """
+
+    def __init__(self, table, config, ip_version=4):
+        self.ip_version = ip_version
+        super(NftablesUpdater, self).__init__(table, config, ip_version)
+        self._restore_cmd = "nft"
+        self._table_spec = _table_spec(table, ip_version)
+
+    @actor_message(needs_own_batch=True)
+    def _load_chain_names_from_iptables(self):
+        """
+        Loads the set of (our) chains that already exist from nftables.
+
+        Populates self._chains_in_dataplane.
+        """
+        self._stats.increment("Refreshed chain list")
+        self._chains_in_dataplane = _extract_our_nft_chains(
+            self._list_table()
+        )
+
+    def _get_unreferenced_chains(self):
+        return _extract_our_unreffed_nft_chains(self._list_table())
+
+    def _list_table(self):
+        """
+        :returns str: output of "nft list table" for our table or the
+            empty string if our table doesn't exist yet.
+        """
+        try:
+            return futils.check_call(
+                ["nft", "list", "table"] + self._table_spec.split()
+            ).stdout
+        except FailedSystemCall as e:
+            if "No such file or directory" in e.stderr:
+                return ""
+            raise
+
+    def _insert_rule(self, rule_fragment, log_level=logging.INFO):
+        chain = rule_fragment.split()[0]
+        _log.log(log_level, "Rewriting base chain %s to insert rule %r",
+                 chain, rule_fragment)
+        self._rewrite_base_chain(chain)
+
+    def _remove_rule(self, rule_fragment, log_level=logging.INFO):
+        chain = rule_fragment.split()[0]
+        _log.log(log_level, "Rewriting base chain %s to remove rule %r",
+                 chain, rule_fragment)
+        self._rewrite_base_chain(chain)
+
+    def _rewrite_base_chain(self, chain):
+        """
+        Rewrites one of the base chains of our table so that it contains
+        exactly the rule fragments that have been inserted into it.
+        """
+        input_lines = ["*%s" % self.table, "--flush %s" % chain]
+        for fragment in sorted(self._inserted_rule_fragments):
+            if fragment.split()[0] == chain:
+                input_lines.append("--append %s" % fragment)
+        input_lines.append("COMMIT")
+        self._execute_iptables(input_lines)
+
+    def _execute_iptables(self, input_lines, fail_log_level=logging.ERROR):
+        """
+        Translates the given iptables-restore input to an nftables script
+        and applies it.  nftables applies the whole script as a single
+        transaction so, unlike iptables-restore, there is no need to retry.
+
+        :raises FailedSystemCall: if nft fails or if the input can't be
+            translated.
+        """
+        try:
+            script = ipt_restore_to_nft(input_lines, self.ip_version)
+        except UnsupportedRuleFragment as e:
+            _log.log(fail_log_level, "Unable to translate to nftables: %s",
+                     e)
+            self._stats.increment("nft translation failure")
+            raise FailedSystemCall("Unable to translate to nftables",
+                                   ["nft", "-f", "-"], 1, "", str(e),
+                                   input="\n".join(input_lines))
+        input_str = "\n".join(script) + "\n"
+        _log.debug("nft input:\n%s", input_str)
+        self._histograms.record("Input lines", len(script))
+        start_time = time.time()
+        try:
+            futils.check_call(["nft", "-f", "-"], input_str=input_str)
+        except FailedSystemCall as e:
+            _log.log(fail_log_level,
+                     "nft failed.\nOutput:\n%s\nError:\n%s\nInput was:\n%s",
+                     e.stdout, e.stderr, input_str)
+            self._stats.increment("nft failure")
+            raise
+        else:
+            self._stats.increment("nft success")
+        finally:
+            self._histograms.record("Restore time (ms)",
+                                    (time.time() - start_time) * 1000)
+
+
+class NftSet(Ipset):
+    """
+    Replacement for Ipset that programs a native nftables set, with the
+    same name, in each of our tables for the IP version.
+
+    Since each update is a single nftables transaction, the temporary set
+    is not needed for atomic rewrites.
+    """
+    def __init__(self, ipset_name, temp_ipset_name, ip_family,
+                 ipset_type="hash:ip", format_member=str):
+        super(NftSet, self).__init__(ipset_name, temp_ipset_name, ip_family,
+                                     ipset_type, format_member)
+        self.ip_version = 4 if ip_family == "inet" else 6
+
+    @classmethod
+    def read_all_members(cls):
+        # Not supported for nftables sets; they are not audited.
+        return None
+
+    @classmethod
+    def list_names(cls):
+        """
+        :returns list[str]: the names of the sets in our tables.
+        """
+        names = set()
+        for spec in _all_table_specs():
+            try:
+                output = futils.check_call(["nft", "list", "table"] +
+                                           spec.split()).stdout
+            except FailedSystemCall as e:
+                if "No such file or directory" in e.stderr:
+                    # We haven't created this table yet.
+                    continue
+                raise
+            for line in output.splitlines():
+                match = _SET_RE.match(line)
+                if match:
+                    names.add(match.group(1))
+        return sorted(names)
+
+    @classmethod
+    def destroy(cls, set_name):
+        """
+        Deletes the named set from each of our tables that contains it.
+
+        :raises FailedSystemCall: if the set can't be deleted, for example
+            because a rule still refers to it.
+        """
+        for spec in _all_table_specs():
+            try:
+                futils.check_call(["nft", "delete", "set"] + spec.split() +
+                                  [set_name])
+            except FailedSystemCall as e:
+                if "No such file or directory" not in e.stderr:
+                    raise
+
+    def _table_specs(self):
+        return [_table_spec(t, self.ip_version)
+                for t in NFT_TABLES_BY_IP_VERSION[self.ip_version]]
+
+    def _create_lines(self):
+        addr_type = "ipv4_addr" if self.ip_version == 4 else "ipv6_addr"
+        if self.type == "hash:net":
+            flags = " flags interval; auto-merge;"
+        else:
+            flags = ""
+        lines = []
+        for spec in self._table_specs():
+            lines.append("add table %s" % spec)
+            lines.append("add set %s %s { type %s;%s }" %
+                         (spec, self.set_name, addr_type, flags))
+        return lines
+
+    def _element_lines(self, command, members):
+        if not members:
+            return []
+        elements = ", ".join(self.format_member(m) for m in sorted(members))
+        return ["%s element %s %s { %s }" % (command, spec, self.set_name,
+                                             elements)
+                for spec in self._table_specs()]
+
+    def exists(self):
+        try:
+            futils.check_call(["nft", "list", "set"] +
+                              self._table_specs()[0].split() +
+                              [self.set_name])
+        except FailedSystemCall:
+            return False
+        else:
+            return True
+
+    def ensure_exists(self):
+        self._exec_nft(self._create_lines())
+
+    def update_members(self, old_members, new_members):
+        try:
+            lines = self._update_members_lines(old_members, new_members)
+            _log.info("Making %d changes (new size %d) to nftables set %s",
+                      len(lines), len(new_members), self.set_name)
+            if lines:
+                self._exec_nft(lines)
+        except FailedSystemCall as err:
+            _log.error("Failed to update nftables set %s (%s) - retrying",
+                       self.set_name, err.stderr)
+            self.replace_members(new_members)
+
+    def replace_members(self, members):
+        _log.info("Rewriting nftables set %s with %d members", self,
+                  len(members))
+        self._exec_nft(self._replace_members_lines(members))
+
+    def _update_members_lines(self, old_members, new_members):
+        return (self._element_lines("delete", old_members - new_members) +
+                self._element_lines("add", new_members - old_members))
+
+    def _replace_members_lines(self, members):
+        lines = self._create_lines()
+        lines += ["flush set %s %s" % (spec, self.set_name)
+                  for spec in self._table_specs()]
+        lines += self._element_lines("add", members)
+        return lines
+
+    def _exec_and_commit(self, input_lines):
+        # Each nft -f invocation is already a single transaction.
+        self._exec_nft(input_lines)
+
+    def delete(self):
+        _log.debug("Delete nftables set %s if it exists", self.set_name)
+        for spec in self._table_specs():
+            futils.call_silent(["nft", "delete", "set"] + spec.split() +
+                               [self.set_name])
+
+    def _exec_nft(self, lines):
+        futils.check_call(["nft", "-f", "-"],
+                          input_str="\n".join(lines) + "\n")
+
+
+class UnsupportedRuleFragment(Exception):
+    pass
@@ -118,13 +118,18 @@ MARK:
   profile chain.
 
 """
+import hashlib
+import json
 import logging
 import itertools
+from collections import deque
 from calico.felix import devices
 from calico.felix import futils
+from calico.felix.futils import StatCounter
 from calico.common import KNOWN_RULE_KEYS
 import re
-from calico.felix.ipsets import HOSTS_IPSET_V4
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.ipsets import HOSTS_IPSET_V4, NetSetId
 
 _log = logging.getLogger(__name__)
 
@@ -132,6 +137,18 @@ _log = logging.getLogger(__name__)
 # 2 entries.
 MAX_MULTIPORT_ENTRIES = 15
 
+# Maximum number of rendered rule lists to keep in the rendered rules cache.
+RENDERED_RULES_CACHE_SIZE = 1000
+# Chain name used when rendering rules into the cache; it gets stripped off
+# and replaced with the real chain name on the way out.
+_PLACEHOLDER_CHAIN = "felix-chain"
+
+# Rule keys that are generated by optimize_rules() rather than coming from
+# the datamodel.  They hold the name of an ipset of CIDRs.
+OPTIMIZER_RULE_KEYS = frozenset(["src_net_set", "dst_net_set"])
+
+_optimizer_stats = StatCounter("Rule optimizer")
+
 # Chain names
 FELIX_PREFIX = "felix-"
 CHAIN_PREROUTING = FELIX_PREFIX + "PREROUTING"
@@ -144,6 +161,7 @@ CHAIN_FROM_LEAF = FELIX_PREFIX + "FROM-EP-PFX"
 CHAIN_TO_PREFIX = FELIX_PREFIX + "to-"
 CHAIN_FROM_PREFIX = FELIX_PREFIX + "from-"
 CHAIN_PROFILE_PREFIX = FELIX_PREFIX + "p-"
+CHAIN_SHARED_PREFIX = FELIX_PREFIX + "s-"
 
 # Name of the global, stateless IP-in-IP device name.
 IP_IN_IP_DEV_NAME = "tunl0"
@@ -280,6 +298,9 @@ def rules_to_chain_rewrite_lines(chain_name, rules, ip_version, tag_to_ipset,
     Convert our JSON representation of a list of rules into iptables
     fragments.
 
+    The rendered rules are cached (without the chain name) so that
+    re-rendering an unchanged set of rules is cheap.
+
     :returns list[str] a list of fragments.
     """
     # Start by marking all packets.
@@ -291,14 +312,11 @@ def rules_to_chain_rewrite_lines(chain_name, rules, ip_version, tag_to_ipset,
     fragments = [
         '--append %s --jump MARK --set-mark 1' % chain_name
     ]
-    for r in rules:
-        rule_version = r.get('ip_version')
-        if rule_version is None or rule_version == ip_version:
-            fragments.extend(rule_to_iptables_fragments(chain_name, r,
-                                                        ip_version,
-                                                        tag_to_ipset,
-                                                        on_allow=on_allow,
-                                                        on_deny=on_deny))
+    rule_bodies = _rendered_rules_cache.get_or_render(rules, ip_version,
+                                                      tag_to_ipset,
+                                                      on_allow, on_deny)
+    prefix = "--append %s " % chain_name
+    fragments.extend(prefix + body for body in rule_bodies)
 
     # If we get to the end of the chain without a match, we remove the mark
     # again to indicate that the packet wasn't matched.
@@ -310,6 +328,218 @@ def rules_to_chain_rewrite_lines(chain_name, rules, ip_version, tag_to_ipset,
     return fragments
 
 
+def optimize_rules(rules, ip_version, min_rules):
+    """
+    Rule optimizer pass.  Compiles runs of consecutive rules that differ
+    only in their src_net (or only in their dst_net) into a single rule
+    that matches on a hash:net ipset of the CIDRs.  Since the rules in a
+    run have the same action, and iptables stops at the first match, the
+    result is equivalent but only costs one rule per packet.
+
+    Rules that don't apply to the given IP version are dropped.
+
+    :param list[dict] rules: Datamodel rules.
+    :param int ip_version: 4 or 6.
+    :param int min_rules: Minimum length of run to compile into an ipset;
+           0 disables the optimizer.
+    :returns tuple[list[dict],list[NetSetId]]: the optimized rules and the
+             IDs of the ipsets that they reference.
+    """
+    applicable_rules = [r for r in rules
+                        if r.get("ip_version") in (None, ip_version)]
+    if min_rules <= 0:
+        return applicable_rules, []
+    candidates = [(r, _cidr_group_keys(r, ip_version))
+                  for r in applicable_rules]
+
+    ip_type = IPV4 if ip_version == 4 else IPV6
+    optimized = []
+    net_set_ids = []
+    i = 0
+    while i < len(candidates):
+        rule, group_keys = candidates[i]
+        # Find the longest run of rules, starting with this one, that
+        # differ only in the same field.
+        best_field = None
+        best_len = 1
+        for field, key in group_keys.iteritems():
+            j = i + 1
+            while j < len(candidates) and candidates[j][1].get(field) == key:
+                j += 1
+            if j - i > best_len:
+                best_field = field
+                best_len = j - i
+        if best_field is not None and best_len >= min_rules:
+            run = candidates[i:i + best_len]
+            net_set_id = NetSetId(ip_type, [r[best_field] for r, _ in run])
+            new_rule = dict((k, v) for (k, v) in rule.iteritems()
+                            if k != best_field)
+            new_rule[best_field + "_set"] = net_set_id.name
+            optimized.append(new_rule)
+            net_set_ids.append(net_set_id)
+            _optimizer_stats.increment("CIDR rules compiled into ipsets",
+                                       by=best_len)
+            i += best_len
+        else:
+            optimized.append(rule)
+            i += 1
+    _optimizer_stats.increment("Rules before optimization",
+                               by=len(candidates))
+    _optimizer_stats.increment("Rules after optimization",
+                               by=len(optimized))
+    return optimized, net_set_ids
+
+
+def _cidr_group_keys(rule, ip_version):
+    """
+    :returns dict[str,str]: map from the CIDR field(s) that the rule could
+             be grouped on to a key that represents the rest of the rule.
+             Rules with the same key for a field can be grouped.
+    """
+    keys = {}
+    for field in ("src_net", "dst_net"):
+        cidr = rule.get(field)
+        if cidr is None or (":" in cidr) != (ip_version == 6):
+            # Not present, or wrong IP version, in which case the rule
+            # doesn't match on the CIDR.
+            continue
+        if cidr.endswith("/0"):
+            # hash:net ipsets don't support zero-length prefixes.
+            continue
+        rest = dict((k, v) for (k, v) in rule.iteritems() if k != field)
+        keys[field] = field + ":" + json.dumps(rest, sort_keys=True)
+    return keys
+
+
+def shared_chain_rewrite_lines(rules, ip_version, tag_to_ipset,
+                               on_allow="ACCEPT", on_deny="DROP"):
+    """
+    Renders the given rules into a chain that is named after a hash of its
+    contents.  Profiles with identical rules map to the same chain, which
+    can then be shared between them.
+
+    :returns tuple[str,list[str]]: the name of the chain and its fragments.
+    """
+    placeholder_lines = rules_to_chain_rewrite_lines(_PLACEHOLDER_CHAIN,
+                                                     rules,
+                                                     ip_version,
+                                                     tag_to_ipset,
+                                                     on_allow=on_allow,
+                                                     on_deny=on_deny)
+    prefix_len = len("--append %s " % _PLACEHOLDER_CHAIN)
+    bodies = [l[prefix_len:] for l in placeholder_lines]
+    content = "\n".join(bodies).encode("utf-8")
+    content_hash = hashlib.sha1(content).hexdigest()
+    chain_name = CHAIN_SHARED_PREFIX + content_hash[:16]
+    lines = ["--append %s %s" % (chain_name, b) for b in bodies]
+    return chain_name, lines
+
+
+def _render_rule_bodies(rules, ip_version, tag_to_ipset, on_allow, on_deny):
+    """
+    Renders the given rules as a list of fragment bodies; i.e. iptables
+    fragments with the leading "--append <chain name> " removed so that the
+    result can be shared between chains.
+    """
+    # Render with a placeholder chain name, which we then strip off.
+    prefix_len = len("--append %s " % _PLACEHOLDER_CHAIN)
+    bodies = []
+    for r in rules:
+        rule_version = r.get('ip_version')
+        if rule_version is None or rule_version == ip_version:
+            frags = rule_to_iptables_fragments(_PLACEHOLDER_CHAIN, r,
+                                               ip_version,
+                                               tag_to_ipset,
+                                               on_allow=on_allow,
+                                               on_deny=on_deny)
+            bodies.extend(f[prefix_len:] for f in frags)
+    return bodies
+
+
+class RenderedRulesCache(object):
+    """
+    LRU cache of rendered rules, keyed on a hash of all the inputs to the
+    rendering.
+
+    Many profiles share identical rules and a resync re-renders every
+    profile, so caching the rendered form avoids repeatedly re-running the
+    port chunking and fragment generation.  Entries are stored without the
+    chain name so that they can be shared between chains.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # Map from key to (last use, bodies).  Each use is numbered from
+        # _use_count and queued, in order, in _uses.  A key's queued uses
+        # other than its last are stale and skipped when evicting.
+        self._entries = {}
+        self._uses = deque()
+        self._use_count = 0
+        self._stats = StatCounter("Rendered rules cache")
+
+    def get_or_render(self, rules, ip_version, tag_to_ipset, on_allow,
+                      on_deny):
+        """
+        :returns list[str]: the rendered fragment bodies for the given rules,
+                 from the cache if possible.
+        """
+        try:
+            key = self._calculate_key(rules, ip_version, tag_to_ipset,
+                                      on_allow, on_deny)
+        except (TypeError, ValueError):
+            # Defensive: rules should always be JSON-serializable since they
+            # came from JSON but, if not, just skip the cache.
+            _log.exception("Failed to calculate cache key for rules %r",
+                           rules)
+            self._stats.increment("Uncacheable rules")
+            return _render_rule_bodies(rules, ip_version, tag_to_ipset,
+                                       on_allow, on_deny)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._stats.increment("Cache hits")
+            bodies = entry[1]
+        else:
+            self._stats.increment("Cache misses")
+            bodies = _render_rule_bodies(rules, ip_version, tag_to_ipset,
+                                         on_allow, on_deny)
+            if len(self._entries) >= self.max_size:
+                self._evict_lru()
+        # Record the use, making the entry the most-recently-used.
+        self._use_count += 1
+        self._entries[key] = (self._use_count, bodies)
+        self._uses.append((self._use_count, key))
+        if len(self._uses) > 2 * self.max_size:
+            # Mostly stale uses from cache hits; drop them.
+            self._uses = deque(sorted((use, k) for k, (use, _) in
+                                      self._entries.iteritems()))
+        return bodies
+
+    def _evict_lru(self):
+        while self._uses:
+            use, key = self._uses.popleft()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == use:
+                del self._entries[key]
+                self._stats.increment("Cache evictions")
+                return
+
+    def clear(self):
+        self._entries.clear()
+        self._uses.clear()
+
+    @staticmethod
+    def _calculate_key(rules, ip_version, tag_to_ipset, on_allow, on_deny):
+        canonical = json.dumps([rules, ip_version, tag_to_ipset, on_allow,
+                                on_deny],
+                               sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(canonical).digest()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_rendered_rules_cache = RenderedRulesCache(RENDERED_RULES_CACHE_SIZE)
+
+
 def commented_drop_fragment(chain_name, comment):
     """
     :return str: a DROP rule fragment with a comment attached.
@@ -339,7 +569,7 @@ def rule_to_iptables_fragments(chain_name, rule, ip_version, tag_to_ipset,
     """
 
     # Check we've not got any unknown fields.
-    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS
+    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS - OPTIMIZER_RULE_KEYS
     assert not unknown_keys, "Unknown keys: %s" % ", ".join(unknown_keys)
 
     # Ports are special, we have a limit on the number of ports that can go in
@@ -420,7 +650,7 @@ def _rule_to_iptables_fragment(chain_name, rule, ip_version, tag_to_ipset,
     """
 
     # Check we've not got any unknown fields.
-    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS
+    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS - OPTIMIZER_RULE_KEYS
     assert not unknown_keys, "Unknown keys: %s" % ", ".join(unknown_keys)
 
     # Build up the update in chunks and join them below.
@@ -443,6 +673,11 @@ def _rule_to_iptables_fragment(chain_name, rule, ip_version, tag_to_ipset,
             if (":" in ip_or_cidr) == (ip_version == 6):
                 append("--%s" % direction, ip_or_cidr)
 
+        # Set of CIDRs, generated by the rule optimizer.
+        net_set_key = dirn + "_net_set"
+        if rule.get(net_set_key) is not None:
+            append("--match set", "--match-set", rule[net_set_key], dirn)
+
         # Tag, which maps to an ipset.
         tag_key = dirn + "_tag"
         if tag_key in rule and rule[tag_key] is not None:
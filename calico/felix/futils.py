@@ -21,6 +21,7 @@ felix.futils
 
 Felix utilities.
 """
+import bisect
 import collections
 import functools
 import hashlib
@@ -31,6 +32,7 @@ from types import StringTypes
 import types
 import gc
 from datetime import datetime
+import gevent.event
 import gevent.lock
 from gevent import subprocess
 from gevent.subprocess import Popen
@@ -38,6 +40,8 @@ import tempfile
 import pkg_resources
 from posix_spawn import posix_spawnp, FileActions
 
+from calico.monotonic import monotonic_time
+
 try:
     import resource
 except ImportError:
@@ -60,15 +64,33 @@ IP_TYPE_TO_VERSION = {IPV4: 4, IPV6: 6}
 
 SHORTENED_PREFIX = "_"
 
-# Semaphore used to limit the number of concurrent shell-outs.  Prevents us
-# from using an unbounded number of file handles for stdin/out/err handling.
-# Tuning: <10 seemed noticeably worse 20-200 hovered around the same.  Chose
-# a value at low end of that range to limit our impact on the system.
+# Bounds on the number of concurrent shell-outs.  Prevents us from using an
+# unbounded number of file handles for stdin/out/err handling.  Tuning: <10
+# seemed noticeably worse 20-200 hovered around the same.  Chose a maximum
+# at low end of that range to limit our impact on the system.  Within those
+# bounds, the limit adapts to the latency of the calls; see
+# AdaptiveSemaphore.
+MIN_CONCURRENT_CALLS = 4
 MAX_CONCURRENT_CALLS = 32
-_call_semaphore = gevent.lock.Semaphore(MAX_CONCURRENT_CALLS)
+
+# AdaptiveSemaphore tuning.  We shrink the limit when calls take more than
+# LATENCY_RATIO_HIGH times their baseline, and grow it when calls are queueing
+# and take less than LATENCY_RATIO_LOW times their baseline.
+LATENCY_RATIO_HIGH = 2.0
+LATENCY_RATIO_LOW = 1.5
+# Weight of each sample in the moving average of the latency ratio.
+LATENCY_RATIO_ALPHA = 0.1
+# Fraction by which each program's baseline latency drifts up per call.
+BASELINE_DRIFT = 0.01
+# Floor on the baseline, so that near-instant calls don't give silly ratios.
+MIN_BASELINE_SECS = 0.001
 
 DEFAULT_TRUNC_LENGTH = 1000
 
+# Pluggable dataplane backend, see set_dataplane().  None means that we talk
+# to the real kernel.
+_dataplane = None
+
 
 class FailedSystemCall(Exception):
     def __init__(self, message, args, retcode, stdout, stderr, input=None):
@@ -91,6 +113,107 @@ class FailedSystemCall(Exception):
                  safe_truncate(self.input)))
 
 
+class AdaptiveSemaphore(object):
+    """
+    Semaphore that limits the number of concurrent shell-outs, with a limit
+    that adapts to how long the calls take.
+
+    Each program has a baseline latency: the lowest that we've seen, allowed
+    to drift upwards slowly so that it follows genuine changes, such as
+    bigger iptables tables.  We keep a moving average of the ratio of each
+    call's latency to its program's baseline.  If that climbs, the calls
+    already in flight are contending with each other, so we shrink the
+    limit multiplicatively.  If it is low and calls are queueing, we grow
+    the limit by one.  We adjust at most once per limit's-worth of calls,
+    so that each adjustment is judged on calls made after the previous one.
+    """
+    def __init__(self, min_limit, max_limit):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.latency_ratio = 1.0
+        self._waiters = collections.deque()
+        self._baselines = {}
+        self._calls_since_adjust = 0
+        register_diags("Shell-out concurrency", self._dump)
+
+    @property
+    def queue_len(self):
+        return len(self._waiters)
+
+    def acquire(self):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        event = gevent.event.Event()
+        self._waiters.append(event)
+        try:
+            event.wait()
+        except:
+            if event.is_set():
+                # We were handed a slot as we were interrupted.
+                self.release()
+            else:
+                self._waiters.remove(event)
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def record_latency(self, program, latency):
+        """
+        Records how long a call took and adjusts the limit accordingly.
+
+        :param str program: the program that was run; used to compare calls
+            with others of their own kind.
+        :param float latency: the time the call took, in seconds.
+        """
+        baseline = self._baselines.get(program, latency)
+        baseline = max(min(latency, baseline * (1 + BASELINE_DRIFT)),
+                       MIN_BASELINE_SECS)
+        self._baselines[program] = baseline
+        self.latency_ratio += LATENCY_RATIO_ALPHA * (latency / baseline -
+                                                     self.latency_ratio)
+        self._calls_since_adjust += 1
+        if self._calls_since_adjust < self.limit:
+            return
+        if (self.latency_ratio > LATENCY_RATIO_HIGH and
+                self.limit > self.min_limit):
+            self.limit = max(self.min_limit, self.limit * 3 // 4)
+            log.info("Shell-outs taking %.1fx their baseline, reducing "
+                     "concurrency limit to %s", self.latency_ratio,
+                     self.limit)
+        elif (self.latency_ratio < LATENCY_RATIO_LOW and self._waiters and
+                self.limit < self.max_limit):
+            self.limit += 1
+            log.debug("Shell-outs queueing, increasing concurrency limit "
+                      "to %s", self.limit)
+            self._wake_waiters()
+        else:
+            return
+        self._calls_since_adjust = 0
+
+    def _wake_waiters(self):
+        while self._waiters and self.in_flight < self.limit:
+            self.in_flight += 1
+            self._waiters.popleft().set()
+
+    def _dump(self, log):
+        log.info("Limit: %s (%s-%s)", self.limit, self.min_limit,
+                 self.max_limit)
+        log.info("In flight: %s, queued: %s", self.in_flight,
+                 len(self._waiters))
+        log.info("Latency/baseline: %.2f", self.latency_ratio)
+
+
 def safe_truncate(s, max_len=DEFAULT_TRUNC_LENGTH):
     if s is None:
         return s
@@ -306,6 +429,27 @@ assert _popen_exc_args == _our_exc_args, "SpawnedProcess._execute_child " \
                                          "Popen._execute_child"
 
 
+def set_dataplane(dataplane):
+    """
+    Installs a dataplane backend (see calico.felix.dataplane).  All
+    subsequent shell-outs, /proc and /sys accesses and netlink sockets
+    are routed to it.
+
+    :param dataplane: Dataplane object, or None to revert to the kernel.
+    """
+    global _dataplane
+    log.warning("Installing dataplane backend: %s", dataplane)
+    _dataplane = dataplane
+
+
+def get_dataplane():
+    """
+    :returns: the installed dataplane backend, or None if we're using the
+        real kernel.
+    """
+    return _dataplane
+
+
 def check_call(args, input_str=None):
     """
     Substitute for the subprocess.check_call function. It has the following
@@ -319,19 +463,31 @@ def check_call(args, input_str=None):
     :raises FailedSystemCall: if the return code of the subprocess is non-zero.
     :raises OSError: if, for example, there is a read error on stdout/err.
     """
-    log.debug("Calling out to system: %s.  %s/%s concurrent calls",
-              args,
-              MAX_CONCURRENT_CALLS - _call_semaphore.counter,
-              MAX_CONCURRENT_CALLS)
+    log.debug("Calling out to system: %s.  %s/%s concurrent calls, "
+              "%s queued", args, _call_semaphore.in_flight,
+              _call_semaphore.limit, _call_semaphore.queue_len)
 
     stdin = subprocess.PIPE if input_str is not None else None
 
+    queued_time = monotonic_time()
     with _call_semaphore:
-        proc = SpawnedProcess(args,
-                              stdin=stdin,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-        stdout, stderr = proc.communicate(input=input_str)
+        # Queue wait is the time that the semaphore, rather than the
+        # command, is costing us.
+        start_time = monotonic_time()
+        _call_histograms.record("Queue wait (ms)",
+                                (start_time - queued_time) * 1000)
+        try:
+            if _dataplane is not None:
+                return _dataplane.check_call(args, input_str=input_str)
+            proc = SpawnedProcess(args,
+                                  stdin=stdin,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate(input=input_str)
+        finally:
+            latency = monotonic_time() - start_time
+            _call_histograms.record("Run time (ms)", latency * 1000)
+            _call_semaphore.record_latency(args[0], latency)
 
     retcode = proc.returncode
     log.debug("Process finished with RC=%s: %s.", retcode, args)
@@ -342,6 +498,18 @@ def check_call(args, input_str=None):
     return CommandOutput(stdout, stderr)
 
 
+def check_output(args):
+    """
+    Substitute for subprocess.check_output(), which honours the installed
+    dataplane backend.
+
+    :raises CalledProcessError or FailedSystemCall: if the command fails.
+    """
+    if _dataplane is not None:
+        return _dataplane.check_output(args)
+    return subprocess.check_output(args)
+
+
 def multi_call(ops):
     """
     Issue multiple ops, all of which must succeed.
@@ -415,6 +583,53 @@ class StatCounter(object):
             log.info("%s: %s", name, stat)
 
 
+# Default histogram bucket upper bounds: 0 then powers of 2 up to 64k.
+DEFAULT_HISTOGRAM_BUCKETS = [0] + [2 ** i for i in xrange(17)]
+
+
+class StatHistogram(object):
+    """
+    Diagnostic histograms.  Like a StatCounter but, for each named stat,
+    records the distribution of the values passed to record().
+    """
+    def __init__(self, name, buckets=DEFAULT_HISTOGRAM_BUCKETS):
+        self.name = name
+        self.buckets = sorted(buckets)
+        # Map from stat to list of counts, one per bucket plus one for
+        # values above the last bucket.
+        self.counts = collections.defaultdict(
+            lambda: [0] * (len(self.buckets) + 1)
+        )
+        self.totals = collections.defaultdict(lambda: 0)
+        self.maxima = {}
+        register_diags(name, self._dump)
+
+    def record(self, stat, value):
+        self.counts[stat][bisect.bisect_left(self.buckets, value)] += 1
+        self.totals[stat] += value
+        self.maxima[stat] = max(self.maxima.get(stat, value), value)
+
+    def _dump(self, log):
+        for stat, counts in sorted(self.counts.items()):
+            num_samples = sum(counts)
+            log.info("%s: count=%s mean=%.2f max=%s", stat, num_samples,
+                     float(self.totals[stat]) / num_samples,
+                     self.maxima[stat])
+            bucket_strs = []
+            for bucket, count in zip(self.buckets, counts):
+                if count:
+                    bucket_strs.append("<=%s: %s" % (bucket, count))
+            if counts[-1]:
+                bucket_strs.append(">%s: %s" % (self.buckets[-1],
+                                                counts[-1]))
+            log.info("%s: %s", stat, ", ".join(bucket_strs))
+
+
+_call_semaphore = AdaptiveSemaphore(MIN_CONCURRENT_CALLS,
+                                    MAX_CONCURRENT_CALLS)
+_call_histograms = StatHistogram("Shell-out latency")
+
+
 def register_process_statistics():
     """
     Called once to register a stats handler for process-specific information.
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.ipset_netlink
+~~~~~~~~~~~~~~~~~~~
+
+Programs ipsets over the kernel's NFNL_SUBSYS_IPSET netlink interface
+rather than by running the ipset command.
+
+IpsetNetlinkClient.restore() accepts the same lines as "ipset restore" and
+sends them as a batch of netlink messages, so the Ipset class can use
+either path.  As with "ipset restore", the batch is not transactional.
+Unlike "ipset restore", lines after a failing one may still be applied,
+but a swap is never sent after a failure, so a partly-filled temporary set
+never replaces the live one.
+"""
+import errno
+import logging
+import socket
+import struct
+
+from calico.felix.futils import FailedSystemCall
+from calico.felix import netlink
+from calico.felix.netlink import (encode_attr, encode_u8_attr,
+                                  encode_u32_attr, encode_str_attr,
+                                  encode_nested_attr, NetlinkError,
+                                  NetlinkSocket, NLM_F_EXCL)
+
+_log = logging.getLogger(__name__)
+
+# These constants map to constants in the Linux kernel; see
+# include/uapi/linux/netfilter/ipset/ip_set.h.
+NFNL_SUBSYS_IPSET = 6
+NFNETLINK_V0 = 0
+# Protocol version that we speak.  Version 6 is accepted by all kernels
+# with ipset support.
+IPSET_PROTOCOL = 6
+
+IPSET_CMD_PROTOCOL = 1
+IPSET_CMD_CREATE = 2
+IPSET_CMD_DESTROY = 3
+IPSET_CMD_FLUSH = 4
+IPSET_CMD_SWAP = 6
+IPSET_CMD_LIST = 7
+IPSET_CMD_ADD = 9
+IPSET_CMD_DEL = 10
+IPSET_CMD_HEADER = 12
+
+IPSET_ATTR_PROTOCOL = 1
+IPSET_ATTR_SETNAME = 2
+IPSET_ATTR_TYPENAME = 3
+IPSET_ATTR_SETNAME2 = IPSET_ATTR_TYPENAME
+IPSET_ATTR_REVISION = 4
+IPSET_ATTR_FAMILY = 5
+IPSET_ATTR_FLAGS = 6
+IPSET_ATTR_DATA = 7
+
+# Attributes nested in IPSET_ATTR_DATA.
+IPSET_ATTR_IP = 1
+IPSET_ATTR_CIDR = 3
+IPSET_ATTR_HASHSIZE = 18
+IPSET_ATTR_MAXELEM = 19
+
+# Attributes nested in IPSET_ATTR_IP.
+IPSET_ATTR_IPADDR_IPV4 = 1
+IPSET_ATTR_IPADDR_IPV6 = 2
+
+IPSET_FLAG_LIST_SETNAME = 1 << 1
+
+NFPROTO_IPV4 = 2
+NFPROTO_IPV6 = 10
+FAMILIES = {"inet": NFPROTO_IPV4, "inet6": NFPROTO_IPV6}
+
+# Set type revision to create.  Revision 0 of the hash types is supported by
+# all kernels and has all the features that we use.
+IPSET_TYPE_REVISION = 0
+
+IPSET_ERR_PRIVATE = 4096
+IPSET_ERR_PROTOCOL = IPSET_ERR_PRIVATE + 1
+IPSET_ERR_FIND_TYPE = IPSET_ERR_PRIVATE + 2
+IPSET_ERR_EXIST_SETNAME2 = IPSET_ERR_PRIVATE + 5
+IPSET_ERR_TYPE_MISMATCH = IPSET_ERR_PRIVATE + 6
+IPSET_ERR_EXIST = IPSET_ERR_PRIVATE + 7
+IPSET_ERR_REFERENCED = IPSET_ERR_PRIVATE + 12
+IPSET_ERR_TYPE_SPECIFIC = 4352
+IPSET_ERR_HASH_FULL = IPSET_ERR_TYPE_SPECIFIC
+
+# Messages matching those of the ipset command, by command and errno.
+_ERROR_MESSAGES = {
+    (IPSET_CMD_CREATE, errno.EEXIST):
+        "Set cannot be created: set with the same name already exists",
+    (IPSET_CMD_CREATE, IPSET_ERR_FIND_TYPE):
+        "Kernel error received: set type not supported",
+    (IPSET_CMD_ADD, IPSET_ERR_EXIST):
+        "Element cannot be added to the set: it's already added",
+    (IPSET_CMD_ADD, IPSET_ERR_HASH_FULL):
+        "Hash is full, cannot add more elements",
+    (IPSET_CMD_DEL, IPSET_ERR_EXIST):
+        "Element cannot be deleted from the set: it's not added",
+    (IPSET_CMD_SWAP, IPSET_ERR_EXIST_SETNAME2):
+        "The set with the given name does not exist",
+    (IPSET_CMD_SWAP, IPSET_ERR_TYPE_MISMATCH):
+        "The sets cannot be swapped: their type does not match",
+    (IPSET_CMD_DESTROY, IPSET_ERR_REFERENCED):
+        "Set cannot be destroyed: it is in use by a kernel component",
+}
+_GENERIC_ERROR_MESSAGES = {
+    errno.ENOENT: "The set with the given name does not exist",
+    IPSET_ERR_PROTOCOL: "Kernel error received: ipset protocol error",
+}
+
+
+class IpsetNetlinkClient(object):
+    """
+    Client for the kernel's ipset netlink interface.
+    """
+    def __init__(self, sock=None):
+        """
+        :param sock: optional pre-made netlink socket, for test.
+        """
+        self._nl = NetlinkSocket(netlink.NETLINK_NETFILTER, sock=sock)
+
+    def check_protocol(self):
+        """
+        Checks that the kernel supports our protocol version.
+
+        :raises NetlinkError: if not.
+        """
+        self._nl.request(*encode_protocol())
+
+    def restore(self, input_lines):
+        """
+        Applies the given lines of "ipset restore" input.
+
+        :raises FailedSystemCall: if any of the lines fail; the stderr
+            matches that of "ipset restore".  The lines before the failing
+            one have been applied, and so may some of those after it (the
+            kernel processes a whole datagram even if a message fails).
+            Swaps are only sent if every earlier line succeeded.
+        """
+        requests = []
+        line_nos = []
+        for line_no, line in enumerate(input_lines, 1):
+            words = line.split()
+            if not words or words[0] == "COMMIT":
+                continue
+            try:
+                request = encode_restore_line(words)
+            except ValueError as e:
+                raise _failure(input_lines, line_no, str(e))
+            if request[0] & 0xff == IPSET_CMD_SWAP:
+                # Only swap in a set that we've filled without errors.
+                requests.append(netlink.BARRIER)
+                line_nos.append(None)
+            requests.append(request)
+            line_nos.append(line_no)
+        if not requests:
+            return
+        failures = self._nl.send_batch(requests)
+        if failures:
+            index, err = failures[0]
+            cmd = requests[index][0] & 0xff
+            message = _ERROR_MESSAGES.get((cmd, err)) or _kernel_error(err)
+            raise _failure(input_lines, line_nos[index], message)
+
+    def list_names(self):
+        """
+        :returns list[str]: names of all ipsets.
+        """
+        names = []
+        for _, _, payload in self._nl.dump(*encode_list_names()):
+            for attr_type, data in netlink.parse_attrs(payload[4:]):
+                if attr_type == IPSET_ATTR_SETNAME:
+                    names.append(data.rstrip("\0"))
+        return names
+
+    def exists(self, set_name):
+        """
+        :returns bool: True if the ipset exists.
+        """
+        try:
+            self._nl.request(*encode_header(set_name))
+        except NetlinkError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def destroy_silent(self, set_name):
+        """
+        Destroys the ipset, ignoring any errors, for example if it doesn't
+        exist.
+        """
+        failures = self._nl.send_batch([encode_simple(IPSET_CMD_DESTROY,
+                                                      set_name)])
+        if failures:
+            _log.debug("Failed to destroy ipset %s: %s", set_name,
+                       _kernel_error(failures[0][1]))
+
+
+def create_client():
+    """
+    :returns IpsetNetlinkClient: a client, or None if the kernel's ipset
+        netlink interface isn't available to us.
+    """
+    try:
+        client = IpsetNetlinkClient()
+        client.check_protocol()
+    except (socket.error, NetlinkError) as e:
+        _log.warning("Ipset netlink interface unavailable (%r), using the "
+                     "ipset command", e)
+        return None
+    return client
+
+
+def encode_restore_line(words):
+    """
+    Converts a line of "ipset restore" input into a netlink request.
+
+    :param list[str] words: the words of the line.
+    :returns tuple: (msg_type, flags, payload).
+    :raises ValueError: if the line isn't one that we support.
+    """
+    exist = False
+    for flag in ("-exist", "--exist", "-!"):
+        while flag in words:
+            words.remove(flag)
+            exist = True
+    cmd, args = words[0], words[1:]
+    if cmd == "create" and len(args) >= 2 and len(args) % 2 == 0:
+        opts = dict(zip(args[2::2], args[3::2]))
+        if not set(opts) <= set(["family", "hashsize", "maxelem"]):
+            raise ValueError("Syntax error: unsupported create options")
+        hashsize = opts.get("hashsize")
+        maxelem = opts.get("maxelem")
+        return encode_create(args[0], args[1], opts.get("family", "inet"),
+                             hashsize and int(hashsize),
+                             maxelem and int(maxelem), exist=exist)
+    elif cmd in ("add", "del") and len(args) == 2:
+        return encode_adt(IPSET_CMD_ADD if cmd == "add" else IPSET_CMD_DEL,
+                          args[0], args[1], exist=exist)
+    elif cmd == "flush" and len(args) == 1:
+        return encode_simple(IPSET_CMD_FLUSH, args[0])
+    elif cmd == "destroy" and len(args) == 1:
+        return encode_simple(IPSET_CMD_DESTROY, args[0])
+    elif cmd == "swap" and len(args) == 2:
+        return encode_swap(args[0], args[1])
+    raise ValueError("Syntax error: unsupported command %s" % cmd)
+
+
+def encode_create(set_name, set_type, family, hashsize=None, maxelem=None,
+                  exist=False):
+    if family not in FAMILIES:
+        raise ValueError("Syntax error: unknown family %s" % family)
+    data = []
+    if hashsize is not None:
+        data.append(encode_u32_attr(IPSET_ATTR_HASHSIZE, hashsize,
+                                    net_byteorder=True))
+    if maxelem is not None:
+        data.append(encode_u32_attr(IPSET_ATTR_MAXELEM, maxelem,
+                                    net_byteorder=True))
+    attrs = [encode_u8_attr(IPSET_ATTR_PROTOCOL, IPSET_PROTOCOL),
+             encode_str_attr(IPSET_ATTR_SETNAME, set_name),
+             encode_str_attr(IPSET_ATTR_TYPENAME, set_type),
+             encode_u8_attr(IPSET_ATTR_REVISION, IPSET_TYPE_REVISION),
+             encode_u8_attr(IPSET_ATTR_FAMILY, FAMILIES[family])]
+    if data:
+        attrs.append(encode_nested_attr(IPSET_ATTR_DATA, *data))
+    return _request(IPSET_CMD_CREATE, attrs, exist)
+
+
+def encode_adt(cmd, set_name, member, exist=False):
+    """
+    Encodes an add or delete of a single member, which may be an IP or a
+    CIDR.
+    """
+    ip, _, prefix_len = member.partition("/")
+    try:
+        if ":" in ip:
+            addr = encode_attr(IPSET_ATTR_IPADDR_IPV6 |
+                               netlink.NLA_F_NET_BYTEORDER,
+                               socket.inet_pton(socket.AF_INET6, ip))
+        else:
+            addr = encode_attr(IPSET_ATTR_IPADDR_IPV4 |
+                               netlink.NLA_F_NET_BYTEORDER,
+                               socket.inet_aton(ip))
+    except socket.error:
+        raise ValueError("Syntax error: '%s' is invalid as number" % member)
+    data = [encode_nested_attr(IPSET_ATTR_IP, addr)]
+    if prefix_len:
+        data.append(encode_u8_attr(IPSET_ATTR_CIDR, int(prefix_len)))
+    attrs = [encode_u8_attr(IPSET_ATTR_PROTOCOL, IPSET_PROTOCOL),
+             encode_str_attr(IPSET_ATTR_SETNAME, set_name),
+             encode_nested_attr(IPSET_ATTR_DATA, *data)]
+    return _request(cmd, attrs, exist)
+
+
+def encode_simple(cmd, set_name):
+    """
+    Encodes a command, such as flush or destroy, that only takes a set name.
+    """
+    return _request(cmd, [encode_u8_attr(IPSET_ATTR_PROTOCOL, IPSET_PROTOCOL),
+                          encode_str_attr(IPSET_ATTR_SETNAME, set_name)])
+
+
+def encode_swap(set_name, set_name2):
+    return _request(IPSET_CMD_SWAP,
+                    [encode_u8_attr(IPSET_ATTR_PROTOCOL, IPSET_PROTOCOL),
+                     encode_str_attr(IPSET_ATTR_SETNAME, set_name),
+                     encode_str_attr(IPSET_ATTR_SETNAME2, set_name2)])
+
+
+def encode_header(set_name):
+    return encode_simple(IPSET_CMD_HEADER, set_name)
+
+
+def encode_protocol():
+    return _request(IPSET_CMD_PROTOCOL,
+                    [encode_u8_attr(IPSET_ATTR_PROTOCOL, IPSET_PROTOCOL)])
+
+
+def encode_list_names():
+    """
+    :returns tuple: (msg_type, payload) for a dump of the names of all
+        ipsets.
+    """
+    msg_type, _, payload = _request(
+        IPSET_CMD_LIST,
+        [encode_u8_attr(IPSET_ATTR_PROTOCOL, IPSET_PROTOCOL),
+         encode_u32_attr(IPSET_ATTR_FLAGS, IPSET_FLAG_LIST_SETNAME,
+                         net_byteorder=True)])
+    return msg_type, payload
+
+
+def _request(cmd, attrs, exist=True):
+    """
+    :returns tuple: (msg_type, flags, payload) for NetlinkSocket.
+    """
+    # The nfgenmsg header; the family is ignored by the ipset subsystem.
+    payload = struct.pack("=BBH", NFPROTO_IPV4, NFNETLINK_V0, 0)
+    payload += "".join(attrs)
+    # Without NLM_F_EXCL, the kernel ignores "already exists" errors, like
+    # the ipset command's -exist option.
+    flags = 0 if exist else NLM_F_EXCL
+    return (NFNL_SUBSYS_IPSET << 8) | cmd, flags, payload
+
+
+def _kernel_error(err):
+    if err in _GENERIC_ERROR_MESSAGES:
+        return _GENERIC_ERROR_MESSAGES[err]
+    if err < IPSET_ERR_PRIVATE:
+        return "Kernel error received: %s" % errno.errorcode.get(err, err)
+    return "Kernel error received: ipset protocol error %s" % err
+
+
+def _failure(input_lines, line_no, message):
+    return FailedSystemCall("Failed to program ipsets over netlink",
+                            ["ipset", "restore"], 1, "",
+                            "Error in line %s: %s\n" % (line_no, message),
+                            input="\n".join(input_lines))
@@ -20,32 +20,91 @@ felix.ipsets
 IP sets management functions.
 """
 
+from array import array
+import functools
 from collections import defaultdict
-from itertools import chain
+import hashlib
+from itertools import chain, count
 import logging
+import random
+import re
+import socket
+import struct
+import sys
+import time
+
+import gevent
+import gevent.lock
+from netaddr import IPNetwork
 
 from calico.felix import futils
-from calico.felix.futils import IPV4, IPV6, FailedSystemCall
-from calico.felix.actor import actor_message, Actor
-from calico.felix.refcount import ReferenceManager, RefCountedActor
+from calico.felix.futils import (IPV4, IPV6, FailedSystemCall, StatCounter,
+                                 StatHistogram)
+from calico.felix.actor import actor_message, Actor, ResultOrExc
+from calico.felix.refcount import ReferenceManager, RefCountedActor, LIVE
+from calico.monotonic import monotonic_time
 
 _log = logging.getLogger(__name__)
 
 FELIX_PFX = "felix-"
 IPSET_PREFIX = {IPV4: FELIX_PFX+"v4-", IPV6: FELIX_PFX+"v6-"}
 IPSET_TMP_PREFIX = {IPV4: FELIX_PFX+"tmp-v4-", IPV6: FELIX_PFX+"tmp-v6-"}
+# Prefixes for the hash:net ipsets that the rule optimizer generates.  These
+# are deliberately outside the tag ipset namespace.
+NET_IPSET_PREFIX = {IPV4: FELIX_PFX+"v4n-", IPV6: FELIX_PFX+"v6n-"}
+NET_IPSET_TMP_PREFIX = {IPV4: FELIX_PFX+"tmp-v4n-",
+                        IPV6: FELIX_PFX+"tmp-v6n-"}
+# Matches the names in the output of "ipset list".  Used with finditer() so
+# that we don't have to split the (potentially huge) output into lines.
+_IPSET_NAME_RE = re.compile(r"^Name: (\S+)", re.MULTILINE)
+
+# Kernel defaults for the size of a hash ipset.  maxelem is a hard limit on
+# the number of members.
+DEFAULT_HASHSIZE = 1024
+DEFAULT_MAXELEM = 65536
+# When an update takes an ipset past this fraction of its maxelem, we
+# rewrite it into a bigger set.
+RESIZE_THRESHOLD = 0.75
+
+_sizing_stats = StatCounter("Ipset sizing")
+_sizing_histograms = StatHistogram("Ipset sizes",
+                                   [2 ** i for i in xrange(0, 25, 2)])
+_audit_stats = StatCounter("Ipset audit")
+
+# Sequence numbers for ipset writes.  The IpsetManager takes one before it
+# reads the kernel's ipsets for an audit so that each IpsetActor can tell
+# whether it has written to its ipset since the read.
+_write_seqs = count()
+
+# The last kernel read for an audit, shared by the IPv4 and IPv6 managers so
+# that they don't both dump every set on the host each interval: tuple of
+# (time of the read, write sequence number, members by set name).  The lock
+# stops the second manager from starting its own read while the first is
+# still reading.
+_audit_read = None
+_audit_read_lock = gevent.lock.Semaphore()
 
 
 class IpsetManager(ReferenceManager):
-    def __init__(self, ip_type):
+    def __init__(self, ip_type, ipset_writer=None, audit_interval=0):
         """
         Manages all the ipsets for tags for either IPv4 or IPv6.
 
+        Also manages the ipsets of CIDRs generated by the rule optimizer;
+        these are requested by passing a NetSetId instead of a tag ID.
+
         :param ip_type: IP type (IPV4 or IPV6)
+        :param IpsetWriter ipset_writer: optional IpsetWriter to combine the
+            updates from our ipsets; if None, each ipset is programmed
+            separately.
+        :param audit_interval: how often, in seconds, to check the members
+            of our ipsets in the kernel; 0 disables the periodic audit.
         """
         super(IpsetManager, self).__init__(qualifier=ip_type)
 
         self.ip_type = ip_type
+        self.ipset_writer = ipset_writer
+        self.audit_interval = audit_interval
 
         # State.
         # Tag IDs indexed by profile IDs
@@ -53,17 +112,28 @@ class IpsetManager(ReferenceManager):
         # EndpointData "structs" indexed by EndpointId.
         self.endpoint_data_by_ep_id = {}
 
+        # To keep the indexes below compact, profile IDs and EndpointIds are
+        # interned as small ints and IP addresses are stored as packed ints.
+        self.profile_interner = IdInterner()
+        self.endpoint_interner = IdInterner()
+
+        # Profile IDs indexed by tag ID.
+        self.prof_ids_by_tag = defaultdict(set)
+
         # Main index.  Since an IP address can be assigned to multiple
         # endpoints, we need to track which endpoints reference an IP.  When
         # we find the set of endpoints with an IP is empty, we remove the
         # ip from the tag.
-        # ip_owners_by_tag[tag][ip] = set([(profile_id, combined_id),
-        #                                  (profile_id, combined_id2), ...]) |
-        #                             (profile_id, combined_id)
-        # Here "combined_id" is an EndpointId object.
+        #
+        # To save occupancy, only tags with a starting or live TagIpset are
+        # indexed.  A tag's entry is built when its TagIpset starts and it
+        # is discarded when the tag is no longer referenced.
+        # ip_owners_by_tag[tag][ip] = set([owner, owner2, ...]) | owner
+        # Here "ip" is the packed IP address and "owner" packs the interned
+        # profile and endpoint IDs, see _owner().
         self.ip_owners_by_tag = defaultdict(lambda: defaultdict(lambda: None))
 
-        # Set of EndpointId objects referenced by profile IDs.
+        # Set of interned endpoint IDs indexed by interned profile ID.
         self.endpoint_ids_by_profile_id = defaultdict(set)
 
         # Set of tag IDs that may be out of sync. Accumulated by the
@@ -72,19 +142,58 @@ class IpsetManager(ReferenceManager):
         self._dirty_tags = set()
         self._force_reprogram = False
 
+        # Optionally, start periodic audit timer.
+        if self.audit_interval > 0:
+            _log.info("Periodic ipset audit enabled, starting audit greenlet")
+            audit_greenlet = gevent.spawn(self._periodic_audit)
+            audit_greenlet.link_exception(self._on_worker_died)
+
     def _create(self, tag_id):
+        if isinstance(tag_id, NetSetId):
+            return NetIpset(tag_id, writer=self.ipset_writer)
         active_ipset = TagIpset(futils.uniquely_shorten(tag_id, 16),
-                                   self.ip_type)
+                                self.ip_type, writer=self.ipset_writer)
         return active_ipset
 
     def _on_object_started(self, tag_id, active_ipset):
+        if isinstance(tag_id, NetSetId):
+            # Contents are fixed by the ID, program them once.
+            _log.debug("NetIpset actor for %s started", tag_id)
+            active_ipset.replace_members(tag_id.cidrs, async=True)
+            return
         _log.debug("TagIpset actor for %s started", tag_id)
+        self._index_tag(tag_id)
         # Fill the ipset in with its members, this will trigger its first
         # programming, after which it will call us back to tell us it is ready.
         # We can't use self._dirty_tags to defer this in case the set becomes
         # unreferenced before _finish_msg_batch() is called.
         self._update_active_ipset(tag_id)
 
+    def _on_object_unreferenced(self, tag_id):
+        if isinstance(tag_id, NetSetId):
+            return
+        _log.debug("Tag %s no longer referenced, discarding its index",
+                   tag_id)
+        self.ip_owners_by_tag.pop(tag_id, None)
+        self._dirty_tags.discard(tag_id)
+
+    def _index_tag(self, tag_id):
+        """
+        Builds the ip_owners_by_tag entry for a newly-started tag from the
+        profile and endpoint indexes.
+        """
+        assert self._is_starting_or_live(tag_id)
+        self.ip_owners_by_tag.pop(tag_id, None)
+        for profile_id in self.prof_ids_by_tag.get(tag_id, ()):
+            prof_idx = self.profile_interner.get_id(profile_id)
+            for ep_idx in self.endpoint_ids_by_profile_id.get(prof_idx, ()):
+                endpoint_id = self.endpoint_interner.value(ep_idx)
+                endpoint = self.endpoint_data_by_ep_id[endpoint_id]
+                for ip in endpoint.ip_addresses:
+                    self._add_mapping(tag_id, prof_idx, ep_idx, ip)
+        # We're about to send the full membership to the TagIpset anyway.
+        self._dirty_tags.discard(tag_id)
+
     def _update_active_ipset(self, tag_id):
         """
         Replaces the members of the identified TagIpset with the
@@ -154,18 +263,57 @@ class IpsetManager(ReferenceManager):
         _log.info("Tags snapshot applied: %s tags, %s endpoints",
                   len(tags_by_prof_id), len(endpoints_by_id))
 
+    def _periodic_audit(self):
+        while True:
+            # Jitter our sleep times by 20%.
+            gevent.sleep(self.audit_interval * (1 + random.random() * 0.2))
+            self.audit_ipsets(async=True)
+
+    def _on_worker_died(self, watch_greenlet):
+        """
+        Greenlet: spawned by the gevent Hub if the audit loop ever stops,
+        kills the process.
+        """
+        _log.critical("Worker greenlet died: %s; exiting.", watch_greenlet)
+        sys.exit(1)
+
+    @actor_message()
+    def audit_ipsets(self):
+        """
+        Checks that the members of our ipsets haven't been changed by
+        another process.
+
+        Reads all the ipsets from the kernel in one call, or reuses the
+        other IP version's read from this interval, and then passes each
+        live ipset actor its members; the actor repairs any drift.
+        """
+        audit_seq, members_by_name = read_members_for_audit(
+            self.audit_interval / 2.0)
+        if members_by_name is None:
+            _log.debug("Ipset backend doesn't support audits")
+            return
+        _audit_stats.increment("Audits")
+        for obj_id, ipset in self.objects_by_id.iteritems():
+            if ipset.ref_mgmt_state != LIVE:
+                continue
+            ipset.audit_members(members_by_name.get(ipset.ipset_name),
+                                audit_seq, async=True)
+        _log.info("Sent kernel members to %s ipsets for audit",
+                  len(self.objects_by_id))
+
     @actor_message()
     def cleanup(self):
         """
         Clean up left-over ipsets that existed at start-of-day.
         """
         _log.info("Cleaning up left-over ipsets.")
-        all_ipsets = list_ipset_names()
+        all_ipsets = _ipset_class.list_names()
         # only clean up our own rubbish.
-        pfx = IPSET_PREFIX[self.ip_type]
-        tmppfx = IPSET_TMP_PREFIX[self.ip_type]
-        felix_ipsets = set([n for n in all_ipsets if (n.startswith(pfx) or
-                                                      n.startswith(tmppfx))])
+        prefixes = (IPSET_PREFIX[self.ip_type],
+                    IPSET_TMP_PREFIX[self.ip_type],
+                    NET_IPSET_PREFIX[self.ip_type],
+                    NET_IPSET_TMP_PREFIX[self.ip_type])
+        felix_ipsets = set([n for n in all_ipsets if n.startswith(prefixes)])
         whitelist = set()
         live_ipsets = self.objects_by_id.itervalues()
         # stopping_objects_by_id is a dict of sets of TagIpset objects,
@@ -183,7 +331,7 @@ class IpsetManager(ReferenceManager):
         # to delete.
         for ipset_name in ipsets_to_delete:
             try:
-                futils.check_call(["ipset", "destroy", ipset_name])
+                _ipset_class.destroy(ipset_name)
             except FailedSystemCall:
                 _log.exception("Failed to clean up dead ipset %s, will "
                                "retry on next cleanup.", ipset_name)
@@ -210,23 +358,33 @@ class IpsetManager(ReferenceManager):
         new_tags = set(tags or [])
         # Find the endpoints that use these tags and work out what tags have
         # been added/removed.
-        endpoint_ids = self.endpoint_ids_by_profile_id.get(profile_id, set())
+        prof_idx = self.profile_interner.get_id(profile_id)
+        endpoint_ids = self.endpoint_ids_by_profile_id.get(prof_idx, set())
         added_tags = new_tags - old_tags
         removed_tags = old_tags - new_tags
-        _log.debug("Endpoint IDs with this profile: %s", endpoint_ids)
+        _log.debug("Number of endpoints with this profile: %s",
+                   len(endpoint_ids))
         _log.debug("Profile %s added tags: %s", profile_id, added_tags)
         _log.debug("Profile %s removed tags: %s", profile_id, removed_tags)
 
-        for endpoint_id in endpoint_ids:
-            endpoint = self.endpoint_data_by_ep_id.get(endpoint_id,
-                                                       EMPTY_ENDPOINT_DATA)
+        for ep_idx in endpoint_ids:
+            endpoint_id = self.endpoint_interner.value(ep_idx)
+            endpoint = self.endpoint_data_by_ep_id[endpoint_id]
             ip_addrs = endpoint.ip_addresses
             for tag_id in removed_tags:
                 for ip in ip_addrs:
-                    self._remove_mapping(tag_id, profile_id, endpoint_id, ip)
+                    self._remove_mapping(tag_id, prof_idx, ep_idx, ip)
             for tag_id in added_tags:
                 for ip in ip_addrs:
-                    self._add_mapping(tag_id, profile_id, endpoint_id, ip)
+                    self._add_mapping(tag_id, prof_idx, ep_idx, ip)
+
+        for tag_id in removed_tags:
+            prof_ids = self.prof_ids_by_tag[tag_id]
+            prof_ids.discard(profile_id)
+            if not prof_ids:
+                del self.prof_ids_by_tag[tag_id]
+        for tag_id in added_tags:
+            self.prof_ids_by_tag[tag_id].add(profile_id)
 
         if tags is None:
             _log.info("Tags for profile %s deleted", profile_id)
@@ -255,6 +413,9 @@ class IpsetManager(ReferenceManager):
         As an optimization, if the endpoint doesn't contain any data relevant
         to this manager, returns EMPTY_ENDPOINT_DATA.
 
+        The EndpointData holds a reference to each of its interned profile
+        IDs; _on_endpoint_data_update() takes ownership of those references.
+
         :param dict|None endpoint_dict: The data model endpoint dict or None.
         :return: An EndpointData object containing the data. If the input
             was None, EMPTY_ENDPOINT_DATA is returned.
@@ -265,8 +426,10 @@ class IpsetManager(ReferenceManager):
             if profile_ids and nets_list:
                 # Optimization: only return an object if this endpoint makes
                 # some contribution to the IP addresses in the tags.
-                ips = map(futils.net_to_ip, nets_list)
-                return EndpointData(profile_ids, ips)
+                ips = [ip_to_int(futils.net_to_ip(n)) for n in nets_list]
+                prof_idxs = [self.profile_interner.incref(p)
+                             for p in set(profile_ids)]
+                return EndpointData(prof_idxs, ips)
             else:
                 _log.debug("Endpoint makes no contribution, "
                            "treating as missing: %s", endpoint_id)
@@ -295,11 +458,15 @@ class IpsetManager(ReferenceManager):
         # removal loop will be skipped.
         old_endpoint = self.endpoint_data_by_ep_id.pop(endpoint_id,
                                                        EMPTY_ENDPOINT_DATA)
+        # Take a reference to the interned endpoint ID for the duration of
+        # the update.  If the endpoint is stored, the reference is kept.
+        ep_idx = self.endpoint_interner.incref(endpoint_id)
         old_prof_ids = old_endpoint.profile_ids
         old_tags = set()
-        for profile_id in old_prof_ids:
+        for prof_idx in old_prof_ids:
+            profile_id = self.profile_interner.value(prof_idx)
             for tag in self.tags_by_prof_id.get(profile_id, []):
-                old_tags.add((profile_id, tag))
+                old_tags.add((prof_idx, tag))
 
         if endpoint_data != EMPTY_ENDPOINT_DATA:
             # EMPTY_ENDPOINT_DATA represents a deletion (or that the endpoint
@@ -310,17 +477,18 @@ class IpsetManager(ReferenceManager):
 
         new_prof_ids = endpoint_data.profile_ids
         new_tags = set()
-        for profile_id in new_prof_ids:
+        for prof_idx in new_prof_ids:
+            profile_id = self.profile_interner.value(prof_idx)
             for tag in self.tags_by_prof_id.get(profile_id, []):
-                new_tags.add((profile_id, tag))
+                new_tags.add((prof_idx, tag))
 
         if new_prof_ids != old_prof_ids:
             # Profile ID changed, or an add/delete.  the _xxx_profile_index
             # methods ignore profile_id == None so we'll do the right thing.
             _log.debug("Profile IDs changed from %s to %s",
                        old_prof_ids, new_prof_ids)
-            self._remove_profile_index(old_prof_ids, endpoint_id)
-            self._add_profile_index(new_prof_ids, endpoint_id)
+            self._remove_profile_index(old_prof_ids, ep_idx)
+            self._add_profile_index(new_prof_ids, ep_idx)
 
         # Since we've defaulted new/old_tags to set() if needed, we can
         # use set operations to calculate the tag changes.
@@ -335,38 +503,50 @@ class IpsetManager(ReferenceManager):
         # Add *new* IPs to new tags.  On a deletion, added_tags will be empty.
         # Do this first to avoid marking ipsets as dirty if an endpoint moves
         # from one profile to another but keeps the same tag.
-        for profile_id, tag in added_tags:
+        for prof_idx, tag in added_tags:
             for ip in new_ips:
-                self._add_mapping(tag, profile_id,  endpoint_id, ip)
+                self._add_mapping(tag, prof_idx, ep_idx, ip)
         # Change IPs in unchanged tags.
         added_ips = new_ips - old_ips
         removed_ips = old_ips - new_ips
-        for profile_id, tag in unchanged_tags:
+        for prof_idx, tag in unchanged_tags:
             for ip in removed_ips:
-                self._remove_mapping(tag, profile_id,  endpoint_id, ip)
+                self._remove_mapping(tag, prof_idx, ep_idx, ip)
             for ip in added_ips:
-                self._add_mapping(tag, profile_id,  endpoint_id, ip)
+                self._add_mapping(tag, prof_idx, ep_idx, ip)
         # Remove *all* *old* IPs from removed tags.  For a deletion, only this
         # loop will fire.
-        for profile_id, tag in removed_tags:
+        for prof_idx, tag in removed_tags:
             for ip in old_ips:
-                self._remove_mapping(tag, profile_id, endpoint_id, ip)
-
-    def _add_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
+                self._remove_mapping(tag, prof_idx, ep_idx, ip)
+
+        # Release the references held by the old data and, if we didn't
+        # store the endpoint, our own reference.
+        for prof_idx in old_prof_ids:
+            self.profile_interner.decref_id(prof_idx)
+        if old_endpoint != EMPTY_ENDPOINT_DATA:
+            self.endpoint_interner.decref_id(ep_idx)
+        if endpoint_data == EMPTY_ENDPOINT_DATA:
+            self.endpoint_interner.decref_id(ep_idx)
+
+    def _add_mapping(self, tag_id, prof_idx, ep_idx, ip_address):
         """
         Adds the given tag->IP->profile->endpoint mapping to the index.
         Marks the tag as dirty if the update resulted in the IP being
         newly added.
 
         :param str tag_id: Tag ID
-        :param str profile_id: Profile ID
-        :param EndpointId endpoint_id: ID of the endpoint
-        :param str ip_address: IP address to add
+        :param int prof_idx: Interned profile ID
+        :param int ep_idx: Interned ID of the endpoint
+        :param int ip_address: packed IP address to add
         """
-        ip_added = not bool(self.ip_owners_by_tag[tag_id][ip_address])
+        if not self._is_starting_or_live(tag_id):
+            # Tag isn't in use, we'll index it if it gets referenced.
+            return
         owners = self.ip_owners_by_tag[tag_id][ip_address]
-        new_mapping = (profile_id, endpoint_id)
-        if not owners:
+        ip_added = owners is None
+        new_mapping = _owner(prof_idx, ep_idx)
+        if owners is None:
             self.ip_owners_by_tag[tag_id][ip_address] = new_mapping
         elif isinstance(owners, set):
             owners.add(new_mapping)
@@ -379,19 +559,21 @@ class IpsetManager(ReferenceManager):
         if ip_added:
             self._dirty_tags.add(tag_id)
 
-    def _remove_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
+    def _remove_mapping(self, tag_id, prof_idx, ep_idx, ip_address):
         """
         Removes the tag->IP->profile->endpoint mapping from index.
         Marks the tag as dirty if the update resulted in the IP being
         removed.
 
         :param str tag_id: Tag ID
-        :param str profile_id: Profile ID
-        :param EndpointId endpoint_id: ID of the endpoint
-        :param str ip_address: IP address to remove
+        :param int prof_idx: Interned profile ID
+        :param int ep_idx: Interned ID of the endpoint
+        :param int ip_address: packed IP address to remove
         """
+        if not self._is_starting_or_live(tag_id):
+            return
         owners = self.ip_owners_by_tag[tag_id][ip_address]
-        removed_mapping = (profile_id, endpoint_id)
+        removed_mapping = _owner(prof_idx, ep_idx)
         if owners == removed_mapping:
             # This was the sole owner of the IP in the tag, remove it.
             _log.debug("%s was sole owner of IP %s, IP no longer in tag",
@@ -411,28 +593,29 @@ class IpsetManager(ReferenceManager):
                            "single tuple", ip_address)
                 self.ip_owners_by_tag[tag_id][ip_address] = owners.pop()
 
-    def _add_profile_index(self, prof_ids, endpoint_id):
+    def _add_profile_index(self, prof_ids, ep_idx):
         """
         Notes in the index that an endpoint uses the given profiles.
 
-        :param set[str] prof_ids: set of profile IDs that the endpoint is in.
-        :param EndpointId endpoint_id: ID of the endpoint
+        :param set[int] prof_ids: set of interned profile IDs that the
+            endpoint is in.
+        :param int ep_idx: Interned ID of the endpoint
         """
         for prof_id in prof_ids:
-            self.endpoint_ids_by_profile_id[prof_id].add(endpoint_id)
+            self.endpoint_ids_by_profile_id[prof_id].add(ep_idx)
 
-    def _remove_profile_index(self, prof_ids, endpoint_id):
+    def _remove_profile_index(self, prof_ids, ep_idx):
         """
         Notes in the index that an endpoint no longer uses any of the
         given profiles.
 
-        :param set[str] prof_ids: set of profile IDs to remove the endpoint
-            from.
-        :param EndpointId endpoint_id: ID of the endpoint
+        :param set[int] prof_ids: set of interned profile IDs to remove the
+            endpoint from.
+        :param int ep_idx: Interned ID of the endpoint
         """
         for prof_id in prof_ids:
             endpoints = self.endpoint_ids_by_profile_id[prof_id]
-            endpoints.discard(endpoint_id)
+            endpoints.discard(ep_idx)
             if not endpoints:
                 _log.debug("No more endpoints use profile %s", prof_id)
                 del self.endpoint_ids_by_profile_id[prof_id]
@@ -459,8 +642,10 @@ class EndpointData(object):
 
     def __init__(self, profile_ids, ip_addresses):
         """
-        :param sequence profile_ids: The profile IDs for the endpoint.
-        :param sequence ip_addresses: IP addresses for the endpoint.
+        :param sequence[int] profile_ids: The interned profile IDs for the
+            endpoint.
+        :param sequence[int] ip_addresses: Packed IP addresses for the
+            endpoint.
         """
         # Note: profile IDs are ordered in the data model but the ipsets
         # code doesn't care about the ordering so it's safe to sort these here
@@ -470,14 +655,14 @@ class EndpointData(object):
 
     @property
     def profile_ids(self):
-        """:returns set[str]: profile IDs."""
+        """:returns set[int]: interned profile IDs."""
         # Generate set on demand to keep occupancy down.  250B overhead for a
         # set vs 64 for a tuple.
         return set(self._profile_ids)
 
     @property
     def ip_addresses(self):
-        """:returns set[str]: IP addresses."""
+        """:returns set[int]: packed IP addresses."""
         # Generate set on demand to keep occupancy down.  250B overhead for a
         # set vs 64 for a tuple.
         return set(self._ip_addresses)
@@ -504,6 +689,95 @@ class EndpointData(object):
 EMPTY_ENDPOINT_DATA = EndpointData([], [])
 
 
+def _owner(prof_idx, ep_idx):
+    """
+    :returns int: the ip_owners_by_tag entry for an interned profile ID and
+        endpoint ID pair.  Much smaller than a tuple.
+    """
+    return (ep_idx << 32) | prof_idx
+
+
+class IdInterner(object):
+    """
+    Reference-counted mapping from hashable values, such as EndpointIds,
+    to small ints (and back) so that our indexes can store ints rather than
+    objects.  IDs are reused once all their references are released.
+    """
+
+    def __init__(self):
+        self._ids_by_value = {}
+        self._values = []
+        self._ref_counts = array("L")
+        self._free_ids = []
+
+    def incref(self, value):
+        """
+        Takes a reference to the value, interning it if needed.
+
+        :returns int: the ID of the value.
+        """
+        idx = self._ids_by_value.get(value)
+        if idx is None:
+            if self._free_ids:
+                idx = self._free_ids.pop()
+                self._values[idx] = value
+            else:
+                idx = len(self._values)
+                self._values.append(value)
+                self._ref_counts.append(0)
+            self._ids_by_value[value] = idx
+        self._ref_counts[idx] += 1
+        return idx
+
+    def decref_id(self, idx):
+        """
+        Releases a reference to the value with the given ID, freeing the ID
+        once it has no more references.
+        """
+        assert self._ref_counts[idx] > 0, "Ref count dropped below 0"
+        self._ref_counts[idx] -= 1
+        if self._ref_counts[idx] == 0:
+            del self._ids_by_value[self._values[idx]]
+            self._values[idx] = None
+            self._free_ids.append(idx)
+
+    def get_id(self, value):
+        """:returns int|NoneType: the ID of the value, if it's interned."""
+        return self._ids_by_value.get(value)
+
+    def value(self, idx):
+        """:returns: the value with the given ID."""
+        return self._values[idx]
+
+    def __len__(self):
+        return len(self._ids_by_value)
+
+
+def ip_to_int(ip):
+    """
+    :param str ip: IPv4 or IPv6 address.
+    :returns int: the address packed into an int.
+    """
+    if ":" in ip:
+        high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6,
+                                                          ip))
+        return (high << 64) | low
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def int_to_ip(ip_type, value):
+    """
+    :param ip_type: IP type (IPV4 or IPV6) of the address.
+    :param int value: packed address, as returned by ip_to_int().
+    :returns str: the address in string form.
+    """
+    if ip_type == IPV4:
+        return socket.inet_ntoa(struct.pack("!I", value))
+    return socket.inet_ntop(socket.AF_INET6,
+                            struct.pack("!QQ", value >> 64,
+                                        value & 0xffffffffffffffff))
+
+
 class IpsetActor(Actor):
     """
     Actor managing a single ipset.
@@ -511,14 +785,17 @@ class IpsetActor(Actor):
     Batches up updates to minimise the number of actual dataplane updates.
     """
 
-    def __init__(self, ipset, qualifier=None):
+    def __init__(self, ipset, qualifier=None, writer=None):
         """
         :param Ipset ipset: Ipset object to wrap.
         :param str qualifier: Actor qualifier string for logging.
+        :param IpsetWriter writer: optional IpsetWriter to send our updates
+            to, so that they can be combined with those of other ipsets.
         """
         super(IpsetActor, self).__init__(qualifier=qualifier)
 
         self._ipset = ipset
+        self._writer = writer
         # Members - which entries should be in the ipset.  None means
         # "unknown", but this is updated immediately on actor startup.
         self.members = None
@@ -527,6 +804,8 @@ class IpsetActor(Actor):
 
         self._force_reprogram = True
         self.stopped = False
+        # Sequence number of our last write to the ipset, see _write_seqs.
+        self._last_write_seq = None
 
     @property
     def ipset_name(self):
@@ -558,6 +837,51 @@ class IpsetActor(Actor):
         self.members = members
         self._force_reprogram |= force_reprogram
 
+    @actor_message()
+    def audit_members(self, kernel_members, audit_seq):
+        """
+        Checks the members of our ipset, as read from the kernel, against
+        the members that we programmed and repairs any differences with
+        targeted adds and deletes.
+
+        :param set[str] kernel_members: members of the ipset, as reported by
+            the kernel, or None if the ipset doesn't exist.
+        :param audit_seq: write sequence number taken before the kernel
+            members were read.  If we've written to the ipset since then,
+            kernel_members may be out of date so we skip the check.
+        """
+        if (self.stopped or self.programmed_members is None or
+                self._force_reprogram or self._last_write_seq > audit_seq):
+            _log.debug("Ipset %s is being updated, skipping audit",
+                       self.name)
+            _audit_stats.increment("Ipsets skipped")
+            return
+        _audit_stats.increment("Ipsets checked")
+        if kernel_members is None:
+            _log.warning("Ipset %s is missing from the dataplane, "
+                         "recreating it", self.name)
+            _audit_stats.increment("Ipsets missing")
+            self._force_reprogram = True
+            return
+        missing, unexpected = self._ipset.diff_members(
+            self.programmed_members, kernel_members)
+        if not missing and not unexpected:
+            return
+        _log.warning("Ipset %s has drifted from its programmed state: %s "
+                     "members missing, %s unexpected members; repairing",
+                     self.name, len(missing), len(unexpected))
+        _audit_stats.increment("Ipsets drifted")
+        _audit_stats.increment("Members missing", len(missing))
+        _audit_stats.increment("Unexpected members", len(unexpected))
+        try:
+            self._ipset.repair_members(missing, unexpected)
+        except FailedSystemCall as e:
+            _log.error("Failed to repair ipset %s (%s), rewriting it",
+                       self.name, e.stderr)
+            self._force_reprogram = True
+        else:
+            self._last_write_seq = next(_write_seqs)
+
     def _finish_msg_batch(self, batch, results):
         _log.debug("IpsetActor._finish_msg_batch() called")
         if not self.stopped:
@@ -568,11 +892,23 @@ class IpsetActor(Actor):
         if self._force_reprogram:
             _log.debug("Replacing content of ipset %s with %s", self,
                        self.members)
-            self._ipset.replace_members(self.members)
+            if self._writer is not None:
+                self._writer.write_members(self._ipset, None, self.members,
+                                           async=False)
+            else:
+                self._ipset.replace_members(self.members)
+            self._last_write_seq = next(_write_seqs)
         elif self.programmed_members != self.members:
             assert self.programmed_members is not None
             _log.debug("Updating ipset %s to %s", self, self.members)
-            self._ipset.update_members(self.programmed_members, self.members)
+            if self._writer is not None:
+                self._writer.write_members(self._ipset,
+                                           self.programmed_members,
+                                           self.members, async=False)
+            else:
+                self._ipset.update_members(self.programmed_members,
+                                           self.members)
+            self._last_write_seq = next(_write_seqs)
         else:
             _log.debug("Ipset %s already in correct state", self)
 
@@ -582,25 +918,15 @@ class IpsetActor(Actor):
         self._force_reprogram = False
 
 
-class TagIpset(IpsetActor, RefCountedActor):
+class RefCountedIpsetActor(IpsetActor, RefCountedActor):
     """
-    Specialised, RefCountedActor managing a single tag's ipset.
+    IpsetActor that is managed by the IpsetManager.  Deletes its ipset when
+    it becomes unreferenced.
     """
 
-    def __init__(self, tag, ip_type):
-        """
-        :param str tag: Name of tag that this ipset represents.  Note: not
-            the name of the ipset itself.  The name of the ipset is derived
-            from this value.
-        :param ip_type: One of the constants, futils.IPV4 or futils.IPV6
-        """
-        self.tag = tag
-        name = tag_to_ipset_name(ip_type, tag)
-        tmpname = tag_to_ipset_name(ip_type, tag, tmp=True)
-        family = "inet" if ip_type == IPV4 else "inet6"
-        # Helper class, used to do atomic rewrites of ipsets.
-        ipset = Ipset(name, tmpname, family, "hash:ip")
-        super(TagIpset, self).__init__(ipset, qualifier=tag)
+    def __init__(self, ipset, qualifier=None, writer=None):
+        super(RefCountedIpsetActor, self).__init__(ipset, qualifier=qualifier,
+                                                   writer=writer)
 
         # Notified ready?
         self.notified_ready = False
@@ -616,26 +942,102 @@ class TagIpset(IpsetActor, RefCountedActor):
             self._notify_cleanup_complete()
 
     def _finish_msg_batch(self, batch, results):
-        _log.debug("_finish_msg_batch on TagIpset")
-        super(TagIpset, self)._finish_msg_batch(batch, results)
+        _log.debug("_finish_msg_batch on %s", self.__class__.__name__)
+        super(RefCountedIpsetActor, self)._finish_msg_batch(batch, results)
         if not self.notified_ready:
             # We have created the set, so we are now ready.
-            _log.debug("TagIpset _finish_msg_batch notifying ready")
+            _log.debug("%s _finish_msg_batch notifying ready",
+                       self.__class__.__name__)
             self.notified_ready = True
             self._notify_ready()
 
 
+class TagIpset(RefCountedIpsetActor):
+    """
+    Specialised, RefCountedActor managing a single tag's ipset.
+    """
+
+    def __init__(self, tag, ip_type, writer=None):
+        """
+        :param str tag: Name of tag that this ipset represents.  Note: not
+            the name of the ipset itself.  The name of the ipset is derived
+            from this value.
+        :param ip_type: One of the constants, futils.IPV4 or futils.IPV6
+        :param IpsetWriter writer: optional shared IpsetWriter.
+        """
+        self.tag = tag
+        name = tag_to_ipset_name(ip_type, tag)
+        tmpname = tag_to_ipset_name(ip_type, tag, tmp=True)
+        family = "inet" if ip_type == IPV4 else "inet6"
+        # Helper class, used to do atomic rewrites of ipsets.
+        # The IpsetManager passes us packed IPs, only the ones that we
+        # actually write need to be converted to strings.
+        ipset = new_ipset(name, tmpname, family, "hash:ip",
+                          functools.partial(int_to_ip, ip_type))
+        super(TagIpset, self).__init__(ipset, qualifier=tag, writer=writer)
+
+
+class NetIpset(RefCountedIpsetActor):
+    """
+    Specialised, RefCountedActor managing a hash:net ipset generated by the
+    rule optimizer.  The contents of the set are fixed by its NetSetId.
+    """
+
+    def __init__(self, net_set_id, writer=None):
+        """
+        :param NetSetId net_set_id: ID of the set.
+        :param IpsetWriter writer: optional shared IpsetWriter.
+        """
+        self.net_set_id = net_set_id
+        family = "inet" if net_set_id.ip_type == IPV4 else "inet6"
+        ipset = new_ipset(net_set_id.name, net_set_id.temp_name, family,
+                          "hash:net")
+        super(NetIpset, self).__init__(ipset, qualifier=net_set_id.name,
+                                       writer=writer)
+
+
+class NetSetId(object):
+    """
+    Identifies a set of CIDRs to be programmed as a hash:net ipset.  The
+    ipset is named after a hash of the CIDRs so that profiles with the same
+    CIDRs share it.
+    """
+
+    def __init__(self, ip_type, cidrs):
+        self.ip_type = ip_type
+        self.cidrs = frozenset(cidrs)
+        digest = hashlib.sha1(",".join(sorted(self.cidrs))).hexdigest()[:16]
+        self.name = NET_IPSET_PREFIX[ip_type] + digest
+        self.temp_name = NET_IPSET_TMP_PREFIX[ip_type] + digest
+
+    def __eq__(self, other):
+        return (isinstance(other, NetSetId) and
+                self.name == other.name)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return "NetSetId<%s,%s CIDRs>" % (self.name, len(self.cidrs))
+
+
 class Ipset(object):
     """
     (Synchronous) wrapper around an ipset, supporting atomic rewrites.
     """
     def __init__(self, ipset_name, temp_ipset_name, ip_family,
-                 ipset_type="hash:ip"):
+                 ipset_type="hash:ip", format_member=str):
         """
         :param str ipset_name: name of the primary ipset.  Must be less than
             32 chars.
         :param str temp_ipset_name: name of a secondary, temporary ipset to
             use when doing an atomic rewrite.  Must be less than 32 chars.
+        :param format_member: function used to convert members to strings;
+            allows callers to pass in members in a more compact form, such as
+            packed IPs.
         """
         assert len(ipset_name) < 32
         assert len(temp_ipset_name) < 32
@@ -644,8 +1046,15 @@ class Ipset(object):
         self.type = ipset_type
         assert ip_family in ("inet", "inet6")
         self.family = ip_family
+        self.format_member = format_member
+        # (hashsize, maxelem) that we believe the main set was created with,
+        # or None if we don't know (for example, if a previous Felix created
+        # it).
+        self._sizing = None
 
     def exists(self):
+        if _netlink_client is not None:
+            return _netlink_client.exists(self.set_name)
         try:
             futils.check_call(["ipset", "list", self.set_name])
         except FailedSystemCall as e:
@@ -663,18 +1072,23 @@ class Ipset(object):
 
         Leaves the set and its contents untouched if it already exists.
         """
-        input_lines = [self._create_cmd(self.set_name)]
-        self._exec_and_commit(input_lines)
+        input_lines = [self._create_cmd(self.set_name, self._sizing)]
+        try:
+            self._exec_and_commit(input_lines)
+        except FailedSystemCall:
+            # Fails if the set exists but with different sizing.
+            if not self.exists():
+                raise
+            _log.info("Ipset %s already exists with different sizing",
+                      self.set_name)
 
     def update_members(self, old_members, new_members):
         """
         Update the ipset with changes to members. The set must exist.
         """
         try:
-            input_lines = ["del %s %s" % (self.set_name, m)
-                           for m in (old_members - new_members)]
-            input_lines += ["add %s %s" % (self.set_name, m)
-                            for m in (new_members - old_members)]
+            input_lines = self._update_members_lines(old_members,
+                                                     new_members)
             _log.info("Making %d changes (new size %d) to ipset %s",
                       len(input_lines), len(new_members), self.set_name)
             self._exec_and_commit(input_lines)
@@ -695,23 +1109,146 @@ class Ipset(object):
         # so we build up the complete set of members in a temporary ipset,
         # swap it into place and then delete the old ipset.
         _log.info("Rewriting ipset %s with %d members", self, len(members))
-        input_lines = [
-            # Ensure both the main set and the temporary set exist.
-            self._create_cmd(self.set_name),
-            self._create_cmd(self.temp_set_name),
+        try:
+            self._exec_and_commit(self._replace_members_lines(members))
+        except FailedSystemCall as e:
+            # Most likely, the main set or a left-over temporary set exists
+            # with different sizing from what we asked for.  Get rid of the
+            # temporary set and only create the main set if it's missing.
+            _log.warning("Failed to rewrite ipset %s (%s), retrying with "
+                         "a fresh temporary set", self.set_name, e.stderr)
+            _destroy_silent(self.temp_set_name)
+            create_main = not self.exists()
+            self._exec_and_commit(
+                self._replace_members_lines(members, create_main=create_main)
+            )
+
+    @classmethod
+    def list_names(cls):
+        """
+        :returns list[str]: the names of all the sets in the dataplane.
+        """
+        return list_ipset_names()
+
+    @classmethod
+    def destroy(cls, set_name):
+        """
+        Destroys the named set.
+
+        :raises FailedSystemCall: if the set can't be destroyed.
+        """
+        if _netlink_client is not None:
+            _netlink_client.restore(["destroy %s" % set_name])
+        else:
+            futils.check_call(["ipset", "destroy", set_name])
+
+    @classmethod
+    def read_all_members(cls):
+        """
+        Reads the members of all of Felix's ipsets with a single
+        "ipset save".
+
+        :returns dict[str,set[str]]: map from ipset name to its members, in
+            the form that the kernel reports them.
+        """
+        data = futils.check_call(["ipset", "save"]).stdout
+        members_by_name = {}
+        for line in data.split("\n"):
+            words = line.split()
+            if len(words) < 3 or not words[1].startswith(FELIX_PFX):
+                continue
+            if words[0] == "create":
+                members_by_name.setdefault(words[1], set())
+            elif words[0] == "add":
+                members_by_name.setdefault(words[1], set()).add(words[2])
+        return members_by_name
+
+    def diff_members(self, members, kernel_members):
+        """
+        Compares the members that we programmed with those that the kernel
+        reported.
+
+        :param members: the members that should be in the set.
+        :param set[str] kernel_members: the members in the kernel, as
+            returned by read_all_members().
+        :returns tuple: list of the members that are missing from the
+            kernel and list of the kernel members (as strings) that
+            shouldn't be there.
+        """
+        if self.type == "hash:net":
+            fmt = lambda m: canonical_net(self.format_member(m))
+        else:
+            fmt = self.format_member
+        expected = dict((fmt(m), m) for m in members)
+        missing = [m for m_str, m in expected.iteritems()
+                   if m_str not in kernel_members]
+        unexpected = [m_str for m_str in kernel_members
+                      if m_str not in expected]
+        return missing, unexpected
+
+    def repair_members(self, missing, unexpected):
+        """
+        Adds the missing members to the set and removes the unexpected
+        ones, as found by diff_members().  The set must exist.
+        """
+        input_lines = ["del %s %s" % (self.set_name, m_str)
+                       for m_str in unexpected]
+        input_lines += ["add %s %s" % (self.set_name, self.format_member(m))
+                        for m in missing]
+        self._exec_and_commit(input_lines)
+
+    def _update_members_lines(self, old_members, new_members):
+        """
+        :returns list[str]: the ipset restore lines (without COMMIT) that
+            update the set from old_members to new_members.
+        """
+        if self._needs_resize(len(new_members)):
+            _log.info("Ipset %s has grown to %s members, rewriting it into a "
+                      "bigger set", self.set_name, len(new_members))
+            return self._replace_members_lines(new_members)
+        fmt = self.format_member
+        input_lines = ["del %s %s" % (self.set_name, fmt(m))
+                       for m in (old_members - new_members)]
+        input_lines += ["add %s %s" % (self.set_name, fmt(m))
+                        for m in (new_members - old_members)]
+        return input_lines
+
+    def _replace_members_lines(self, members, create_main=True):
+        """
+        :returns list[str]: the ipset restore lines (without COMMIT) that
+            atomically rewrite the set with the given members.  The
+            temporary set is sized for the new members, so that the swap
+            also resizes the main set.
+        """
+        sizing = ipset_sizing(len(members))
+        _sizing_histograms.record("Members per rewrite", len(members))
+        if self._sizing is not None and self._sizing != sizing:
+            _log.info("Resizing ipset %s from (hashsize, maxelem) %s to %s",
+                      self.set_name, self._sizing, sizing)
+            _sizing_stats.increment("Ipsets resized")
+        input_lines = []
+        if create_main:
+            # Ensure the main set exists.  If it does, it must be created
+            # with the same parameters.
+            input_lines.append(self._create_cmd(self.set_name,
+                                                self._sizing or sizing))
+        input_lines += [
+            # Ensure the temporary set exists.
+            self._create_cmd(self.temp_set_name, sizing),
             # Flush the temporary set.  This is a no-op unless we had a
             # left-over temporary set before.
             "flush %s" % self.temp_set_name,
         ]
+        self._sizing = sizing
         # Add all the members to the temporary set,
-        input_lines += ["add %s %s" % (self.temp_set_name, m)
+        fmt = self.format_member
+        input_lines += ["add %s %s" % (self.temp_set_name, fmt(m))
                         for m in members]
         # Then, atomically swap the temporary set into place.
         input_lines.append("swap %s %s" % (self.set_name, self.temp_set_name))
         # Finally, delete the temporary set (which was the old active set).
         input_lines.append("destroy %s" % self.temp_set_name)
-        # COMMIT tells ipset restore to actually execute the changes.
-        self._exec_and_commit(input_lines)
+        return input_lines
 
     def _exec_and_commit(self, input_lines):
         """
@@ -719,16 +1256,32 @@ class Ipset(object):
         follows them with a COMMIT call.
         """
         input_lines.append("COMMIT")
+        if _netlink_client is not None:
+            _netlink_client.restore(input_lines)
+            return
         input_str = "\n".join(input_lines) + "\n"
         futils.check_call(["ipset", "restore"], input_str=input_str)
 
-    def _create_cmd(self, name):
+    def _needs_resize(self, num_members):
         """
+        :returns bool: True if the set should be rewritten into a bigger set
+            to hold the given number of members.
+        """
+        _, maxelem = self._sizing or (DEFAULT_HASHSIZE, DEFAULT_MAXELEM)
+        return num_members > maxelem * RESIZE_THRESHOLD
+
+    def _create_cmd(self, name, sizing=None):
+        """
+        :param tuple sizing: (hashsize, maxelem) or None for the kernel
+            defaults.
         :returns an ipset restore line to create the given ipset iff it
             doesn't exist.
         """
-        return ("create %s %s family %s --exist" %
-                (name, self.type, self.family))
+        cmd = "create %s %s family %s" % (name, self.type, self.family)
+        if sizing is not None and sizing != (DEFAULT_HASHSIZE,
+                                             DEFAULT_MAXELEM):
+            cmd += " hashsize %s maxelem %s" % sizing
+        return cmd + " --exist"
 
     def delete(self):
         """
@@ -736,8 +1289,167 @@ class Ipset(object):
         """
         _log.debug("Delete ipsets %s and %s if they exist",
                    self.set_name, self.temp_set_name)
-        futils.call_silent(["ipset", "destroy", self.set_name])
-        futils.call_silent(["ipset", "destroy", self.temp_set_name])
+        _destroy_silent(self.set_name)
+        _destroy_silent(self.temp_set_name)
+
+
+class IpsetWriter(Actor):
+    """
+    Actor that combines the member updates of many IpsetActors into a
+    single "ipset restore" transaction per batch, rather than spawning one
+    process per ipset.
+
+    If the combined transaction fails, falls back to programming each
+    ipset separately so that the failure is reported to the right actor.
+    """
+
+    def __init__(self, qualifier=None):
+        super(IpsetWriter, self).__init__(qualifier=qualifier)
+        # Map from set name to (Ipset, old_members, new_members, [msg, ...])
+        # for the current batch.  old_members is None if the set should be
+        # rewritten from scratch.
+        self._pending = {}
+        self._stats = StatCounter("Ipset writer %s" % qualifier)
+        self._histograms = StatHistogram("Ipset writer %s restore" %
+                                         qualifier)
+
+    @actor_message()
+    def write_members(self, ipset, old_members, new_members):
+        """
+        Queues an update to the members of the given ipset.  The update is
+        applied when the current batch finishes.
+
+        :param Ipset ipset: the ipset to update.
+        :param set[str]|None old_members: the currently-programmed members
+            or None to rewrite the set from scratch.
+        :param set[str] new_members: the desired members.
+        :raises FailedSystemCall: if the update fails.
+        """
+        name = ipset.set_name
+        if name in self._pending:
+            # Coalesce with the earlier update to the same set, starting
+            # from the members that the first update started with (unless
+            # either update needs a full rewrite).
+            _, first_old_members, _, msgs = self._pending[name]
+            if old_members is not None:
+                old_members = first_old_members
+            self._stats.increment("Updates coalesced")
+        else:
+            msgs = []
+        msgs.append(self._current_msg)
+        self._pending[name] = (ipset, old_members, new_members, msgs)
+
+    def _start_msg_batch(self, batch):
+        self._pending = {}
+        return batch
+
+    def _finish_msg_batch(self, batch, results):
+        pending = self._pending
+        self._pending = {}
+        # Each Ipset class has its own restore syntax so group by class.
+        updates_by_cls = defaultdict(list)
+        for ipset, old_members, new_members, msgs in pending.itervalues():
+            updates_by_cls[type(ipset)].append((ipset, old_members,
+                                                new_members, msgs))
+        failed_msgs = {}
+        for updates in updates_by_cls.itervalues():
+            input_lines = []
+            for ipset, old_members, new_members, _ in updates:
+                if old_members is None:
+                    input_lines += ipset._replace_members_lines(new_members)
+                else:
+                    input_lines += ipset._update_members_lines(old_members,
+                                                               new_members)
+            if not input_lines:
+                continue
+            self._histograms.record("Sets per restore", len(updates))
+            start_time = time.time()
+            try:
+                updates[0][0]._exec_and_commit(input_lines)
+            except FailedSystemCall:
+                _log.exception("Combined update of %s ipsets failed, "
+                               "falling back to updating them one by one.",
+                               len(updates))
+                self._stats.increment("Combined restore failures")
+                failed_msgs.update(self._write_individually(updates))
+            else:
+                self._stats.increment("Combined restores")
+            finally:
+                self._histograms.record("Restore time (ms)",
+                                        (time.time() - start_time) * 1000)
+        # Report failures to the messages that requested the failed sets.
+        for i, msg in enumerate(batch):
+            if msg in failed_msgs:
+                results[i] = ResultOrExc(None, failed_msgs[msg])
+
+    def _write_individually(self, updates):
+        """
+        Programs each of the given updates with its own ipset restore.
+
+        :returns dict: map from message to the exception that programming
+            its ipset raised.
+        """
+        failed_msgs = {}
+        for ipset, old_members, new_members, msgs in updates:
+            self._stats.increment("Per-set fallbacks")
+            try:
+                if old_members is None:
+                    ipset.replace_members(new_members)
+                else:
+                    ipset.update_members(old_members, new_members)
+            except FailedSystemCall as e:
+                _log.error("Failed to program ipset %s", ipset.set_name)
+                for msg in msgs:
+                    failed_msgs[msg] = e
+        return failed_msgs
+
+
+# Class used to program the sets behind tags, CIDR sets and IPAM pools.
+_ipset_class = Ipset
+# IpsetNetlinkClient used by Ipset in place of the ipset command, if any.
+_netlink_client = None
+
+
+def set_ipset_class(cls):
+    """
+    Sets the class used by new_ipset(); for example, the nftables backend
+    uses native nftables sets rather than ipsets.
+
+    :param cls: Ipset or a subclass.
+    """
+    global _ipset_class
+    _log.info("Using %s to program sets", cls.__name__)
+    _ipset_class = cls
+
+
+def set_netlink_client(client):
+    """
+    Sets the client that Ipset uses to program ipsets over netlink, rather
+    than running the ipset command.
+
+    :param IpsetNetlinkClient client: the client or None to use the ipset
+        command.
+    """
+    global _netlink_client
+    _log.info("Using %s to program ipsets",
+              "netlink" if client is not None else "the ipset command")
+    _netlink_client = client
+
+
+def _destroy_silent(ipset_name):
+    if _netlink_client is not None:
+        _netlink_client.destroy_silent(ipset_name)
+    else:
+        futils.call_silent(["ipset", "destroy", ipset_name])
+
+
+def new_ipset(ipset_name, temp_ipset_name, ip_family, ipset_type="hash:ip",
+              format_member=str):
+    """
+    :returns Ipset: an instance of the configured Ipset class.
+    """
+    return _ipset_class(ipset_name, temp_ipset_name, ip_family, ipset_type,
+                        format_member)
 
 
 # For IP-in-IP support, a global ipset that contains the IP addresses of all
@@ -748,6 +1460,64 @@ HOSTS_IPSET_V4 = Ipset(FELIX_PFX + "calico-hosts-4",
                        "inet")
 
 
+def ipset_sizing(num_members):
+    """
+    :returns tuple[int,int]: the (hashsize, maxelem) to create an ipset with
+        to hold the given number of members, with room to grow.  Both are
+        powers of 2, as the kernel requires.
+    """
+    hashsize = DEFAULT_HASHSIZE
+    while hashsize < num_members:
+        hashsize *= 2
+    maxelem = DEFAULT_MAXELEM
+    while maxelem < num_members * 2:
+        maxelem *= 2
+    return hashsize, maxelem
+
+
+def read_ipset_members():
+    """
+    Reads the members of all of Felix's sets from the dataplane, using the
+    configured Ipset class.
+
+    :returns dict[str,set[str]]: map from set name to members, or None if
+        the Ipset class doesn't support reading members.
+    """
+    return _ipset_class.read_all_members()
+
+
+def read_members_for_audit(max_age):
+    """
+    Reads the members of all of Felix's sets for an audit, reusing the
+    previous read if it is less than max_age seconds old.
+
+    :returns tuple: the write sequence number taken before the read and the
+        result of read_ipset_members().
+    """
+    global _audit_read
+    with _audit_read_lock:
+        now = monotonic_time()
+        if _audit_read is not None and now - _audit_read[0] < max_age:
+            _audit_stats.increment("Shared reads")
+            return _audit_read[1:]
+        audit_seq = next(_write_seqs)
+        members_by_name = read_ipset_members()
+        _audit_read = (now, audit_seq, members_by_name)
+        return audit_seq, members_by_name
+
+
+def canonical_net(cidr):
+    """
+    :returns str: the CIDR in the form that the kernel reports hash:net
+        members: with the host bits masked off and without the prefix length
+        if it is a single address.
+    """
+    net = IPNetwork(cidr).cidr
+    if net.size == 1:
+        return str(net.ip)
+    return str(net)
+
+
 def tag_to_ipset_name(ip_type, tag, tmp=False):
     """
     Turn a (possibly shortened) tag ID into an ipset name.
@@ -768,16 +1538,20 @@ def list_ipset_names():
     List all names of ipsets. Note that this is *not* the same as the ipset
     list command which lists contents too (hence the name change).
 
+    Only asks for the names; the full listing includes every member of
+    every set, which can be megabytes of text.
+
     :returns: List of names of ipsets.
     """
-    data = futils.check_call(["ipset", "list"]).stdout
-    lines = data.split("\n")
-
-    names = []
-
-    for line in lines:
-        words = line.split()
-        if len(words) > 1 and words[0] == "Name:":
-            names.append(words[1])
+    if _netlink_client is not None:
+        return _netlink_client.list_names()
+    try:
+        data = futils.check_call(["ipset", "list", "-n"]).stdout
+    except FailedSystemCall as e:
+        # Older versions of ipset don't support -n.
+        _log.warning("Failed to list ipset names (%s), falling back to "
+                     "full listing", e.stderr)
+        data = futils.check_call(["ipset", "list"]).stdout
+        return [m.group(1) for m in _IPSET_NAME_RE.finditer(data)]
+    return data.split()
 
-    return names
@@ -3,7 +3,7 @@
 import logging
 from calico.felix.actor import Actor, actor_message
 from calico.felix.futils import IPV4, IPV6
-from calico.felix.ipsets import Ipset, FELIX_PFX
+from calico.felix.ipsets import new_ipset, FELIX_PFX
 
 _log = logging.getLogger(__name__)
 
@@ -26,14 +26,14 @@ class MasqueradeManager(Actor):
         self.pools_by_id = {}
         self._iptables_mgr = iptables_mgr
         ip_family = "inet" if ip_type == IPV4 else "inet6"
-        self._all_pools_ipset = Ipset(ALL_POOLS_SET_NAME,
-                                      ALL_POOLS_SET_NAME + "-tmp",
-                                      ip_family,
-                                      "hash:net")
-        self._masq_pools_ipset = Ipset(MASQ_POOLS_SET_NAME,
-                                       MASQ_POOLS_SET_NAME + "-tmp",
-                                       ip_family,
-                                       "hash:net")
+        self._all_pools_ipset = new_ipset(ALL_POOLS_SET_NAME,
+                                          ALL_POOLS_SET_NAME + "-tmp",
+                                          ip_family,
+                                          "hash:net")
+        self._masq_pools_ipset = new_ipset(MASQ_POOLS_SET_NAME,
+                                           MASQ_POOLS_SET_NAME + "-tmp",
+                                           ip_family,
+                                           "hash:net")
         self._dirty = False
 
     @actor_message()
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.netlink
+~~~~~~~~~~~~~
+
+Minimal netlink message encoding and decoding, and a request/response
+helper for talking to the kernel over a netlink socket.
+
+Many messages can be sent in one datagram; the kernel processes them in
+order and, since we only ask for an ACK on the last one, only failures
+and the final ACK come back.  Note that this is not transactional, and
+that the kernel carries on with the rest of a datagram after a message
+fails: a failure can only stop later datagrams from being sent.  Callers
+that need a request to run only if all the earlier ones succeeded put a
+BARRIER before it, which starts a new datagram.
+"""
+from itertools import count
+import logging
+import os
+import socket
+import struct
+
+import gevent.lock
+
+from calico.felix.futils import StatCounter
+
+_log = logging.getLogger(__name__)
+
+# These constants map to constants in the Linux kernel.
+NLMSG_NOOP = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+# Modifiers to NEW requests.
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_APPEND = 0x800
+
+NLA_F_NESTED = 0x8000
+NLA_F_NET_BYTEORDER = 0x4000
+NLA_TYPE_MASK = ~(NLA_F_NESTED | NLA_F_NET_BYTEORDER) & 0xffff
+
+NETLINK_ROUTE = 0
+NETLINK_NETFILTER = 12
+
+NLMSG_HDR = struct.Struct("=LHHLL")
+NLA_HDR = struct.Struct("=HH")
+
+# Limit on the size of each datagram that we send.  Bounds the size of the
+# error replies that we can get back for one datagram so that they fit in
+# the socket's receive buffer.
+MAX_BATCH_BYTES = 64 * 1024
+RECV_BUFSIZE = 65536
+
+# Marker for NetlinkSocket.send_batch(): the requests after it go in a new
+# datagram, which is only sent if all the requests before it succeeded.
+BARRIER = object()
+
+
+class NetlinkError(Exception):
+    """
+    Raised when the kernel rejects a netlink request.
+    """
+    def __init__(self, errno, message=None):
+        super(NetlinkError, self).__init__(message or os.strerror(errno))
+        self.errno = errno
+
+
+def align(length):
+    """
+    :returns int: the length rounded up to the netlink alignment of 4.
+    """
+    return (length + 3) & ~3
+
+
+def encode_msg(msg_type, flags, seq, payload):
+    """
+    :returns str: the netlink message, including its header and padding.
+    """
+    length = NLMSG_HDR.size + len(payload)
+    return (NLMSG_HDR.pack(length, msg_type, flags, seq, 0) + payload +
+            "\0" * (align(length) - length))
+
+
+def encode_attr(attr_type, data):
+    """
+    :returns str: a netlink attribute, including its header and padding.
+    """
+    length = NLA_HDR.size + len(data)
+    return (NLA_HDR.pack(length, attr_type) + data +
+            "\0" * (align(length) - length))
+
+
+def encode_u8_attr(attr_type, value):
+    return encode_attr(attr_type, struct.pack("=B", value))
+
+
+def encode_u32_attr(attr_type, value, net_byteorder=False):
+    if net_byteorder:
+        return encode_attr(attr_type | NLA_F_NET_BYTEORDER,
+                           struct.pack("!I", value))
+    return encode_attr(attr_type, struct.pack("=I", value))
+
+
+def encode_str_attr(attr_type, value):
+    # Strings are NUL-terminated.
+    return encode_attr(attr_type, value + "\0")
+
+
+def encode_nested_attr(attr_type, *attrs):
+    return encode_attr(attr_type | NLA_F_NESTED, "".join(attrs))
+
+
+def parse_messages(data):
+    """
+    Generator: parses every netlink message in a buffer.
+
+    :returns: iterator over (msg_type, flags, seq, payload) tuples.
+    """
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        length, msg_type, flags, seq, _ = NLMSG_HDR.unpack_from(data, offset)
+        if length < NLMSG_HDR.size or offset + length > len(data):
+            _log.error("Truncated netlink message, length %s at offset %s "
+                       "of %s", length, offset, len(data))
+            return
+        yield (msg_type, flags, seq,
+               data[offset + NLMSG_HDR.size:offset + length])
+        offset += align(length)
+
+
+def parse_attrs(data):
+    """
+    Generator: parses a sequence of netlink attributes.
+
+    :returns: iterator over (attr_type, data) tuples.  The nested and byte
+        order flags are masked out of attr_type.
+    """
+    offset = 0
+    while offset + NLA_HDR.size <= len(data):
+        length, attr_type = NLA_HDR.unpack_from(data, offset)
+        if length < NLA_HDR.size:
+            # Matches the kernel's RTA_OK()/nla_ok() check.
+            return
+        yield (attr_type & NLA_TYPE_MASK,
+               data[offset + NLA_HDR.size:offset + length])
+        offset += align(length)
+
+
+def parse_error(payload):
+    """
+    :returns int: the (positive) errno from an NLMSG_ERROR payload, or 0
+        if the message is an ACK.
+    """
+    error, = struct.unpack_from("=i", payload)
+    return -error
+
+
+class NetlinkSocket(object):
+    """
+    Request/response wrapper around a netlink socket.
+
+    Safe to share between greenlets: requests are serialized so that each
+    one only sees its own replies.
+    """
+    def __init__(self, protocol, sock=None):
+        """
+        :param protocol: netlink protocol, e.g. NETLINK_NETFILTER.
+        :param sock: optional pre-made socket, for test.
+        """
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 protocol)
+            sock.bind((0, 0))
+        self._sock = sock
+        self._seqs = count(1)
+        self._lock = gevent.lock.Semaphore()
+        self._stats = StatCounter("Netlink protocol %s" % protocol)
+
+    def send_batch(self, requests, stop_on_error=True):
+        """
+        Sends the requests, packing as many as possible into each datagram.
+
+        The kernel processes every message in a datagram, even after one
+        fails, so stop_on_error only stops the datagrams after a failure.
+        Put a BARRIER before any request that mustn't run if an earlier
+        one failed.
+
+        :param list requests: list of (msg_type, flags, payload) tuples,
+            and BARRIERs.  NLM_F_REQUEST is added to the flags.
+        :param stop_on_error: if True, don't send any further datagrams
+            after a request fails.
+        :returns list: (index into requests, errno) for each failure.
+        """
+        failures = []
+        with self._lock:
+            start = 0
+            while start < len(requests):
+                if requests[start] is BARRIER:
+                    start += 1
+                    continue
+                end, chunk, seq_base = self._encode_chunk(requests, start)
+                self._sock.sendto(chunk, (0, 0))
+                self._stats.increment("Datagrams sent")
+                self._stats.increment("Messages sent", end - start)
+                last_seq = seq_base + (end - start - 1)
+                for seq, errno in self._recv_acks(last_seq):
+                    failures.append((start + seq - seq_base, errno))
+                start = end
+                if failures and stop_on_error:
+                    break
+        if failures:
+            self._stats.increment("Messages failed", len(failures))
+        return failures
+
+    def request(self, msg_type, flags, payload):
+        """
+        Sends a single request and waits for its ACK.
+
+        :returns list: (msg_type, flags, payload) for any replies before the
+            ACK.
+        :raises NetlinkError: if the kernel rejects the request.
+        """
+        with self._lock:
+            seq = next(self._seqs)
+            self._sock.sendto(encode_msg(msg_type,
+                                         flags | NLM_F_REQUEST | NLM_F_ACK,
+                                         seq, payload), (0, 0))
+            replies = []
+            while True:
+                for reply in parse_messages(self._sock.recv(RECV_BUFSIZE)):
+                    r_type, r_flags, r_seq, r_payload = reply
+                    if r_seq != seq:
+                        continue
+                    if r_type == NLMSG_ERROR:
+                        errno = parse_error(r_payload)
+                        if errno:
+                            raise NetlinkError(errno)
+                        return replies
+                    replies.append((r_type, r_flags, r_payload))
+
+    def dump(self, msg_type, payload):
+        """
+        Sends a dump request.
+
+        :returns list: (msg_type, flags, payload) for each reply.
+        :raises NetlinkError: if the kernel rejects the request.
+        """
+        return list(self.iter_dump(msg_type, payload))
+
+    def iter_dump(self, msg_type, payload):
+        """
+        Generator: sends a dump request and yields the replies as they
+        arrive, so that a large dump needn't be held in memory.  The socket
+        is locked until the generator finishes, so don't make other requests
+        on it from the loop.
+
+        :returns: iterator over (msg_type, flags, payload) for each reply.
+        :raises NetlinkError: if the kernel rejects the request.
+        """
+        with self._lock:
+            seq = next(self._seqs)
+            self._sock.sendto(encode_msg(msg_type,
+                                         NLM_F_REQUEST | NLM_F_DUMP,
+                                         seq, payload), (0, 0))
+            while True:
+                for reply in parse_messages(self._sock.recv(RECV_BUFSIZE)):
+                    r_type, r_flags, r_seq, r_payload = reply
+                    if r_seq != seq:
+                        continue
+                    if r_type == NLMSG_DONE:
+                        return
+                    if r_type == NLMSG_ERROR:
+                        raise NetlinkError(parse_error(r_payload))
+                    yield r_type, r_flags, r_payload
+
+    def _encode_chunk(self, requests, start):
+        """
+        Encodes requests from start onwards, up to the next BARRIER or
+        MAX_BATCH_BYTES.  Only the last message in the chunk asks for an
+        ACK.
+
+        :returns tuple: (index after the last request in the chunk,
+            encoded chunk, sequence number of the first request).
+        """
+        seq_base = next(self._seqs)
+        msgs = []
+        size = 0
+        end = start
+        while end < len(requests) and requests[end] is not BARRIER:
+            msg_type, flags, payload = requests[end]
+            msg = encode_msg(msg_type, flags | NLM_F_REQUEST,
+                             seq_base + (end - start), payload)
+            if msgs and size + len(msg) > MAX_BATCH_BYTES:
+                break
+            msgs.append(msg)
+            size += len(msg)
+            end += 1
+        msgs[-1] = _add_ack(msgs[-1])
+        # Reserve the sequence numbers that we used.
+        for _ in xrange(end - start - 1):
+            next(self._seqs)
+        return end, "".join(msgs), seq_base
+
+    def _recv_acks(self, last_seq):
+        """
+        Generator: reads replies until the ACK for last_seq.
+
+        :returns: iterator over (seq, errno) for each failed request.
+        """
+        while True:
+            for r_type, _, r_seq, r_payload in parse_messages(
+                    self._sock.recv(RECV_BUFSIZE)):
+                if r_type != NLMSG_ERROR:
+                    continue
+                errno = parse_error(r_payload)
+                if errno:
+                    yield r_seq, errno
+                if r_seq == last_seq:
+                    return
+
+
+def _add_ack(msg):
+    """
+    :returns str: copy of an encoded message with NLM_F_ACK set.
+    """
+    length, msg_type, flags, seq, pid = NLMSG_HDR.unpack_from(msg)
+    return (NLMSG_HDR.pack(length, msg_type, flags | NLM_F_ACK, seq, pid) +
+            msg[NLMSG_HDR.size:])
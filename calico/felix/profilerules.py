@@ -21,8 +21,9 @@ ProfileRules actor, handles local profile chains.
 
 import logging
 from calico.felix.actor import actor_message
-from calico.felix.frules import (profile_to_chain_name,
-                                 rules_to_chain_rewrite_lines)
+from calico.felix.frules import (optimize_rules, profile_to_chain_name,
+                                 rules_to_chain_rewrite_lines,
+                                 shared_chain_rewrite_lines)
 from calico.felix.futils import FailedSystemCall
 from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
 
@@ -38,15 +39,17 @@ class RulesManager(ReferenceManager):
     This class ensures that rules chains are properly quiesced
     before their Actors are deleted.
     """
-    def __init__(self, ip_version, iptables_updater, ipset_manager):
+    def __init__(self, config, ip_version, iptables_updater, ipset_manager):
         super(RulesManager, self).__init__(qualifier="v%d" % ip_version)
+        self.config = config
         self.ip_version = ip_version
         self.iptables_updater = iptables_updater
         self.ipset_manager = ipset_manager
         self.rules_by_profile_id = {}
 
     def _create(self, profile_id):
-        return ProfileRules(profile_id,
+        return ProfileRules(self.config,
+                            profile_id,
                             self.ip_version,
                             self.iptables_updater,
                             self.ipset_manager)
@@ -90,20 +93,28 @@ class ProfileRules(RefCountedActor):
     """
     Actor that owns the per-profile rules chains.
     """
-    def __init__(self, profile_id, ip_version, iptables_updater, ipset_mgr):
+    def __init__(self, config, profile_id, ip_version, iptables_updater,
+                 ipset_mgr):
         super(ProfileRules, self).__init__(qualifier=profile_id)
         assert profile_id is not None
 
+        self.config = config
         self.id = profile_id
         self.ip_version = ip_version
         self._ipset_mgr = ipset_mgr
         self._iptables_updater = iptables_updater
         self._ipset_refs = RefHelper(self, ipset_mgr, self._on_ipsets_acquired)
+        # References to the ipsets of CIDRs generated by the rule optimizer.
+        self._net_ipset_refs = RefHelper(self, ipset_mgr,
+                                         self._on_ipsets_acquired)
 
         # Latest profile update - a profile dictionary.
         self._pending_profile = None
         # Currently-programmed profile dictionary.
         self._profile = None
+        # Output of the rule optimizer for the current profile; map from
+        # direction to list of rules.
+        self._optimized_rules = {}
 
         # State flags.
         self._notified_ready = False
@@ -169,6 +180,8 @@ class ProfileRules(RefCountedActor):
                     self._delete_chains()
                     self._ipset_refs.discard_all()
                     self._ipset_refs = None # Break ref cycle.
+                    self._net_ipset_refs.discard_all()
+                    self._net_ipset_refs = None
                     self._profile = None
                     self._pending_profile = None
                 finally:
@@ -187,11 +200,13 @@ class ProfileRules(RefCountedActor):
                 for tag in added_tags:
                     _log.debug("Requesting ipset for tag %s", tag)
                     self._ipset_refs.acquire_ref(tag)
+                self._optimize_rules()
                 self._dirty = True
                 self._profile = self._pending_profile
 
             if (self._dirty and
                     self._ipset_refs.ready and
+                    self._net_ipset_refs.ready and
                     self._pending_profile is not None):
                 _log.info("Ready to program rules for %s", self.id)
                 try:
@@ -212,10 +227,32 @@ class ProfileRules(RefCountedActor):
                                    self.id)
                 else:
                     self._dirty = False
-            elif not self._ipset_refs.ready:
+            elif not (self._ipset_refs.ready and self._net_ipset_refs.ready):
                 _log.info("Can't program rules %s yet, waiting on ipsets",
                           self.id)
 
+    def _optimize_rules(self):
+        """
+        Runs the rule optimizer over the pending profile and updates our
+        references to the ipsets that it generates.
+        """
+        self._optimized_rules = {}
+        net_set_ids = set()
+        if self._pending_profile is not None:
+            for direction in ("inbound", "outbound"):
+                rules = self._pending_profile.get("%s_rules" % direction, [])
+                optimized, ids = optimize_rules(
+                    rules, self.ip_version, self.config.CIDR_IPSET_MIN_RULES)
+                if ids:
+                    num_rules = sum(1 for r in rules if r.get("ip_version")
+                                    in (None, self.ip_version))
+                    _log.info("Profile %s %s chain: %d rules per packet "
+                              "before optimization, %d after", self.id,
+                              direction, num_rules, len(optimized))
+                self._optimized_rules[direction] = optimized
+                net_set_ids.update(ids)
+        self._net_ipset_refs.replace_all(net_set_ids)
+
     def _delete_chains(self):
         """
         Removes our chains from the dataplane, blocks until complete.
@@ -239,26 +276,47 @@ class ProfileRules(RefCountedActor):
         assert self._pending_profile is not None, \
                "_update_chains called with no _pending_profile"
         updates = {}
+        deps = {}
+        shared_chains = {}
         for direction in ("inbound", "outbound"):
             chain_name = self.chain_names[direction]
             _log.info("Updating %s chain %r for profile %s",
                       direction, chain_name, self.id)
             _log.debug("Profile %s: %s", self.id, self._profile)
-            rules_key = "%s_rules" % direction
-            new_rules = self._pending_profile.get(rules_key, [])
+            new_rules = self._optimized_rules[direction]
             tag_to_ip_set_name = {}
             for tag, ipset in self._ipset_refs.iteritems():
                 tag_to_ip_set_name[tag] = ipset.ipset_name
-            updates[chain_name] = rules_to_chain_rewrite_lines(
-                chain_name,
-                new_rules,
-                self.ip_version,
-                tag_to_ip_set_name,
-                on_allow="RETURN",
-                comment_tag=self.id)
+            if self.config.SHARE_PROFILE_CHAINS:
+                # Program the rules into a chain that is named after its
+                # contents, so that it can be shared with any other profiles
+                # that have the same rules.  Our chain just jumps to it.
+                shared_name, shared_lines = shared_chain_rewrite_lines(
+                    new_rules,
+                    self.ip_version,
+                    tag_to_ip_set_name,
+                    on_allow="RETURN")
+                shared_chains[shared_name] = shared_lines
+                updates[chain_name] = [
+                    "--append %s --goto %s" % (chain_name, shared_name)
+                ]
+                deps[chain_name] = set([shared_name])
+            else:
+                updates[chain_name] = rules_to_chain_rewrite_lines(
+                    chain_name,
+                    new_rules,
+                    self.ip_version,
+                    tag_to_ip_set_name,
+                    on_allow="RETURN",
+                    comment_tag=self.id)
         _log.debug("Queueing programming for rules %s: %s", self.id,
                    updates)
-        self._iptables_updater.rewrite_chains(updates, {}, async=False)
+        if shared_chains:
+            self._iptables_updater.rewrite_chains(updates, deps,
+                                                  shared_chains=shared_chains,
+                                                  async=False)
+        else:
+            self._iptables_updater.rewrite_chains(updates, {}, async=False)
 
 
 def extract_tags_from_profile(profile):
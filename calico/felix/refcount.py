@@ -126,6 +126,7 @@ class ReferenceManager(Actor):
                 self.stopping_objects_by_id[object_id].add(obj)
             self.objects_by_id.pop(object_id)
             self.pending_ref_callbacks.pop(object_id, None)
+            self._on_object_unreferenced(object_id)
 
     @actor_message()
     def on_object_cleanup_complete(self, object_id, obj):
@@ -186,6 +187,14 @@ class ReferenceManager(Actor):
         """
         raise NotImplementedError()  # pragma nocover
 
+    def _on_object_unreferenced(self, obj_id):
+        """
+        May be overridden by subclasses, called when the last reference to
+        the object with the given ID is returned, after it has been removed
+        from objects_by_id.
+        """
+        pass
+
     def _create(self, object_id):
         """
         To be overriden by subclasses.
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.rtnetlink
+~~~~~~~~~~~~~~~
+
+Programs routes and neighbor (ARP) entries over RTNETLINK rather than by
+running the ip and arp commands, and tracks the routes to each interface.
+
+RtnetlinkClient.run_batch() accepts the same lines as "ip -batch", so
+callers can use either path.  Unlike "ip -batch", which exits at the first
+failing line, it carries on past failures: the kernel processes every
+message in a datagram.  That's safe for the lines that we send since each
+one is an idempotent replace or delete of a single route or neighbor
+entry.
+"""
+from collections import defaultdict
+import errno
+import logging
+import os
+import socket
+import struct
+
+import gevent.lock
+
+from calico.felix.futils import FailedSystemCall, StatCounter
+from calico.felix import netlink
+from calico.felix.netlink import (encode_attr, encode_u32_attr,
+                                  encode_str_attr, parse_attrs,
+                                  parse_messages, NetlinkError,
+                                  NetlinkSocket, NLM_F_CREATE, NLM_F_REPLACE,
+                                  RECV_BUFSIZE)
+
+_log = logging.getLogger(__name__)
+
+# These constants map to constants in the Linux kernel.
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_ROUTE = 0x400
+
+IFF_UP = 0x1
+IFLA_IFNAME = 3
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_TABLE = 15
+RTM_F_CLONED = 0x200
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_PERMANENT = 0x80
+
+IFINFOMSG = struct.Struct("=BBHiII")
+RTMSG = struct.Struct("=BBBBBBBBI")
+NDMSG = struct.Struct("=BBHiHBB")
+
+# Receive buffer for route events.  If it overflows, we resync from a dump.
+EVENT_RCVBUF = 1024 * 1024
+
+_FAMILY_TO_VERSION = {socket.AF_INET: 4, socket.AF_INET6: 6}
+
+
+class RtnetlinkClient(object):
+    """
+    Client for programming routes and neighbors over RTNETLINK.
+    """
+    def __init__(self, sock=None):
+        """
+        :param sock: optional pre-made netlink socket, for test.
+        """
+        self._nl = NetlinkSocket(netlink.NETLINK_ROUTE, sock=sock)
+
+    def get_ifindex(self, if_name):
+        """
+        :returns int: the index of the interface.
+        :raises NetlinkError: if the interface doesn't exist.
+        """
+        replies = self._nl.request(RTM_GETLINK, 0, encode_getlink(if_name))
+        for msg_type, _, payload in replies:
+            if msg_type == RTM_NEWLINK:
+                return IFINFOMSG.unpack_from(payload)[3]
+        raise NetlinkError(errno.ENODEV)
+
+    def run_batch(self, lines):
+        """
+        Applies the given lines of "ip -batch" input.  Supports the
+        "route replace/del" and "neigh replace/del" lines that
+        devices.py generates.
+
+        :raises FailedSystemCall: if any of the lines fail, reporting the
+            first failure.  Unlike "ip -batch", lines after the failing one
+            may still have been applied.
+        """
+        ifindexes = {}
+        requests = []
+        for line_no, line in enumerate(lines, 1):
+            words = line.split()
+            try:
+                if_name = words[words.index("dev") + 1]
+            except (ValueError, IndexError):
+                raise _failure(lines, line_no, "Error: device is required.")
+            if if_name not in ifindexes:
+                try:
+                    ifindexes[if_name] = self.get_ifindex(if_name)
+                except NetlinkError:
+                    raise _failure(lines, line_no,
+                                   'Cannot find device "%s"' % if_name)
+            try:
+                requests.append(encode_ip_line(words, ifindexes[if_name]))
+            except ValueError as e:
+                raise _failure(lines, line_no, str(e))
+        failures = self._nl.send_batch(requests)
+        if failures:
+            index, err = failures[0]
+            raise _failure(lines, index + 1,
+                           "RTNETLINK answers: %s" % os.strerror(err))
+
+
+class RouteTable(object):
+    """
+    Index of the host routes in the main routing table, by interface.
+
+    Seeded from RTM_GETLINK and RTM_GETROUTE dumps and then kept up to date
+    from RTNETLINK events.  Rather than having a greenlet read the events,
+    each lookup first applies whatever events are queued on the socket.
+    The kernel queues the event for a change before it acknowledges the
+    change, so a lookup always sees the effect of our own earlier writes.
+    """
+    def __init__(self, event_sock=None, dump_sock=None):
+        """
+        :param event_sock: optional pre-made event socket, for test.
+        :param dump_sock: optional pre-made request socket, for test.
+        """
+        if event_sock is None:
+            event_sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                       netlink.NETLINK_ROUTE)
+            event_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                  EVENT_RCVBUF)
+            event_sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_ROUTE |
+                             RTMGRP_IPV6_ROUTE))
+        event_sock.setblocking(False)
+        self._events = event_sock
+        self._nl = NetlinkSocket(netlink.NETLINK_ROUTE, sock=dump_sock)
+        self._lock = gevent.lock.Semaphore()
+        self._stats = StatCounter("Route table")
+        self._resync_needed = True
+
+        # Interface name to index and vice-versa.
+        self._ifindexes = {}
+        self._if_names = {}
+        # Indexes of the interfaces that are admin up.
+        self._up_ifindexes = set()
+        # Maps (IP version, ifindex) to the set of IPs routed to that
+        # interface and (IP version, IP) to the set of ifindexes.
+        self._ips = defaultdict(set)
+        self._oifs = defaultdict(set)
+
+    def interface_ips(self, ip_version, if_name):
+        """
+        :returns set[str]: the IPs that have a host route to the interface;
+            empty if the interface doesn't exist.
+        """
+        with self._lock:
+            self._read_events()
+            while self._resync_needed:
+                self._resync()
+                self._read_events()
+            ifindex = self._ifindexes.get(if_name)
+            return set(self._ips.get((ip_version, ifindex), ()))
+
+    def _read_events(self):
+        """
+        Applies all the events that are queued on the socket, without
+        blocking.
+        """
+        while True:
+            try:
+                data = self._events.recv(RECV_BUFSIZE)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.errno == errno.ENOBUFS:
+                    _log.warning("Route event queue overflowed, resyncing")
+                    self._stats.increment("Event queue overflows")
+                    self._resync_needed = True
+                    continue
+                raise
+            for msg_type, flags, _, payload in parse_messages(data):
+                self._stats.increment("Events")
+                self._on_message(msg_type, flags, payload)
+
+    def _resync(self):
+        """
+        Rebuilds the index from dumps of the interfaces and routes.  Events
+        queued during the dumps get applied afterwards; since they are
+        applied in order, the index still ends up matching the kernel.
+        """
+        _log.info("Loading routes from the kernel")
+        self._stats.increment("Resyncs")
+        self._resync_needed = False
+        self._ifindexes.clear()
+        self._if_names.clear()
+        self._up_ifindexes.clear()
+        self._ips.clear()
+        self._oifs.clear()
+        dumps = [(RTM_GETLINK, encode_getlink_dump())]
+        dumps += [(RTM_GETROUTE, RTMSG.pack(family, 0, 0, 0, 0, 0, 0, 0, 0))
+                  for family in (socket.AF_INET, socket.AF_INET6)]
+        for msg_type, payload in dumps:
+            for r_type, r_flags, r_payload in self._nl.dump(msg_type,
+                                                             payload):
+                self._on_message(r_type, r_flags, r_payload)
+
+    def _on_message(self, msg_type, flags, payload):
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            self._on_link(msg_type, payload)
+        elif msg_type in (RTM_NEWROUTE, RTM_DELROUTE):
+            self._on_route(msg_type, flags, payload)
+
+    def _on_link(self, msg_type, payload):
+        _, _, _, ifindex, if_flags, _ = IFINFOMSG.unpack_from(payload)
+        attrs = dict(parse_attrs(payload[IFINFOMSG.size:]))
+        if_name = attrs.get(IFLA_IFNAME, "").rstrip("\0")
+        was_up = ifindex in self._up_ifindexes
+        old_name = self._if_names.get(ifindex)
+        if old_name is not None and (msg_type == RTM_DELLINK or
+                                     (if_name and if_name != old_name)):
+            del self._if_names[ifindex]
+            if self._ifindexes.get(old_name) == ifindex:
+                del self._ifindexes[old_name]
+        if msg_type == RTM_DELLINK:
+            # The kernel doesn't send events for the IPv4 routes that go
+            # with the interface.
+            self._up_ifindexes.discard(ifindex)
+            for ip_version in (4, 6):
+                for ip in self._ips.pop((ip_version, ifindex), ()):
+                    self._discard_oif(ip_version, ip, ifindex)
+            return
+        if if_name:
+            self._ifindexes[if_name] = ifindex
+            self._if_names[ifindex] = if_name
+        if if_flags & IFF_UP:
+            self._up_ifindexes.add(ifindex)
+        elif was_up:
+            # Taking an interface down removes (some of) its routes, again
+            # without events, so reload.
+            _log.debug("Interface %s went down, need to resync", if_name)
+            self._up_ifindexes.discard(ifindex)
+            self._resync_needed = True
+
+    def _on_route(self, msg_type, flags, payload):
+        (family, dst_len, _, _, table, _, _, _,
+         rt_flags) = RTMSG.unpack_from(payload)
+        attrs = dict(parse_attrs(payload[RTMSG.size:]))
+        if RTA_TABLE in attrs:
+            table, = struct.unpack("=I", attrs[RTA_TABLE])
+        ip_version = _FAMILY_TO_VERSION.get(family)
+        dst = attrs.get(RTA_DST)
+        if (ip_version is None or table != RT_TABLE_MAIN or
+                rt_flags & RTM_F_CLONED or RTA_OIF not in attrs or
+                dst is None or dst_len != len(dst) * 8):
+            # Not a host route via an interface, which is all we track.
+            return
+        ip = socket.inet_ntop(family, dst)
+        ifindex, = struct.unpack("=I", attrs[RTA_OIF])
+        if msg_type == RTM_DELROUTE:
+            self._discard_oif(ip_version, ip, ifindex)
+            self._ips[(ip_version, ifindex)].discard(ip)
+            return
+        if flags & NLM_F_REPLACE:
+            # Replaced any other route to the same IP.
+            for old_ifindex in self._oifs.pop((ip_version, ip), ()):
+                self._ips[(ip_version, old_ifindex)].discard(ip)
+        self._oifs[(ip_version, ip)].add(ifindex)
+        self._ips[(ip_version, ifindex)].add(ip)
+
+    def _discard_oif(self, ip_version, ip, ifindex):
+        oifs = self._oifs.get((ip_version, ip))
+        if oifs is not None:
+            oifs.discard(ifindex)
+            if not oifs:
+                del self._oifs[(ip_version, ip)]
+
+
+def create_client():
+    """
+    :returns RtnetlinkClient: a client, or None if RTNETLINK isn't available
+        to us.
+    """
+    try:
+        client = RtnetlinkClient()
+        client.get_ifindex("lo")
+    except (socket.error, NetlinkError) as e:
+        _log.warning("RTNETLINK unavailable (%r), using the ip command", e)
+        return None
+    return client
+
+
+def create_route_table():
+    """
+    :returns RouteTable: a loaded route table, or None if RTNETLINK isn't
+        available to us.
+    """
+    try:
+        table = RouteTable()
+        table.interface_ips(4, "lo")
+    except (socket.error, NetlinkError) as e:
+        _log.warning("RTNETLINK unavailable (%r), using the ip command to "
+                     "list routes", e)
+        return None
+    return table
+
+
+def encode_ip_line(words, ifindex):
+    """
+    Converts a line of "ip -batch" input into a netlink request.
+
+    :param list[str] words: the words of the line.
+    :param int ifindex: index of the interface named in the line.
+    :returns tuple: (msg_type, flags, payload).
+    :raises ValueError: if the line isn't one that we support.
+    """
+    obj, op = words[:2]
+    if obj == "route" and op in ("replace", "del") and len(words) == 5:
+        return encode_route(op == "replace", words[2], ifindex)
+    if (obj == "neigh" and op == "replace" and len(words) == 9 and
+            words[3] == "lladdr" and words[7:] == ["nud", "permanent"]):
+        return encode_neigh(True, words[2], ifindex, words[4])
+    if obj == "neigh" and op == "del" and len(words) == 5:
+        return encode_neigh(False, words[2], ifindex)
+    raise ValueError("Error: unsupported command \"%s\"" % " ".join(words))
+
+
+def encode_getlink(if_name):
+    """
+    :returns str: payload of an RTM_GETLINK request for the named interface.
+    """
+    return (IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0) +
+            encode_str_attr(IFLA_IFNAME, if_name))
+
+
+def encode_getlink_dump():
+    """
+    :returns str: payload of an RTM_GETLINK request to dump all interfaces.
+    """
+    return IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0)
+
+
+def encode_route(replace, dst, ifindex):
+    """
+    Encodes the equivalent of "ip route replace|del <dst> dev <iface>".
+    """
+    family, addr, dst_len = _parse_prefix(dst)
+    if replace:
+        rtmsg = RTMSG.pack(family, dst_len, 0, 0, RT_TABLE_MAIN, RTPROT_BOOT,
+                           RT_SCOPE_LINK, RTN_UNICAST, 0)
+        msg_type, flags = RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE
+    else:
+        rtmsg = RTMSG.pack(family, dst_len, 0, 0, RT_TABLE_MAIN, 0,
+                           RT_SCOPE_NOWHERE, 0, 0)
+        msg_type, flags = RTM_DELROUTE, 0
+    return msg_type, flags, (rtmsg + encode_attr(RTA_DST, addr) +
+                             encode_u32_attr(RTA_OIF, ifindex))
+
+
+def encode_neigh(replace, dst, ifindex, mac=None):
+    """
+    Encodes the equivalent of "ip neigh replace <dst> lladdr <mac> dev
+    <iface> nud permanent" or "ip neigh del <dst> dev <iface>".
+    """
+    family, addr, _ = _parse_prefix(dst)
+    payload = NDMSG.pack(family, 0, 0, ifindex, NUD_PERMANENT, 0, 0)
+    payload += encode_attr(NDA_DST, addr)
+    if replace:
+        try:
+            lladdr = "".join(chr(int(b, 16)) for b in mac.split(":"))
+        except ValueError:
+            raise ValueError("Error: \"%s\" is invalid lladdr." % mac)
+        payload += encode_attr(NDA_LLADDR, lladdr)
+        return RTM_NEWNEIGH, NLM_F_CREATE | NLM_F_REPLACE, payload
+    return RTM_DELNEIGH, 0, payload
+
+
+def _parse_prefix(prefix):
+    """
+    :returns tuple: (address family, packed address, prefix length).
+    """
+    ip, _, prefix_len = prefix.partition("/")
+    family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+    try:
+        addr = socket.inet_pton(family, ip)
+    except socket.error:
+        raise ValueError("Error: an inet prefix is expected rather than "
+                         "\"%s\"." % prefix)
+    return family, addr, int(prefix_len or len(addr) * 8)
+
+
+def _failure(lines, line_no, message):
+    return FailedSystemCall("Failed to program routes over netlink",
+                            ["ip", "-batch", "-"], 1, "",
+                            "%s\nCommand failed -:%s\n" % (message, line_no),
+                            input="\n".join(lines))
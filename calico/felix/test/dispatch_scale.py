@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.dispatch_scale
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Benchmark for the dispatch chain tree: reports the number of rules that a
+packet traverses to reach its endpoint chain as the number of interfaces
+scales.
+
+Usage: python -m calico.felix.test.dispatch_scale [<max fan-out>]
+"""
+import collections
+import random
+import sys
+import time
+
+from calico.felix.dispatch import DispatchChains
+from calico.felix.frules import CHAIN_FROM_ENDPOINT
+
+Config = collections.namedtuple("Config", ["IFACE_PREFIX",
+                                           "DISPATCH_MAX_FANOUT"])
+
+
+def rules_traversed(updates, iface):
+    """
+    Follows the "from" dispatch chains in the given updates, as the kernel
+    would, for a packet from the given interface.
+
+    :returns int: the number of rules that the packet is tested against
+        before it is sent to its endpoint chain.
+    """
+    chain = CHAIN_FROM_ENDPOINT
+    count = 0
+    while True:
+        for rule in updates[chain]:
+            count += 1
+            words = rule.split()
+            if "--in-interface" not in words:
+                raise AssertionError("%s not dispatched" % iface)
+            match = words[words.index("--in-interface") + 1]
+            if (iface == match or
+                    (match.endswith("+") and iface.startswith(match[:-1]))):
+                chain = words[words.index("--goto") + 1]
+                break
+        if chain not in updates:
+            # Reached the endpoint chain.
+            return count
+
+
+def random_ifaces(num_ifaces):
+    # Neutron-style names: "tap" plus 11 hex characters.
+    return set("tap%011x" % random.getrandbits(44)
+               for _ in xrange(num_ifaces))
+
+
+def run(max_fanout):
+    print "%8s %10s %10s %8s %8s" % ("ifaces", "max rules", "mean rules",
+                                     "chains", "time")
+    for num_ifaces in (10, 100, 1000, 4000, 10000, 20000):
+        config = Config("tap", max_fanout)
+        dispatch = DispatchChains(config, 4, None)
+        ifaces = random_ifaces(num_ifaces)
+        start = time.time()
+        _, _, updates, _ = dispatch._calculate_update(ifaces)
+        elapsed = time.time() - start
+        counts = [rules_traversed(updates, i) for i in ifaces]
+        print "%8s %10s %10.1f %8s %7.3fs" % (
+            len(ifaces), max(counts), float(sum(counts)) / len(counts),
+            len(updates), elapsed)
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 16)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.endpoint_id_scale
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+CPU benchmark for EndpointIds in the set- and dict-heavy indexes that
+Felix keeps: loads N endpoints into per-host sets and an endpoint dict, as
+the etcd watcher does on a snapshot, then applies U updates, each with a
+freshly-constructed ID.  Runs the same workload with the old,
+non-canonicalized EndpointId for comparison.
+
+Usage: python -m calico.felix.test.endpoint_id_scale [<num endpoints>
+[<num updates>]]
+"""
+import collections
+import sys
+import time
+
+from calico.datamodel_v1 import EndpointId
+
+
+class LegacyEndpointId(object):
+    """
+    The EndpointId from before it was a flyweight.
+    """
+    __slots__ = ["host", "orchestrator", "workload", "endpoint"]
+
+    def __init__(self, host, orchestrator, workload, endpoint):
+        self.host = intern(host.encode("utf8"))
+        self.orchestrator = intern(orchestrator.encode("utf8"))
+        self.workload = intern(workload.encode("utf8"))
+        self.endpoint = intern(endpoint.encode("utf8"))
+
+    def __eq__(self, other):
+        if other is self:
+            return True
+        if not isinstance(other, LegacyEndpointId):
+            return False
+        return (other.endpoint == self.endpoint and
+                other.workload == self.workload and
+                other.host == self.host and
+                other.orchestrator == self.orchestrator)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self.endpoint) + hash(self.workload)
+
+
+def run(id_cls, num_endpoints, num_updates):
+    ids_per_host = collections.defaultdict(set)
+    endpoints_by_id = {}
+    fields = [("host-%s" % (e // 100), "openstack", "wl-%s" % e, "ep-%s" % e)
+              for e in xrange(num_endpoints)]
+
+    start = time.time()
+    for f in fields:
+        ep_id = id_cls(*f)
+        ids_per_host[ep_id.host].add(ep_id)
+        endpoints_by_id[ep_id] = f
+    load_time = time.time() - start
+
+    start = time.time()
+    for u in xrange(num_updates):
+        ep_id = id_cls(*fields[(u * 7919) % num_endpoints])
+        # Delete and recreate, as on an endpoint move.
+        ids_per_host[ep_id.host].discard(ep_id)
+        old = endpoints_by_id.pop(ep_id)
+        ids_per_host[ep_id.host].add(ep_id)
+        endpoints_by_id[ep_id] = old
+    update_time = time.time() - start
+
+    print "%s: loaded %s endpoints in %.2fs, %s updates in %.2fs" % (
+        id_cls.__name__, num_endpoints, load_time, num_updates, update_time)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    num_endpoints = args[0] if len(args) > 0 else 100000
+    num_updates = args[1] if len(args) > 1 else 500000
+    run(LegacyEndpointId, num_endpoints, num_updates)
+    run(EndpointId, num_endpoints, num_updates)
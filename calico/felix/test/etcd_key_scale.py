@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.etcd_key_scale
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+CPU benchmark for classifying the keys of an etcd snapshot: compares
+parse_key() with the chain of regexes that the snapshot load used to try
+in turn, on a snapshot of N keys with the mix of kinds of a large
+deployment.  Only the keys are classified; values aren't parsed.
+
+Usage: python -m calico.felix.test.etcd_key_scale [<num keys>]
+"""
+import gc
+import sys
+import time
+
+from calico.datamodel_v1 import (RULES_KEY_RE, TAGS_KEY_RE, ENDPOINT_KEY_RE,
+                                 IPAM_V4_CIDR_KEY_RE, HOST_IP_KEY_RE,
+                                 EndpointId, parse_key, key_for_endpoint,
+                                 key_for_profile_rules, key_for_profile_tags,
+                                 key_for_config, dir_for_host)
+
+
+def make_keys(num_keys):
+    """
+    :returns list[str]: num_keys keys: mostly endpoints, with a profile (and
+        so a rules and a tags key) per 20 endpoints, a host per 50 endpoints
+        and a sprinkling of config and IPAM keys.
+    """
+    keys = []
+    e = 0
+    while len(keys) < num_keys:
+        host = "host-%s" % (e // 50)
+        keys.append(key_for_endpoint(host, "openstack", "wl-%s" % e,
+                                     "ep-%s" % e))
+        if e % 20 == 0:
+            keys.append(key_for_profile_rules("prof-%s" % e))
+            keys.append(key_for_profile_tags("prof-%s" % e))
+        if e % 50 == 0:
+            keys.append(dir_for_host(host) + "/bird_ip")
+            keys.append(dir_for_host(host) + "/config/marker_created")
+        if e % 1000 == 0:
+            keys.append(key_for_config("Config-%s" % e))
+            keys.append("/calico/v1/ipam/v4/pool/10.%s.0.0-16" % (e // 1000))
+        e += 1
+    return keys[:num_keys]
+
+
+def classify_with_regexes(key):
+    """
+    The classification that the snapshot load used to do.
+    """
+    m = RULES_KEY_RE.match(key)
+    if m:
+        return "rules", m.group("profile_id")
+    m = TAGS_KEY_RE.match(key)
+    if m:
+        return "tags", m.group("profile_id")
+    m = ENDPOINT_KEY_RE.match(key)
+    if m:
+        return "endpoint", EndpointId(m.group("hostname"),
+                                      m.group("orchestrator"),
+                                      m.group("workload_id"),
+                                      m.group("endpoint_id"))
+    m = IPAM_V4_CIDR_KEY_RE.match(key)
+    if m:
+        return "ipam_v4_pool", m.group("encoded_cidr")
+    m = HOST_IP_KEY_RE.match(key)
+    if m:
+        return "host_ip", m.group("hostname")
+    return None
+
+
+def time_classifier(name, fn, keys):
+    # Keep the garbage collector, which scans all the results, out of the
+    # timings.
+    gc.disable()
+    start = time.time()
+    results = [fn(k) for k in keys]
+    elapsed = time.time() - start
+    gc.enable()
+    print "%s: classified %s keys in %.2fs (%.2fus per key)" % (
+        name, len(keys), elapsed, elapsed * 1e6 / len(keys))
+    return results
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    num_keys = args[0] if len(args) > 0 else 200000
+    keys = make_keys(num_keys)
+    # Creating the EndpointIds costs more than classifying the keys, so
+    # create them up front, keeping them alive, to compare just the
+    # classification.
+    ids = [parse_key(k) for k in keys]
+    old = time_classifier("Regex chain", classify_with_regexes, keys)
+    new = time_classifier("parse_key", parse_key, keys)
+    assert [r and tuple(r) for r in new] == old, "Classifications differ"
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.ipset_index_scale
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Memory benchmark for the IpsetManager's tag index: loads N remote
+endpoints, each in a profile with T tags, all of which are referenced, and
+reports the memory and time taken.  Does not touch the dataplane.
+
+Usage: python -m calico.felix.test.ipset_index_scale [<num endpoints>
+[<tags per profile> [<num profiles>]]]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import resource
+import sys
+import time
+
+from calico.datamodel_v1 import EndpointId
+from calico.felix.futils import IPV4
+from calico.felix.ipsets import IpsetManager
+from calico.felix.refcount import CREATED
+
+
+class FakeTagIpset(object):
+    """
+    Stands in for a TagIpset; discards its members rather than programming
+    them.
+    """
+    def __init__(self, tag_id):
+        self.ref_mgmt_state = CREATED
+        self.ref_count = 0
+
+    def start(self):
+        pass
+
+    def replace_members(self, members, force_reprogram=False, async=None):
+        pass
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(num_endpoints, tags_per_profile, num_profiles):
+    mgr = IpsetManager(IPV4)
+    mgr._create = FakeTagIpset
+    mgr.start()
+    tags_by_prof_id = {}
+    for p in xrange(num_profiles):
+        tags = ["tag-%s-%s" % (p, t) for t in xrange(tags_per_profile)]
+        tags_by_prof_id["prof-%s" % p] = tags
+        mgr.on_tags_update("prof-%s" % p, tags, async=True)
+        for tag in tags:
+            mgr.get_and_incref(tag, async=True)
+
+    start_rss = max_rss_kb()
+    start = time.time()
+    for e in xrange(num_endpoints):
+        ep_id = EndpointId("host-%s" % (e // 100), "openstack",
+                           "wl-%s" % e, "ep-%s" % e)
+        mgr.on_endpoint_update(ep_id, {
+            "profile_ids": ["prof-%s" % (e % num_profiles)],
+            "ipv4_nets": ["10.%s.%s.%s/32" % ((e >> 16) & 0xff,
+                                              (e >> 8) & 0xff, e & 0xff)],
+        }, async=True)
+        if e % 1000 == 999:
+            # Wait for the manager to catch up (with a no-op update) so that
+            # we measure the index rather than the queued messages.
+            mgr.on_tags_update("prof-0", tags_by_prof_id["prof-0"],
+                               async=False)
+    mgr.on_tags_update("prof-0", tags_by_prof_id["prof-0"], async=False)
+    elapsed = time.time() - start
+    rss_delta_kb = max_rss_kb() - start_rss
+
+    num_entries = sum(len(ips) for ips in mgr.ip_owners_by_tag.itervalues())
+    print "Indexed %s endpoints, %s tag memberships in %.2fs" % (
+        num_endpoints, num_entries, elapsed)
+    print "Memory: %.1f MB (%.0f bytes per endpoint)" % (
+        rss_delta_kb / 1024.0, rss_delta_kb * 1024.0 / num_endpoints)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    num_endpoints = args[0] if len(args) > 0 else 100000
+    tags_per_profile = args[1] if len(args) > 1 else 5
+    num_profiles = args[2] if len(args) > 2 else 100
+    run(num_endpoints, tags_per_profile, num_profiles)
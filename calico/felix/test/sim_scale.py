@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.sim_scale
+~~~~~~~~~~~~~~~~~~~~
+
+Scale benchmark: runs Felix's actors against the simulated dataplane and
+times how long it takes to program a snapshot of N local endpoints.  Does
+not need root or etcd.
+
+Usage: python -m calico.felix.test.sim_scale [<num endpoints> [<num
+profiles> [<per-op latency ms>]]]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+import os
+import sys
+import time
+
+import gevent
+
+from calico import common
+from calico.datamodel_v1 import EndpointId
+from calico.felix import futils
+from calico.felix.config import Config
+from calico.felix.dataplane import SimulatedDataplane
+from calico.felix.dispatch import DispatchChains
+from calico.felix.endpoint import EndpointManager
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.frules import (install_global_rules, interface_to_suffix,
+                                 profile_to_chain_name)
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.ipsets import IpsetManager, IpsetWriter
+from calico.felix.masq import MasqueradeManager
+from calico.felix.profilerules import RulesManager
+from calico.felix.splitter import UpdateSplitter
+
+_log = logging.getLogger(__name__)
+
+HOSTNAME = "sim-host"
+IFACE_PREFIX = "tap"
+
+
+def load_config():
+    common.default_logging()
+    os.environ.setdefault("FELIX_LOGFILEPATH", "none")
+    os.environ.setdefault("FELIX_LOGSEVERITYSCREEN", "warning")
+    os.environ["FELIX_FELIXHOSTNAME"] = HOSTNAME
+    config = Config("/dev/null")
+    config.report_etcd_config({}, {"InterfacePrefix": IFACE_PREFIX,
+                                   "MetadataAddr": "None",
+                                   "IptablesRefreshInterval": "0",
+                                   "ReportingIntervalSecs": "0"})
+    return config
+
+
+def build_snapshot(num_endpoints, num_profiles):
+    rules_by_prof_id = {}
+    tags_by_prof_id = {}
+    for p in xrange(num_profiles):
+        prof_id = "prof-%s" % p
+        rules_by_prof_id[prof_id] = {
+            "inbound_rules": [{"src_tag": prof_id},
+                              {"protocol": "tcp", "dst_ports": [22, 80]}],
+            "outbound_rules": [{}],
+        }
+        tags_by_prof_id[prof_id] = [prof_id]
+    endpoints_by_id = {}
+    for e in xrange(num_endpoints):
+        ep_id = EndpointId(HOSTNAME, "openstack", "wl-%s" % e, "ep-%s" % e)
+        endpoints_by_id[ep_id] = {
+            "state": "active",
+            "name": "%s%010x" % (IFACE_PREFIX, e),
+            "mac": "02:00:00:%02x:%02x:%02x" % ((e >> 16) & 0xff,
+                                                (e >> 8) & 0xff, e & 0xff),
+            "profile_ids": ["prof-%s" % (e % num_profiles)],
+            "ipv4_nets": ["10.%s.%s.%s/32" % ((e >> 16) & 0xff,
+                                              (e >> 8) & 0xff, e & 0xff)],
+            "ipv6_nets": [],
+        }
+    return rules_by_prof_id, tags_by_prof_id, endpoints_by_id
+
+
+def run(num_endpoints, num_profiles, latency_ms):
+    config = load_config()
+    dataplane = SimulatedDataplane(default_latency=latency_ms / 1000.0)
+    futils.set_dataplane(dataplane)
+
+    rules, tags, endpoints = build_snapshot(num_endpoints, num_profiles)
+    for ep in endpoints.itervalues():
+        dataplane.add_interface(ep["name"], mac=ep["mac"])
+
+    v4_filter_updater = IptablesUpdater("filter", ip_version=4, config=config)
+    v4_nat_updater = IptablesUpdater("nat", ip_version=4, config=config)
+    v6_raw_updater = IptablesUpdater("raw", ip_version=6, config=config)
+    v6_filter_updater = IptablesUpdater("filter", ip_version=6,
+                                        config=config)
+    ipset_writers = [IpsetWriter(IPV4), IpsetWriter(IPV6)]
+    ipset_mgrs = [IpsetManager(IPV4, ipset_writers[0]),
+                  IpsetManager(IPV6, ipset_writers[1])]
+    rules_mgrs = [RulesManager(config, 4, v4_filter_updater, ipset_mgrs[0]),
+                  RulesManager(config, 6, v6_filter_updater, ipset_mgrs[1])]
+    dispatch = [DispatchChains(config, 4, v4_filter_updater),
+                DispatchChains(config, 6, v6_filter_updater)]
+    ep_mgrs = [EndpointManager(config, IPV4, v4_filter_updater, dispatch[0],
+                               rules_mgrs[0], None),
+               EndpointManager(config, IPV6, v6_filter_updater, dispatch[1],
+                               rules_mgrs[1], None)]
+    masq_mgr = MasqueradeManager(IPV4, v4_nat_updater)
+    updaters = [v4_filter_updater, v6_filter_updater, v6_raw_updater,
+                v4_nat_updater]
+    splitter = UpdateSplitter(config, ipset_mgrs, rules_mgrs, ep_mgrs,
+                              updaters, masq_mgr)
+    for actor in (updaters + ipset_writers + ipset_mgrs + rules_mgrs + dispatch + ep_mgrs +
+                  [masq_mgr, splitter]):
+        actor.start()
+    install_global_rules(config, v4_filter_updater, v6_filter_updater,
+                         v4_nat_updater, v6_raw_updater)
+
+    start = time.time()
+    splitter.apply_snapshot(rules, tags, endpoints, {}, async=True)
+    expected_chains = set("felix-from-%s" %
+                          interface_to_suffix(config, ep["name"])
+                          for ep in endpoints.itervalues())
+    expected_chains.update(profile_to_chain_name(d, p)
+                           for p in rules for d in ("inbound", "outbound"))
+    while True:
+        gevent.sleep(0.1)
+        v4_chains = dataplane.tables[4]["filter"].chains
+        programmed = sum(1 for c in expected_chains if c in v4_chains)
+        if (programmed == len(expected_chains) and
+                len(dataplane.routes[4]) == num_endpoints):
+            break
+    elapsed = time.time() - start
+
+    print "Programmed %s endpoints (%s profiles) in %.2fs" % (
+        num_endpoints, num_profiles, elapsed)
+    print "Chains: %s, rules: %s, ipsets: %s" % (
+        len(v4_chains), sum(len(r) for r in v4_chains.itervalues()),
+        len(dataplane.ipsets))
+    for name, count in sorted(dataplane._stats.stats.iteritems()):
+        print "  %s: %s" % (name, count)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    num_endpoints = args[0] if len(args) > 0 else 10000
+    num_profiles = args[1] if len(args) > 1 else 100
+    latency_ms = args[2] if len(args) > 2 else 0
+    run(num_endpoints, num_profiles, latency_ms)
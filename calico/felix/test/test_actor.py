@@ -26,7 +26,8 @@ import sys
 
 from gevent.event import AsyncResult
 import mock
-from calico.felix.actor import actor_message, ResultOrExc, SplitBatchAndRetry
+from calico.felix.actor import (actor_message, FailMessagesAndRetry,
+                                ResultOrExc, SplitBatchAndRetry)
 from calico.felix.test.base import BaseTestCase
 from calico.felix import actor
 
@@ -146,6 +147,25 @@ class TestActor(BaseTestCase):
             ["sb", "b", "a", "fb"],
         ])
 
+    def test_fail_messages_and_retry(self):
+        f_a1 = self._actor.do_a(async=True)
+        f_b1 = self._actor.do_b(async=True)
+        f_a2 = self._actor.do_a(async=True)
+        self._actor._finish_side_effects = iter([
+            FailMessagesAndRetry({1: ExpectedException()}),
+            None,
+        ])
+        self.run_actor_loop()
+        # The failed message isn't re-executed, the rest are retried as a
+        # single batch.
+        self.assertEqual(self._actor.batches, [
+            ["sb", "a", "b", "a", "fb"],
+            ["sb", "a", "a", "fb"],
+        ])
+        self.assertRaises(ExpectedException, f_b1.get)
+        self.assertEqual(f_a1.get(), "a")
+        self.assertEqual(f_a2.get(), "a")
+
     def test_split_batch_exc(self):
         f_a = self._actor.do_a(async=True)
         f_exc = self._actor.do_exc(async=True)
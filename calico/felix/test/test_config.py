@@ -82,6 +82,17 @@ class TestConfig(unittest.TestCase):
             self.assertEqual(config.METADATA_IP, "1.2.3.4")
             self.assertEqual(config.REPORTING_INTERVAL_SECS, 30)
             self.assertEqual(config.REPORTING_TTL_SECS, 90)
+            # Rule optimizations that change the programmed ruleset are
+            # opt-in.
+            self.assertEqual(config.CIDR_IPSET_MIN_RULES, 0)
+            self.assertFalse(config.SHARE_PROFILE_CHAINS)
+            # The ipset audit dumps every set on the host so it's opt-in.
+            self.assertEqual(config.IPSET_AUDIT_INTERVAL, 0)
+            # The netlink clients replace the CLI tools so they're opt-in.
+            self.assertFalse(config.IPSET_NETLINK_ENABLED)
+            self.assertFalse(config.ROUTE_NETLINK_ENABLED)
+            self.assertFalse(config.ROUTE_TABLE_CACHE_ENABLED)
+            self.assertFalse(config.CONNTRACK_NETLINK_ENABLED)
 
     def test_invalid_port(self):
         data = { "felix_invalid_port.cfg": "Invalid port in field",
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_ctnetlink
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the conntrack netlink client.
+"""
+import errno
+import logging
+import socket
+import struct
+
+from calico.felix import netlink
+from calico.felix.ctnetlink import (ConntrackNetlinkClient, encode_delete,
+                                    encode_nfgenmsg, CTA_TUPLE_ORIG,
+                                    CTA_TUPLE_REPLY, CTA_ID)
+from calico.felix.netlink import (encode_attr, encode_nested_attr,
+                                  encode_msg, parse_attrs, parse_messages,
+                                  NetlinkError)
+from calico.felix.test.base import BaseTestCase
+from calico.felix.test.test_ipset_netlink import FakeNetlinkSocket, h
+
+_log = logging.getLogger(__name__)
+
+
+def flow(src, dst, flow_id):
+    """
+    :returns str: the payload of a dumped UDP flow from src to dst.
+    """
+    def tuple_attrs(src, dst):
+        return (encode_nested_attr(1,
+                                   encode_attr(1, socket.inet_aton(src)),
+                                   encode_attr(2, socket.inet_aton(dst))) +
+                encode_nested_attr(2, encode_attr(1, "\x11")))
+    return (encode_nfgenmsg(socket.AF_INET) +
+            encode_nested_attr(CTA_TUPLE_ORIG, tuple_attrs(src, dst)) +
+            encode_nested_attr(CTA_TUPLE_REPLY, tuple_attrs(dst, src)) +
+            encode_attr(CTA_ID, struct.pack("!I", flow_id)))
+
+
+class FakeConntrackSocket(FakeNetlinkSocket):
+    """
+    Fake ctnetlink socket that answers dumps with self.flows.
+    """
+    def __init__(self):
+        super(FakeConntrackSocket, self).__init__()
+        self.flows = []
+
+    def sendto(self, data, addr):
+        (_, flags, seq, _), = list(parse_messages(data))[:1]
+        if (flags & netlink.NLM_F_DUMP) != netlink.NLM_F_DUMP:
+            return super(FakeConntrackSocket, self).sendto(data, addr)
+        self.sent.append(data)
+        self.replies.append(
+            "".join(encode_msg(0x0100, netlink.NLM_F_MULTI, seq, f)
+                    for f in self.flows) +
+            encode_msg(netlink.NLMSG_DONE, 0, seq, "\0" * 4))
+
+
+class TestConntrackNetlinkClient(BaseTestCase):
+    def setUp(self):
+        super(TestConntrackNetlinkClient, self).setUp()
+        self.sock = FakeConntrackSocket()
+        self.sock.flows = [flow("10.0.0.1", "8.8.8.8", 1),
+                           flow("8.8.4.4", "10.0.0.2", 2),
+                           flow("10.0.0.3", "8.8.8.8", 3)]
+        self.client = ConntrackNetlinkClient(sock=self.sock)
+
+    def test_encode_delete(self):
+        attrs = dict(parse_attrs(self.sock.flows[0][4:]))
+        msg_type, flags, payload = encode_delete(socket.AF_INET, attrs)
+        self.assertEqual(encode_msg(msg_type, flags, 1, payload), h(
+            "40000000 0201 0000 01000000 00000000"
+            "02000000"  # nfgenmsg
+            "24000180"  # Nested CTA_TUPLE_ORIG, copied from the dump.
+            "14000180 08000100 0a000001 08000200 08080808"
+            "0c000280 05000100 11000000"
+            "08000c00 00000001"  # CTA_ID
+        ))
+
+    def test_remove_flows(self):
+        self.assertEqual(self.client.remove_flows(["10.0.0.1", "10.0.0.2"],
+                                                  4), 2)
+        # One dump, then one datagram of deletes.
+        self.assertEqual(len(self.sock.sent), 2)
+        deletes = list(parse_messages(self.sock.sent[1]))
+        self.assertEqual([t for t, _, _, _ in deletes], [0x0102, 0x0102])
+
+    def test_remove_flows_gone(self):
+        self.sock.errors[2] = errno.ENOENT
+        self.assertEqual(self.client.remove_flows(["10.0.0.1", "10.0.0.2"],
+                                                  4), 1)
+
+    def test_remove_flows_error(self):
+        self.sock.errors[3] = errno.EPERM
+        self.assertRaises(NetlinkError, self.client.remove_flows,
+                          ["10.0.0.1", "10.0.0.2"], 4)
+
+    def test_remove_flows_none(self):
+        self.assertEqual(self.client.remove_flows(["10.0.0.9"], 4), 0)
+        self.assertEqual(len(self.sock.sent), 1)
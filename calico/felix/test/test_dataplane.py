@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_dataplane
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the simulated dataplane, mostly driven through the real Felix
+code that uses it.
+"""
+import logging
+
+import gevent
+from mock import Mock, patch, call
+
+from calico.datamodel_v1 import EndpointId
+from calico.felix import devices, futils, ipsets
+from calico.felix.dataplane import SimulatedDataplane, OP_IPSET
+from calico.felix.fiptables import (IptablesUpdater, _extract_our_chains,
+                                    _extract_our_unreffed_chains,
+                                    _parse_ipt_restore_error)
+from calico.felix.futils import FailedSystemCall, IPV4, IPV6
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestSimulatedDataplane(BaseTestCase):
+    def setUp(self):
+        super(TestSimulatedDataplane, self).setUp()
+        self.dp = SimulatedDataplane()
+        futils.set_dataplane(self.dp)
+
+    def tearDown(self):
+        futils.set_dataplane(None)
+        super(TestSimulatedDataplane, self).tearDown()
+
+    def restore(self, lines, cmd="iptables-restore"):
+        return futils.check_call([cmd, "--noflush", "--verbose"],
+                                 input_str="\n".join(lines) + "\n")
+
+    def test_unknown_command(self):
+        self.assertRaises(OSError, futils.check_call, ["ebtables", "-L"])
+
+    def test_iptables_restore_and_save(self):
+        self.restore(["*filter",
+                      ":felix-a -",
+                      ":felix-b -",
+                      "--append felix-a --jump felix-b",
+                      "--append felix-b --jump DROP "
+                      "-m comment --comment \"a comment\"",
+                      "COMMIT"])
+        save = futils.check_output(["iptables-save", "--table", "filter"])
+        self.assertEqual(_extract_our_chains("filter", save),
+                         set(["felix-a", "felix-b"]))
+        self.assertTrue('-A felix-b --jump DROP -m comment '
+                        '--comment "a comment"' in save)
+        self.assertTrue(self.dp.chain_referenced(4, "filter", "felix-b"))
+        self.assertFalse(self.dp.chain_referenced(6, "filter", "felix-b"))
+        listing = futils.check_output(["iptables", "--wait", "--list",
+                                       "--table", "filter"])
+        self.assertEqual(_extract_our_unreffed_chains(listing),
+                         set(["felix-a"]))
+
+    def test_iptables_restore_is_atomic(self):
+        input_lines = ["*filter",
+                       ":felix-a -",
+                       "--append felix-a --jump felix-missing",
+                       "COMMIT"]
+        with self.assertRaises(FailedSystemCall) as cm:
+            self.restore(input_lines)
+        self.assertEqual(cm.exception.stderr,
+                         "iptables-restore: line 3 failed\n")
+        retryable, _ = _parse_ipt_restore_error(input_lines,
+                                                cm.exception.stderr)
+        self.assertFalse(retryable)
+        self.assertFalse("felix-a" in self.dp.tables[4]["filter"].chains)
+
+    def test_commit_failure_retryable(self):
+        retryable, _ = _parse_ipt_restore_error(
+            ["*filter", ":felix-a -", "COMMIT"],
+            "iptables-restore: line 3 failed\n"
+        )
+        self.assertTrue(retryable)
+
+    def test_iptables_flush_on_recreate(self):
+        self.restore(["*filter", ":felix-a -",
+                      "--append felix-a --jump DROP", "COMMIT"])
+        self.restore(["*filter", ":felix-a -",
+                      "--append felix-a --jump ACCEPT", "COMMIT"])
+        self.assertEqual(self.dp.tables[4]["filter"].chains["felix-a"],
+                         ["--jump ACCEPT"])
+
+    def test_iptables_delete_chain(self):
+        self.restore(["*filter", ":felix-a -", ":felix-b -",
+                      "--append felix-a --goto felix-b", "COMMIT"])
+        # Referenced, so the delete should fail.
+        self.assertRaises(FailedSystemCall, self.restore,
+                          ["*filter", ":felix-b -", "--delete-chain felix-b",
+                           "COMMIT"])
+        self.restore(["*filter", ":felix-a -", ":felix-b -",
+                      "--delete-chain felix-a", "--delete-chain felix-b",
+                      "COMMIT"])
+        self.assertEqual(self.dp.tables[4]["filter"].chains.keys(),
+                         ["INPUT", "FORWARD", "OUTPUT"])
+
+    def test_iptables_insert_delete_rule(self):
+        self.restore(["*filter", ":felix-a -",
+                      "--insert INPUT --jump felix-a", "COMMIT"])
+        self.assertRaises(FailedSystemCall, self.restore,
+                          ["*filter", "--delete INPUT --jump ACCEPT",
+                           "COMMIT"])
+        self.restore(["*filter", "--delete INPUT --jump felix-a", "COMMIT"])
+        self.assertEqual(self.dp.tables[4]["filter"].chains["INPUT"], [])
+
+    def test_iptables_bad_table(self):
+        self.assertRaises(FailedSystemCall, self.restore,
+                          ["*nat", "COMMIT"], cmd="ip6tables-restore")
+
+    def test_iptables_updater(self):
+        m_config = Mock()
+        m_config.REFRESH_INTERVAL = 0
+        ipt = IptablesUpdater("filter", m_config, 6)
+        self.step_actor(ipt)
+        ipt.rewrite_chains({"felix-foo": ["--append felix-foo "
+                                          "--jump felix-bar"]},
+                           {"felix-foo": set(["felix-bar"])},
+                           async=True)
+        self.step_actor(ipt)
+        chains = self.dp.tables[6]["filter"].chains
+        self.assertEqual(chains["felix-foo"], ["--jump felix-bar"])
+        self.assertEqual(chains["felix-bar"][-1].split()[:2],
+                         ["--jump", "DROP"])
+        ipt.delete_chains(["felix-foo"], async=True)
+        self.step_actor(ipt)
+        self.assertFalse("felix-foo" in self.dp.tables[6]["filter"].chains)
+
+    def test_iptables_updater_isolates_bad_message(self):
+        m_config = Mock()
+        m_config.REFRESH_INTERVAL = 0
+        ipt = IptablesUpdater("filter", m_config, 4)
+        self.step_actor(ipt)
+        futures = []
+        for name in ("felix-a", "felix-b", "felix-c", "felix-d"):
+            # felix-c jumps to a chain that doesn't exist and wasn't
+            # declared as a dependency so iptables-restore rejects it.
+            target = "felix-missing" if name == "felix-c" else "ACCEPT"
+            futures.append(ipt.rewrite_chains(
+                {name: ["--append %s --jump %s" % (name, target)]}, {},
+                async=True))
+        with patch.object(ipt, "_execute_iptables",
+                          wraps=ipt._execute_iptables) as m_exec:
+            self.step_actor(ipt)
+        # One failed attempt, then one retry without the bad message.
+        self.assertEqual(m_exec.call_count, 2)
+        self.assertRaises(FailedSystemCall, futures[2].get)
+        for f in futures[:2] + futures[3:]:
+            f.get()
+        chains = self.dp.tables[4]["filter"].chains
+        self.assertEqual(sorted(c for c in chains if c.startswith("felix")),
+                         ["felix-a", "felix-b", "felix-d"])
+        self.assertEqual(ipt._stats.stats["Batch retried without culprit"],
+                         1)
+
+    def test_iptables_updater_blames_shared_chain_writer(self):
+        m_config = Mock()
+        m_config.REFRESH_INTERVAL = 0
+        ipt = IptablesUpdater("filter", m_config, 4)
+        self.step_actor(ipt)
+        # felix-a writes a bad shared chain, felix-b reuses it in the same
+        # batch.  felix-a should be failed first since it wrote the chain.
+        failures = []
+        futures = []
+        shared = {"felix-s-1": ["--append felix-s-1 --jump felix-missing"]}
+        for name in ("felix-a", "felix-b", "felix-c"):
+            futures.append(ipt.rewrite_chains(
+                {name: ["--append %s --jump %s" %
+                        (name, "ACCEPT" if name == "felix-c"
+                         else "felix-s-1")]},
+                {name: set(["felix-s-1"])} if name != "felix-c" else {},
+                shared_chains=shared if name != "felix-c" else None,
+                callback=(lambda e, name=name: failures.append((name, e))),
+                async=True))
+        self.step_actor(ipt)
+        for f in futures[:2]:
+            self.assertRaises(FailedSystemCall, f.get)
+        futures[2].get()
+        self.assertEqual([(n, e is None) for n, e in failures],
+                         [("felix-a", False),
+                          ("felix-b", False),
+                          ("felix-c", True)])
+        chains = self.dp.tables[4]["filter"].chains
+        self.assertEqual(sorted(c for c in chains if c.startswith("felix")),
+                         ["felix-c"])
+
+    def test_iptables_lock_contention(self):
+        m_config = Mock()
+        m_config.REFRESH_INTERVAL = 0
+        m_config.IPTABLES_LOCK_DETECTION = True
+        ipt = IptablesUpdater("filter", m_config, 4)
+        self.dp.xtables_lock_failures = 2
+        with patch("gevent.sleep", autospec=True) as m_sleep:
+            ipt._execute_iptables(["*filter", ":felix-a -", "COMMIT"])
+        self.assertEqual(m_sleep.call_count, 2)
+        self.assertTrue("felix-a" in self.dp.tables[4]["filter"].chains)
+        self.assertEqual(ipt._stats.stats["iptables commit failure "
+                                          "(xtables lock held)"], 2)
+        self.assertEqual(ipt._histograms.maxima["Retries per commit"], 2)
+        self.assertEqual(
+            ipt._histograms.maxima["xtables lock failures per commit"], 2)
+
+        # Without lock detection, the failure isn't retried.
+        ipt.detect_lock_contention = False
+        self.dp.xtables_lock_failures = 1
+        self.assertRaises(FailedSystemCall, ipt._execute_iptables,
+                          ["*filter", ":felix-b -", "COMMIT"])
+        self.assertEqual(ipt._stats.stats["iptables non-retryable failure"],
+                         1)
+
+    def test_ipset_restore_and_list(self):
+        ipset = ipsets.Ipset("felix-v4-a", "felix-tmp-v4-a", "inet")
+        ipset.replace_members(set(["10.0.0.1", "10.0.0.2"]))
+        self.assertTrue(ipset.exists())
+        self.assertEqual(self.dp.ipsets["felix-v4-a"].members,
+                         set(["10.0.0.1", "10.0.0.2"]))
+        self.assertFalse("felix-tmp-v4-a" in self.dp.ipsets)
+        ipset.update_members(set(["10.0.0.1", "10.0.0.2"]),
+                             set(["10.0.0.2", "10.0.0.3"]))
+        self.assertEqual(self.dp.ipsets["felix-v4-a"].members,
+                         set(["10.0.0.2", "10.0.0.3"]))
+        self.assertEqual(ipsets.list_ipset_names(), ["felix-v4-a"])
+        ipset.delete()
+        self.assertFalse(ipset.exists())
+
+    def test_ipset_resize(self):
+        ipset = ipsets.Ipset("felix-v4-a", "felix-tmp-v4-a", "inet")
+        ipset.replace_members(set(["10.0.0.1"]))
+        self.assertEqual(self.dp.ipsets["felix-v4-a"].maxelem, 65536)
+        # Growing past the threshold rewrites the set into a bigger one.
+        members = set("10.%s.%s.%s" % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+                      for i in xrange(50000))
+        ipset.update_members(set(["10.0.0.1"]), members)
+        self.assertEqual(self.dp.ipsets["felix-v4-a"].maxelem, 131072)
+        self.assertEqual(self.dp.ipsets["felix-v4-a"].members, members)
+        self.assertFalse("felix-tmp-v4-a" in self.dp.ipsets)
+
+        # A new Felix doesn't know the size of the existing set but it can
+        # still rewrite it.
+        ipset = ipsets.Ipset("felix-v4-a", "felix-tmp-v4-a", "inet")
+        ipset.replace_members(set(["10.0.0.2"]))
+        self.assertEqual(self.dp.ipsets["felix-v4-a"].maxelem, 65536)
+        self.assertEqual(self.dp.ipsets["felix-v4-a"].members,
+                         set(["10.0.0.2"]))
+        ipset.ensure_exists()
+
+    def test_ipset_audit(self):
+        writer = ipsets.IpsetWriter(futils.IPV4)
+        mgr = ipsets.IpsetManager(futils.IPV4, writer)
+        writer.start()
+        mgr.start()
+        ep_id = EndpointId("host", "orch", "wl", "ep")
+        mgr.on_tags_update("prof", ["tag"], async=True)
+        mgr.on_endpoint_update(ep_id, {"profile_ids": ["prof"],
+                                       "ipv4_nets": ["10.0.0.1/32",
+                                                     "10.0.0.2/32"]},
+                               async=True)
+        mgr.get_and_incref("tag", async=False)
+        name = ipsets.tag_to_ipset_name(futils.IPV4, "tag")
+        gevent.sleep(0.1)
+        self.assertEqual(self.dp.ipsets[name].members,
+                         set(["10.0.0.1", "10.0.0.2"]))
+
+        # Another process changes the set behind our back.
+        futils.check_call(["ipset", "del", name, "10.0.0.1"])
+        futils.check_call(["ipset", "add", name, "10.0.0.3"])
+        mgr.audit_ipsets(async=False)
+        gevent.sleep(0.1)
+        self.assertEqual(self.dp.ipsets[name].members,
+                         set(["10.0.0.1", "10.0.0.2"]))
+
+        # Or deletes it.
+        futils.check_call(["ipset", "destroy", name])
+        mgr.audit_ipsets(async=False)
+        gevent.sleep(0.1)
+        self.assertEqual(self.dp.ipsets[name].members,
+                         set(["10.0.0.1", "10.0.0.2"]))
+
+    def test_ipset_restore_not_transactional(self):
+        with self.assertRaises(FailedSystemCall) as cm:
+            futils.check_call(["ipset", "restore"], input_str=(
+                "create felix-a hash:ip family inet --exist\n"
+                "add felix-a 10.0.0.1\n"
+                "add felix-a 10.0.0.1\n"
+                "add felix-a 10.0.0.2\n"))
+        self.assertTrue("Error in line 3: Element cannot be added to the "
+                        "set: it's already added" in cm.exception.stderr)
+        self.assertEqual(self.dp.ipsets["felix-a"].members,
+                         set(["10.0.0.1"]))
+
+    def test_ipset_in_use(self):
+        futils.check_call(["ipset", "restore"],
+                          input_str="create felix-a hash:ip family inet\n")
+        self.restore(["*filter", ":felix-a -",
+                      "--append felix-a --match set --match-set felix-a src "
+                      "--jump ACCEPT", "COMMIT"])
+        self.assertRaises(FailedSystemCall, futils.check_call,
+                          ["ipset", "destroy", "felix-a"])
+
+    def test_ipset_bad_member(self):
+        ipset = ipsets.Ipset("felix-v6-a", "felix-tmp-v6-a", "inet6")
+        self.assertRaises(FailedSystemCall, ipset.replace_members,
+                          set(["10.0.0.1"]))
+
+    def test_routes_arp_and_conntrack(self):
+        self.dp.add_interface("tap1", mac="aa:bb:cc:dd:ee:ff")
+        self.dp.add_flow(4, "10.0.0.2", "8.8.8.8")
+        devices.set_routes(IPV4, set(["10.0.0.1", "10.0.0.2"]), "tap1",
+                           mac="aa:bb:cc:dd:ee:ff")
+        self.assertEqual(self.dp.routes[4], {"10.0.0.1": "tap1",
+                                             "10.0.0.2": "tap1"})
+        self.assertEqual(self.dp.arp_entries["10.0.0.1"],
+                         ("aa:bb:cc:dd:ee:ff", "tap1"))
+        self.assertEqual(devices.list_interface_ips(IPV4, "tap1"),
+                         set(["10.0.0.1", "10.0.0.2"]))
+        devices.set_routes(IPV4, set(["10.0.0.1"]), "tap1",
+                           mac="aa:bb:cc:dd:ee:ff")
+        self.assertEqual(self.dp.routes[4], {"10.0.0.1": "tap1"})
+        self.assertEqual(self.dp.flows[4], [])
+        self.dp.remove_interface("tap1")
+        self.assertEqual(self.dp.routes[4], {})
+        self.assertFalse(devices.interface_exists("tap1"))
+
+    def test_route_batch(self):
+        self.dp.add_interface("tap1")
+        devices.add_route(IPV6, "fd00::1", "tap1", "aa:bb:cc:dd:ee:ff")
+        self.assertEqual(self.dp.routes[6], {"fd00::1": "tap1"})
+        # Batches stop at the first failure.
+        with self.assertRaises(FailedSystemCall) as cm:
+            futils.check_call(["ip", "-batch", "-"],
+                              input_str="route replace 10.0.0.1 dev tap1\n"
+                                        "neigh del 10.0.0.2 dev tap1\n"
+                                        "route replace 10.0.0.3 dev tap1\n")
+        self.assertTrue(cm.exception.stderr.endswith("Command failed -:2\n"))
+        self.assertEqual(self.dp.routes[4], {"10.0.0.1": "tap1"})
+
+    def test_route_to_down_interface(self):
+        self.dp.add_interface("tap1", up=False)
+        self.assertRaises(FailedSystemCall, devices.add_route, IPV6,
+                          "fd00::1", "tap1", "aa:bb:cc:dd:ee:ff")
+
+    def test_sysctls(self):
+        self.dp.add_interface("tap1")
+        devices.configure_global_kernel_config()
+        devices.configure_interface_ipv4("tap1")
+        self.assertEqual(devices._read_proc_sys(
+            "/proc/sys/net/ipv4/conf/tap1/proxy_arp"), "1")
+        self.assertEqual(devices._read_proc_sys(
+            "/proc/sys/net/ipv4/neigh/tap1/proxy_delay"), "0")
+        self.assertRaises(IOError, devices.configure_interface_ipv4, "tap2")
+        self.assertTrue(devices.interface_up("tap1"))
+        self.assertFalse(devices.interface_up("tap2"))
+        self.dp.set_interface_up("tap1", False)
+        self.assertFalse(devices.interface_up("tap1"))
+
+    def test_auto_create(self):
+        self.dp.auto_create_prefix = "tap"
+        self.assertTrue(devices.interface_exists("tapabcdef"))
+        self.assertFalse(devices.interface_exists("eth1"))
+
+    def test_latency(self):
+        self.dp.latency = {OP_IPSET: 0.5}
+        self.dp.default_latency = 0.1
+        with patch("gevent.sleep", autospec=True) as m_sleep:
+            futils.check_call(["ipset", "list"])
+            devices.interface_up("lo")
+        self.assertEqual(m_sleep.mock_calls, [call(0.5), call(0.1)])
+
+    def test_interface_watcher(self):
+        m_splitter = Mock()
+        watcher = devices.InterfaceWatcher(m_splitter)
+        watcher.start()
+        socket = self.dp.netlink_socket(devices.RTMGRP_LINK)
+        self.dp.add_interface("tap1")
+        self.dp.set_interface_up("tap1", False)
+        self.dp.remove_interface("tap1")
+        self.dp.add_interface("tap2", up=False)
+        with patch.object(self.dp, "netlink_socket",
+                          return_value=_FiniteSocket(socket)), \
+                patch("calico.felix.devices._interface_table", None):
+            self.assertRaises(_Done, watcher.watch_interfaces, async=False)
+            # The dump of the existing interfaces comes after the events.
+            self.assertEqual(m_splitter.on_interface_update.mock_calls, [
+                call("tap1", iface_up=True, async=True),
+                call("tap1", iface_up=False, async=True),
+                call("tap1", iface_up=False, async=True),
+                call("tap2", iface_up=False, async=True),
+                call("lo", iface_up=True, async=True),
+                call("tap2", iface_up=False, async=True),
+            ])
+            table = watcher.interface_table
+            self.assertTrue(table.loaded)
+            self.assertEqual(table.get("lo").index, 1)
+            self.assertEqual(table.get("tap2").mac, "02:00:00:00:00:03")
+            self.assertEqual(table.get("tap1"), None)
+            # devices now uses the table rather than the dataplane.
+            self.dp.add_interface("tap3")
+            self.assertTrue(devices.interface_up("lo"))
+            self.assertFalse(devices.interface_up("tap2"))
+            self.assertTrue(devices.interface_exists("tap2"))
+            self.assertFalse(devices.interface_exists("tap3"))
+
+
+class _Done(Exception):
+    pass
+
+
+class _FiniteSocket(object):
+    """
+    Wraps a simulated netlink socket, raising _Done once it has been
+    drained, to break out of the InterfaceWatcher's infinite loop.
+    """
+    def __init__(self, socket):
+        self.socket = socket
+
+    def sendto(self, data, addr):
+        self.socket.sendto(data, addr)
+
+    def recv(self, bufsize):
+        if self.socket._queue.empty():
+            raise _Done()
+        return self.socket.recv(bufsize)
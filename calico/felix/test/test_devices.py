@@ -32,6 +32,8 @@ else:
 import calico.felix.devices as devices
 import calico.felix.futils as futils
 import calico.felix.test.stub_utils as stub_utils
+from calico.felix.netlink import NetlinkError
+from calico.felix.test.base import BaseTestCase
 
 # Logger
 log = logging.getLogger(__name__)
@@ -105,8 +107,10 @@ class TestDevices(unittest.TestCase):
         ip = "1.2.3.4"
         with mock.patch('calico.felix.futils.check_call', return_value=retcode):
             devices.add_route(type, ip, tap, mac)
-            futils.check_call.assert_any_call(['arp', '-s', ip, mac, '-i', tap])
-            futils.check_call.assert_called_with(["ip", "route", "replace", ip, "dev", tap])
+            futils.check_call.assert_called_once_with(
+                ["ip", "-batch", "-"],
+                input_str="neigh replace %s lladdr %s dev %s nud permanent\n"
+                          "route replace %s dev %s\n" % (ip, mac, tap, ip, tap))
 
         with self.assertRaisesRegexp(ValueError,
                                      "mac must be supplied if ip is provided"):
@@ -116,7 +120,9 @@ class TestDevices(unittest.TestCase):
         ip = "2001::"
         with mock.patch('calico.felix.futils.check_call', return_value=retcode):
             devices.add_route(type, ip, tap, mac)
-            futils.check_call.assert_called_with(["ip", "-6", "route", "replace", ip, "dev", tap])
+            futils.check_call.assert_called_once_with(
+                ["ip", "-batch", "-"],
+                input_str="route replace %s dev %s\n" % (ip, tap))
 
         with self.assertRaisesRegexp(ValueError,
                                      "mac must be supplied if ip is provided"):
@@ -130,14 +136,27 @@ class TestDevices(unittest.TestCase):
         ip = "1.2.3.4"
         with mock.patch('calico.felix.futils.check_call', return_value=retcode):
             devices.del_route(type, ip, tap)
-            futils.check_call.assert_any_call(['arp', '-d', ip, '-i', tap])
-            futils.check_call.assert_called_with(["ip", "route", "del", ip, "dev", tap])
+            futils.check_call.assert_called_once_with(
+                ["ip", "-batch", "-"],
+                input_str="neigh del %s dev %s\n"
+                          "route del %s dev %s\n" % (ip, tap, ip, tap))
 
         type = futils.IPV6
         ip = "2001::"
         with mock.patch('calico.felix.futils.check_call', return_value=retcode):
             devices.del_route(type, ip, tap)
-            futils.check_call.assert_called_once_with(["ip", "-6", "route", "del", ip, "dev", tap])
+            futils.check_call.assert_called_once_with(
+                ["ip", "-batch", "-"],
+                input_str="route del %s dev %s\n" % (ip, tap))
+
+    def test_route_netlink(self):
+        m_client = mock.Mock()
+        with mock.patch('calico.felix.devices._rtnetlink_client', m_client):
+            with mock.patch('calico.felix.futils.check_call') as m_check_call:
+                devices.del_route(futils.IPV6, "2001::", "tap1")
+                self.assertFalse(m_check_call.called)
+        m_client.run_batch.assert_called_once_with(
+            ["route del 2001:: dev tap1"])
 
     def test_set_routes_mac_required(self):
         type = futils.IPV4
@@ -160,24 +179,31 @@ class TestDevices(unittest.TestCase):
             devices.set_routes(futils.IPV6, ips, interface, mac=mac,
                                reset_arp=True)
 
+    def assert_batch(self, m_check_call, lines):
+        m_check_call.assert_called_once_with(
+            ["ip", "-batch", "-"], input_str="".join(l + "\n" for l in lines))
+
     @mock.patch("calico.felix.devices.remove_conntrack_flows", autospec=True)
     def test_set_routes_mainline(self, m_remove_conntrack):
         type = futils.IPV4
         ips = set(["1.2.3.4", "2.3.4.5"])
         interface = "tapabcdef"
         mac = stub_utils.get_mac()
-        calls = [mock.call(['arp', '-s', "1.2.3.4", mac, '-i', interface]),
-                 mock.call(["ip", "route", "replace", "1.2.3.4", "dev", interface]),
-                 mock.call(['arp', '-s', "2.3.4.5", mac, '-i', interface]),
-                 mock.call(["ip", "route", "replace", "2.3.4.5", "dev", interface])]
+        lines = [
+            "neigh replace 1.2.3.4 lladdr %s dev %s nud permanent" %
+            (mac, interface),
+            "route replace 1.2.3.4 dev %s" % interface,
+            "neigh replace 2.3.4.5 lladdr %s dev %s nud permanent" %
+            (mac, interface),
+            "route replace 2.3.4.5 dev %s" % interface,
+        ]
 
         with mock.patch('calico.felix.futils.check_call',
                         return_value=futils.CommandOutput("", "")):
             with mock.patch('calico.felix.devices.list_interface_ips',
                             return_value=set()):
                 devices.set_routes(type, ips, interface, mac)
-                self.assertEqual(futils.check_call.call_count, len(calls))
-                futils.check_call.assert_has_calls(calls, any_order=True)
+                self.assert_batch(futils.check_call, lines)
                 m_remove_conntrack.assert_called_once_with(set(), 4)
 
     @mock.patch("calico.felix.devices.remove_conntrack_flows", autospec=True)
@@ -203,19 +229,19 @@ class TestDevices(unittest.TestCase):
         interface = "tapabcdef"
         mac = stub_utils.get_mac()
         retcode = futils.CommandOutput("", "")
-        calls = [mock.call(['arp', '-s', "1.2.3.4", mac, '-i', interface]),
-                 mock.call(["ip", "route", "replace", "1.2.3.4", "dev",
-                            interface]),
-                 mock.call(['arp', '-d', "3.4.5.6", '-i', interface]),
-                 mock.call(["ip", "route", "del", "3.4.5.6", "dev",
-                            interface])]
+        lines = [
+            "neigh del 3.4.5.6 dev %s" % interface,
+            "route del 3.4.5.6 dev %s" % interface,
+            "neigh replace 1.2.3.4 lladdr %s dev %s nud permanent" %
+            (mac, interface),
+            "route replace 1.2.3.4 dev %s" % interface,
+        ]
 
         with mock.patch('calico.felix.futils.check_call', return_value=retcode):
             with mock.patch('calico.felix.devices.list_interface_ips',
                             return_value=current_ips):
                 devices.set_routes(ip_type, ips, interface, mac)
-                self.assertEqual(futils.check_call.call_count, len(calls))
-                futils.check_call.assert_has_calls(calls, any_order=True)
+                self.assert_batch(futils.check_call, lines)
                 m_remove_conntrack.assert_called_once_with(set(["3.4.5.6"]), 4)
 
     @mock.patch("calico.felix.devices.remove_conntrack_flows", autospec=True)
@@ -226,17 +252,20 @@ class TestDevices(unittest.TestCase):
         mac = stub_utils.get_mac()
         retcode = futils.CommandOutput("", "")
         current_ips = set(["2.3.4.5", "3.4.5.6"])
-        calls = [mock.call(['arp', '-s', "1.2.3.4", mac, '-i', interface]),
-                 mock.call(["ip", "route", "replace", "1.2.3.4", "dev", interface]),
-                 mock.call(['arp', '-s', "2.3.4.5", mac, '-i', interface]),
-                 mock.call(['arp', '-d', "3.4.5.6", '-i', interface]),
-                 mock.call(["ip", "route", "del", "3.4.5.6", "dev", interface])]
+        lines = [
+            "neigh del 3.4.5.6 dev %s" % interface,
+            "route del 3.4.5.6 dev %s" % interface,
+            "neigh replace 1.2.3.4 lladdr %s dev %s nud permanent" %
+            (mac, interface),
+            "route replace 1.2.3.4 dev %s" % interface,
+            "neigh replace 2.3.4.5 lladdr %s dev %s nud permanent" %
+            (mac, interface),
+        ]
         with mock.patch('calico.felix.futils.check_call', return_value=retcode):
             with mock.patch('calico.felix.devices.list_interface_ips',
                             return_value=current_ips):
                 devices.set_routes(type, ips, interface, mac, reset_arp=True)
-                self.assertEqual(futils.check_call.call_count, len(calls))
-                futils.check_call.assert_has_calls(calls, any_order=True)
+                self.assert_batch(futils.check_call, lines)
                 m_remove_conntrack.assert_called_once_with(set(["3.4.5.6"]), 4)
 
     @mock.patch("calico.felix.devices.remove_conntrack_flows", autospec=True)
@@ -247,21 +276,33 @@ class TestDevices(unittest.TestCase):
         mac = stub_utils.get_mac()
         retcode = futils.CommandOutput("", "")
         current_ips = set()
-        calls = [mock.call(['arp', '-s', "1.2.3.4", mac, '-i', interface]),
-                 mock.call(["ip", "route", "replace", "1.2.3.4", "dev",
-                            interface]),
-                 mock.call(['arp', '-s', "2.3.4.5", mac, '-i', interface]),
-                 mock.call(["ip", "route", "replace", "2.3.4.5", "dev",
-                            interface])]
+        lines = [
+            "neigh replace 1.2.3.4 lladdr %s dev %s nud permanent" %
+            (mac, interface),
+            "route replace 1.2.3.4 dev %s" % interface,
+            "neigh replace 2.3.4.5 lladdr %s dev %s nud permanent" %
+            (mac, interface),
+            "route replace 2.3.4.5 dev %s" % interface,
+        ]
 
         with mock.patch('calico.felix.futils.check_call', return_value=retcode):
             with mock.patch('calico.felix.devices.list_interface_ips',
                             return_value=current_ips):
                 devices.set_routes(type, ips, interface, mac, reset_arp=True)
-                self.assertEqual(futils.check_call.call_count, len(calls))
-                futils.check_call.assert_has_calls(calls, any_order=True)
+                self.assert_batch(futils.check_call, lines)
                 m_remove_conntrack.assert_called_once_with(set(), 4)
 
+    def test_list_interface_ips_route_table(self):
+        m_table = mock.Mock()
+        m_table.interface_ips.return_value = set(["fd00::1"])
+        with mock.patch('calico.felix.devices._route_table', m_table):
+            with mock.patch('calico.felix.futils.check_call') as m_check_call:
+                self.assertEqual(
+                    devices.list_interface_ips(futils.IPV6, "tap1"),
+                    set(["fd00::1"]))
+                self.assertFalse(m_check_call.called)
+        m_table.interface_ips.assert_called_once_with(6, "tap1")
+
     def test_list_interface_ips(self):
         type = futils.IPV4
         tap = "tap" + str(uuid.uuid4())[:11]
@@ -465,3 +506,112 @@ class TestDevices(unittest.TestCase):
             mock.call(["conntrack", "--family", "ipv4", "--delete",
                        "--reply-dst", "10.0.0.1"]),
         ])
+
+    @mock.patch("calico.felix.futils.check_call", autospec=True)
+    def test_remove_conntrack_netlink(self, m_check_call):
+        m_client = mock.Mock()
+        with mock.patch("calico.felix.devices._ctnetlink_client", m_client):
+            devices.remove_conntrack_flows(set(["10.0.0.1"]), 4)
+        m_client.remove_flows.assert_called_once_with(set(["10.0.0.1"]), 4)
+        self.assertFalse(m_check_call.called)
+
+    @mock.patch("calico.felix.futils.check_call", autospec=True)
+    def test_remove_conntrack_netlink_fails(self, m_check_call):
+        m_client = mock.Mock()
+        m_client.remove_flows.side_effect = NetlinkError(1)
+        with mock.patch("calico.felix.devices._ctnetlink_client", m_client):
+            devices.remove_conntrack_flows(set(["10.0.0.1"]), 4)
+        # Falls back to the conntrack command.
+        self.assertEqual(m_check_call.call_count, 4)
+
+
+class TestConntrackManager(BaseTestCase):
+    def setUp(self):
+        super(TestConntrackManager, self).setUp()
+        self.mgr = devices.ConntrackManager()
+        m_remove = mock.patch("calico.felix.devices._remove_conntrack_flows",
+                              autospec=True)
+        self.m_remove = m_remove.start()
+        self.addCleanup(m_remove.stop)
+
+    def test_remove_async(self):
+        with mock.patch("calico.felix.devices._conntrack_manager",
+                        self.mgr):
+            devices.remove_conntrack_flows(set(["10.0.0.1"]), 4)
+            devices.remove_conntrack_flows(set(["10.0.0.2"]), 4)
+            devices.remove_conntrack_flows(set(["fd00::1"]), 6)
+            devices.remove_conntrack_flows(set(), 4)
+        self.assertFalse(self.m_remove.called)
+        self.step_actor(self.mgr)
+        # The batch was combined into one removal per IP version.
+        self.assertEqual(self.m_remove.mock_calls, [
+            mock.call(set(["10.0.0.1", "10.0.0.2"]), 4),
+            mock.call(set(["fd00::1"]), 6),
+        ])
+
+
+class TestInterfaceTable(BaseTestCase):
+    def setUp(self):
+        super(TestInterfaceTable, self).setUp()
+        self.table = devices.InterfaceTable()
+        self.table.update(devices.Interface("tap1", 5, 0x1, 6, None))
+
+    def test_rename(self):
+        self.table.update(devices.Interface("tap2", 5, 0x1, 6, None))
+        self.assertEqual(self.table.get("tap1"), None)
+        self.assertEqual(self.table.get("tap2").index, 5)
+        self.assertEqual(len(self.table), 1)
+
+    def test_recreate(self):
+        self.table.update(devices.Interface("tap1", 6, 0x1, 6, None))
+        self.assertEqual(self.table.get_by_index(5), None)
+        self.table.remove(5)
+        self.assertEqual(self.table.get("tap1").index, 6)
+        self.table.remove(6)
+        self.assertEqual(self.table.get("tap1"), None)
+
+    def test_devices_use_table(self):
+        self.table.update(devices.Interface("tap2", 6, 0, 2, None))
+        with mock.patch("calico.felix.devices._interface_table", self.table):
+            with mock.patch('calico.felix.futils.check_call') as m_check_call:
+                # Not used until loaded.
+                devices.interface_exists("tap1")
+                self.assertTrue(m_check_call.called)
+                m_check_call.reset_mock()
+                self.table.loaded = True
+                self.assertTrue(devices.interface_exists("tap1"))
+                self.assertFalse(devices.interface_exists("tap3"))
+                self.assertTrue(devices.interface_up("tap1"))
+                self.assertFalse(devices.interface_up("tap2"))
+                self.assertFalse(devices.interface_up("tap3"))
+                self.assertFalse(m_check_call.called)
+
+    @mock.patch("calico.felix.devices._write_proc_sys", autospec=True)
+    def test_sysctl_cache(self, m_write_proc_sys):
+        with mock.patch("calico.felix.devices._interface_table", self.table):
+            devices.configure_interface_ipv4("tap1")
+            self.assertEqual(m_write_proc_sys.call_count, 4)
+            # Not cached until the table has loaded.
+            self.table.loaded = True
+            devices.configure_interface_ipv4("tap1")
+            self.assertEqual(m_write_proc_sys.call_count, 8)
+            devices.configure_interface_ipv4("tap1")
+            devices.configure_interface_ipv6("tap1", None)
+            devices.configure_interface_ipv6("tap1", None)
+            self.assertEqual(m_write_proc_sys.call_count, 9)
+            # Recreated.
+            self.table.remove(5)
+            self.table.update(devices.Interface("tap1", 7, 0x1, 6, None))
+            devices.configure_interface_ipv4("tap1")
+            self.assertEqual(m_write_proc_sys.call_count, 13)
+
+    @mock.patch("calico.felix.devices._write_proc_sys", autospec=True)
+    def test_sysctl_cache_write_fails(self, m_write_proc_sys):
+        self.table.loaded = True
+        m_write_proc_sys.side_effect = iter([None, IOError()])
+        with mock.patch("calico.felix.devices._interface_table", self.table):
+            self.assertRaises(IOError, devices.configure_interface_ipv4,
+                              "tap1")
+            m_write_proc_sys.side_effect = None
+            devices.configure_interface_ipv4("tap1")
+        self.assertEqual(m_write_proc_sys.call_count, 5)
@@ -27,10 +27,13 @@ from calico.felix.test.base import BaseTestCase
 from calico.felix.dispatch import (
     DispatchChains, CHAIN_TO_ENDPOINT, CHAIN_FROM_ENDPOINT
 )
+from calico.felix.test.dispatch_scale import rules_traversed
 
 
 # A mocked config object for use with interface_to_suffix.
-Config = collections.namedtuple('Config', ['IFACE_PREFIX', 'METADATA_IP', 'METADATA_PORT'])
+Config = collections.namedtuple('Config', ['IFACE_PREFIX', 'METADATA_IP',
+                                           'METADATA_PORT',
+                                           'DISPATCH_MAX_FANOUT'])
 
 
 class TestDispatchChains(BaseTestCase):
@@ -40,7 +43,7 @@ class TestDispatchChains(BaseTestCase):
     def setUp(self):
         super(TestDispatchChains, self).setUp()
         self.iptables_updater = mock.MagicMock()
-        self.config = Config('tap', None, 8775)
+        self.config = Config('tap', None, 8775, 16)
 
     def getDispatchChain(self):
         return DispatchChains(
@@ -77,7 +80,7 @@ class TestDispatchChains(BaseTestCase):
         """
         Tests that a snapshot with metadata works OK.
         """
-        self.config = Config('tap', '127.0.0.1', 8775)
+        self.config = Config('tap', '127.0.0.1', 8775, 16)
         d = self.getDispatchChain()
 
         ifaces = ['tapabcdef', 'tap123456', 'tapb7d849']
@@ -117,9 +120,9 @@ class TestDispatchChains(BaseTestCase):
         self.assertEqual(to_delete, set(["felix-FROM-EP-PFX-z"]))
         self.assertEqual(deps, {
             'felix-TO-ENDPOINT': set(
-                ['felix-FROM-EP-PFX-a', 'felix-FROM-EP-PFX-b', 'felix-to-c']),
+                ['felix-TO-EP-PFX-a', 'felix-TO-EP-PFX-b', 'felix-to-c']),
             'felix-FROM-ENDPOINT': set(
-                ['felix-TO-EP-PFX-a', 'felix-TO-EP-PFX-b', 'felix-from-c']),
+                ['felix-FROM-EP-PFX-a', 'felix-FROM-EP-PFX-b', 'felix-from-c']),
 
             'felix-TO-EP-PFX-a': set(['felix-to-a1', 'felix-to-a2', 'felix-to-a3']),
             'felix-TO-EP-PFX-b': set(['felix-to-b1', 'felix-to-b2']),
@@ -168,6 +171,94 @@ class TestDispatchChains(BaseTestCase):
                 '--append felix-TO-EP-PFX-b --jump DROP']
         })
 
+    def test_tree_building_multi_level(self):
+        self.config = Config('tap', None, 8775, 2)
+        d = self.getDispatchChain()
+        ifaces = ['tapab1', 'tapab2', 'tapac1', 'tapb']
+        to_delete, deps, updates, new_leaf_chains = d._calculate_update(ifaces)
+        self.assertEqual(new_leaf_chains, set([
+            'felix-FROM-EP-PFX-a', 'felix-FROM-EP-PFX-ab',
+            'felix-TO-EP-PFX-a', 'felix-TO-EP-PFX-ab',
+        ]))
+        self.assertEqual(deps['felix-FROM-EP-PFX-a'],
+                         set(['felix-FROM-EP-PFX-ab', 'felix-from-ac1']))
+        self.assertEqual(deps['felix-TO-EP-PFX-ab'],
+                         set(['felix-to-ab1', 'felix-to-ab2']))
+        self.assertEqual(updates['felix-FROM-EP-PFX-a'], [
+            '--append felix-FROM-EP-PFX-a --in-interface tapab+ '
+            '--goto felix-FROM-EP-PFX-ab',
+            '--append felix-FROM-EP-PFX-a --in-interface tapac1 '
+            '--goto felix-from-ac1',
+            '--append felix-FROM-EP-PFX-a --jump DROP',
+        ])
+
+    def test_incremental_update(self):
+        """
+        Tests that only the chains whose contents change are rewritten.
+        """
+        self.config = Config('tap', None, 8775, 2)
+        d = self.getDispatchChain()
+        d.apply_snapshot(['tapab1', 'tapab2', 'tapac1', 'tapb'], async=True)
+        self.step_actor(d)
+        args = self.iptables_updater.rewrite_chains.call_args[0]
+        self.assertEqual(len(args[0]), 6)
+
+        # Adding an interface to an existing leaf only touches that leaf.
+        d.on_endpoint_added('tapab3', async=True)
+        self.step_actor(d)
+        args = self.iptables_updater.rewrite_chains.call_args[0]
+        self.assertEqual(set(args[0].keys()),
+                         set(['felix-FROM-EP-PFX-ab', 'felix-TO-EP-PFX-ab']))
+        self.assertEqual(args[1]['felix-FROM-EP-PFX-ab'],
+                         set(['felix-from-ab1', 'felix-from-ab2',
+                              'felix-from-ab3']))
+        self.assertFalse(self.iptables_updater.delete_chains.called)
+
+        # Removing a leaf rewrites its parent and deletes the leaf.
+        d.on_endpoint_removed('tapab1', async=True)
+        d.on_endpoint_removed('tapab2', async=True)
+        d.on_endpoint_removed('tapab3', async=True)
+        self.step_actor(d)
+        args = self.iptables_updater.rewrite_chains.call_args[0]
+        self.assertEqual(set(args[0].keys()),
+                         set(['felix-FROM-ENDPOINT', 'felix-TO-ENDPOINT']))
+        self.assertEqual(
+            set(self.iptables_updater.delete_chains.call_args[0][0]),
+            set(['felix-FROM-EP-PFX-a', 'felix-TO-EP-PFX-a',
+                 'felix-FROM-EP-PFX-ab', 'felix-TO-EP-PFX-ab']))
+
+        # No change, no rewrite.
+        self.iptables_updater.reset_mock()
+        d.on_endpoint_removed('tapab1', async=True)
+        d.on_endpoint_added('tapac1', async=True)
+        self.step_actor(d)
+        self.assertFalse(self.iptables_updater.rewrite_chains.called)
+
+        # A snapshot always rewrites everything.
+        d.apply_snapshot(['tapac1', 'tapb'], async=True)
+        self.step_actor(d)
+        args = self.iptables_updater.rewrite_chains.call_args[0]
+        self.assertEqual(set(args[0].keys()),
+                         set(['felix-FROM-ENDPOINT', 'felix-TO-ENDPOINT']))
+
+    def test_tree_depth_scales(self):
+        """
+        Tests that the number of rules that a packet traverses grows
+        slowly with the number of interfaces.
+        """
+        d = self.getDispatchChain()
+        ifaces = set("tap%011x" % (i * 2654435761 % (1 << 44))
+                     for i in xrange(4000))
+        _, _, updates, _ = d._calculate_update(ifaces)
+        counts = [rules_traversed(updates, i) for i in ifaces]
+        # With a two-level tree, this would be ~250+16.
+        self.assertTrue(max(counts) < 64, "Max rules %s" % max(counts))
+        for chain, rules in updates.iteritems():
+            # Every chain should have at most one rule per hex character,
+            # plus the trailing DROP.
+            self.assertTrue(len(rules) <= 17,
+                            "Chain %s has %s rules" % (chain, len(rules)))
+
     def test_applying_snapshot_clean(self):
         """
         Tests that a snapshot can be applied to a previously unused actor.
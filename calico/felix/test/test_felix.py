@@ -48,6 +48,7 @@ class TestBasic(BaseTestCase):
         else:
             sys.modules['etcd'] = self._real_etcd
 
+    @mock.patch("calico.felix.devices.set_conntrack_manager", autospec=True)
     @mock.patch("calico.felix.devices.configure_global_kernel_config",
                 autospec=True)
     @mock.patch("calico.felix.devices.interface_up",
@@ -66,7 +67,8 @@ class TestBasic(BaseTestCase):
                            m_IptablesUpdater, m_UpdateSplitter,
                            m_start, m_load,
                            m_ipset_4, m_check_call, m_iface_exists,
-                           m_iface_up, m_configure_global_kernel_config):
+                           m_iface_up, m_configure_global_kernel_config,
+                           m_set_conntrack_manager):
         m_IptablesUpdater.return_value.greenlet = mock.Mock()
         m_MasqueradeManager.return_value.greenlet = mock.Mock()
         m_UpdateSplitter.return_value.greenlet = mock.Mock()
@@ -79,6 +81,13 @@ class TestBasic(BaseTestCase):
         m_config.IP_IN_IP_ENABLED = True
         m_config.IP_IN_IP_MTU = 1480
         m_config.DEFAULT_INPUT_CHAIN_ACTION = "RETURN"
+        m_config.DATAPLANE_DRIVER = "kernel"
+        m_config.FIREWALL_BACKEND = "iptables"
+        m_config.IPSET_AUDIT_INTERVAL = 0
+        m_config.IPSET_NETLINK_ENABLED = False
+        m_config.ROUTE_NETLINK_ENABLED = False
+        m_config.ROUTE_TABLE_CACHE_ENABLED = False
+        m_config.CONNTRACK_NETLINK_ENABLED = False
         with gevent.Timeout(5):
             self.assertRaises(TestException,
                               felix._main_greenlet, m_config)
@@ -86,6 +95,7 @@ class TestBasic(BaseTestCase):
         m_iface_exists.assert_called_once_with("tunl0")
         m_iface_up.assert_called_once_with("tunl0")
         m_configure_global_kernel_config.assert_called_once_with()
+        self.assertEqual(m_set_conntrack_manager.call_count, 1)
 
         # Check all IptablesUpdaters get passed to the splitter, which handles
         # cleanup.
@@ -243,6 +243,47 @@ class TestEtcdWatcher(BaseTestCase):
             set([EndpointId("hostname", "orch", "wlid", "epid")])
         )
 
+    def test_on_snapshot_loaded_all_kinds(self):
+        self.m_config.IP_IN_IP_ENABLED = True
+
+        def node(key, value, action="get"):
+            n = Mock()
+            n.key = key
+            n.value = value
+            n.action = action
+            return n
+
+        m_response = Mock()
+        m_response.children = [
+            node("/calico/v1/policy/profile/prof1/rules", RULES_STR),
+            node("/calico/v1/policy/profile/prof1/tags", TAGS_STR),
+            node("/calico/v1/policy/profile/prof2/tags", None,
+                 action="delete"),
+            node("/calico/v1/host/hostname/workload/orch/wlid/endpoint/epid",
+                 ENDPOINT_STR),
+            node("/calico/v1/host/hostname/bird_ip", "10.0.0.1"),
+            node("/calico/v1/host/other/bird_ip", "bad IP"),
+            node("/calico/v1/ipam/v4/pool/10.1.0.0-16",
+                 '{"cidr": "10.1.0.0/16"}'),
+            node("/calico/v1/config/LogSeverityFile", "DEBUG"),
+            node("/calico/v1/Ready", "true"),
+        ]
+        with patch.object(self.watcher, "clean_up_endpoint_statuses"):
+            self.watcher._on_snapshot_loaded(m_response)
+
+        ep_id = EndpointId("hostname", "orch", "wlid", "epid")
+        self.m_splitter.apply_snapshot.assert_called_once_with(
+            {"prof1": RULES},
+            {"prof1": TAGS, "prof2": None},
+            {ep_id: ANY},
+            {"10.1.0.0-16": {"cidr": "10.1.0.0/16"}},
+            async=True,
+        )
+        self.assertEqual(dict(self.watcher.endpoint_ids_per_host),
+                         {"hostname": set([ep_id])})
+        self.assertEqual(self.watcher.ipv4_by_hostname,
+                         {"hostname": "10.0.0.1"})
+
     def test_resync_flag(self):
         self.watcher.resync_after_current_poll = True
         self.watcher.next_etcd_index = 1
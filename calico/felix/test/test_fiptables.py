@@ -119,6 +119,102 @@ class TestIptablesUpdater(BaseTestCase):
         self.step_actor(self.ipt)
         cb.assert_called_once_with(None)
 
+    def test_rewrite_chains_shared(self):
+        """
+        Tests that shared chains are only written once and are deleted
+        once they're no longer referenced.
+        """
+        shared = {"felix-s-1": ["--append felix-s-1 --jump ACCEPT"]}
+        self.ipt.rewrite_chains(
+            {"felix-a": ["--append felix-a --goto felix-s-1"],
+             "felix-b": ["--append felix-b --goto felix-s-1"]},
+            {"felix-a": set(["felix-s-1"]), "felix-b": set(["felix-s-1"])},
+            shared_chains=shared,
+            async=True,
+        )
+        self.step_actor(self.ipt)
+        self.assertEqual(self.stub.chains_contents["felix-s-1"],
+                         ["--append felix-s-1 --jump ACCEPT"])
+        self.assertEqual(self.ipt._shared_chains, set(["felix-s-1"]))
+        # Rewriting one of the referring chains shouldn't rewrite the shared
+        # chain.
+        self.ipt.rewrite_chains(
+            {"felix-a": ["--append felix-a --goto felix-s-1"]},
+            {"felix-a": set(["felix-s-1"])},
+            shared_chains=shared,
+            async=True,
+        )
+        self.step_actor(self.ipt)
+        self.assertEqual(self.ipt._stats.stats["Shared chains written"], 1)
+        self.assertEqual(self.ipt._stats.stats["Shared chains reused"], 1)
+        # Remove one reference, shared chain should stay.
+        self.ipt.delete_chains(["felix-a"], async=True)
+        self.step_actor(self.ipt)
+        self.assertTrue("felix-s-1" in self.stub.chains_contents)
+        # Move the other reference to a different shared chain, the old one
+        # should get cleaned up.
+        self.ipt.rewrite_chains(
+            {"felix-b": ["--append felix-b --goto felix-s-2"]},
+            {"felix-b": set(["felix-s-2"])},
+            shared_chains={"felix-s-2": ["--append felix-s-2 --jump DROP"]},
+            async=True,
+        )
+        self.step_actor(self.ipt)
+        self.assertEqual(self.stub.chains_contents, {
+            "felix-b": ["--append felix-b --goto felix-s-2"],
+            "felix-s-2": ["--append felix-s-2 --jump DROP"],
+        })
+        self.assertEqual(self.ipt._shared_chains, set(["felix-s-2"]))
+
+    def test_adopt_existing_chains(self):
+        """
+        Tests that, during the graceful restart window, chains that already
+        have the right content are adopted rather than rewritten.
+        """
+        self.stub.iptables_save_output = ["\n".join([
+            "*filter",
+            ":felix-a - [0:0]",
+            ":felix-b - [0:0]",
+            "-A felix-a -s 10.0.0.1/32 -p tcp -m multiport --dports 22,80 "
+            "-j felix-b",
+            "-A felix-a -m mark --mark 0x1/0x1 "
+            "-m comment --comment \"Profile accepted packet\" -j RETURN",
+            "-A felix-b -j MARK --set-xmark 0x0/0xffffffff",
+            "COMMIT",
+        ])]
+        ipt = IptablesUpdater("filter", self.m_config, 4)
+        ipt._execute_iptables = Mock(wraps=self.stub.apply_iptables_restore)
+        self.step_actor(ipt)
+        ipt.rewrite_chains(
+            {"felix-a": ["--append felix-a --protocol tcp "
+                         "--source 10.0.0.1 --match multiport "
+                         "--destination-ports 80,22 --jump felix-b",
+                         '--append felix-a --match mark --mark 1/1 '
+                         '--match comment --comment "Profile accepted '
+                         'packet" --jump RETURN'],
+             "felix-b": ["--append felix-b --jump MARK --set-mark 1"]},
+            {"felix-a": set(["felix-b"])},
+            async=True,
+        )
+        self.step_actor(ipt)
+        # felix-a matched so only felix-b (different mark) was rewritten.
+        self.assertEqual(ipt._stats.stats["Chains adopted"], 1)
+        self.assertEqual(ipt._stats.stats["Chains rewritten"], 1)
+        input_lines = ipt._execute_iptables.call_args[0][0]
+        self.assertFalse(any("felix-a" in l for l in input_lines))
+        # Once touched, a chain isn't adopted again.
+        self.assertEqual(ipt._chain_contents_in_dataplane.keys(),
+                         ["felix-a"])
+        # After the grace period, everything is rewritten.
+        ipt._grace_period_finished = True
+        ipt.rewrite_chains(
+            {"felix-a": ["--append felix-a --jump felix-b"]},
+            {"felix-a": set(["felix-b"])},
+            async=True,
+        )
+        self.step_actor(ipt)
+        self.assertEqual(ipt._stats.stats["Chains rewritten"], 2)
+
     def test_delete_required_chain_stub(self):
         """
         Tests that deleting a required chain stubs it out instead.
@@ -505,6 +601,70 @@ class TestUtilityFunctions(BaseTestCase):
                                           "but got: %s" % (inp, exp, output))
 
 
+class TestNormalizeRule(BaseTestCase):
+    def test_normalize_matches_iptables_save(self):
+        for ours, saved in [
+            ("--append felix-x --protocol udp --sport 68 --dport 67 "
+             "--jump ACCEPT",
+             "-A felix-x -p udp -m udp --sport 68 --dport 67 -j ACCEPT"),
+            ('--append felix-x --match mac ! --mac-source aa:bb:cc:dd:ee:ff '
+             '--jump DROP --match comment --comment "Incorrect source MAC"',
+             '-A felix-x -m mac ! --mac-source AA:BB:CC:DD:EE:FF '
+             '-m comment --comment "Incorrect source MAC" -j DROP'),
+            ("--append felix-x --match conntrack --ctstate "
+             "RELATED,ESTABLISHED --jump ACCEPT",
+             "-A felix-x -m conntrack --ctstate RELATED,ESTABLISHED "
+             "-j ACCEPT"),
+            ("--append felix-x --protocol icmpv6 --source fd00::1 "
+             "--match set --match-set felix-v6-a dst --goto felix-y",
+             "-A felix-x -s fd00::1/128 -p ipv6-icmp "
+             "-m set --match-set felix-v6-a dst -g felix-y"),
+            ("--append felix-x --protocol icmpv6 --match icmp6 "
+             "--icmpv6-type 128 --jump ACCEPT",
+             "-A felix-x -p ipv6-icmp -m icmp6 --icmpv6-type 128 -j ACCEPT"),
+            ("--append felix-x --protocol tcp --match multiport "
+             "--destination-ports 80,22 --jump ACCEPT",
+             "-A felix-x -p tcp -m multiport --dports 22,80 -j ACCEPT"),
+        ]:
+            self.assertEqual(fiptables._normalize_rule(ours),
+                             fiptables._normalize_rule(saved))
+
+    def test_normalize_distinguishes(self):
+        for first, second in [
+            ("-A felix-x -j DROP", "-A felix-y -j DROP"),
+            ("-A felix-x -s 10.0.0.1 -j DROP",
+             "-A felix-x -d 10.0.0.1 -j DROP"),
+            ("-A felix-x -m set --match-set a src -j DROP",
+             "-A felix-x -m set ! --match-set a src -j DROP"),
+            ("-A felix-x -j felix-y", "-A felix-x -g felix-y"),
+            ("-A felix-x -j MARK --set-mark 1",
+             "-A felix-x -j MARK --set-xmark 0x1/0x1"),
+            # Only the protocol's own module is implicit.
+            ("-A felix-x -m mark --mark 0x1 -j DROP",
+             "-A felix-x -m connmark --mark 0x1 -j DROP"),
+            ("-A felix-x -p udp --dport 80 -j DROP",
+             "-A felix-x -p udp -m tcp --dport 80 -j DROP"),
+        ]:
+            self.assertNotEqual(fiptables._normalize_rule(first),
+                                fiptables._normalize_rule(second))
+
+    def test_normalize_bad_input(self):
+        self.assertRaises(ValueError, fiptables._normalize_rule,
+                          "--insert felix-x -j DROP")
+        self.assertRaises(ValueError, fiptables._normalize_rule,
+                          "-A felix-x -j")
+        self.assertEqual(
+            fiptables._extract_our_chain_contents("filter", "\n".join([
+                "*filter",
+                ":felix-x - [0:0]",
+                ":felix-y - [0:0]",
+                "-A felix-x -j DROP",
+                "-A felix-y -j",
+                "COMMIT",
+            ])).keys(),
+            ["felix-x"])
+
+
 class IptablesStub(object):
     """
     Fake version of the dataplane, accepts iptables-restore input and
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fnftables
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the nftables backend.  The translations of Felix's real rule
+renderers are checked against golden files in data/nftables.  To
+regenerate them after an intentional change, set
+FELIX_UPDATE_GOLDEN_FILES=1 and re-run the tests.
+"""
+import collections
+import logging
+import os
+
+from mock import Mock, patch, call
+
+from calico.felix import fnftables, frules
+from calico.felix.dispatch import DispatchChains
+from calico.felix.endpoint import _build_to_or_from_chain
+from calico.felix.fnftables import (
+    NftablesUpdater, NftSet, ipt_restore_to_nft, translate_rule,
+    UnsupportedRuleFragment
+)
+from calico.felix.futils import CommandOutput, FailedSystemCall
+from calico.felix.masq import MASQ_RULE_FRAGMENT
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "data", "nftables")
+
+DispatchConfig = collections.namedtuple("DispatchConfig",
+                                        ["IFACE_PREFIX",
+                                         "DISPATCH_MAX_FANOUT"])
+
+NFT_LISTING = """table ip felix-filter {
+\tchain INPUT {
+\t\ttype filter hook input priority 0; policy accept;
+\t\tjump felix-INPUT
+\t}
+\tchain felix-INPUT {
+\t\tiifname != "tap*" return
+\t}
+\tchain felix-FROM-ENDPOINT {
+\t\tiifname vmap { "tapa" : goto felix-from-a, "tapb" : goto felix-from-b }
+\t}
+\tchain felix-from-a {
+\t}
+\tchain felix-from-b {
+\t}
+\tchain felix-orphan {
+\t}
+}
+"""
+
+
+def restore_input(table, chains):
+    """
+    :returns list[str]: iptables-restore input that rewrites the given
+        chains, in the same form as the IptablesUpdater generates.
+    """
+    lines = ["*%s" % table]
+    lines += [":%s -" % chain for chain, _ in chains]
+    for chain, updates in chains:
+        lines.append("--flush %s" % chain)
+        lines.extend(updates)
+    lines.append("COMMIT")
+    return lines
+
+
+class TestGoldenFiles(BaseTestCase):
+    def assert_golden(self, name, input_lines, ip_version=4):
+        script = "\n".join(ipt_restore_to_nft(input_lines, ip_version)) + "\n"
+        path = os.path.join(GOLDEN_DIR, name + ".nft")
+        if os.environ.get("FELIX_UPDATE_GOLDEN_FILES"):
+            with open(path, "w") as f:
+                f.write(script)
+        with open(path) as f:
+            expected = f.read()
+        self.assertEqual(script, expected,
+                         "nftables script for %s did not match %s; got:\n%s" %
+                         (name, path, script))
+
+    def test_global_filter_v4(self):
+        input_chain, _ = frules._build_input_chain(
+            "tap+", "10.0.0.1", 8775, 68, 67, ipv6=False,
+            default_action="RETURN", hosts_set_name=None)
+        forward_chain, _ = frules._build_forward_chain("tap+")
+        self.assert_golden("global_filter_v4", restore_input("filter", [
+            (frules.CHAIN_INPUT, input_chain),
+            (frules.CHAIN_FORWARD, forward_chain),
+        ]))
+
+    def test_global_filter_v6(self):
+        input_chain, _ = frules._build_input_chain(
+            "tap+", None, None, 546, 547, ipv6=True,
+            default_action="DROP", hosts_set_name=None)
+        self.assert_golden("global_filter_v6", restore_input("filter", [
+            (frules.CHAIN_INPUT, input_chain),
+        ]), ip_version=6)
+
+    def test_nat_v4(self):
+        input_lines = restore_input("nat", [
+            (frules.CHAIN_PREROUTING, [
+                "--append %s --protocol tcp --dport 80 "
+                "--destination 169.254.169.254/32 "
+                "--jump DNAT --to-destination 10.0.0.1:8775" %
+                frules.CHAIN_PREROUTING
+            ]),
+        ])
+        # Inserted rules are programmed by rewriting the base chain.
+        input_lines += ["*nat",
+                        "--flush POSTROUTING",
+                        "--append " + MASQ_RULE_FRAGMENT,
+                        "COMMIT"]
+        self.assert_golden("nat_v4", input_lines)
+
+    def test_profile_v4(self):
+        rules = [
+            {"action": "deny", "src_tag": "bad"},
+            {"protocol": "tcp", "dst_ports": [22, "1000:2000"],
+             "src_net": "10.0.0.0/8"},
+            {"protocol": "udp", "src_ports": [53]},
+            {"protocol": "icmp", "icmp_type": 8, "icmp_code": 0},
+            {"dst_net_set": "felix-v4n-0123456789abcdef"},
+        ]
+        chain = frules.profile_to_chain_name("inbound", "prof1")
+        fragments = frules.rules_to_chain_rewrite_lines(
+            chain, rules, 4, {"bad": "felix-v4-bad"}, on_allow="RETURN")
+        self.assert_golden("profile_v4",
+                           restore_input("filter", [(chain, fragments)]))
+
+    def test_endpoint_v4(self):
+        chain, _ = _build_to_or_from_chain("ep1", ["prof1", "prof2"],
+                                           "felix-from-1234", "outbound",
+                                           expected_mac="AA:BB:CC:DD:EE:FF")
+        self.assert_golden("endpoint_v4",
+                           restore_input("filter", [("felix-from-1234",
+                                                     chain)]))
+
+    def test_dispatch_v4(self):
+        d = DispatchChains(DispatchConfig("tap", 2), 4, None)
+        _, _, updates, _ = d._calculate_update(["tapa1", "tapa2", "tapa3",
+                                                "tapb1", "tapc"])
+        self.assert_golden("dispatch_v4",
+                           restore_input("filter", sorted(updates.items())))
+
+
+class TestTranslation(BaseTestCase):
+    def test_translate_rule(self):
+        for fragment, ip_version, expected in [
+            ("--jump ACCEPT", 4, "accept"),
+            ("! --in-interface tap+ --jump RETURN", 4,
+             'iifname != "tap*" return'),
+            ("--source fd00::/64 --jump felix-x", 6,
+             "ip6 saddr fd00::/64 jump felix-x"),
+            ("--match set ! --match-set felix-v6-a dst --goto felix-y", 6,
+             "ip6 daddr != @felix-v6-a goto felix-y"),
+            ("--in-interface tap+ --match rpfilter --invert -j DROP", 6,
+             'iifname "tap*" fib saddr . iif oif missing drop'),
+            ("--protocol ipv6-icmp --icmpv6-type 130 --jump ACCEPT", 6,
+             "meta l4proto ipv6-icmp icmpv6 type 130 accept"),
+            ('--jump DROP -m comment --comment "a comment"', 4,
+             'drop comment "a comment"'),
+        ]:
+            self.assertEqual(translate_rule(fragment, ip_version), expected)
+
+    def test_translate_unsupported(self):
+        self.assertRaises(UnsupportedRuleFragment, translate_rule,
+                          "--match physdev --physdev-in eth0 --jump DROP", 4)
+        self.assertRaises(UnsupportedRuleFragment, translate_rule,
+                          "--dport 80 --jump DROP", 4)
+        self.assertRaises(UnsupportedRuleFragment, ipt_restore_to_nft,
+                          ["*filter", "--append felix-a --jump DROP"], 4)
+
+    def test_vmap_skips_duplicates_and_wildcards(self):
+        script = ipt_restore_to_nft([
+            "*filter",
+            "--append felix-a --in-interface tapa --goto felix-1",
+            "--append felix-a --in-interface tapa --goto felix-2",
+            "--append felix-a --in-interface tapb+ --goto felix-3",
+            "--append felix-a --in-interface tapc --goto felix-4",
+            "COMMIT",
+        ], 4)
+        self.assertEqual(script[-3:], [
+            'add rule ip felix-filter felix-a iifname vmap '
+            '{ "tapa" : goto felix-1 }',
+            'add rule ip felix-filter felix-a iifname "tapb*" goto felix-3',
+            'add rule ip felix-filter felix-a iifname vmap '
+            '{ "tapc" : goto felix-4 }',
+        ])
+
+    def test_extract_chains(self):
+        self.assertEqual(
+            fnftables._extract_our_nft_chains(NFT_LISTING),
+            set(["felix-INPUT", "felix-FROM-ENDPOINT", "felix-from-a",
+                 "felix-from-b", "felix-orphan"]))
+        self.assertEqual(
+            fnftables._extract_our_unreffed_nft_chains(NFT_LISTING),
+            set(["felix-FROM-ENDPOINT", "felix-orphan"]))
+
+
+class TestNftablesUpdater(BaseTestCase):
+    def setUp(self):
+        super(TestNftablesUpdater, self).setUp()
+        self.m_config = Mock()
+        self.m_config.REFRESH_INTERVAL = 0
+        self.m_config.IPTABLES_LOCK_DETECTION = False
+        self.check_call_patch = patch("calico.felix.futils.check_call",
+                                      autospec=True)
+        self.m_check_call = self.check_call_patch.start()
+        self.m_check_call.return_value = CommandOutput(NFT_LISTING, "")
+        self.nft = NftablesUpdater("filter", self.m_config, 4)
+        self.step_actor(self.nft)
+
+    def tearDown(self):
+        self.check_call_patch.stop()
+        super(TestNftablesUpdater, self).tearDown()
+
+    def nft_scripts(self):
+        return [c[2]["input_str"].splitlines()
+                for c in self.m_check_call.mock_calls
+                if c[1][0] == ["nft", "-f", "-"]]
+
+    def test_load_chains(self):
+        self.assertEqual(self.nft._chains_in_dataplane,
+                         set(["felix-INPUT", "felix-FROM-ENDPOINT",
+                              "felix-from-a", "felix-from-b",
+                              "felix-orphan"]))
+
+    def test_missing_table(self):
+        self.m_check_call.side_effect = FailedSystemCall(
+            "Failed", [], 1, "", "Error: No such file or directory")
+        self.assertEqual(self.nft._get_unreferenced_chains(), set())
+
+    def test_rewrite_chains(self):
+        self.nft.rewrite_chains({"felix-a": ["--append felix-a "
+                                             "--jump felix-b"]},
+                                {"felix-a": set(["felix-b"])}, async=True)
+        self.step_actor(self.nft)
+        script = self.nft_scripts()[-1]
+        self.assertEqual(script[0], "add table ip felix-filter")
+        self.assertTrue("add rule ip felix-filter felix-a jump felix-b" in
+                        script)
+        # The missing dependency gets stubbed out.
+        self.assertTrue("add chain ip felix-filter felix-b" in script)
+        self.assertTrue(any(l.startswith("add rule ip felix-filter felix-b "
+                                         "drop") for l in script))
+
+    def test_insert_and_remove_rule(self):
+        self.nft.ensure_rule_inserted("INPUT --jump felix-INPUT", async=True)
+        self.step_actor(self.nft)
+        self.nft.ensure_rule_inserted("INPUT --jump felix-X", async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.nft_scripts()[-1][-3:], [
+            "flush chain ip felix-filter INPUT",
+            "add rule ip felix-filter INPUT jump felix-INPUT",
+            "add rule ip felix-filter INPUT jump felix-X",
+        ])
+        self.nft.ensure_rule_removed("INPUT --jump felix-X", async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.nft_scripts()[-1][-2:], [
+            "flush chain ip felix-filter INPUT",
+            "add rule ip felix-filter INPUT jump felix-INPUT",
+        ])
+
+    def test_untranslatable_message_fails(self):
+        f = self.nft.rewrite_chains({"felix-a": ["--append felix-a "
+                                                 "--match physdev "
+                                                 "--physdev-in x"]},
+                                    {}, async=True)
+        self.step_actor(self.nft)
+        self.assertRaises(FailedSystemCall, f.get)
+
+
+class TestNftSet(BaseTestCase):
+    def setUp(self):
+        super(TestNftSet, self).setUp()
+        self.set = NftSet("felix-v4-a", "felix-tmp-v4-a", "inet", "hash:net")
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_replace_members(self, m_check_call):
+        self.set.replace_members(set(["10.0.0.0/8", "10.1.0.1"]))
+        self.assertEqual(m_check_call.mock_calls, [
+            call(["nft", "-f", "-"], input_str=(
+                "add table ip felix-filter\n"
+                "add set ip felix-filter felix-v4-a "
+                "{ type ipv4_addr; flags interval; auto-merge; }\n"
+                "add table ip felix-nat\n"
+                "add set ip felix-nat felix-v4-a "
+                "{ type ipv4_addr; flags interval; auto-merge; }\n"
+                "flush set ip felix-filter felix-v4-a\n"
+                "flush set ip felix-nat felix-v4-a\n"
+                "add element ip felix-filter felix-v4-a "
+                "{ 10.0.0.0/8, 10.1.0.1 }\n"
+                "add element ip felix-nat felix-v4-a "
+                "{ 10.0.0.0/8, 10.1.0.1 }\n"
+            ))
+        ])
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_update_members_falls_back(self, m_check_call):
+        m_check_call.side_effect = iter([
+            FailedSystemCall("Failed", [], 1, "", "No such file"),
+            None
+        ])
+        self.set.update_members(set(["10.0.0.1"]), set(["10.0.0.2"]))
+        first = m_check_call.mock_calls[0][2]["input_str"]
+        self.assertTrue("delete element ip felix-filter felix-v4-a "
+                        "{ 10.0.0.1 }" in first)
+        second = m_check_call.mock_calls[1][2]["input_str"]
+        self.assertTrue("flush set ip felix-nat felix-v4-a" in second)
@@ -141,6 +141,112 @@ class TestRules(BaseTestCase):
             )
             self.assertEqual(fragments, expected_output)
 
+    def test_rules_generation_cached(self):
+        cache = frules.RenderedRulesCache(2)
+        with patch("calico.felix.frules._rendered_rules_cache", cache):
+            for rules, ip_version, expected_output in RULES_TESTS:
+                for _ in xrange(2):
+                    fragments = rules_to_chain_rewrite_lines(
+                        "chain-foo",
+                        rules,
+                        ip_version,
+                        IP_SET_MAPPING,
+                        on_allow="RETURN",
+                    )
+                    self.assertEqual(fragments, expected_output)
+            # Same rules, different chain: should hit the cache.
+            fragments = rules_to_chain_rewrite_lines(
+                "chain-bar", [{"action": "deny"}], 4, {})
+            self.assertEqual(fragments[1], "--append chain-bar --jump DROP")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache._stats.stats["Cache misses"],
+                         len(RULES_TESTS) + 1)
+        self.assertEqual(cache._stats.stats["Cache hits"], len(RULES_TESTS))
+        self.assertEqual(cache._stats.stats["Cache evictions"],
+                         len(RULES_TESTS) - 1)
+
+    def test_rules_cache_lru(self):
+        cache = frules.RenderedRulesCache(2)
+
+        def render(action):
+            return cache.get_or_render([{"action": action}], 4, {},
+                                       "ACCEPT", "DROP")
+
+        render("allow")
+        render("deny")
+        # Lots of hits on "allow" make "deny" the least-recently-used.
+        for _ in xrange(10):
+            render("allow")
+        render("next-tier")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache._stats.stats["Cache evictions"], 1)
+        render("allow")
+        self.assertEqual(cache._stats.stats["Cache hits"], 11)
+        render("deny")
+        self.assertEqual(cache._stats.stats["Cache misses"], 4)
+        # The stale uses don't build up.
+        self.assertTrue(len(cache._uses) <= 4)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_rules_cache_key(self):
+        cache = frules.RenderedRulesCache(10)
+        rules = [{"action": "allow", "src_tag": "foo"}]
+        self.assertEqual(cache.get_or_render(rules, 4, {"foo": "set-1"},
+                                             "RETURN", "DROP"),
+                         ["--match set --match-set set-1 src --jump RETURN"])
+        # A change to any input should result in a miss.
+        self.assertEqual(cache.get_or_render(rules, 4, {"foo": "set-2"},
+                                             "RETURN", "DROP"),
+                         ["--match set --match-set set-2 src --jump RETURN"])
+        self.assertEqual(cache.get_or_render(rules, 4, {"foo": "set-1"},
+                                             "ACCEPT", "DROP"),
+                         ["--match set --match-set set-1 src --jump ACCEPT"])
+        self.assertEqual(cache._stats.stats["Cache misses"], 3)
+        self.assertEqual(cache._stats.stats["Cache hits"], 0)
+
+    def test_optimize_rules(self):
+        rules = [
+            {"action": "deny", "src_net": "10.0.0.0/8"},
+            {"src_net": "10.0.0.1/32", "protocol": "tcp"},
+            {"src_net": "10.0.0.2/32", "protocol": "tcp"},
+            {"src_net": "10.0.0.3/32", "protocol": "tcp"},
+            {"src_net": "10.0.0.1/32", "protocol": "udp"},
+            {"dst_net": "10.0.0.1/32", "src_net": "10.0.0.0/8"},
+            {"dst_net": "10.0.0.2/32", "src_net": "10.0.0.0/8"},
+            {"dst_net": "10.0.0.3/32", "src_net": "10.0.0.0/8"},
+            {"ip_version": 6, "src_net": "dead::/64"},
+        ]
+        optimized, net_set_ids = frules.optimize_rules(rules, 4, 3)
+        src_set, dst_set = net_set_ids
+        self.assertEqual(src_set.cidrs, set(["10.0.0.1/32", "10.0.0.2/32",
+                                             "10.0.0.3/32"]))
+        self.assertEqual(dst_set.cidrs, set(["10.0.0.1/32", "10.0.0.2/32",
+                                             "10.0.0.3/32"]))
+        # Same CIDRs so the ipset can be shared.
+        self.assertEqual(src_set, dst_set)
+        self.assertEqual(optimized, [
+            {"action": "deny", "src_net": "10.0.0.0/8"},
+            {"src_net_set": src_set.name, "protocol": "tcp"},
+            {"src_net": "10.0.0.1/32", "protocol": "udp"},
+            {"dst_net_set": dst_set.name, "src_net": "10.0.0.0/8"},
+        ])
+        self.assertEqual(
+            _rule_to_iptables_fragment("foo", optimized[1], 4, {}),
+            "--append foo --protocol tcp --match set --match-set %s src "
+            "--jump ACCEPT" % src_set.name
+        )
+        # Below the threshold, or disabled, rules are untouched.
+        self.assertEqual(frules.optimize_rules(rules, 4, 4),
+                         (rules[:-1], []))
+        self.assertEqual(frules.optimize_rules(rules, 4, 0),
+                         (rules[:-1], []))
+
+    def test_optimize_rules_ignores_unsupported_cidrs(self):
+        rules = [{"src_net": "0.0.0.0/0"}, {"src_net": "10.0.0.0/8"},
+                 {"src_net": "dead::/64"}, {"src_net": "11.0.0.0/8"}]
+        self.assertEqual(frules.optimize_rules(rules, 4, 2), (rules, []))
+
     def test_bad_icmp_type(self):
         with self.assertRaises(UnsupportedICMPType):
             _rule_to_iptables_fragment("foo", {"icmp_type": 255}, 4, {})
@@ -19,6 +19,7 @@ felix.test.test_futils
 Test Felix utils.
 """
 import logging
+import gevent
 import mock
 import sys
 
@@ -141,6 +142,76 @@ class TestFutils(unittest.TestCase):
                          (s, expected, result))
 
 
+class TestAdaptiveSemaphore(unittest.TestCase):
+    def setUp(self):
+        self.sem = futils.AdaptiveSemaphore(2, 4)
+
+    def test_queueing(self):
+        self.sem.limit = 2
+        self.sem.acquire()
+        self.sem.acquire()
+        order = []
+
+        def waiter(name):
+            with self.sem:
+                order.append(name)
+
+        greenlets = [gevent.spawn(waiter, n) for n in ("a", "b")]
+        gevent.sleep(0.01)
+        self.assertEqual(self.sem.queue_len, 2)
+        self.assertEqual(order, [])
+        self.sem.release()
+        gevent.joinall(greenlets, timeout=1)
+        self.assertEqual(order, ["a", "b"])
+        self.assertEqual(self.sem.in_flight, 1)
+        self.assertEqual(self.sem.queue_len, 0)
+
+    def test_interrupted_waiter(self):
+        self.sem.limit = 1
+        self.sem.acquire()
+        greenlet = gevent.spawn(self.sem.acquire)
+        gevent.sleep(0.01)
+        greenlet.kill()
+        self.assertEqual(self.sem.queue_len, 0)
+        self.sem.release()
+        self.assertEqual(self.sem.in_flight, 0)
+
+    def test_shrinks_when_slow(self):
+        for _ in xrange(4):
+            self.sem.record_latency("iptables-restore", 0.01)
+        self.assertEqual(self.sem.limit, 4)
+        for _ in xrange(20):
+            self.sem.record_latency("iptables-restore", 0.1)
+        self.assertEqual(self.sem.limit, 2)
+        # Other programs are judged against their own baseline.
+        self.sem.record_latency("ipset", 1)
+        self.assertTrue(self.sem.latency_ratio > 2)
+
+    def test_grows_when_queueing(self):
+        self.sem.limit = 2
+        self.sem.acquire()
+        self.sem.acquire()
+        greenlet = gevent.spawn(self.sem.acquire)
+        gevent.sleep(0.01)
+        for _ in xrange(2):
+            self.sem.record_latency("ip", 0.01)
+        self.assertEqual(self.sem.limit, 3)
+        # The new slot went to the waiter.
+        gevent.sleep(0.01)
+        self.assertTrue(greenlet.ready())
+        self.assertEqual(self.sem.in_flight, 3)
+        # No more growth without a queue.
+        for _ in xrange(10):
+            self.sem.record_latency("ip", 0.01)
+        self.assertEqual(self.sem.limit, 3)
+
+    def test_check_call_records_latency(self):
+        with mock.patch("calico.felix.futils._call_histograms") as m_hists:
+            futils.check_call(["true"])
+        self.assertEqual(sorted(c[1][0] for c in m_hists.mock_calls),
+                         ["Queue wait (ms)", "Run time (ms)"])
+
+
 class TestStats(unittest.TestCase):
     def setUp(self):
         futils._registered_diags = []
@@ -165,6 +236,21 @@ class TestStats(unittest.TestCase):
             mock.call.info("%s: %s", "baz", 3),
         ])
 
+    def test_stat_histogram(self):
+        hist = futils.StatHistogram("hist", buckets=[1, 10])
+        self.assertTrue(("hist", hist._dump) in futils._registered_diags)
+        for value in (0, 1, 5, 10, 20):
+            hist.record("bar", value)
+        self.assertEqual(hist.counts["bar"], [2, 2, 1])
+        self.assertEqual(hist.maxima["bar"], 20)
+        m_log = mock.Mock(spec=logging.Logger)
+        hist._dump(m_log)
+        m_log.assert_has_calls([
+            mock.call.info("%s: count=%s mean=%.2f max=%s", "bar", 5, 7.2,
+                           20),
+            mock.call.info("%s: %s", "bar", "<=1: 2, <=10: 2, >10: 1"),
+        ])
+
     def test_dump_diags(self):
         with mock.patch("calico.felix.futils.stat_log") as m_log:
             self.sc.increment("bar")
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_ipset_netlink
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the ipset netlink client, using golden encodings of the netlink
+messages.
+"""
+import errno
+import logging
+import struct
+
+from mock import patch
+
+from calico.felix import netlink
+from calico.felix.futils import FailedSystemCall
+from calico.felix.ipset_netlink import (IpsetNetlinkClient, encode_create,
+                                        encode_adt, encode_swap,
+                                        encode_list_names, IPSET_CMD_ADD,
+                                        IPSET_ERR_EXIST)
+from calico.felix.netlink import encode_msg, parse_messages
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+def h(hex_str):
+    """Converts a readable hex string to bytes."""
+    return "".join(hex_str.split()).decode("hex")
+
+
+# Netlink attributes that appear in most messages.
+PROTOCOL_ATTR = "05000100 06000000"
+SETNAME_ATTR = "0f000200 " + "felix-v4-a".encode("hex") + "0000"
+
+
+class FakeNetlinkSocket(object):
+    """
+    Fake netlink socket: ACKs every message that asks for one, and fails
+    the messages with a sequence number in self.errors.
+    """
+    def __init__(self):
+        self.sent = []
+        self.errors = {}
+        self.replies = []
+
+    def sendto(self, data, addr):
+        assert addr == (0, 0)
+        self.sent.append(data)
+        reply = ""
+        for _, flags, seq, payload in parse_messages(data):
+            err = self.errors.get(seq, 0)
+            if err or flags & netlink.NLM_F_ACK:
+                hdr = data[:16]
+                reply += encode_msg(netlink.NLMSG_ERROR, 0, seq,
+                                    struct.pack("=i", -err) + hdr)
+        self.replies.append(reply)
+
+    def recv(self, bufsize):
+        return self.replies.pop(0)
+
+
+class TestEncoding(BaseTestCase):
+    def test_create(self):
+        msg_type, flags, payload = encode_create("felix-v4-a", "hash:ip",
+                                                 "inet", exist=True)
+        self.assertEqual(encode_msg(msg_type, flags, 1, payload), h(
+            "48000000 0206 0000 01000000 00000000"  # nlmsghdr
+            "02000000"  # nfgenmsg
+            + PROTOCOL_ATTR + SETNAME_ATTR +
+            "0c000300 " + "hash:ip".encode("hex") + "00"
+            "05000400 00000000"  # Revision 0.
+            "05000500 02000000"  # Family NFPROTO_IPV4.
+        ))
+
+    def test_create_sized(self):
+        msg_type, flags, payload = encode_create("felix-v4-a", "hash:ip",
+                                                 "inet", 2048, 131072)
+        self.assertEqual(encode_msg(msg_type, flags, 1, payload), h(
+            "5c000000 0206 0002 01000000 00000000"  # NLM_F_EXCL
+            "02000000"
+            + PROTOCOL_ATTR + SETNAME_ATTR +
+            "0c000300 " + "hash:ip".encode("hex") + "00"
+            "05000400 00000000"
+            "05000500 02000000"
+            "14000780"  # Nested data.
+            "08001240 00000800"  # Hashsize, network byte order.
+            "08001340 00020000"  # Maxelem.
+        ))
+
+    def test_add_ipv4(self):
+        msg_type, flags, payload = encode_adt(IPSET_CMD_ADD, "felix-v4-a",
+                                              "10.0.0.1")
+        self.assertEqual(encode_msg(msg_type, flags, 2, payload), h(
+            "3c000000 0906 0002 02000000 00000000"
+            "02000000"
+            + PROTOCOL_ATTR + SETNAME_ATTR +
+            "10000780"  # Nested data.
+            "0c000180"  # Nested IP.
+            "08000140 0a000001"
+        ))
+
+    def test_add_ipv6_net(self):
+        msg_type, flags, payload = encode_adt(IPSET_CMD_ADD, "felix-v6n-x",
+                                              "fd00::/64", exist=True)
+        self.assertEqual(encode_msg(msg_type, flags, 3, payload), h(
+            "50000000 0906 0000 03000000 00000000"
+            "02000000"
+            + PROTOCOL_ATTR +
+            "10000200 " + "felix-v6n-x".encode("hex") + "00"
+            "24000780"
+            "18000180"
+            "14000240 fd000000 00000000 00000000 00000000"
+            "05000300 40000000"  # CIDR.
+        ))
+
+    def test_swap(self):
+        msg_type, flags, payload = encode_swap("felix-v4-a",
+                                               "felix-tmp-v4-a")
+        self.assertEqual(encode_msg(msg_type, flags, 4, payload), h(
+            "40000000 0606 0000 04000000 00000000"
+            "02000000"
+            + PROTOCOL_ATTR + SETNAME_ATTR +
+            "13000300 " + "felix-tmp-v4-a".encode("hex") + "0000"
+        ))
+
+    def test_list_names(self):
+        msg_type, payload = encode_list_names()
+        self.assertEqual(msg_type, 0x0607)
+        self.assertEqual(payload, h(
+            "02000000" + PROTOCOL_ATTR +
+            "08000640 00000002"  # IPSET_FLAG_LIST_SETNAME
+        ))
+
+    def test_bad_member(self):
+        self.assertRaises(ValueError, encode_adt, IPSET_CMD_ADD, "foo",
+                          "bad-ip")
+
+    def test_parse_messages(self):
+        data = (encode_msg(16, 0, 1, "abcde") + encode_msg(17, 2, 2, "") +
+                "\x40\x00")
+        self.assertEqual(list(parse_messages(data)),
+                         [(16, 0, 1, "abcde"), (17, 2, 2, "")])
+
+
+class TestIpsetNetlinkClient(BaseTestCase):
+    def setUp(self):
+        super(TestIpsetNetlinkClient, self).setUp()
+        self.sock = FakeNetlinkSocket()
+        self.client = IpsetNetlinkClient(sock=self.sock)
+
+    def test_restore_batches(self):
+        self.client.restore(["create felix-v4-a hash:ip family inet --exist",
+                             "add felix-v4-a 10.0.0.1",
+                             "del felix-v4-a 10.0.0.2",
+                             "COMMIT"])
+        self.assertEqual(len(self.sock.sent), 1)
+        msgs = list(parse_messages(self.sock.sent[0]))
+        self.assertEqual([(t, f) for t, f, _, _ in msgs],
+                         [(0x0602, 0x1), (0x0609, 0x201), (0x060a, 0x205)])
+
+    def test_restore_error(self):
+        self.sock.errors[2] = IPSET_ERR_EXIST
+        with self.assertRaises(FailedSystemCall) as cm:
+            self.client.restore(["create felix-v4-a hash:ip family inet",
+                                 "add felix-v4-a 10.0.0.1",
+                                 "COMMIT"])
+        self.assertEqual(cm.exception.stderr,
+                         "Error in line 2: Element cannot be added to the "
+                         "set: it's already added\n")
+
+    def test_restore_bad_line(self):
+        with self.assertRaises(FailedSystemCall) as cm:
+            self.client.restore(["rename felix-v4-a felix-v4-b"])
+        self.assertTrue("Error in line 1" in cm.exception.stderr)
+        self.assertEqual(self.sock.sent, [])
+
+    @patch("calico.felix.netlink.MAX_BATCH_BYTES", 100)
+    def test_restore_chunks(self):
+        self.sock.errors[2] = errno.ENOENT
+        lines = ["add felix-v4-a 10.0.0.%s" % i for i in xrange(5)]
+        self.assertRaises(FailedSystemCall, self.client.restore, lines)
+        # One message per datagram; we stop after the failure.
+        self.assertEqual(len(self.sock.sent), 2)
+        for data in self.sock.sent:
+            (_, flags, _, _), = parse_messages(data)
+            self.assertTrue(flags & netlink.NLM_F_ACK)
+
+    def test_list_names(self):
+        def reply(name):
+            return encode_msg(0x0607, netlink.NLM_F_MULTI, 1,
+                              h("02000000" + PROTOCOL_ATTR) +
+                              netlink.encode_str_attr(2, name))
+        self.sock.replies = [reply("felix-v4-a") + reply("felix-v4-b"),
+                             encode_msg(netlink.NLMSG_DONE,
+                                        netlink.NLM_F_MULTI, 1, "\0" * 4)]
+        self.sock.sendto = lambda data, addr: self.sock.sent.append(data)
+        self.assertEqual(self.client.list_names(),
+                         ["felix-v4-a", "felix-v4-b"])
+
+    def test_exists(self):
+        self.assertTrue(self.client.exists("felix-v4-a"))
+        self.sock.errors[2] = errno.ENOENT
+        self.assertFalse(self.client.exists("felix-v4-a"))
+
+    def test_restore_no_swap_after_failure(self):
+        lines = ["create felix-tmp-v4-a hash:ip family inet --exist",
+                 "add felix-tmp-v4-a 10.0.0.1",
+                 "add felix-tmp-v4-a 10.0.0.2",
+                 "swap felix-v4-a felix-tmp-v4-a",
+                 "destroy felix-tmp-v4-a",
+                 "COMMIT"]
+        self.sock.errors[2] = errno.ENOENT
+        with self.assertRaises(FailedSystemCall) as cm:
+            self.client.restore(lines)
+        self.assertTrue("Error in line 2" in cm.exception.stderr)
+        # The rest of the first datagram was processed but the swap and
+        # destroy were never sent.
+        self.assertEqual(len(self.sock.sent), 1)
+        self.assertEqual([t & 0xff for t, _, _, _ in
+                          parse_messages(self.sock.sent[0])], [2, 9, 9])
+
+    def test_restore_swap_in_own_datagram(self):
+        self.client.restore(["create felix-tmp-v4-a hash:ip family inet",
+                             "add felix-tmp-v4-a 10.0.0.1",
+                             "swap felix-v4-a felix-tmp-v4-a",
+                             "destroy felix-tmp-v4-a",
+                             "COMMIT"])
+        self.assertEqual(len(self.sock.sent), 2)
+        msgs = [list(parse_messages(d)) for d in self.sock.sent]
+        self.assertEqual([[(t & 0xff, f) for t, f, _, _ in m] for m in msgs],
+                         [[(2, 0x201), (9, 0x205)],
+                          [(6, 0x1), (3, 0x5)]])
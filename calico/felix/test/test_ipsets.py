@@ -24,9 +24,14 @@ import logging
 from pprint import pformat
 from mock import *
 from calico.datamodel_v1 import EndpointId
-from calico.felix.futils import IPV4, FailedSystemCall
+from calico.felix.fnftables import NftSet
+from calico.felix.futils import (IPV4, IPV6, CommandOutput,
+                                 FailedSystemCall)
 from calico.felix.ipsets import (EndpointData,  IpsetManager, IpsetActor,
-                                 TagIpset, EMPTY_ENDPOINT_DATA, Ipset)
+                                 TagIpset, EMPTY_ENDPOINT_DATA, Ipset,
+                                 NetIpset, NetSetId, IpsetWriter, IdInterner,
+                                 ip_to_int, int_to_ip, ipset_sizing,
+                                 list_ipset_names)
 from calico.felix.refcount import CREATED
 from calico.felix.test.base import BaseTestCase
 
@@ -93,7 +98,50 @@ class TestIpsetManager(BaseTestCase):
         self.created_refs[tag_id].append(ipset)
         return ipset
 
+    def ip_owners_by_tag(self):
+        """
+        :returns: the manager's ip_owners_by_tag index with the interned
+            IDs and packed IPs expanded.
+        """
+        def owner(packed):
+            return (self.mgr.profile_interner.value(packed & 0xffffffff),
+                    self.mgr.endpoint_interner.value(packed >> 32))
+        decoded = {}
+        for tag, owners_by_ip in self.mgr.ip_owners_by_tag.iteritems():
+            decoded[tag] = {}
+            for ip, owners in owners_by_ip.iteritems():
+                if isinstance(owners, set):
+                    owners = set(owner(o) for o in owners)
+                else:
+                    owners = owner(owners)
+                decoded[tag][int_to_ip(IPV4, ip)] = owners
+        return decoded
+
+    def endpoint_data_by_ep_id(self):
+        decoded = {}
+        for ep_id, data in self.mgr.endpoint_data_by_ep_id.iteritems():
+            decoded[ep_id] = EndpointData(
+                [self.mgr.profile_interner.value(p)
+                 for p in data.profile_ids],
+                [int_to_ip(IPV4, ip) for ip in data.ip_addresses]
+            )
+        return decoded
+
+    def endpoint_ids_by_profile_id(self):
+        return dict((self.mgr.profile_interner.value(p),
+                     set(self.mgr.endpoint_interner.value(e) for e in eps))
+                    for p, eps in
+                    self.mgr.endpoint_ids_by_profile_id.iteritems())
+
+    def incref(self, *tag_ids):
+        # Only tags that are in use are indexed.
+        for tag_id in tag_ids:
+            self.mgr.get_and_incref(tag_id, callback=self.on_ref_acquired,
+                                    async=True)
+        self.step_mgr()
+
     def test_tag_then_endpoint(self):
+        self.incref("tag1")
         # Send in the messages.
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
@@ -102,6 +150,7 @@ class TestIpsetManager(BaseTestCase):
         self.assert_one_ep_one_tag()
 
     def test_endpoint_then_tag(self):
+        self.incref("tag1")
         # Send in the messages.
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
@@ -110,6 +159,7 @@ class TestIpsetManager(BaseTestCase):
         self.assert_one_ep_one_tag()
 
     def test_endpoint_then_tag_idempotent(self):
+        self.incref("tag1")
         for _ in xrange(3):
             # Send in the messages.
             self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
@@ -119,10 +169,10 @@ class TestIpsetManager(BaseTestCase):
             self.assert_one_ep_one_tag()
 
     def assert_one_ep_one_tag(self):
-        self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
+        self.assertEqual(self.endpoint_data_by_ep_id(), {
             EP_ID_1_1: EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.ip_owners_by_tag(), {
             "tag1": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             }
@@ -130,6 +180,7 @@ class TestIpsetManager(BaseTestCase):
 
     def test_change_ip(self):
         # Initial set-up.
+        self.incref("tag1")
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.step_mgr()
@@ -137,7 +188,7 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_IP, async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.ip_owners_by_tag(), {
             "tag1": {
                 "10.0.0.2": ("prof1", EP_ID_1_1),
                 "10.0.0.3": ("prof1", EP_ID_1_1),
@@ -146,6 +197,7 @@ class TestIpsetManager(BaseTestCase):
 
     def test_tag_updates(self):
         # Initial set-up.
+        self.incref("tag1", "tag2")
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.step_mgr()
@@ -153,7 +205,7 @@ class TestIpsetManager(BaseTestCase):
         # Add a tag, keep a tag.
         self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.ip_owners_by_tag(), {
             "tag1": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             },
@@ -166,7 +218,7 @@ class TestIpsetManager(BaseTestCase):
         # Remove a tag.
         self.mgr.on_tags_update("prof1", ["tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.ip_owners_by_tag(), {
             "tag2": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             }
@@ -175,7 +227,7 @@ class TestIpsetManager(BaseTestCase):
         # Delete the tags:
         self.mgr.on_tags_update("prof1", None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.ip_owners_by_tag, {})
+        self.assertEqual(self.ip_owners_by_tag(), {})
         self.assertEqual(self.mgr.tags_by_prof_id, {})
 
     def step_mgr(self):
@@ -184,6 +236,7 @@ class TestIpsetManager(BaseTestCase):
 
     def test_update_profile_and_ips(self):
         # Initial set-up.
+        self.incref("tag1", "tag3")
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_tags_update("prof3", ["tag3"], async=True)
@@ -192,12 +245,12 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_PROF_IP, async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.ip_owners_by_tag(), {
             "tag3": {
                 "10.0.0.3": ("prof3", EP_ID_1_1)
             }
         })
-        self.assertEqual(self.mgr.endpoint_ids_by_profile_id, {
+        self.assertEqual(self.endpoint_ids_by_profile_id(), {
             "prof3": set([EP_ID_1_1])
         })
 
@@ -207,7 +260,7 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1_IPV6, async=True)
         self.step_mgr()
         # Index should contain only 1_1:
-        self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
+        self.assertEqual(self.endpoint_data_by_ep_id(), {
             EP_ID_1_1: EP_DATA_1_1,
         })
 
@@ -217,30 +270,31 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1_NO_NETS, async=True)
         self.step_mgr()
         # Index should contain only 1_1:
-        self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
+        self.assertEqual(self.endpoint_data_by_ep_id(), {
             EP_ID_1_1: EP_DATA_1_1,
         })
         # Should be happy to then add it in.
         self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1, async=True)
         self.step_mgr()
         # Index should contain both:
-        self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
+        self.assertEqual(self.endpoint_data_by_ep_id(), {
             EP_ID_1_1: EP_DATA_1_1,
             EP_ID_2_1: EP_DATA_2_1,
         })
 
     def test_duplicate_ips(self):
+        self.incref("tag1", "tag2")
         # Add in two endpoints with the same IP.
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1, async=True)
         self.step_mgr()
         # Index should contain both:
-        self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
+        self.assertEqual(self.endpoint_data_by_ep_id(), {
             EP_ID_1_1: EP_DATA_1_1,
             EP_ID_2_1: EP_DATA_2_1,
         })
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.ip_owners_by_tag(), {
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -252,7 +306,7 @@ class TestIpsetManager(BaseTestCase):
         # Second profile tags arrive:
         self.mgr.on_tags_update("prof2", ["tag1", "tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.ip_owners_by_tag(), {
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -268,10 +322,10 @@ class TestIpsetManager(BaseTestCase):
         # Remove one, check the index gets updated.
         self.mgr.on_endpoint_update(EP_ID_2_1, None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
+        self.assertEqual(self.endpoint_data_by_ep_id(), {
             EP_ID_1_1: EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.ip_owners_by_tag, {
+        self.assertEqual(self.ip_owners_by_tag(), {
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -286,10 +340,13 @@ class TestIpsetManager(BaseTestCase):
         # Remove the other, index should get completely cleaned up.
         self.mgr.on_endpoint_update(EP_ID_1_1, None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.endpoint_data_by_ep_id, {})
-        self.assertEqual(self.mgr.ip_owners_by_tag, {},
+        self.assertEqual(self.endpoint_data_by_ep_id(), {})
+        self.assertEqual(self.ip_owners_by_tag(), {},
                          "ip_owners_by_tag should be empty, not %s" %
-                         pformat(self.mgr.ip_owners_by_tag))
+                         pformat(self.ip_owners_by_tag()))
+        # And the interned IDs should have been released.
+        self.assertEqual(len(self.mgr.endpoint_interner), 0)
+        self.assertEqual(len(self.mgr.profile_interner), 0)
 
     def on_ref_acquired(self, tag_id, ipset):
         self.acquired_refs[tag_id] = ipset
@@ -327,11 +384,13 @@ class TestIpsetManager(BaseTestCase):
             "felix-v4-bar",
             "felix-v4-baz",
             "felix-v4-biff",
+            "felix-v4n-0123456789abcdef",
         ]
         m_check_call.side_effect = iter([
             # Exception on any individual call should be ignored.
             FailedSystemCall("Dummy", [], None, None, None),
             None,
+            None,
         ])
         self.mgr.cleanup(async=True)
         self.step_mgr()
@@ -342,8 +401,94 @@ class TestIpsetManager(BaseTestCase):
                          sorted([
                              call(["ipset", "destroy", "felix-v4-biff"]),
                              call(["ipset", "destroy", "felix-v4-baz"]),
+                             call(["ipset", "destroy",
+                                   "felix-v4n-0123456789abcdef"]),
                          ]))
 
+    @patch("calico.felix.ipsets._ipset_class", NftSet)
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_cleanup_nftables(self, m_check_call):
+        # Under nftables, the sets should be listed and deleted with nft,
+        # never with the ipset command.
+        self.mgr.get_and_incref("foo", callback=self.on_ref_acquired,
+                                async=True)
+        self.step_mgr()
+        self._notify_ready(["foo"])
+        self.step_mgr()
+
+        def check_call(args, input_str=None):
+            if args[:3] == ["nft", "list", "table"]:
+                if args[3:] == ["ip6", "felix-raw"]:
+                    raise FailedSystemCall("Dummy", args, 1, "",
+                                           "No such file or directory")
+                return CommandOutput(
+                    "table %s %s {\n"
+                    "\tset felix-v4-foo {\n\t}\n"
+                    "\tset felix-v4-bar {\n\t}\n"
+                    "\tset felix-v6-bar {\n\t}\n"
+                    "\tchain felix-FORWARD {\n\t}\n"
+                    "}\n" % tuple(args[3:]), "")
+            if args[-1] == "felix-v4-bar" and args[4] == "felix-nat":
+                raise FailedSystemCall("Dummy", args, 1, "",
+                                       "No such file or directory")
+            return CommandOutput("", "")
+        m_check_call.side_effect = check_call
+
+        self.mgr.cleanup(async=True)
+        self.step_mgr()
+
+        deletes = [c for c in m_check_call.mock_calls
+                   if c[1][0][:3] == ["nft", "delete", "set"]]
+        self.assertEqual(sorted(deletes), sorted([
+            call(["nft", "delete", "set", "ip", "felix-filter",
+                  "felix-v4-bar"]),
+            call(["nft", "delete", "set", "ip", "felix-nat",
+                  "felix-v4-bar"]),
+            call(["nft", "delete", "set", "ip6", "felix-filter",
+                  "felix-v4-bar"]),
+            call(["nft", "delete", "set", "ip6", "felix-raw",
+                  "felix-v4-bar"]),
+        ]))
+        self.assertFalse([c for c in m_check_call.mock_calls
+                          if c[1][0][0] == "ipset"])
+
+    @patch("calico.felix.ipsets._audit_read", None)
+    @patch("calico.felix.ipsets.monotonic_time", autospec=True)
+    @patch("calico.felix.ipsets.read_ipset_members", autospec=True)
+    def test_audit_shares_read(self, m_read, m_time):
+        # The v4 and v6 managers should share one read per interval.
+        m_read.return_value = {}
+        m_time.return_value = 1000
+        v4_mgr = IpsetManager(IPV4, audit_interval=60)
+        v6_mgr = IpsetManager(IPV6, audit_interval=60)
+        v4_mgr.audit_ipsets(async=True)
+        self.step_actor(v4_mgr)
+        m_time.return_value = 1010
+        v6_mgr.audit_ipsets(async=True)
+        self.step_actor(v6_mgr)
+        self.assertEqual(m_read.call_count, 1)
+        # Next interval, the first manager to audit reads again.
+        m_time.return_value = 1065
+        v6_mgr.audit_ipsets(async=True)
+        self.step_actor(v6_mgr)
+        self.assertEqual(m_read.call_count, 2)
+
+    def test_net_ipset(self):
+        net_set_id = NetSetId(IPV4, ["10.0.0.0/8", "11.0.0.0/8"])
+        self.assertEqual(net_set_id,
+                         NetSetId(IPV4, ["11.0.0.0/8", "10.0.0.0/8"]))
+        self.assertTrue(net_set_id.name.startswith("felix-v4n-"))
+        self.mgr._create = IpsetManager._create.__get__(self.mgr)
+        ipset = self.mgr._create(net_set_id)
+        self.assertTrue(isinstance(ipset, NetIpset))
+        self.assertEqual(ipset.owned_ipset_names(),
+                         set([net_set_id.name, net_set_id.temp_name]))
+        self.assertEqual(ipset._ipset.type, "hash:net")
+        m_ipset = Mock(spec=NetIpset)
+        self.mgr._on_object_started(net_set_id, m_ipset)
+        m_ipset.replace_members.assert_called_once_with(net_set_id.cidrs,
+                                                        async=True)
+
     def test_apply_snapshot_mainline(self):
         self.mgr.apply_snapshot(
             {"prof1": ["tag1"], "prof2": ["B"], "prof3": ["B"]},
@@ -367,17 +512,46 @@ class TestIpsetManager(BaseTestCase):
         self.step_mgr()
         self.assertEqual(self.mgr.tags_by_prof_id,
                          {"prof1": ["tag1", "tag2"]})
-        self.assertEqual(self.mgr.endpoint_data_by_ep_id,
+        self.assertEqual(self.endpoint_data_by_ep_id(),
                          {EP_ID_1_1: EP_DATA_1_1})
         ipset = self.acquired_refs["tag1"]
         self.assertEqual(
             ipset.replace_members.mock_calls,
             [
-                call(set(['10.0.0.1']), force_reprogram=True, async=True),
-                call(set(['10.0.0.1']), force_reprogram=True, async=True),
+                call(set([ip_to_int('10.0.0.1')]), force_reprogram=True,
+                     async=True),
             ]
         )
 
+    def test_only_referenced_tags_indexed(self):
+        self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1, async=True)
+        self.step_mgr()
+        self.assertEqual(self.ip_owners_by_tag(), {})
+        self.assertEqual(self.mgr.prof_ids_by_tag,
+                         {"tag1": set(["prof1"]), "tag2": set(["prof1"])})
+
+        # Referencing the tag builds its index from the endpoints.
+        self.incref("tag1")
+        self.assertEqual(self.ip_owners_by_tag(), {
+            "tag1": {
+                "10.0.0.1": set([
+                    ("prof1", EP_ID_1_1),
+                    ("prof1", EP_ID_2_1),
+                ])
+            }
+        })
+        self.created_refs["tag1"][0].replace_members.assert_called_once_with(
+            frozenset([ip_to_int("10.0.0.1")]), force_reprogram=False,
+            async=True
+        )
+
+        # Dropping the last reference discards it.
+        self.mgr.decref("tag1", async=True)
+        self.step_mgr()
+        self.assertEqual(self.ip_owners_by_tag(), {})
+
     def test_apply_snapshot_forces_reprogram(self):
         # Apply a snapshot but mock the finish call so that we can check that
         # apply_snapshot set the flag...
@@ -409,6 +583,33 @@ class TestIpsetManager(BaseTestCase):
         self.step_mgr()
 
 
+class TestIdInterner(BaseTestCase):
+    def test_incref_decref(self):
+        interner = IdInterner()
+        idx = interner.incref("a")
+        self.assertEqual(interner.incref("a"), idx)
+        idx_b = interner.incref("b")
+        self.assertNotEqual(idx, idx_b)
+        self.assertEqual(interner.value(idx_b), "b")
+        self.assertEqual(interner.get_id("a"), idx)
+        interner.decref_id(idx)
+        self.assertEqual(interner.get_id("a"), idx)
+        interner.decref_id(idx)
+        self.assertEqual(interner.get_id("a"), None)
+        self.assertEqual(len(interner), 1)
+        # Freed IDs get reused.
+        self.assertEqual(interner.incref("c"), idx)
+        interner.decref_id(idx_b)
+        self.assertRaises(AssertionError, interner.decref_id, idx_b)
+
+    def test_ip_packing(self):
+        self.assertEqual(ip_to_int("10.0.0.1"), 0x0a000001)
+        self.assertEqual(int_to_ip(IPV4, 0x0a000001), "10.0.0.1")
+        packed = ip_to_int("dead:beef::1")
+        self.assertEqual(packed, (0xdeadbeef << 96) | 1)
+        self.assertEqual(int_to_ip(IPV6, packed), "dead:beef::1")
+
+
 class TestEndpointData(BaseTestCase):
     def test_repr(self):
         self.assertEqual(repr(EP_DATA_1_1),
@@ -509,6 +710,115 @@ class TestIpsetActor(BaseTestCase):
             self.actor._sync_to_ipset()
         self.ipset.reset_mock()
 
+    def test_audit_members(self):
+        self.actor.members = set(["10.0.0.1", "10.0.0.2"])
+        self.actor._sync_to_ipset()
+        self.ipset.diff_members.return_value = ([], [])
+        self.actor.audit_members(set(["10.0.0.1", "10.0.0.2"]), 10 ** 9,
+                                 async=True)
+        self.step_actor(self.actor)
+        self.ipset.diff_members.assert_called_once_with(
+            set(["10.0.0.1", "10.0.0.2"]), set(["10.0.0.1", "10.0.0.2"]))
+        self.assertFalse(self.ipset.repair_members.called)
+
+        # Drift is repaired in place.
+        self.ipset.diff_members.return_value = (["10.0.0.2"], ["10.0.0.9"])
+        self.actor.audit_members(set(["10.0.0.1", "10.0.0.9"]), 10 ** 9,
+                                 async=True)
+        self.step_actor(self.actor)
+        self.ipset.repair_members.assert_called_once_with(["10.0.0.2"],
+                                                          ["10.0.0.9"])
+        self.assertEqual(self.ipset.replace_members.call_count, 1)
+
+        # If the repair fails, we rewrite the set.
+        self.ipset.repair_members.side_effect = FailedSystemCall(
+            "Blah", [], 1, "", "err")
+        self.actor.audit_members(set(["10.0.0.1", "10.0.0.9"]), 10 ** 9,
+                                 async=True)
+        self.step_actor(self.actor)
+        self.assertEqual(self.ipset.replace_members.call_count, 2)
+
+        # As we do if the set is missing.
+        self.actor.audit_members(None, 10 ** 9, async=True)
+        self.step_actor(self.actor)
+        self.assertEqual(self.ipset.replace_members.call_count, 3)
+
+    def test_audit_members_stale(self):
+        self.actor.members = set(["10.0.0.1"])
+        self.actor._sync_to_ipset()
+        # Kernel members were read before our last write so they can't be
+        # trusted.
+        self.actor.audit_members(set(), self.actor._last_write_seq - 1,
+                                 async=True)
+        self.step_actor(self.actor)
+        self.assertFalse(self.ipset.diff_members.called)
+        self.assertEqual(self.ipset.replace_members.call_count, 1)
+
+
+class TestIpsetWriter(BaseTestCase):
+    def setUp(self):
+        super(TestIpsetWriter, self).setUp()
+        self.writer = IpsetWriter(IPV4)
+        self.foo = Ipset("foo", "foo-tmp", "inet")
+        self.bar = Ipset("bar", "bar-tmp", "inet")
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_combined_restore(self, m_check_call):
+        f1 = self.writer.write_members(self.foo, set(["10.0.0.1"]),
+                                       set(["10.0.0.2"]), async=True)
+        f2 = self.writer.write_members(self.bar, None, set(["10.0.0.3"]),
+                                       async=True)
+        # Coalesces with the first update.
+        f3 = self.writer.write_members(self.foo, set(["10.0.0.2"]),
+                                       set(["10.0.0.4"]), async=True)
+        self.step_actor(self.writer)
+        for f in (f1, f2, f3):
+            f.get()
+        self.assertEqual(m_check_call.call_count, 1)
+        input_str = m_check_call.call_args[1]["input_str"]
+        self.assertEqual(
+            sorted(input_str.splitlines()),
+            sorted([
+                'del foo 10.0.0.1',
+                'add foo 10.0.0.4',
+                'create bar hash:ip family inet --exist',
+                'create bar-tmp hash:ip family inet --exist',
+                'flush bar-tmp',
+                'add bar-tmp 10.0.0.3',
+                'swap bar bar-tmp',
+                'destroy bar-tmp',
+                'COMMIT',
+            ])
+        )
+        self.assertEqual(self.writer._histograms.maxima["Sets per restore"],
+                         2)
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_fallback_on_error(self, m_check_call):
+        def check_call(cmd, input_str=None):
+            if input_str and "add foo-tmp 10.0.0.2" in input_str:
+                raise FailedSystemCall("Blah", [], 1, "", "err")
+        m_check_call.side_effect = check_call
+        f_foo = self.writer.write_members(self.foo, None, set(["10.0.0.2"]),
+                                          async=True)
+        f_bar = self.writer.write_members(self.bar, set(),
+                                          set(["10.0.0.3"]), async=True)
+        self.step_actor(self.writer)
+        # Only the set that really failed reports the failure.
+        self.assertRaises(FailedSystemCall, f_foo.get)
+        f_bar.get()
+        # One combined attempt, then one attempt per set; the rewrite of
+        # foo is retried with a fresh temporary set.
+        self.assertEqual(m_check_call.call_args_list[1:], [
+            call(["ipset", "restore"], input_str=ANY),
+            call(["ipset", "destroy", "foo-tmp"]),
+            call(["ipset", "list", "foo"]),
+            call(["ipset", "restore"], input_str=ANY),
+            call(["ipset", "restore"], input_str=ANY),
+        ])
+        self.assertEqual(
+            self.writer._stats.stats["Combined restore failures"], 1)
+
 
 class TestIpset(BaseTestCase):
     def setUp(self):
@@ -576,6 +886,98 @@ class TestIpset(BaseTestCase):
         self.assertEqual(m_check_call.call_count, 2)
         m_check_call.assert_has_calls(calls)
 
+    def test_ipset_sizing(self):
+        self.assertEqual(ipset_sizing(0), (1024, 65536))
+        self.assertEqual(ipset_sizing(1025), (2048, 65536))
+        self.assertEqual(ipset_sizing(40000), (65536, 131072))
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_format_member(self, m_check_call):
+        ipset = Ipset("foo", "foo-tmp", "inet",
+                      format_member=lambda m: int_to_ip(IPV4, m))
+        ipset.update_members(set([ip_to_int("10.0.0.1")]),
+                             set([ip_to_int("10.0.0.2")]))
+        m_check_call.assert_called_once_with(
+            ["ipset", "restore"],
+            input_str='del foo 10.0.0.1\n'
+                      'add foo 10.0.0.2\n'
+                      'COMMIT\n'
+        )
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    @patch("calico.felix.ipsets._netlink_client")
+    def test_netlink(self, m_client, m_check_call):
+        self.ipset.update_members(set(["10.0.0.1"]), set(["10.0.0.2"]))
+        m_client.restore.assert_called_once_with(["del foo 10.0.0.1",
+                                                  "add foo 10.0.0.2",
+                                                  "COMMIT"])
+        m_client.exists.return_value = False
+        self.assertFalse(self.ipset.exists())
+        self.ipset.delete()
+        self.assertEqual(m_client.destroy_silent.mock_calls,
+                         [call("foo"), call("foo-tmp")])
+        self.assertFalse(m_check_call.called)
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_list_ipset_names(self, m_check_call):
+        m_check_call.return_value.stdout = "felix-v4-a\nfelix-v4-b\n"
+        self.assertEqual(list_ipset_names(), ["felix-v4-a", "felix-v4-b"])
+        m_check_call.assert_called_once_with(["ipset", "list", "-n"])
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_list_ipset_names_fallback(self, m_check_call):
+        def check_call(cmd, input_str=None):
+            if "-n" in cmd:
+                raise FailedSystemCall("Blah", cmd, 1, "", "Unknown argument")
+            return Mock(stdout="Name: felix-v4-a\nType: hash:ip\n"
+                               "Members:\n10.0.0.1\n\n"
+                               "Name: felix-v4-b\nType: hash:ip\n"
+                               "Members:\n")
+        m_check_call.side_effect = check_call
+        self.assertEqual(list_ipset_names(), ["felix-v4-a", "felix-v4-b"])
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_read_all_members(self, m_check_call):
+        m_check_call.return_value.stdout = (
+            "create felix-v4-a hash:ip family inet hashsize 1024 maxelem "
+            "65536\n"
+            "add felix-v4-a 10.0.0.1\n"
+            "add felix-v4-a 10.0.0.2\n"
+            "create felix-v4-b hash:ip family inet hashsize 1024 maxelem "
+            "65536\n"
+            "create other hash:ip family inet hashsize 1024 maxelem 65536\n"
+            "add other 10.0.0.3\n"
+        )
+        self.assertEqual(Ipset.read_all_members(), {
+            "felix-v4-a": set(["10.0.0.1", "10.0.0.2"]),
+            "felix-v4-b": set(),
+        })
+        m_check_call.assert_called_once_with(["ipset", "save"])
+
+    def test_diff_members(self):
+        self.assertEqual(
+            self.ipset.diff_members(set(["10.0.0.1", "10.0.0.2"]),
+                                    set(["10.0.0.2", "10.0.0.3"])),
+            (["10.0.0.1"], ["10.0.0.3"])
+        )
+        # Members of hash:net sets are compared in the kernel's form.
+        ipset = Ipset("foo", "foo-tmp", "inet", "hash:net")
+        self.assertEqual(
+            ipset.diff_members(set(["10.0.0.1/32", "10.1.2.3/16"]),
+                               set(["10.0.0.1", "10.1.0.0/16"])),
+            ([], [])
+        )
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_repair_members(self, m_check_call):
+        self.ipset.repair_members(["10.0.0.1"], ["10.0.0.2"])
+        m_check_call.assert_called_once_with(
+            ["ipset", "restore"],
+            input_str='del foo 10.0.0.2\n'
+                      'add foo 10.0.0.1\n'
+                      'COMMIT\n'
+        )
+
     @patch("calico.felix.futils.check_call", autospec=True)
     def test_ensure_exists(self, m_check_call):
         self.ipset.ensure_exists()
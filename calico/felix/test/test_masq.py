@@ -21,6 +21,7 @@ Unit tests for the MasqueradeManager.
 import logging
 from mock import *
 from calico.felix.fiptables import IptablesUpdater
+from calico.felix.ipsets import Ipset
 from calico.felix.masq import *
 
 # Logger
@@ -34,7 +35,7 @@ class TestMasqueradeManager(BaseTestCase):
         super(TestMasqueradeManager, self).setUp()
         self.m_iptables_mgr = Mock(spec=IptablesUpdater)
         self.m_iptables_mgr.table = "nat"
-        with patch("calico.felix.masq.Ipset", autospec=True) as m_Ipset:
+        with patch("calico.felix.masq.new_ipset", autospec=True) as m_Ipset:
             self.masq_mgr = MasqueradeManager(IPV4, self.m_iptables_mgr)
             _log.info("Ipset calls: %s", m_Ipset.mock_calls)
             m_Ipset.assert_has_calls([
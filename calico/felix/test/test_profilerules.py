@@ -23,7 +23,7 @@ import logging
 from mock import Mock, call
 from calico.felix.fiptables import IptablesUpdater
 from calico.felix.futils import FailedSystemCall
-from calico.felix.ipsets import IpsetManager, TagIpset
+from calico.felix.ipsets import IpsetManager, TagIpset, NetSetId
 from calico.felix.profilerules import ProfileRules, RulesManager
 
 from calico.felix.test.base import BaseTestCase
@@ -102,8 +102,11 @@ class TestProfileRules(BaseTestCase):
         self.m_mgr = Mock(spec=RulesManager)
         self.m_ipt_updater = Mock(spec=IptablesUpdater)
         self.m_ips_mgr = Mock(spec=IpsetManager)
-        self.rules = ProfileRules("prof1", 4, self.m_ipt_updater,
-                                  self.m_ips_mgr)
+        self.m_config = Mock()
+        self.m_config.SHARE_PROFILE_CHAINS = False
+        self.m_config.CIDR_IPSET_MIN_RULES = 0
+        self.rules = ProfileRules(self.m_config, "prof1", 4,
+                                  self.m_ipt_updater, self.m_ips_mgr)
         self.rules._manager = self.m_mgr
         self.rules._id = "prof1"
 
@@ -131,6 +134,58 @@ class TestProfileRules(BaseTestCase):
                                               self.rules,
                                               async=True)
 
+    def test_shared_chains(self):
+        """
+        Test that, in shared chain mode, the rules get programmed into
+        content-addressed chains.
+        """
+        self.m_config.SHARE_PROFILE_CHAINS = True
+        self.rules.on_profile_update(RULES_1, async=True)
+        self.step_actor(self.rules)
+        self._process_ipset_refs(set(["src-tag", "dst-tag"]))
+        self.assertEqual(len(self.m_ipt_updater.rewrite_chains.mock_calls), 1)
+        _, args, kwargs = self.m_ipt_updater.rewrite_chains.mock_calls[0]
+        updates, deps = args
+        shared_chains = kwargs["shared_chains"]
+        self.assertEqual(len(shared_chains), 2)
+        for chain_name, expected_lines in RULES_1_CHAINS.iteritems():
+            shared_name, = deps[chain_name]
+            self.assertTrue(shared_name.startswith("felix-s-"))
+            self.assertEqual(updates[chain_name], [
+                "--append %s --goto %s" % (chain_name, shared_name)
+            ])
+            self.assertEqual(
+                shared_chains[shared_name],
+                [l.replace(chain_name, shared_name) for l in expected_lines]
+            )
+
+    def test_cidr_rules_optimized(self):
+        """
+        Test that runs of CIDR rules get compiled into an ipset, which we
+        acquire before programming the chain.
+        """
+        self.m_config.CIDR_IPSET_MIN_RULES = 2
+        self.rules.on_profile_update({
+            "inbound_rules": [{"src_net": "10.0.0.0/8"},
+                              {"src_net": "11.0.0.0/8"}],
+            "outbound_rules": [],
+        }, async=True)
+        self.step_actor(self.rules)
+        net_set_id = NetSetId("IPv4", ["10.0.0.0/8", "11.0.0.0/8"])
+        self.assertTrue(self.rules._dirty)
+        self._process_ipset_refs(set([net_set_id]))
+        self.assertFalse(self.rules._dirty)
+        _, args, _ = self.m_ipt_updater.rewrite_chains.mock_calls[0]
+        self.assertEqual(args[0]["felix-p-prof1-i"][1],
+                         "--append felix-p-prof1-i --match set "
+                         "--match-set %s src --jump RETURN" % net_set_id.name)
+
+        # Removing the rules should release the ipset.
+        self.rules.on_profile_update({"inbound_rules": [],
+                                      "outbound_rules": []}, async=True)
+        self.step_actor(self.rules)
+        self.m_ips_mgr.decref.assert_called_once_with(net_set_id, async=True)
+
     def test_coalesce_updates(self):
         """
         Test multiple updates in the same batch are squashed and only the
@@ -320,7 +375,10 @@ class TestProfileRules(BaseTestCase):
             callback = kwargs["callback"]
             seen_tags.add(obj_id)
             m_ipset = Mock(spec=TagIpset)
-            m_ipset.ipset_name = obj_id + "-name"
+            if isinstance(obj_id, NetSetId):
+                m_ipset.ipset_name = obj_id.name
+            else:
+                m_ipset.ipset_name = obj_id + "-name"
             callback(obj_id, m_ipset)
             self.step_actor(self.rules)
         self.m_ips_mgr.get_and_incref.reset_mock()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_rtnetlink
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the RTNETLINK route client, using golden encodings of the netlink
+messages.
+"""
+import errno
+import logging
+import socket
+
+from calico.felix import netlink
+from calico.felix.futils import FailedSystemCall
+from calico.felix.netlink import encode_msg, parse_messages
+from calico.felix.rtnetlink import (RtnetlinkClient, RouteTable,
+                                    encode_ip_line, IFINFOMSG, RTMSG,
+                                    RTM_NEWLINK, RTM_DELLINK, RTM_NEWROUTE,
+                                    RTM_DELROUTE, RTM_GETLINK, RTM_GETROUTE,
+                                    RTA_DST, RTA_OIF, RT_TABLE_MAIN)
+from calico.felix.test.base import BaseTestCase
+from calico.felix.test.test_ipset_netlink import FakeNetlinkSocket, h
+
+_log = logging.getLogger(__name__)
+
+
+class TestEncoding(BaseTestCase):
+    def test_route_replace(self):
+        msg_type, flags, payload = encode_ip_line(
+            "route replace 10.0.0.1 dev tap1".split(), 5)
+        self.assertEqual(encode_msg(msg_type, flags, 1, payload), h(
+            "2c000000 1800 0005 01000000 00000000"  # CREATE|REPLACE
+            "02200000 fe03fd01 00000000"  # rtmsg: main table, scope link.
+            "08000100 0a000001"  # RTA_DST
+            "08000400 05000000"  # RTA_OIF
+        ))
+
+    def test_route_del_ipv6(self):
+        msg_type, flags, payload = encode_ip_line(
+            "route del fd00::1 dev tap1".split(), 5)
+        self.assertEqual(encode_msg(msg_type, flags, 1, payload), h(
+            "38000000 1900 0000 01000000 00000000"
+            "0a800000 fe00ff00 00000000"  # Scope nowhere.
+            "14000100 fd000000 00000000 00000000 00000001"
+            "08000400 05000000"
+        ))
+
+    def test_neigh_replace(self):
+        msg_type, flags, payload = encode_ip_line(
+            "neigh replace 10.0.0.1 lladdr aa:bb:cc:dd:ee:ff dev tap1 "
+            "nud permanent".split(), 5)
+        self.assertEqual(encode_msg(msg_type, flags, 1, payload), h(
+            "30000000 1c00 0005 01000000 00000000"
+            "02000000 05000000 8000 0000"  # ndmsg: NUD_PERMANENT.
+            "08000100 0a000001"  # NDA_DST
+            "0a000200 aabbccddeeff 0000"  # NDA_LLADDR
+        ))
+
+    def test_neigh_del(self):
+        msg_type, flags, payload = encode_ip_line(
+            "neigh del 10.0.0.1 dev tap1".split(), 5)
+        self.assertEqual(encode_msg(msg_type, flags, 1, payload), h(
+            "24000000 1d00 0000 01000000 00000000"
+            "02000000 05000000 8000 0000"
+            "08000100 0a000001"
+        ))
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, encode_ip_line,
+                          "route add 10.0.0.1 via 10.0.0.2".split(), 5)
+        self.assertRaises(ValueError, encode_ip_line,
+                          "route replace 10.0.0.300 dev tap1".split(), 5)
+
+
+class FakeRouteSocket(FakeNetlinkSocket):
+    """
+    Fake RTNETLINK socket that answers RTM_GETLINK for the interfaces in
+    self.ifindexes.
+    """
+    def __init__(self):
+        super(FakeRouteSocket, self).__init__()
+        self.ifindexes = {"tap1": 5, "tap2": 6}
+        self.getlinks = []
+
+    def sendto(self, data, addr):
+        (msg_type, _, seq, payload), = list(parse_messages(data))[:1]
+        if msg_type != 18:
+            return super(FakeRouteSocket, self).sendto(data, addr)
+        name = payload[IFINFOMSG.size + 4:].rstrip("\0")
+        self.getlinks.append(name)
+        if name in self.ifindexes:
+            reply = encode_msg(RTM_NEWLINK, 0, seq, IFINFOMSG.pack(
+                0, 0, 0, self.ifindexes[name], 0, 0))
+            reply += encode_msg(netlink.NLMSG_ERROR, 0, seq, "\0" * 20)
+        else:
+            reply = encode_msg(netlink.NLMSG_ERROR, 0, seq,
+                               "\xed\xff\xff\xff" + data[:16])  # -ENODEV
+        self.replies.append(reply)
+
+
+class TestRtnetlinkClient(BaseTestCase):
+    def setUp(self):
+        super(TestRtnetlinkClient, self).setUp()
+        self.sock = FakeRouteSocket()
+        self.client = RtnetlinkClient(sock=self.sock)
+
+    def test_run_batch(self):
+        self.client.run_batch([
+            "neigh replace 10.0.0.1 lladdr aa:bb:cc:dd:ee:ff dev tap1 "
+            "nud permanent",
+            "route replace 10.0.0.1 dev tap1",
+            "route del 10.0.0.2 dev tap2",
+            "route replace 10.0.0.3 dev tap1",
+        ])
+        # One lookup per interface, then one datagram for the batch.
+        self.assertEqual(self.sock.getlinks, ["tap1", "tap2"])
+        msgs = list(parse_messages(self.sock.sent[-1]))
+        self.assertEqual([(t, f) for t, f, _, _ in msgs],
+                         [(28, 0x501), (24, 0x501), (25, 0x1), (24, 0x505)])
+
+    def test_run_batch_error(self):
+        self.sock.errors[3] = errno.ESRCH
+        with self.assertRaises(FailedSystemCall) as cm:
+            self.client.run_batch(["route replace 10.0.0.1 dev tap1",
+                                   "route del 10.0.0.2 dev tap1"])
+        self.assertEqual(cm.exception.stderr,
+                         "RTNETLINK answers: No such process\n"
+                         "Command failed -:2\n")
+
+    def test_run_batch_error_mid_batch(self):
+        # The kernel carries on after the failing message, so the lines
+        # after it are sent and applied in the same datagram.
+        self.sock.errors[3] = errno.ESRCH
+        with self.assertRaises(FailedSystemCall) as cm:
+            self.client.run_batch(["route replace 10.0.0.1 dev tap1",
+                                   "route del 10.0.0.2 dev tap1",
+                                   "route replace 10.0.0.3 dev tap1"])
+        self.assertTrue(cm.exception.stderr.endswith("Command failed -:2\n"))
+        msgs = list(parse_messages(self.sock.sent[-1]))
+        self.assertEqual([(t, s) for t, _, s, _ in msgs],
+                         [(24, 2), (25, 3), (24, 4)])
+
+    def test_run_batch_no_device(self):
+        with self.assertRaises(FailedSystemCall) as cm:
+            self.client.run_batch(["route replace 10.0.0.1 dev tap1",
+                                   "route replace 10.0.0.1 dev tap9"])
+        self.assertEqual(cm.exception.stderr,
+                         'Cannot find device "tap9"\nCommand failed -:2\n')
+        self.assertEqual(self.sock.sent, [])
+
+
+def link_msg(msg_type, ifindex, name, up=True):
+    return (msg_type, 0, IFINFOMSG.pack(0, 0, 0, ifindex, int(up), 0) +
+            netlink.encode_str_attr(3, name))
+
+
+def route_msg(msg_type, ip, ifindex, flags=0, table=RT_TABLE_MAIN):
+    family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+    addr = socket.inet_pton(family, ip)
+    return (msg_type, flags,
+            RTMSG.pack(family, len(addr) * 8, 0, 0, table, 0, 0, 0, 0) +
+            netlink.encode_attr(RTA_DST, addr) +
+            netlink.encode_u32_attr(RTA_OIF, ifindex))
+
+
+class FakeEventSocket(object):
+    def __init__(self):
+        self.datagrams = []
+
+    def setblocking(self, flag):
+        assert not flag
+
+    def queue(self, *msgs):
+        self.datagrams.append("".join(encode_msg(t, f, 0, p)
+                                      for t, f, p in msgs))
+
+    def recv(self, bufsize):
+        if not self.datagrams:
+            raise socket.error(errno.EAGAIN, "Resource temporarily "
+                                             "unavailable")
+        data = self.datagrams.pop(0)
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+
+class FakeDumpSocket(object):
+    """
+    Fake RTNETLINK socket that answers dumps from self.links and
+    self.routes.
+    """
+    def __init__(self):
+        self.links = []
+        self.routes = []
+        self.dumps = []
+        self.replies = []
+
+    def sendto(self, data, addr):
+        (msg_type, _, seq, payload), = parse_messages(data)
+        self.dumps.append(msg_type)
+        msgs = self.links if msg_type == RTM_GETLINK else [
+            m for m in self.routes
+            if m[2][:1] == payload[:1]  # Same family.
+        ]
+        self.replies.append("".join(encode_msg(t, netlink.NLM_F_MULTI, seq, p)
+                                    for t, _, p in msgs) +
+                            encode_msg(netlink.NLMSG_DONE, 0, seq, "\0" * 4))
+
+    def recv(self, bufsize):
+        return self.replies.pop(0)
+
+
+class TestRouteTable(BaseTestCase):
+    def setUp(self):
+        super(TestRouteTable, self).setUp()
+        self.events = FakeEventSocket()
+        self.dump_sock = FakeDumpSocket()
+        self.dump_sock.links = [link_msg(RTM_NEWLINK, 5, "tap1"),
+                                link_msg(RTM_NEWLINK, 6, "tap2")]
+        self.dump_sock.routes = [
+            route_msg(RTM_NEWROUTE, "10.0.0.1", 5),
+            route_msg(RTM_NEWROUTE, "10.0.0.2", 5),
+            route_msg(RTM_NEWROUTE, "fd00::1", 5),
+            route_msg(RTM_NEWROUTE, "10.0.0.3", 5, table=255),  # Local.
+        ]
+        self.table = RouteTable(event_sock=self.events,
+                                dump_sock=self.dump_sock)
+
+    def test_load(self):
+        self.assertEqual(self.table.interface_ips(4, "tap1"),
+                         set(["10.0.0.1", "10.0.0.2"]))
+        self.assertEqual(self.table.interface_ips(6, "tap1"),
+                         set(["fd00::1"]))
+        self.assertEqual(self.table.interface_ips(4, "tap2"), set())
+        self.assertEqual(self.table.interface_ips(4, "tap9"), set())
+        self.assertEqual(self.dump_sock.dumps,
+                         [RTM_GETLINK, RTM_GETROUTE, RTM_GETROUTE])
+
+    def test_events(self):
+        self.table.interface_ips(4, "tap1")
+        self.events.queue(route_msg(RTM_DELROUTE, "10.0.0.1", 5),
+                          route_msg(RTM_NEWROUTE, "10.0.0.4", 6))
+        # A replace moves the route to the new interface.
+        self.events.queue(route_msg(RTM_NEWROUTE, "10.0.0.2", 6,
+                                    flags=netlink.NLM_F_REPLACE))
+        self.assertEqual(self.table.interface_ips(4, "tap1"), set())
+        self.assertEqual(self.table.interface_ips(4, "tap2"),
+                         set(["10.0.0.2", "10.0.0.4"]))
+        self.assertEqual(len(self.dump_sock.dumps), 3)
+
+    def test_link_removed(self):
+        self.table.interface_ips(4, "tap1")
+        self.events.queue(link_msg(RTM_DELLINK, 5, "tap1"))
+        self.assertEqual(self.table.interface_ips(4, "tap1"), set())
+        self.assertEqual(self.table.interface_ips(6, "tap1"), set())
+        # Recreated with a new index.
+        self.events.queue(link_msg(RTM_NEWLINK, 7, "tap1"),
+                          route_msg(RTM_NEWROUTE, "10.0.0.1", 7))
+        self.assertEqual(self.table.interface_ips(4, "tap1"),
+                         set(["10.0.0.1"]))
+        self.assertEqual(len(self.dump_sock.dumps), 3)
+
+    def test_link_down_resyncs(self):
+        self.table.interface_ips(4, "tap1")
+        self.dump_sock.routes = []
+        self.events.queue(link_msg(RTM_NEWLINK, 5, "tap1", up=False))
+        self.assertEqual(self.table.interface_ips(4, "tap1"), set())
+        self.assertEqual(len(self.dump_sock.dumps), 6)
+
+    def test_overflow_resyncs(self):
+        self.table.interface_ips(4, "tap1")
+        self.events.datagrams.append(socket.error(errno.ENOBUFS,
+                                                  "No buffer space"))
+        self.table.interface_ips(4, "tap1")
+        self.assertEqual(len(self.dump_sock.dumps), 6)
@@ -19,9 +19,13 @@ test.test_datamodel_v1
 Test data model key calculations etc.
 """
 
+import copy
+import gc
 import logging
+import pickle
 import unittest
 
+from calico import datamodel_v1
 from calico.datamodel_v1 import *
 
 
@@ -113,3 +117,85 @@ class TestEndpointId(unittest.TestCase):
                                         "workload", "notanendpoint")
         self.assertFalse(ep_id == bad_endpoint_ep_id)
         self.assertTrue(ep_id != bad_endpoint_ep_id)
+
+    def test_flyweight(self):
+        ep_id = EndpointId("localhost", "orchestrator", "workload", "endpoint")
+        self.assertTrue(EndpointId(u"localhost", u"orchestrator", u"workload",
+                                   u"endpoint") is ep_id)
+        self.assertTrue(get_endpoint_id_from_key(
+            "/calico/v1/host/localhost/workload/orchestrator/workload/"
+            "endpoint/endpoint"
+        ) is ep_id)
+        self.assertTrue(copy.copy(ep_id) is ep_id)
+        self.assertTrue(pickle.loads(pickle.dumps(ep_id)) is ep_id)
+        self.assertEqual(hash(ep_id), hash(("localhost", "orchestrator",
+                                            "workload", "endpoint")))
+
+    def test_non_ascii(self):
+        ep_id = EndpointId(u"h\xe9", "o", "w", "e")
+        self.assertEqual(ep_id.host, "h\xc3\xa9")
+        self.assertTrue(EndpointId(u"h\xe9", "o", "w", "e") is ep_id)
+        self.assertTrue(EndpointId("h\xc3\xa9", "o", "w", "e") is ep_id)
+
+    def test_registry_is_weak(self):
+        key = ("host", "orch", "workload", "unreferenced")
+        EndpointId(*key)
+        gc.collect()
+        self.assertFalse(key in datamodel_v1._endpoint_ids)
+
+
+class TestParseKey(unittest.TestCase):
+    KEYS = [
+        "/calico/v1/policy/profile/prof1/rules",
+        "/calico/v1/policy/profile/prof1/rules/",
+        "/calico/v1/policy/profile/prof1/rule",
+        "/calico/v1/policy/profile/prof1/tags",
+        "/calico/v1/policy/profile//tags",
+        "/calico/v1/policy/profile/prof1",
+        "/calico/v1/host/h1/workload/orch/wl/endpoint/ep",
+        "/calico/v1/host/h1/workload/orch/wl/endpoint/ep/extra",
+        "/calico/v1/host/h1/workload/orch/wl/endpoint/",
+        "/calico/v1/host/h1/workload/orch//endpoint/ep",
+        "/calico/v1/host/h1/workload/orch/wl",
+        "/calico/felix/v1/host/h1/workload/orch/wl/endpoint/ep",
+        "/calico/felix/v1/host/h1/status",
+        "/calico/v1/host/h1/bird_ip",
+        "/calico/v1/host/h1/bird_ip6",
+        "/calico/v1/host//bird_ip",
+        "/calico/v1/host/h1/config/Foo",
+        "/calico/v1/ipam/v4/pool/10.0.0.0-8",
+        "/calico/v1/ipam/v4/pool/",
+        "/calico/v1/ipam/v6/pool/fd00::-64",
+        "/calico/v1/config/Foo",
+        "/calico/v1/Ready",
+        "/calico/v1",
+        "calico/v1/host/h1/bird_ip",
+        "",
+    ]
+
+    def test_matches_regexes(self):
+        regexes = [
+            (KIND_RULES, RULES_KEY_RE, "profile_id"),
+            (KIND_TAGS, TAGS_KEY_RE, "profile_id"),
+            (KIND_HOST_IP, HOST_IP_KEY_RE, "hostname"),
+            (KIND_IPAM_V4_POOL, IPAM_V4_CIDR_KEY_RE, "encoded_cidr"),
+        ]
+        for key in self.KEYS:
+            expected = None
+            m = ENDPOINT_KEY_RE.match(key)
+            if m:
+                expected = ParsedKey(KIND_ENDPOINT, EndpointId(
+                    m.group("hostname"), m.group("orchestrator"),
+                    m.group("workload_id"), m.group("endpoint_id")))
+            for kind, regex, group in regexes:
+                m = regex.match(key)
+                if m:
+                    expected = ParsedKey(kind, m.group(group))
+            self.assertEqual(parse_key(key), expected, key)
+
+    def test_get_endpoint_id_from_key(self):
+        self.assertEqual(get_endpoint_id_from_key(
+            "/calico/felix/v1/host/h1/workload/orch/wl/endpoint/ep"),
+            EndpointId("h1", "orch", "wl", "ep"))
+        self.assertEqual(get_endpoint_id_from_key(
+            "/calico/v1/policy/profile/prof1/rules"), None)